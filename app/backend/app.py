@@ -1,18 +1,24 @@
+import asyncio
+import hashlib
 import io
 import json
 import logging
 import mimetypes
 import os
 import time
+import uuid
 from pathlib import Path
-from typing import AsyncGenerator
+from typing import Any, AsyncGenerator, Optional, cast
 
-from datetime import datetime
 from history.cosmosdbservice import CosmosConversationClient
+from history.historystore import ConversationHistoryStore, StorageHistoryBackend
+from history.metadatacache import ConversationMetadataCache
+from history.storage import ConversationStorage, InMemoryConversationStorage, SQLiteConversationStorage
+from history.summaryworker import SummaryWorker
+from history.titleworker import TitleWorker
+from history.writebehind import WriteBehindQueue
 from auth.auth_utils import get_authenticated_user_details
-from flask import Flask, request, jsonify
 
-import aiohttp
 import openai
 from azure.core.exceptions import ResourceNotFoundError
 from azure.identity.aio import DefaultAzureCredential
@@ -34,25 +40,52 @@ from quart import (
 )
 from quart_cors import cors
 
+from approaches.cachedapproach import CachedApproach
 from approaches.chatreadretrieveread import ChatReadRetrieveReadApproach
 from approaches.retrievethenread import RetrieveThenReadApproach
 from approaches.chatconversation import ChatConversationReadApproach
+from core.answercache import AnswerCache
 from core.authentication import AuthenticationHelper
+from core.cache import CacheBackend, InMemoryCacheBackend, SQLiteCacheBackend
+from core.documentcache import DocumentCache
+from core.embeddingcache import EmbeddingCache
+from core.indexversion import INDEX_VERSION_BLOB_NAME, IndexVersion
+from core.messagebuilder import create_truncation_policy
+from core.retriever import Retriever
+from core.rewritepolicy import create_rewrite_policy
+from core.searchcache import SearchResultCache
+from core.sourcepacker import SourcePacker
+from core.sessionpool import ClientSessionPool
+from localsearch.client import LocalSearchClient
 
 
 ## Logging level for development, set to logging.INFO or logging.DEBUG for more verbose logging
 logger = logging.getLogger ('werkzeug') # grabs underlying WSGI logger
 logger.setLevel (logging.INFO) # set log level to INFO
 
-app = Flask(__name__)
-
 CONFIG_OPENAI_TOKEN = "openai_token"
 CONFIG_CREDENTIAL = "azure_credential"
 CONFIG_ASK_APPROACH = "ask_approach"
 CONFIG_CHAT_APPROACH = "chat_approach"
+CONFIG_CHATCONVERSATION_APPROACH = "chatconversation_approach"
+CONFIG_ANSWER_CACHE = "answer_cache"
+CONFIG_EMBEDDING_CACHE = "embedding_cache"
+CONFIG_DOCUMENT_CACHE = "document_cache"
+CONFIG_SEARCH_RESULT_CACHE = "search_result_cache"
+CONFIG_RETRIEVER = "retriever"
+CONFIG_SOURCE_PACKER = "source_packer"
 CONFIG_BLOB_CONTAINER_CLIENT = "blob_container_client"
 CONFIG_AUTH_CLIENT = "auth_client"
 CONFIG_SEARCH_CLIENT = "search_client"
+CONFIG_OPENAI_SESSION_POOL = "openai_session_pool"
+CONFIG_CONVERSATION_STORAGE = "conversation_storage"
+CONFIG_TITLE_WORKER = "title_worker"
+CONFIG_SUMMARY_WORKER = "summary_worker"
+CONFIG_HISTORY_STORE = "history_store"
+CONFIG_WRITE_BEHIND_QUEUE = "write_behind_queue"
+CONFIG_CONVERSATION_METADATA_CACHE = "conversation_metadata_cache"
+CONVERSATION_PAGE_SIZE = 20
+CONVERSATION_MAX_PAGE_SIZE = 100
 ERROR_MESSAGE = """The app encountered an error processing your request.
 If you are an administrator of the app, view the full error in the logs. See aka.ms/appservice-logs for more information.
 Error type: {error_type}
@@ -137,12 +170,9 @@ async def ask():
     context["auth_claims"] = await auth_helper.get_auth_claims_if_enabled(request.headers)
     try:
         approach = current_app.config[CONFIG_ASK_APPROACH]
-        # Workaround for: https://github.com/openai/openai-python/issues/371
-        async with aiohttp.ClientSession() as s:
-            openai.aiosession.set(s)
-            r = await approach.run(
-                request_json["messages"], context=context, session_state=request_json.get("session_state")
-            )
+        r = await approach.run(
+            request_json["messages"], context=context, session_state=request_json.get("session_state")
+        )
         return jsonify(r)
     except Exception as error:
         return error_response(error, "/ask")
@@ -157,6 +187,13 @@ async def format_as_ndjson(r: AsyncGenerator[dict, None]) -> AsyncGenerator[str,
         yield json.dumps(error_dict(e))
 
 
+def validate_query_variants(overrides: dict[str, Any]):
+    try:
+        int(overrides.get("query_variants") or 1)
+    except (TypeError, ValueError):
+        abort(400, "query_variants must be an integer")
+
+
 @bp.route("/chat", methods=["POST"])
 async def chat():
     if not request.is_json:
@@ -165,226 +202,434 @@ async def chat():
     context = request_json.get("context", {})
     auth_helper = current_app.config[CONFIG_AUTH_CLIENT]
     context["auth_claims"] = await auth_helper.get_auth_claims_if_enabled(request.headers)
+    validate_query_variants(context.get("overrides", {}))
+    # With a conversation_id, the history is kept on the server and messages only holds the new message.
+    # A null conversation_id starts a new conversation, whose id is returned in the response context
+    use_history_store = "conversation_id" in request_json
+    history_store = get_history_store() if use_history_store else None
     try:
         approach = current_app.config[CONFIG_CHAT_APPROACH]
+        messages = request_json["messages"]
+        new_messages = messages
+        conversation_id = request_json.get("conversation_id")
+        if history_store:
+            user_id = get_authenticated_user_details(request_headers=request.headers)["user_principal_id"]
+        if history_store and conversation_id:
+            history = await history_store.get(user_id, conversation_id)
+            if history is None:
+                return jsonify({"error": f"Conversation {conversation_id} was not found"}), 404
+            history_messages, context["history_token_counts"] = history.get_prompt_messages()
+            messages = history_messages + new_messages
         result = await approach.run(
-            request_json["messages"],
+            messages,
             stream=request_json.get("stream", False),
             context=context,
             session_state=request_json.get("session_state"),
         )
         if isinstance(result, dict):
+            if history_store:
+                answer = {"role": "assistant", "content": result["choices"][0]["message"]["content"]}
+                conversation_id = await history_store.append(user_id, conversation_id, new_messages + [answer])
+                result["choices"][0]["context"]["conversation_id"] = conversation_id
             return jsonify(result)
         else:
+            if history_store:
+                result = stream_with_history(result, history_store, user_id, conversation_id, new_messages)
             response = await make_response(format_as_ndjson(result))
             response.timeout = None  # type: ignore
             response.mimetype = "application/json-lines"
             return response
     except Exception as error:
         return error_response(error, "/chat")
-    
+
+
+async def stream_with_history(
+    events: AsyncGenerator[dict, None],
+    history_store: ConversationHistoryStore,
+    user_id: str,
+    conversation_id: Optional[str],
+    new_messages: list[dict[str, str]],
+) -> AsyncGenerator[dict, None]:
+    """
+    Streams the answer events, then adds the new messages and the answer to the conversation history
+    and sends the conversation id in a last event.
+    """
+    answer = ""
+    async for event in events:
+        answer += event["choices"][0]["delta"].get("content") or ""
+        yield event
+    conversation_id = await history_store.append(
+        user_id, conversation_id, new_messages + [{"role": "assistant", "content": answer}]
+    )
+    yield {
+        "choices": [
+            {
+                "delta": {},
+                "context": {"conversation_id": conversation_id},
+                "finish_reason": None,
+                "index": 0,
+            }
+        ],
+        "object": "chat.completion.chunk",
+    }
+
+
+def get_history_store() -> ConversationHistoryStore:
+    history_store = current_app.config[CONFIG_HISTORY_STORE]
+    if history_store is None:
+        abort(501, "Conversation history is not configured, set HISTORY_STORAGE or AZURE_COSMOSDB_ACCOUNT to enable it")
+    return history_store
+
+
+def get_conversation_client() -> ConversationStorage:
+    conversation_client = current_app.config[CONFIG_CONVERSATION_STORAGE]
+    if conversation_client is None:
+        abort(501, "Conversation history is not configured, set HISTORY_STORAGE or AZURE_COSMOSDB_ACCOUNT to enable it")
+    return conversation_client
+
+
+async def flush_pending_writes(user_id: str, conversation_id: Optional[str] = None):
+    """
+    Writes the turns of the user, or of one of their conversations, that are still queued, so that reads see them.
+    """
+    if write_queue := current_app.config[CONFIG_WRITE_BEHIND_QUEUE]:
+        await write_queue.flush(user_id, conversation_id)
+
+
 @bp.route("/conversation/add", methods=["POST"])
 async def add_conversation():
     authenticated_user = get_authenticated_user_details(request_headers=request.headers)
-    user_id = authenticated_user['user_principal_id']
-    generate_title = False
-    ensure_openai_token()
-
-    approach = request.json["approach"]
+    user_id = authenticated_user["user_principal_id"]
+    get_conversation_client()
+    request_json = await request.get_json()
 
     ## check request for conversation_id
-    conversation_id = request.json.get("conversation_id", None)
+    conversation_id = request_json.get("conversation_id", None)
 
     ## check to see if a conversation title should be generated
-    generate_title = request.json.get("generate_title", False)
+    generate_title = request_json.get("generate_title", False)
 
     try:
-        impl = chatconversation_approaches.get(approach)
-        if not impl:
-            return jsonify({"error": "unknown approach"}), 400
-        ## BDL TODO: should all of this conversation history be moved to the parent "approach" class so it can be shared across all approaches?
-        # check for the conversation_id, if the conversation is not set, we will create a new one
-        if not conversation_id:
-            generate_title = True ## if this is a new conversation, we will generate a title
-            conversation_dict = cosmos_conversation_client.create_conversation(user_id=user_id)
-            conversation_id = conversation_dict['id']
-
-        ## Format the incoming message object in the "chat/completions" messages format
-        ## then write it to the conversation history in cosmos
-        message_prompt = request.json["history"][-1]["user"]
-        msg = {"role": "user", "content": message_prompt}
-        resp = cosmos_conversation_client.create_message(
-            conversation_id=conversation_id,
-            user_id=user_id,
-            input_message=msg
-        )
+        impl = current_app.config[CONFIG_CHATCONVERSATION_APPROACH]
+        history = request_json["history"]
+        context = {"overrides": request_json.get("overrides") or {}}
+        user_message = {"role": "user", "content": history[-1]["user"]}
+        ## if this is a new conversation, it is created along with the first turn and we will generate a title
+        new_conversation = not conversation_id
+        if new_conversation:
+            generate_title = True
+            conversation_id = str(uuid.uuid4())
+
+        if request_json.get("stream", False):
+            # Submit prompt to Chat Completions and stream the answer, while the user message is written to cosmos
+            events = await impl.run(history, stream=True, context=context)
+            response = await make_response(
+                format_as_ndjson(
+                    stream_conversation_turn(
+                        current_app.config,
+                        user_id,
+                        conversation_id,
+                        new_conversation,
+                        user_message,
+                        events,
+                        generate_title,
+                    )
+                )
+            )
+            response.timeout = None  # type: ignore
+            response.mimetype = "application/json-lines"
+            return response
 
         # Submit prompt to Chat Completions for response
-        r = impl.run(request.json["history"], request.json.get("overrides") or {})
-
-        ## Format the incoming message object in the "chat/completions" messages format
-        ## then write it to the conversation history in cosmos
-        msg = {"role": "assistant", "content": r['answer']}
-        resp = cosmos_conversation_client.create_message(
-            conversation_id=conversation_id,
-            user_id=user_id,
-            input_message=msg
+        r = await impl.run(history, context=context)
+
+        ## Write the user message and the answer in the "chat/completions" messages format
+        ## to the conversation history in cosmos, in a single transactional batch
+        request_charge = await save_turn(
+            current_app.config,
+            user_id,
+            conversation_id,
+            [user_message, {"role": "assistant", "content": r["answer"]}],
+            new_conversation,
+            generate_title,
         )
 
-        if generate_title:
-            ## Generate a title for the conversation
-            generate_conversation_title(user_id=user_id, conversation_id=conversation_id, overwrite_title=True)
-
         ## we need to return the conversation_id in the response so the client can keep track of it
-        r['conversation_id'] = conversation_id
+        r["conversation_id"] = conversation_id
+        if request_charge is not None:
+            r["request_charge"] = request_charge
         # returns the response from the bot
         return jsonify(r)
+    except Exception as error:
+        return error_response(error, "/conversation/add")
+
+
+async def save_turn(
+    config: dict[str, Any],
+    user_id: str,
+    conversation_id: str,
+    messages: list[dict[str, str]],
+    new_conversation: bool,
+    generate_title: bool,
+) -> Optional[float]:
+    """
+    Writes the messages to the conversation, and then queues the generation of its title if requested.
+    Returns the request charge of the write, or None if the write-behind queue is enabled and the write happens later.
+    """
+    title_worker = config[CONFIG_TITLE_WORKER]
+    if write_queue := config[CONFIG_WRITE_BEHIND_QUEUE]:
+        written = write_queue.enqueue(user_id, conversation_id, messages, create_conversation=new_conversation)
+        if generate_title:
+
+            def submit_title(written: asyncio.Future):
+                if not written.cancelled() and written.exception() is None:
+                    title_worker.submit(user_id, conversation_id)
+
+            written.add_done_callback(submit_title)
+        return None
+
+    turn = await config[CONFIG_CONVERSATION_STORAGE].create_turn(
+        user_id, conversation_id, messages, create_conversation=new_conversation
+    )
+    logging.debug("Conversation turn written for %.2f RUs", turn["request_charge"])
+    if generate_title:
+        ## Generate a title for the conversation in the background, the answer does not wait for it
+        title_worker.submit(user_id, conversation_id)
+    return turn["request_charge"]
+
+
+async def stream_conversation_turn(
+    config: dict[str, Any],
+    user_id: str,
+    conversation_id: str,
+    new_conversation: bool,
+    user_message: dict[str, str],
+    events: AsyncGenerator[dict, None],
+    generate_title: bool,
+) -> AsyncGenerator[dict, None]:
+    """
+    Streams the answer events, writing the user message to cosmos while the answer is generated
+    and the assistant message once the answer is complete.
+    """
+    user_turn = asyncio.create_task(
+        save_turn(config, user_id, conversation_id, [user_message], new_conversation, False)
+    )
+    answer = ""
+    try:
+        yield {
+            "choices": [
+                {
+                    "delta": {"role": "assistant"},
+                    "context": {"conversation_id": conversation_id},
+                    "finish_reason": None,
+                    "index": 0,
+                }
+            ],
+            "object": "chat.completion.chunk",
+        }
+        async for event in events:
+            answer += event["choices"][0]["delta"].get("content") or ""
+            yield event
+    finally:
+        # The user message is kept even if the answer fails, as it is in the conversation the user sees
+        user_request_charge = await user_turn
+
+    assistant_request_charge = await save_turn(
+        config, user_id, conversation_id, [{"role": "assistant", "content": answer}], False, generate_title
+    )
+    context: dict[str, Any] = {"conversation_id": conversation_id}
+    if user_request_charge is not None and assistant_request_charge is not None:
+        context["request_charge"] = user_request_charge + assistant_request_charge
+    yield {
+        "choices": [{"delta": {}, "context": context, "finish_reason": "stop", "index": 0}],
+        "object": "chat.completion.chunk",
+    }
+
 
-    except Exception as e:
-        logging.exception("Exception in /conversation")
-        return jsonify({"error": str(e)}), 500
-    
 ## Conversation routes needed read, delete, update
 @bp.route("/conversation/delete", methods=["POST"])
-def delete_conversation():
+async def delete_conversation():
     ## get the user id from the request headers
     authenticated_user = get_authenticated_user_details(request_headers=request.headers)
-    user_id = authenticated_user['user_principal_id']
+    user_id = authenticated_user["user_principal_id"]
+    conversation_client = get_conversation_client()
 
     ## check request for conversation_id
-    conversation_id = request.json.get("conversation_id", None)
+    conversation_id = (await request.get_json()).get("conversation_id", None)
     if not conversation_id:
         return jsonify({"error": "conversation_id is required"}), 400
 
-    ## delete the conversation messages from cosmos first
-    deleted_messages = cosmos_conversation_client.delete_messages(conversation_id, user_id)
+    try:
+        await flush_pending_writes(user_id, conversation_id)
+        ## delete the conversation messages and then the conversation from cosmos, in batches
+        deleted = await conversation_client.delete_conversation_and_messages(user_id, conversation_id)
+    except Exception as error:
+        return error_response(error, "/conversation/delete")
+
+    return (
+        jsonify(
+            {
+                "message": "Successfully deleted conversation and messages",
+                "conversation_id": conversation_id,
+                **deleted,
+            }
+        ),
+        200,
+    )
+
+
+@bp.route("/conversation/delete_all", methods=["POST"])
+async def delete_all_conversations():
+    authenticated_user = get_authenticated_user_details(request_headers=request.headers)
+    user_id = authenticated_user["user_principal_id"]
+    conversation_client = get_conversation_client()
+
+    try:
+        await flush_pending_writes(user_id)
+        deleted = await conversation_client.delete_all_conversations(user_id)
+    except Exception as error:
+        return error_response(error, "/conversation/delete_all")
 
-    ## Now delete the conversation 
-    deleted_conversation = cosmos_conversation_client.delete_conversation(user_id, conversation_id)
+    return jsonify({"message": "Successfully deleted all conversations and messages", **deleted}), 200
 
-    #BDL TODO: add some error handling here
-    return jsonify({"message": "Successfully deleted conversation and messages", "conversation_id": conversation_id}), 200
 
 @bp.route("/conversation/update", methods=["POST"])
-def update_conversation():
-    ## check request for conversation_id
-    conversation_id = request.json.get("conversation_id", None)
+async def update_conversation():
     return jsonify({"error": "not implemented"}), 501
 
+
+def get_page_params(request_json: dict) -> tuple[int, Optional[str]]:
+    page_size = request_json.get("page_size", CONVERSATION_PAGE_SIZE)
+    if not isinstance(page_size, int) or not 0 < page_size <= CONVERSATION_MAX_PAGE_SIZE:
+        abort(400, f"page_size must be an integer between 1 and {CONVERSATION_MAX_PAGE_SIZE}")
+    return page_size, request_json.get("continuation")
+
+
+def make_etag(*parts: Any) -> str:
+    return hashlib.sha256(json.dumps(parts, sort_keys=True).encode()).hexdigest()[:32]
+
+
+async def not_modified(etag: str):
+    """
+    Returns an empty 304 response if the client sent the ETag in If-None-Match, as it already has that version.
+    """
+    if request.if_none_match.contains(etag):
+        response = await make_response("", 304)
+        response.set_etag(etag)
+        return response
+    return None
+
+
 @bp.route("/conversation/list", methods=["POST"])
-def list_conversations():
+async def list_conversations():
     authenticated_user = get_authenticated_user_details(request_headers=request.headers)
-    user_id = authenticated_user['user_principal_id']
-
-    ## get the conversations from cosmos
-    conversations = cosmos_conversation_client.get_conversations(user_id)
-    if not conversations:
+    user_id = authenticated_user["user_principal_id"]
+    conversation_client = get_conversation_client()
+    page_size, continuation = get_page_params(await request.get_json())
+
+    await flush_pending_writes(user_id)
+    ## get a page of conversations from cosmos, with only the fields needed to list them
+    page = await conversation_client.get_conversations_page(user_id, page_size, continuation)
+    if not page["conversations"] and not continuation:
         return jsonify({"error": f"No conversations for {user_id} were found"}), 404
 
-    ## return the conversation ids
+    etag = make_etag(page)
+    if response := await not_modified(etag):
+        return response
+    response = jsonify(page)
+    response.set_etag(etag)
+    return response, 200
 
-    return jsonify(conversations), 200
 
 @bp.route("/conversation/read", methods=["POST"])
-def get_conversation():
+async def get_conversation():
     authenticated_user = get_authenticated_user_details(request_headers=request.headers)
-    user_id = authenticated_user['user_principal_id']
+    user_id = authenticated_user["user_principal_id"]
+    conversation_client = get_conversation_client()
+    request_json = await request.get_json()
+    page_size, continuation = get_page_params(request_json)
 
     ## check request for conversation_id
-    conversation_id = request.json.get("conversation_id", None)
-
+    conversation_id = request_json.get("conversation_id", None)
     if not conversation_id:
         return jsonify({"error": "conversation_id is required"}), 400
 
+    await flush_pending_writes(user_id, conversation_id)
     ## get the conversation object and the related messages from cosmos
-    conversation = cosmos_conversation_client.get_conversation(user_id, conversation_id)
-    ## return the conversation id and the messages in the bot frontend format
+    conversation = await conversation_client.get_conversation(user_id, conversation_id)
     if not conversation:
-        return jsonify({"error": f"Conversation {conversation_id} was not found. It either does not exist or the logged in user does not have access to it."}), 404
+        return (
+            jsonify(
+                {
+                    "error": f"Conversation {conversation_id} was not found. It either does not exist or the logged in user does not have access to it."
+                }
+            ),
+            404,
+        )
 
-    # get the messages for the conversation from cosmos
-    conversation_messages = cosmos_conversation_client.get_messages(user_id, conversation_id)
-    if not conversation_messages:
+    # the messages only change when the conversation's updatedAt does, so the client's version is checked
+    # before they are read
+    etag = make_etag(conversation_id, conversation.get("updatedAt"), page_size, continuation)
+    if response := await not_modified(etag):
+        return response
+
+    # get the most recent turns (a user message and an answer each) for the conversation from cosmos,
+    # the continuation token returned with them reads the turns before those
+    page = await conversation_client.get_messages_page(user_id, conversation_id, page_size * 2, continuation)
+    if not page["messages"] and not continuation:
         return jsonify({"error": f"No messages for {conversation_id} were found"}), 404
 
     ## format the messages in the bot frontend format
-    messages = format_messages(conversation_messages, input_format='cosmos', output_format='botfrontend')
+    messages = format_messages(page["messages"], input_format="cosmos", output_format="botfrontend")
+
+    response = jsonify({"conversation_id": conversation_id, "messages": messages, "continuation": page["continuation"]})
+    response.set_etag(etag)
+    return response, 200
 
-    return jsonify({"conversation_id": conversation_id, "messages": messages}), 200
 
 ## add a route to generate a title for a conversation
 @bp.route("/conversation/gen_title", methods=["POST"])
-def gen_title():
-    ## lookup the conversation in cosmos
+async def gen_title():
     authenticated_user = get_authenticated_user_details(request_headers=request.headers)
-    user_id = authenticated_user['user_principal_id']
+    user_id = authenticated_user["user_principal_id"]
+    request_json = await request.get_json()
 
     ## check request for conversation_id
-    conversation_id = request.json.get("conversation_id", None)
+    conversation_id = request_json.get("conversation_id", None)
 
-    overwrite_existing_title = request.json.get("overwrite_existing_title", False)
+    overwrite_existing_title = request_json.get("overwrite_existing_title", False)
 
     try:
-        conversation_title_response_dict = generate_conversation_title(user_id, conversation_id, overwrite_title=overwrite_existing_title)
+        conversation_title_response_dict = await generate_conversation_title(
+            user_id, conversation_id, overwrite_title=overwrite_existing_title
+        )
     except Exception as e:
         return jsonify({"error": f"Error generating title for conversation {conversation_id}: {str(e)}"}), 500
-    finally:
-        return jsonify(conversation_title_response_dict)
+    return jsonify(conversation_title_response_dict)
+
 
+async def generate_conversation_title(user_id, conversation_id, overwrite_title=False):
+    conversation_client = get_conversation_client()
+    await flush_pending_writes(user_id, conversation_id)
 
-def generate_conversation_title(user_id, conversation_id, overwrite_title=False):
     ## get the conversation from cosmos
-    conversation_dict = cosmos_conversation_client.get_conversation(user_id, conversation_id)
+    conversation_dict = await conversation_client.get_conversation(user_id, conversation_id)
     if not conversation_dict:
-        ## raise an error
-        raise Exception(f"Conversation {conversation_id} was not found. It either does not exist or the logged in user does not have access to it.")
+        raise Exception(
+            f"Conversation {conversation_id} was not found. It either does not exist or the logged in user does not have access to it."
+        )
 
     ## check if the conversation already has a title
-    conversation_title = conversation_dict.get('title', None)
+    conversation_title = conversation_dict.get("title", None)
 
     if not overwrite_title and conversation_title:
-        raise Exception(f"Conversation {conversation_id} already has a title and overwrite_title flag was set to False.")
-
-    ## otherwise go for it and create the title! 
-    ## get the messages for the conversation from cosmos
-    conversation_messages = cosmos_conversation_client.get_messages(user_id, conversation_id)
-    if not conversation_messages:
-        raise Exception(f"No messages for {conversation_id} were found")
-
-    ## generate a title for the conversation
-    title = create_conversation_title(conversation_messages)
-    conversation_dict['title'] = title
-    conversation_dict['updatedAt'] = datetime.utcnow().isoformat()
-
-    ## update the conversation in cosmos
-    resp = cosmos_conversation_client.upsert_conversation(conversation_dict)
-
-    return resp
-
-
-def create_conversation_title(conversation_messages):
-    ## make sure the messages are sorted by _ts descending
-    messages = format_messages(conversation_messages, input_format='cosmos' ,output_format='chatcompletions')
-
-    title_prompt = 'Summarize the conversation so far into a 4-word or less title. Do not use any quotation marks or punctuation. Respond with a json object in the format {{"title": string}}. Do not include any other commentary or description.'
-
-    messages.append({'role': 'user', 'content': title_prompt})
-
-    ensure_openai_token()
-
-    try:
-        ## Submit prompt to Chat Completions for response
-        completion = openai.ChatCompletion.create(    
-            engine=AZURE_OPENAI_CHATGPT_DEPLOYMENT,
-            messages=messages,
-            temperature=1,
-            max_tokens=64 
+        raise Exception(
+            f"Conversation {conversation_id} already has a title and overwrite_title flag was set to False."
         )
-        title = json.loads(completion['choices'][0]['message']['content'])['title']
 
-        return title
-    except Exception as e:
-        return jsonify({"error": f"Error generating title for the conversation: {e}"}), 500
+    ## otherwise go for it and create the title from the first messages of the conversation
+    return await current_app.config[CONFIG_TITLE_WORKER].generate_title(user_id, conversation_id)
+
 
 def format_messages(messages, input_format='cosmos', output_format='chatcompletions'):
 
@@ -413,6 +658,9 @@ def format_messages(messages, input_format='cosmos', output_format='chatcompleti
                 if message['role'] == 'user':
                     botfrontend_messages.append({"user": message['content']})
                 elif message['role'] == 'assistant':
+                    ## a page of messages can start with the answer to a question on the previous page
+                    if not botfrontend_messages:
+                        botfrontend_messages.append({})
                     botfrontend_messages[-1]["bot"] = message['content']
                 last_role = message['role']            
 
@@ -420,6 +668,35 @@ def format_messages(messages, input_format='cosmos', output_format='chatcompleti
 
 
 
+# Connection pool statistics, used to monitor keep-alive reuse rates under load
+@bp.route("/metrics", methods=["GET"])
+def metrics():
+    stats = {
+        "openai_session_pool": current_app.config[CONFIG_OPENAI_SESSION_POOL].get_stats(),
+        "embedding_cache": current_app.config[CONFIG_EMBEDDING_CACHE].get_stats(),
+        "retrieval": current_app.config[CONFIG_RETRIEVER].get_stats(),
+    }
+    if answer_cache := current_app.config[CONFIG_ANSWER_CACHE]:
+        stats["answer_cache"] = answer_cache.get_stats()
+    if title_worker := current_app.config[CONFIG_TITLE_WORKER]:
+        stats["title_worker"] = title_worker.get_stats()
+    if summary_worker := current_app.config[CONFIG_SUMMARY_WORKER]:
+        stats["summary_worker"] = summary_worker.get_stats()
+    if history_store := current_app.config[CONFIG_HISTORY_STORE]:
+        stats["history_store"] = history_store.get_stats()
+    if write_queue := current_app.config[CONFIG_WRITE_BEHIND_QUEUE]:
+        stats["write_behind_queue"] = write_queue.get_stats()
+    if metadata_cache := current_app.config[CONFIG_CONVERSATION_METADATA_CACHE]:
+        stats["conversation_metadata_cache"] = metadata_cache.get_stats()
+    if document_cache := current_app.config[CONFIG_DOCUMENT_CACHE]:
+        stats["document_cache"] = document_cache.get_stats()
+    if search_cache := current_app.config[CONFIG_SEARCH_RESULT_CACHE]:
+        stats["search_result_cache"] = search_cache.get_stats()
+    if source_packer := current_app.config[CONFIG_SOURCE_PACKER]:
+        stats["source_packer"] = source_packer.get_stats()
+    return jsonify(stats)
+
+
 # Send MSAL.js settings to the client UI
 @bp.route("/auth_setup", methods=["GET"])
 def auth_setup():
@@ -440,13 +717,26 @@ async def ensure_openai_token():
         openai.api_key = openai_token.token
 
 
+@bp.before_request
+async def set_openai_session():
+    # Workaround for: https://github.com/openai/openai-python/issues/371
+    # The SDK reads its aiohttp session from a context variable, so it is set for each request (including
+    # streamed responses, which are generated in the same context) to the app-lifetime pooled session.
+    openai.aiosession.set(current_app.config[CONFIG_OPENAI_SESSION_POOL].session)
+
+
 @bp.before_app_serving
 async def setup_clients():
     # Replace these with your own values, either in environment variables or directly here
     AZURE_STORAGE_ACCOUNT = os.environ["AZURE_STORAGE_ACCOUNT"]
     AZURE_STORAGE_CONTAINER = os.environ["AZURE_STORAGE_CONTAINER"]
-    AZURE_SEARCH_SERVICE = os.environ["AZURE_SEARCH_SERVICE"]
-    AZURE_SEARCH_INDEX = os.environ["AZURE_SEARCH_INDEX"]
+    # Search a local index written by prepdocs --localindex instead of Azure AI Search, the search service is then
+    # not needed
+    LOCAL_SEARCH_INDEX = os.getenv("LOCAL_SEARCH_INDEX")
+    AZURE_SEARCH_SERVICE = (
+        os.getenv("AZURE_SEARCH_SERVICE", "") if LOCAL_SEARCH_INDEX else os.environ["AZURE_SEARCH_SERVICE"]
+    )
+    AZURE_SEARCH_INDEX = os.getenv("AZURE_SEARCH_INDEX", "") if LOCAL_SEARCH_INDEX else os.environ["AZURE_SEARCH_INDEX"]
     # Shared by all OpenAI deployments
     OPENAI_HOST = os.getenv("OPENAI_HOST", "azure")
     OPENAI_CHATGPT_MODEL = os.environ["AZURE_OPENAI_CHATGPT_MODEL"]
@@ -477,6 +767,70 @@ async def setup_clients():
     AZURE_COSMOSDB_CONVERSATIONS_CONTAINER = os.getenv("AZURE_COSMOSDB_CONVERSATIONS_CONTAINER") or "conversations"
     AZURE_COSMOSDB_MESSAGES_CONTAINER = os.getenv("AZURE_COSMOSDB_MESSAGES_CONTAINER") or "messages"
     AZURE_COSMOSDB_ACCOUNT_KEY = os.getenv("AZURE_COSMOSDB_ACCOUNT_KEY") or None
+    TITLE_WORKER_CONCURRENCY = int(os.getenv("TITLE_WORKER_CONCURRENCY", "2"))
+    TITLE_WORKER_MAX_RETRIES = int(os.getenv("TITLE_WORKER_MAX_RETRIES", "3"))
+    HISTORY_STORE_MAX_CONVERSATIONS = int(os.getenv("HISTORY_STORE_MAX_CONVERSATIONS", "1000"))
+    HISTORY_STORE_MAX_MESSAGES = int(os.getenv("HISTORY_STORE_MAX_MESSAGES", "50"))
+    # Fold the older messages of long conversations continued with /chat into a running summary, generated in the
+    # background, with a cheaper model if one is configured
+    HISTORY_SUMMARY = os.getenv("HISTORY_SUMMARY", "").lower() == "true"
+    HISTORY_SUMMARY_THRESHOLD = int(os.getenv("HISTORY_SUMMARY_THRESHOLD", "20"))
+    HISTORY_SUMMARY_KEEP_RECENT = int(os.getenv("HISTORY_SUMMARY_KEEP_RECENT", "6"))
+    AZURE_OPENAI_SUMMARY_DEPLOYMENT = os.getenv("AZURE_OPENAI_SUMMARY_DEPLOYMENT")
+    AZURE_OPENAI_SUMMARY_MODEL = os.getenv("AZURE_OPENAI_SUMMARY_MODEL")
+    # Write conversation turns in the background instead of on the request path
+    HISTORY_WRITE_BEHIND = os.getenv("HISTORY_WRITE_BEHIND", "").lower() == "true"
+    HISTORY_WRITE_BEHIND_INTERVAL = float(os.getenv("HISTORY_WRITE_BEHIND_INTERVAL", "0.1"))
+    HISTORY_WRITE_BEHIND_MAX_PENDING = int(os.getenv("HISTORY_WRITE_BEHIND_MAX_PENDING", "100"))
+    HISTORY_WRITE_BEHIND_MAX_ATTEMPTS = int(os.getenv("HISTORY_WRITE_BEHIND_MAX_ATTEMPTS", "5"))
+    # Where conversation history is stored: "cosmos", "sqlite" (shared by workers on the same host) or "memory",
+    # Cosmos DB by default when an account is configured
+    HISTORY_STORAGE = os.getenv("HISTORY_STORAGE") or ("cosmos" if AZURE_COSMOSDB_ACCOUNT else None)
+    HISTORY_SQLITE_PATH = os.getenv("HISTORY_SQLITE_PATH", "conversation_history.db")
+    # Cache the conversation list of each user, until one of their conversations changes or the TTL expires. On by
+    # default, so that clients polling the list with If-None-Match are answered without querying the storage
+    HISTORY_LIST_CACHE = os.getenv("HISTORY_LIST_CACHE", "true").lower() == "true"
+    HISTORY_LIST_CACHE_TTL = float(os.getenv("HISTORY_LIST_CACHE_TTL", "30"))
+    HISTORY_LIST_CACHE_MAX_USERS = int(os.getenv("HISTORY_LIST_CACHE_MAX_USERS", "1000"))
+
+    # Connection pool shared by all requests to OpenAI
+    OPENAI_POOL_LIMIT = int(os.getenv("OPENAI_POOL_LIMIT", "100"))
+    OPENAI_POOL_LIMIT_PER_HOST = int(os.getenv("OPENAI_POOL_LIMIT_PER_HOST", "0"))
+    OPENAI_POOL_KEEPALIVE_TIMEOUT = float(os.getenv("OPENAI_POOL_KEEPALIVE_TIMEOUT", "30"))
+    OPENAI_POOL_DNS_CACHE_TTL = int(os.getenv("OPENAI_POOL_DNS_CACHE_TTL", "300"))
+
+    # Cache of query embeddings, shared by all approaches
+    EMBEDDING_CACHE_MAX_ENTRIES = int(os.getenv("EMBEDDING_CACHE_MAX_ENTRIES", "2000"))
+    # Search only for the keys of the hits and read their content from a local cache, cleared when prepdocs
+    # changes the index
+    SEARCH_DOCUMENT_CACHE = os.getenv("SEARCH_DOCUMENT_CACHE", "").lower() == "true"
+    SEARCH_DOCUMENT_CACHE_MAX_ENTRIES = int(os.getenv("SEARCH_DOCUMENT_CACHE_MAX_ENTRIES", "5000"))
+    SEARCH_INDEX_VERSION_CHECK_INTERVAL = float(os.getenv("SEARCH_INDEX_VERSION_CHECK_INTERVAL", "30"))
+    # Search result cache shared by all approaches, one of "memory" or "sqlite" (shared by workers on the same host)
+    SEARCH_RESULT_CACHE_BACKEND = os.getenv("SEARCH_RESULT_CACHE_BACKEND")
+    SEARCH_RESULT_CACHE_TTL = float(os.getenv("SEARCH_RESULT_CACHE_TTL", "3600"))
+    SEARCH_RESULT_CACHE_MAX_ENTRIES = int(os.getenv("SEARCH_RESULT_CACHE_MAX_ENTRIES", "5000"))
+    SEARCH_RESULT_CACHE_SQLITE_PATH = os.getenv("SEARCH_RESULT_CACHE_SQLITE_PATH", "search_cache.db")
+    # Token budget of the sources of an answer, packed from SOURCE_CANDIDATES results instead of the top results
+    SOURCE_TOKEN_BUDGET = os.getenv("SOURCE_TOKEN_BUDGET")
+    SOURCE_CANDIDATES = int(os.getenv("SOURCE_CANDIDATES", "10"))
+
+    # How chat history is truncated when it does not fit: newest_first, summarize_oldest or keep_first_last
+    HISTORY_TRUNCATION_POLICY = os.getenv("HISTORY_TRUNCATION_POLICY", "newest_first")
+    HISTORY_KEEP_FIRST = int(os.getenv("HISTORY_KEEP_FIRST", "2"))
+    HISTORY_KEEP_LAST = int(os.getenv("HISTORY_KEEP_LAST", "8"))
+    # Whether to rewrite questions into search queries: "always", "skip_first_turn" or "heuristic"
+    QUERY_REWRITE_POLICY = os.getenv("QUERY_REWRITE_POLICY", "always")
+    # Number of query variants generated by rewrites, searched concurrently and merged, overridable per request
+    QUERY_VARIANTS = int(os.getenv("QUERY_VARIANTS", "1"))
+    QUERY_VARIANTS_MAX = int(os.getenv("QUERY_VARIANTS_MAX", "5"))
+
+    # Answer cache in front of /ask and /chat, one of "memory" or "sqlite" (shared by workers on the same host)
+    ANSWER_CACHE_BACKEND = os.getenv("ANSWER_CACHE_BACKEND")
+    ANSWER_CACHE_TTL = float(os.getenv("ANSWER_CACHE_TTL", "3600"))
+    ANSWER_CACHE_MAX_ENTRIES = int(os.getenv("ANSWER_CACHE_MAX_ENTRIES", "1000"))
+    ANSWER_CACHE_SQLITE_PATH = os.getenv("ANSWER_CACHE_SQLITE_PATH", "answer_cache.db")
+    ANSWER_CACHE_SIMILARITY_THRESHOLD = os.getenv("ANSWER_CACHE_SIMILARITY_THRESHOLD")
 
     # Use the current user identity to authenticate with Azure OpenAI, AI Search and Blob Storage (no secrets needed,
     # just use 'az login' locally, and managed identity when deployed on Azure). If you need to use keys, use separate AzureKeyCredential instances with the
@@ -495,11 +849,17 @@ async def setup_clients():
     )
 
     # Set up clients for AI Search and Storage
-    search_client = SearchClient(
-        endpoint=f"https://{AZURE_SEARCH_SERVICE}.search.windows.net",
-        index_name=AZURE_SEARCH_INDEX,
-        credential=azure_credential,
-    )
+    local_search_client = None
+    if LOCAL_SEARCH_INDEX:
+        local_search_client = await LocalSearchClient.open(LOCAL_SEARCH_INDEX)
+        # The local search client implements the part of the SearchClient interface used by the approaches
+        search_client = cast(SearchClient, local_search_client)
+    else:
+        search_client = SearchClient(
+            endpoint=f"https://{AZURE_SEARCH_SERVICE}.search.windows.net",
+            index_name=AZURE_SEARCH_INDEX,
+            credential=azure_credential,
+        )
     blob_client = BlobServiceClient(
         account_url=f"https://{AZURE_STORAGE_ACCOUNT}.blob.core.windows.net", credential=azure_credential
     )
@@ -519,58 +879,229 @@ async def setup_clients():
         openai.api_key = OPENAI_API_KEY
         openai.organization = OPENAI_ORGANIZATION
 
-    # Initialize a CosmosDB client with AAD auth and containers
-    cosmos_endpoint = f'https://{AZURE_COSMOSDB_ACCOUNT}.documents.azure.com:443/'
-    # credential = azure_credential
-    if not AZURE_COSMOSDB_ACCOUNT_KEY:
-        credential = azure_credential
-    else:
-        credential = AZURE_COSMOSDB_ACCOUNT_KEY
+    chatconversation_approach = ChatConversationReadApproach(
+        OPENAI_HOST,
+        AZURE_OPENAI_CHATGPT_DEPLOYMENT,
+        OPENAI_CHATGPT_MODEL,
+    )
 
-    cosmos_conversation_client = CosmosConversationClient(
-    cosmosdb_endpoint=cosmos_endpoint, 
-    credential=credential, 
-    database_name=AZURE_COSMOSDB_DATABASE,
-    container_name=AZURE_COSMOSDB_CONVERSATIONS_CONTAINER
+    # Initialize the storage of conversation history, shared by all requests. The CosmosDB client uses the account
+    # key if one is given, or AAD auth otherwise.
+    conversation_storage: Optional[ConversationStorage] = None
+    if HISTORY_STORAGE == "cosmos":
+        conversation_storage = CosmosConversationClient(
+            cosmosdb_endpoint=f"https://{AZURE_COSMOSDB_ACCOUNT}.documents.azure.com:443/",
+            credential=AZURE_COSMOSDB_ACCOUNT_KEY or azure_credential,
+            database_name=AZURE_COSMOSDB_DATABASE,
+            container_name=AZURE_COSMOSDB_CONVERSATIONS_CONTAINER,
+        )
+    elif HISTORY_STORAGE == "sqlite":
+        conversation_storage = SQLiteConversationStorage(HISTORY_SQLITE_PATH)
+    elif HISTORY_STORAGE == "memory":
+        conversation_storage = InMemoryConversationStorage()
+    elif HISTORY_STORAGE:
+        raise ValueError(f"Unknown history storage {HISTORY_STORAGE}")
+
+    # The cache wraps the storage, so that every write of a conversation, including those written behind the
+    # requests and the generated titles, invalidates the cached list
+    metadata_cache = None
+    if conversation_storage and HISTORY_LIST_CACHE:
+        conversation_storage = metadata_cache = ConversationMetadataCache(
+            conversation_storage, ttl=HISTORY_LIST_CACHE_TTL, max_users=HISTORY_LIST_CACHE_MAX_USERS
+        )
+
+    # Turns written behind the requests, in batches, when enabled
+    write_queue = None
+    if conversation_storage and HISTORY_WRITE_BEHIND:
+        write_queue = WriteBehindQueue(
+            conversation_storage,
+            flush_interval=HISTORY_WRITE_BEHIND_INTERVAL,
+            max_pending_messages=HISTORY_WRITE_BEHIND_MAX_PENDING,
+            max_attempts=HISTORY_WRITE_BEHIND_MAX_ATTEMPTS,
+        )
+        write_queue.start()
+
+    openai_session_pool = ClientSessionPool(
+        limit=OPENAI_POOL_LIMIT,
+        limit_per_host=OPENAI_POOL_LIMIT_PER_HOST,
+        keepalive_timeout=OPENAI_POOL_KEEPALIVE_TIMEOUT,
+        dns_cache_ttl=OPENAI_POOL_DNS_CACHE_TTL,
     )
+    openai_session_pool.open()
+    # Tasks copy the context they are created in, so the background workers created below use the pooled session
+    # for their completions, like the requests do through set_openai_session
+    openai.aiosession.set(openai_session_pool.session)
+
+    # Conversation titles are generated in the background, by a bounded number of workers
+    title_worker = None
+    if conversation_storage:
+        title_worker = TitleWorker(
+            conversation_storage,
+            create_title=chatconversation_approach.create_title,
+            max_concurrency=TITLE_WORKER_CONCURRENCY,
+            max_retries=TITLE_WORKER_MAX_RETRIES,
+        )
+        title_worker.start()
+
+    summary_worker = None
+    if conversation_storage and HISTORY_SUMMARY:
+        summary_approach = ChatConversationReadApproach(
+            OPENAI_HOST,
+            AZURE_OPENAI_SUMMARY_DEPLOYMENT or AZURE_OPENAI_CHATGPT_DEPLOYMENT,
+            AZURE_OPENAI_SUMMARY_MODEL or OPENAI_CHATGPT_MODEL,
+        )
+        summary_worker = SummaryWorker(
+            conversation_storage,
+            create_summary=summary_approach.create_summary,
+            threshold=HISTORY_SUMMARY_THRESHOLD,
+            keep_recent=HISTORY_SUMMARY_KEEP_RECENT,
+        )
+        summary_worker.start()
+
+    # Recent history of conversations continued with /chat, so clients only send the new message of each turn
+    history_store = None
+    if conversation_storage:
+        history_store = ConversationHistoryStore(
+            StorageHistoryBackend(conversation_storage, write_queue),
+            OPENAI_CHATGPT_MODEL,
+            max_conversations=HISTORY_STORE_MAX_CONVERSATIONS,
+            max_messages=max(HISTORY_STORE_MAX_MESSAGES, HISTORY_SUMMARY_THRESHOLD if summary_worker else 0),
+            summary_worker=summary_worker,
+        )
+
+    embedding_cache = EmbeddingCache(max_entries=EMBEDDING_CACHE_MAX_ENTRIES)
+
+    # prepdocs rewrites the index version blob every time it changes the index
+    async def get_index_version() -> Optional[str]:
+        # The local index is compiled when the app starts and keeps its version until the app restarts
+        if local_search_client:
+            return local_search_client.version
+        try:
+            properties = await blob_container_client.get_blob_client(INDEX_VERSION_BLOB_NAME).get_blob_properties()
+        except ResourceNotFoundError:
+            return None
+        return properties.etag
+
+    index_version = IndexVersion(get_index_version, check_interval=SEARCH_INDEX_VERSION_CHECK_INTERVAL)
+
+    document_cache = None
+    if SEARCH_DOCUMENT_CACHE:
+        document_cache = DocumentCache(
+            search_client,
+            [KB_FIELDS_SOURCEPAGE, KB_FIELDS_CONTENT],
+            index_version,
+            max_entries=SEARCH_DOCUMENT_CACHE_MAX_ENTRIES,
+        )
+
+    search_cache = None
+    if SEARCH_RESULT_CACHE_BACKEND:
+        search_cache_backend: CacheBackend
+        if SEARCH_RESULT_CACHE_BACKEND == "sqlite":
+            search_cache_backend = SQLiteCacheBackend(
+                SEARCH_RESULT_CACHE_SQLITE_PATH, max_entries=SEARCH_RESULT_CACHE_MAX_ENTRIES
+            )
+        else:
+            search_cache_backend = InMemoryCacheBackend(max_entries=SEARCH_RESULT_CACHE_MAX_ENTRIES)
+        search_cache = SearchResultCache(search_cache_backend, index_version, ttl=SEARCH_RESULT_CACHE_TTL)
 
     current_app.config[CONFIG_CREDENTIAL] = azure_credential
+    current_app.config[CONFIG_EMBEDDING_CACHE] = embedding_cache
+    current_app.config[CONFIG_DOCUMENT_CACHE] = document_cache
+    current_app.config[CONFIG_SEARCH_RESULT_CACHE] = search_cache
+    current_app.config[CONFIG_OPENAI_SESSION_POOL] = openai_session_pool
+    current_app.config[CONFIG_CONVERSATION_STORAGE] = conversation_storage
+    current_app.config[CONFIG_TITLE_WORKER] = title_worker
+    current_app.config[CONFIG_SUMMARY_WORKER] = summary_worker
+    current_app.config[CONFIG_HISTORY_STORE] = history_store
+    current_app.config[CONFIG_WRITE_BEHIND_QUEUE] = write_queue
+    current_app.config[CONFIG_CONVERSATION_METADATA_CACHE] = metadata_cache
     current_app.config[CONFIG_SEARCH_CLIENT] = search_client
     current_app.config[CONFIG_BLOB_CONTAINER_CLIENT] = blob_container_client
     current_app.config[CONFIG_AUTH_CLIENT] = auth_helper
 
     # Various approaches to integrate GPT and external knowledge, most applications will use a single one of these patterns
     # or some derivative, here we include several for exploration purposes
-    current_app.config[CONFIG_ASK_APPROACH] = RetrieveThenReadApproach(
+    source_packer = None
+    if SOURCE_TOKEN_BUDGET:
+        source_packer = SourcePacker(OPENAI_CHATGPT_MODEL, int(SOURCE_TOKEN_BUDGET), candidates=SOURCE_CANDIDATES)
+    current_app.config[CONFIG_SOURCE_PACKER] = source_packer
+
+    # Both approaches retrieve their sources through the same retriever, which owns the search and embedding clients
+    # and the retrieval caches
+    retriever = Retriever(
         search_client,
         OPENAI_HOST,
-        AZURE_OPENAI_CHATGPT_DEPLOYMENT,
-        OPENAI_CHATGPT_MODEL,
         AZURE_OPENAI_EMB_DEPLOYMENT,
         OPENAI_EMB_MODEL,
         KB_FIELDS_SOURCEPAGE,
         KB_FIELDS_CONTENT,
         AZURE_SEARCH_QUERY_LANGUAGE,
         AZURE_SEARCH_QUERY_SPELLER,
+        embedding_cache=embedding_cache,
+        document_cache=document_cache,
+        search_cache=search_cache,
+        source_packer=source_packer,
     )
+    current_app.config[CONFIG_RETRIEVER] = retriever
 
-    current_app.config[CONFIG_CHAT_APPROACH] = ChatReadRetrieveReadApproach(
-        search_client,
+    current_app.config[CONFIG_ASK_APPROACH] = RetrieveThenReadApproach(
+        retriever,
         OPENAI_HOST,
         AZURE_OPENAI_CHATGPT_DEPLOYMENT,
         OPENAI_CHATGPT_MODEL,
-        AZURE_OPENAI_EMB_DEPLOYMENT,
-        OPENAI_EMB_MODEL,
-        KB_FIELDS_SOURCEPAGE,
-        KB_FIELDS_CONTENT,
-        AZURE_SEARCH_QUERY_LANGUAGE,
-        AZURE_SEARCH_QUERY_SPELLER,
     )
 
-    current_app.config[CONFIG_CHAT_APPROACH] = ChatConversationReadApproach(
+    current_app.config[CONFIG_CHAT_APPROACH] = ChatReadRetrieveReadApproach(
+        retriever,
+        OPENAI_HOST,
         AZURE_OPENAI_CHATGPT_DEPLOYMENT,
+        OPENAI_CHATGPT_MODEL,
+        truncation_policy=create_truncation_policy(
+            HISTORY_TRUNCATION_POLICY, keep_first=HISTORY_KEEP_FIRST, keep_last=HISTORY_KEEP_LAST
+        ),
+        rewrite_policy=create_rewrite_policy(QUERY_REWRITE_POLICY),
+        query_variants=QUERY_VARIANTS,
+        max_query_variants=QUERY_VARIANTS_MAX,
     )
 
+    current_app.config[CONFIG_CHATCONVERSATION_APPROACH] = chatconversation_approach
+
+    answer_cache = None
+    if ANSWER_CACHE_BACKEND:
+        answer_cache_backend: CacheBackend
+        if ANSWER_CACHE_BACKEND == "sqlite":
+            answer_cache_backend = SQLiteCacheBackend(ANSWER_CACHE_SQLITE_PATH, max_entries=ANSWER_CACHE_MAX_ENTRIES)
+        else:
+            answer_cache_backend = InMemoryCacheBackend(max_entries=ANSWER_CACHE_MAX_ENTRIES)
+
+        answer_cache = AnswerCache(
+            answer_cache_backend,
+            ttl=ANSWER_CACHE_TTL,
+            similarity_threshold=(
+                float(ANSWER_CACHE_SIMILARITY_THRESHOLD) if ANSWER_CACHE_SIMILARITY_THRESHOLD else None
+            ),
+            embed=retriever.compute_embedding,
+        )
+        current_app.config[CONFIG_ASK_APPROACH] = CachedApproach(current_app.config[CONFIG_ASK_APPROACH], answer_cache)
+        current_app.config[CONFIG_CHAT_APPROACH] = CachedApproach(
+            current_app.config[CONFIG_CHAT_APPROACH], answer_cache
+        )
+    current_app.config[CONFIG_ANSWER_CACHE] = answer_cache
+
+
+@bp.after_app_serving
+async def close_clients():
+    # Pending turns are written before the conversation storage is closed
+    if write_queue := current_app.config[CONFIG_WRITE_BEHIND_QUEUE]:
+        await write_queue.close()
+    if title_worker := current_app.config[CONFIG_TITLE_WORKER]:
+        await title_worker.close()
+    if summary_worker := current_app.config[CONFIG_SUMMARY_WORKER]:
+        await summary_worker.close()
+    if conversation_storage := current_app.config[CONFIG_CONVERSATION_STORAGE]:
+        await conversation_storage.close()
+    # The workers drained above may still call OpenAI, so the pooled session is closed last
+    await current_app.config[CONFIG_OPENAI_SESSION_POOL].close()
 
 
 def create_app():
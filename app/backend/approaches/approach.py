@@ -2,6 +2,7 @@ from abc import ABC
 from typing import Any, AsyncGenerator, Optional, Union
 
 from core.authentication import AuthenticationHelper
+from core.retriever import Retrieval
 
 
 class Approach(ABC):
@@ -15,6 +16,14 @@ class Approach(ABC):
             filters.append(security_filter)
         return None if len(filters) == 0 else " and ".join(filters)
 
+    def describe_packing(self, retrieval: Retrieval) -> str:
+        if retrieval.source_tokens is None:
+            return ""
+        return (
+            f"Sources:<br>packed {len(retrieval.sources)} of {retrieval.candidates} candidates into "
+            f"{retrieval.source_tokens} of {retrieval.token_budget} tokens<br><br>"
+        )
+
     async def run(
         self, messages: list[dict], stream: bool = False, session_state: Any = None, context: dict[str, Any] = {}
     ) -> Union[dict[str, Any], AsyncGenerator[dict[str, Any], None]]:
@@ -0,0 +1,51 @@
+from typing import Any, AsyncGenerator, Optional, Union
+
+from approaches.approach import Approach
+from core.answercache import AnswerCache
+
+
+class CachedApproach(Approach):
+    """
+    Wraps another approach with an answer cache, so repeated questions asked with the same filter, overrides and
+    history are answered without calling OpenAI or AI Search again. Both non-streaming and streamed responses
+    are cached and replayed in the format they were requested in.
+    """
+
+    def __init__(self, approach: Approach, answer_cache: AnswerCache):
+        self.approach = approach
+        self.answer_cache = answer_cache
+
+    def build_filter(self, overrides: dict[str, Any], auth_claims: dict[str, Any]) -> Optional[str]:
+        return self.approach.build_filter(overrides, auth_claims)
+
+    async def run(
+        self, messages: list[dict], stream: bool = False, session_state: Any = None, context: dict[str, Any] = {}
+    ) -> Union[dict[str, Any], AsyncGenerator[dict[str, Any], None]]:
+        overrides = context.get("overrides", {})
+        auth_claims = context.get("auth_claims", {})
+        question = messages[-1]["content"]
+        scope = self.answer_cache.build_scope(messages, self.build_filter(overrides, auth_claims), overrides, stream)
+
+        cached, tier = await self.answer_cache.get(scope, question)
+        if cached is not None:
+            if stream:
+                return self.replay_stream(cached, session_state, tier)
+            cached["choices"][0]["session_state"] = session_state
+            cached["choices"][0]["context"]["answer_cache"] = tier
+            return cached
+
+        response = await self.approach.run(messages, stream=stream, session_state=session_state, context=context)
+        if isinstance(response, dict):
+            await self.answer_cache.set(scope, question, response)
+            return response
+        return self.answer_cache.record_stream(scope, question, response)
+
+    async def replay_stream(
+        self, events: list[dict[str, Any]], session_state: Any, tier: Optional[str]
+    ) -> AsyncGenerator[dict[str, Any], None]:
+        for event in events:
+            choice = event["choices"][0] if event.get("choices") else {}
+            if "session_state" in choice:
+                choice["session_state"] = session_state
+                choice["context"]["answer_cache"] = tier
+            yield event
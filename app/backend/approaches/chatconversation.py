@@ -1,52 +1,116 @@
-import openai
-from approaches.approach import Approach
-
-# Simple ChatGPT experience that calls the Azure OpenAI APIs directly. The input history is converted to the chat/completions "messages" format and submitted to the model.
-class ChatConversationReadApproach(Approach):
+import json
+from typing import Any, AsyncGenerator, Optional, Union
 
-    def __init__(self, chatgpt_deployment: str): ## BDL: removed search_client, gpt_deployment, sourcepage_field, content_field as they're not needed for vanilla chatgptread
-        self.chatgpt_deployment = chatgpt_deployment
+import openai
 
-    def run(self, history: list[dict], overrides: dict) -> any:
+from approaches.approach import Approach
 
-        ## add a system prompt to the messages
-        ## then convert the input history to the chat/completions "messages" format
 
-        ## if the system override for the prompt is set, use that for the system prompt. Otherwise, use the default
-        prompt_override = overrides.get("prompt_template")
-        if prompt_override is None:
-            system_prompt = "You are an AI chatbot that responds to whatever the user says."
-        else:
-            system_prompt = prompt_override
+class ChatConversationReadApproach(Approach):
+    """
+    Simple ChatGPT experience that calls the OpenAI APIs directly, without searching for sources.
+    The input history of {"user", "bot"} turns is converted to the chat/completions "messages" format.
+    """
 
-        ## Use the "ChatCompletions" format for the input prompt messages.
-        messages = [
-            {"role": "system", "content": f"{system_prompt}"},
-        ]
+    ASSISTANT = "assistant"
+    default_system_prompt = "You are an AI chatbot that responds to whatever the user says."
+    title_prompt = (
+        "Summarize the conversation so far into a 4-word or less title. Do not use any quotation marks or "
+        'punctuation. Respond with a json object in the format {"title": string}. '
+        "Do not include any other commentary or description."
+    )
+    summary_prompt = (
+        "Summarize the conversation above for an assistant that will continue it without seeing these messages. "
+        "Keep the facts, names, numbers, decisions and open questions. Respond with the summary only, in at most "
+        "200 words."
+    )
 
-        for utterance_dict in history:
-            ## check if the user key exists in the dict
-            if "user" in utterance_dict:
-                messages.append({"role": "user", "content": utterance_dict["user"]})
-            ## then check if the "bot" key exists in the dict
-            if "bot" in utterance_dict:
-                messages.append({"role": "system", "content": utterance_dict["bot"]})
+    def __init__(
+        self,
+        openai_host: str,
+        chatgpt_deployment: Optional[str],  # Not needed for non-Azure OpenAI
+        chatgpt_model: str,
+    ):
+        self.openai_host = openai_host
+        self.chatgpt_deployment = chatgpt_deployment
+        self.chatgpt_model = chatgpt_model
 
-        openai.api_version = "2023-03-15-preview"
+    def get_messages(self, history: list[dict[str, str]], overrides: dict[str, Any]) -> list[dict[str, str]]:
+        # If the system override for the prompt is set, use that for the system prompt. Otherwise, use the default
+        messages = [{"role": "system", "content": overrides.get("prompt_template") or self.default_system_prompt}]
+        for turn in history:
+            if "user" in turn:
+                messages.append({"role": "user", "content": turn["user"]})
+            if turn.get("bot"):
+                messages.append({"role": self.ASSISTANT, "content": turn["bot"]})
+        return messages
 
-        completion = openai.ChatCompletion.create(    
-            engine=self.chatgpt_deployment,
-            messages=messages,
+    async def run(
+        self, messages: list[dict], stream: bool = False, session_state: Any = None, context: dict[str, Any] = {}
+    ) -> Union[dict[str, Any], AsyncGenerator[dict[str, Any], None]]:
+        overrides = context.get("overrides", {})
+        chatgpt_args = {"deployment_id": self.chatgpt_deployment} if self.openai_host == "azure" else {}
+        chat_coroutine = openai.ChatCompletion.acreate(
+            **chatgpt_args,
+            model=self.chatgpt_model,
+            messages=self.get_messages(messages, overrides),
             temperature=overrides.get("temperature") or 0.7,
-            max_tokens=1024 
+            max_tokens=1024,
+            n=1,
+            stream=stream,
+        )
+        if stream:
+            return self.run_with_streaming(chat_coroutine)
+        completion = await chat_coroutine
+        return {
+            "data_points": "There were no documents searched. This is vanilla",
+            "answer": completion["choices"][0]["message"]["content"],
+            "thoughts": "I have no thoughts, I'm a robot",
+        }
+
+    async def create_title(self, messages: list[dict[str, str]]) -> str:
+        """
+        Summarizes the {"role", "content"} messages of a conversation into a short title.
+        """
+        chatgpt_args = {"deployment_id": self.chatgpt_deployment} if self.openai_host == "azure" else {}
+        completion = await openai.ChatCompletion.acreate(
+            **chatgpt_args,
+            model=self.chatgpt_model,
+            messages=[{"role": message["role"], "content": message["content"]} for message in messages]
+            + [{"role": "user", "content": self.title_prompt}],
+            temperature=1,
+            max_tokens=64,
         )
+        content = completion["choices"][0]["message"]["content"]
+        try:
+            return json.loads(content)["title"]
+        except (ValueError, KeyError, TypeError):
+            # The model did not follow the requested format, so use its answer as the title
+            return content.strip().strip('"')
 
-        return {"data_points": "There were no documents searched. This is vanilla", "answer": completion['choices'][0]['message']['content'], "thoughts": f"I have no thoughts, I'm a robot"}
+    async def create_summary(self, previous_summary: Optional[str], messages: list[dict[str, str]]) -> str:
+        """
+        Folds the {"role", "content"} messages of a conversation into the summary of the messages before them.
+        """
+        chatgpt_args = {"deployment_id": self.chatgpt_deployment} if self.openai_host == "azure" else {}
+        summary_messages = (
+            [{"role": "system", "content": f"Summary of the earlier conversation:\n{previous_summary}"}]
+            if previous_summary
+            else []
+        )
+        completion = await openai.ChatCompletion.acreate(
+            **chatgpt_args,
+            model=self.chatgpt_model,
+            messages=summary_messages
+            + [{"role": message["role"], "content": message["content"]} for message in messages]
+            + [{"role": "user", "content": self.summary_prompt}],
+            temperature=0,
+            max_tokens=400,
+        )
+        return completion["choices"][0]["message"]["content"].strip()
 
-    def get_chat_history_as_text(self, history, include_last_turn=True, approx_max_tokens=1000) -> str:
-        history_text = ""
-        for h in reversed(history if include_last_turn else history[:-1]):
-            history_text = """<|im_start|>user""" +"\n" + h["user"] + "\n" + """<|im_end|>""" + "\n" + """<|im_start|>assistant""" + "\n" + (h.get("bot") + """<|im_end|>""" if h.get("bot") else "") + "\n" + history_text
-            if len(history_text) > approx_max_tokens*4:
-                break    
-        return history_text
\ No newline at end of file
+    async def run_with_streaming(self, chat_coroutine) -> AsyncGenerator[dict[str, Any], None]:
+        async for event in await chat_coroutine:
+            # "2023-07-01-preview" API version has a bug where first response has empty choices
+            if event["choices"]:
+                yield event
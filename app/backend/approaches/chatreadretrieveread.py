@@ -1,17 +1,17 @@
+import asyncio
 import json
 import logging
 import re
+import time
 from typing import Any, AsyncGenerator, Optional, Union
 
-import aiohttp
 import openai
-from azure.search.documents.aio import SearchClient
-from azure.search.documents.models import QueryType
 
 from approaches.approach import Approach
-from core.messagebuilder import MessageBuilder
-from core.modelhelper import get_token_limit
-from text import nonewlines
+from core.messagebuilder import HistoryPacker, TruncationPolicy
+from core.modelhelper import get_token_limit, num_tokens_from_messages_batch
+from core.retriever import Retriever
+from core.rewritepolicy import AlwaysRewritePolicy, QueryRewritePolicy
 
 
 class ChatReadRetrieveReadApproach(Approach):
@@ -50,6 +50,8 @@ Do not include any text inside [] or <<>> in the search query terms.
 Do not include any special characters like '+'.
 If the question is not in English, translate the question to English before generating the search query.
 If you cannot generate a search query, return just the number 0.
+"""
+    query_variants_prompt_template = """Generate up to {count} different search queries, each of which could find sources that answer the question, for example by using synonyms or by searching for different parts of the question.
 """
     query_prompt_few_shots = [
         {"role": USER, "content": "What are my health plans?"},
@@ -60,27 +62,23 @@ If you cannot generate a search query, return just the number 0.
 
     def __init__(
         self,
-        search_client: SearchClient,
+        retriever: Retriever,
         openai_host: str,
         chatgpt_deployment: Optional[str],  # Not needed for non-Azure OpenAI
         chatgpt_model: str,
-        embedding_deployment: Optional[str],  # Not needed for non-Azure OpenAI or for retrieval_mode="text"
-        embedding_model: str,
-        sourcepage_field: str,
-        content_field: str,
-        query_language: str,
-        query_speller: str,
+        truncation_policy: Optional[TruncationPolicy] = None,
+        rewrite_policy: Optional[QueryRewritePolicy] = None,
+        query_variants: int = 1,
+        max_query_variants: int = 5,
     ):
-        self.search_client = search_client
+        self.retriever = retriever
         self.openai_host = openai_host
         self.chatgpt_deployment = chatgpt_deployment
         self.chatgpt_model = chatgpt_model
-        self.embedding_deployment = embedding_deployment
-        self.embedding_model = embedding_model
-        self.sourcepage_field = sourcepage_field
-        self.content_field = content_field
-        self.query_language = query_language
-        self.query_speller = query_speller
+        self.truncation_policy = truncation_policy
+        self.rewrite_policy = rewrite_policy or AlwaysRewritePolicy()
+        self.query_variants = query_variants
+        self.max_query_variants = max_query_variants
         self.chatgpt_token_limit = get_token_limit(chatgpt_model)
 
     async def run_until_final_call(
@@ -89,110 +87,95 @@ If you cannot generate a search query, return just the number 0.
         overrides: dict[str, Any],
         auth_claims: dict[str, Any],
         should_stream: bool = False,
+        history_token_counts: Optional[list[int]] = None,
     ) -> tuple:
         has_text = overrides.get("retrieval_mode") in ["text", "hybrid", None]
         has_vector = overrides.get("retrieval_mode") in ["vectors", "hybrid", None]
-        use_semantic_captions = True if overrides.get("semantic_captions") and has_text else False
-        top = overrides.get("top", 3)
         filter = self.build_filter(overrides, auth_claims)
 
         original_user_query = history[-1]["content"]
         user_query_request = "Generate search query for: " + original_user_query
 
-        functions = [
-            {
-                "name": "search_sources",
-                "description": "Retrieve sources from the Azure AI Search index",
-                "parameters": {
-                    "type": "object",
-                    "properties": {
-                        "search_query": {
-                            "type": "string",
-                            "description": "Query string to retrieve documents from azure search eg: 'Health care plan'",
-                        }
-                    },
-                    "required": ["search_query"],
-                },
-            }
-        ]
+        # STEP 1: Generate an optimized keyword search query based on the chat history and the last question,
+        # unless the rewrite policy decides the question can be searched for as asked
+        should_rewrite, rewrite_reason = self.rewrite_policy.should_rewrite(history)
+        # Optionally generate several variants of the query, which are searched concurrently
+        query_variants = int(overrides.get("query_variants") or self.query_variants)
+        query_variants = min(max(query_variants, 1), self.max_query_variants)
+        fan_out = should_rewrite and query_variants > 1
 
-        # STEP 1: Generate an optimized keyword search query based on the chat history and the last question
-        messages = self.get_messages_from_history(
-            system_prompt=self.query_prompt_template,
-            model_id=self.chatgpt_model,
-            history=history,
-            user_content=user_query_request,
-            max_tokens=self.chatgpt_token_limit - len(user_query_request),
-            few_shots=self.query_prompt_few_shots,
-        )
+        # Optionally embed the original question while the query is generated, in case the query comes back unchanged
+        speculative_embedding = None
+        if should_rewrite and not fan_out and has_vector and overrides.get("speculative_embedding"):
+            speculative_embedding = asyncio.create_task(self.retriever.compute_timed_embedding(original_user_query))
 
         chatgpt_args = {"deployment_id": self.chatgpt_deployment} if self.openai_host == "azure" else {}
-        chat_completion = await openai.ChatCompletion.acreate(
-            **chatgpt_args,
-            model=self.chatgpt_model,
-            messages=messages,
-            temperature=0.0,
-            max_tokens=100,  # Setting too low risks malformed JSON, setting too high may affect performance
-            n=1,
-            functions=functions,
-            function_call="auto",
-        )
-
-        query_text = self.get_search_query(chat_completion, original_user_query)
+        if should_rewrite:
+            system_prompt = self.query_prompt_template
+            if fan_out:
+                system_prompt += self.query_variants_prompt_template.format(count=query_variants)
+            messages = self.get_messages_from_history(
+                system_prompt=system_prompt,
+                model_id=self.chatgpt_model,
+                history=history,
+                user_content=user_query_request,
+                max_tokens=self.chatgpt_token_limit - len(user_query_request),
+                few_shots=self.query_prompt_few_shots,
+                history_token_counts=history_token_counts,
+            )
+            rewrite_start = time.perf_counter()
+            try:
+                chat_completion = await openai.ChatCompletion.acreate(
+                    **chatgpt_args,
+                    model=self.chatgpt_model,
+                    messages=messages,
+                    temperature=0.0,
+                    # Setting too low risks malformed JSON, setting too high may affect performance
+                    max_tokens=100 * query_variants if fan_out else 100,
+                    n=1,
+                    functions=self.get_search_functions(query_variants if fan_out else 1),
+                    function_call="auto",
+                )
+            except Exception:
+                if speculative_embedding:
+                    self.discard_speculative_embedding(speculative_embedding)
+                raise
+            self.rewrite_policy.record_latency((time.perf_counter() - rewrite_start) * 1000)
+            if fan_out:
+                query_texts = self.get_search_queries(chat_completion, original_user_query, query_variants)
+            else:
+                query_texts = [self.get_search_query(chat_completion, original_user_query)]
+        else:
+            query_texts = [original_user_query]
+        query_text = query_texts[0]
+        query_rewrite = self.rewrite_policy.describe(should_rewrite, rewrite_reason)
 
         # STEP 2: Retrieve relevant documents from the search index with the GPT optimized query
 
-        # If retrieval mode includes vectors, compute an embedding for the query
-        if has_vector:
-            embedding_args = {"deployment_id": self.embedding_deployment} if self.openai_host == "azure" else {}
-            embedding = await openai.Embedding.acreate(**embedding_args, model=self.embedding_model, input=query_text)
-            query_vector = embedding["data"][0]["embedding"]
-        else:
-            query_vector = None
-
-        # Only keep the text query if the retrieval mode uses text, otherwise drop it
-        if not has_text:
-            query_text = None
-
-        # Use semantic L2 reranker if requested and if retrieval mode is text or hybrid (vectors + text)
-        if overrides.get("semantic_ranker") and has_text:
-            r = await self.search_client.search(
-                query_text,
-                filter=filter,
-                query_type=QueryType.SEMANTIC,
-                query_language=self.query_language,
-                query_speller=self.query_speller,
-                semantic_configuration_name="default",
-                top=top,
-                query_caption="extractive|highlight-false" if use_semantic_captions else None,
-                vector=query_vector,
-                top_k=50 if query_vector else None,
-                vector_fields="embedding" if query_vector else None,
-            )
-        else:
-            r = await self.search_client.search(
-                query_text,
-                filter=filter,
-                top=top,
-                vector=query_vector,
-                top_k=50 if query_vector else None,
-                vector_fields="embedding" if query_vector else None,
-            )
-        if use_semantic_captions:
-            results = [
-                doc[self.sourcepage_field] + ": " + nonewlines(" . ".join([c.text for c in doc["@search.captions"]]))
-                async for doc in r
-            ]
-        else:
-            results = [doc[self.sourcepage_field] + ": " + nonewlines(doc[self.content_field]) async for doc in r]
-        content = "\n".join(results)
+        # The query is embedded by the retriever if the retrieval mode includes vectors, unless the speculative
+        # embedding of the original question can be used
+        query_vector = None
+        speculation_thoughts = ""
+        if speculative_embedding and query_text.strip() == original_user_query.strip():
+            wait_start = time.perf_counter()
+            try:
+                query_vector, embedding_ms = await speculative_embedding
+            except Exception as error:
+                # The retriever embeds the query itself, so a failed speculation only costs the time it took
+                logging.warning("Speculative embedding failed: %s", error)
+                speculation_thoughts = "Speculative embedding:<br>failed, the query was embedded again<br><br>"
+            else:
+                # Only the part of the embedding call that overlapped with query generation is saved
+                saved_ms = embedding_ms - (time.perf_counter() - wait_start) * 1000
+                speculation_thoughts = f"Speculative embedding:<br>used, saved {max(saved_ms, 0):.0f} ms<br><br>"
+        elif speculative_embedding:
+            self.discard_speculative_embedding(speculative_embedding)
+            speculation_thoughts = "Speculative embedding:<br>discarded, search query was rewritten<br><br>"
 
         follow_up_questions_prompt = (
             self.follow_up_questions_prompt_content if overrides.get("suggest_followup_questions") else ""
         )
 
-        # STEP 3: Generate a contextual and content specific answer using the search results and chat history
-
         # Allow client to replace the entire prompt, or to inject into the exiting prompt using >>>
         prompt_override = overrides.get("prompt_template")
         if prompt_override is None:
@@ -208,21 +191,69 @@ If you cannot generate a search query, return just the number 0.
 
         response_token_limit = 1024
         messages_token_limit = self.chatgpt_token_limit - response_token_limit
+        # When sources are packed into a token budget, they may take what is left once the system message and the
+        # question are counted, and the history gets the tokens they leave
+        user_content_prefix = original_user_query + "\n\nSources:\n"
+        token_budget = None
+        if self.retriever.source_packer:
+            prompt_messages = [
+                {"role": self.SYSTEM, "content": system_message},
+                {"role": self.USER, "content": user_content_prefix},
+            ]
+            token_budget = messages_token_limit - sum(
+                num_tokens_from_messages_batch(prompt_messages, self.chatgpt_model)
+            )
+
+        variants_thoughts = ""
+        if len(query_texts) > 1:
+            retrieval, variants = await self.retriever.retrieve_variants(query_texts, overrides, filter, token_budget)
+            variants_thoughts = (
+                "Query variants:<br>"
+                + "<br>".join(
+                    f"{variant.query}: {variant.search_ms:.0f} ms, {variant.results} results, "
+                    f"{variant.contributed} in sources"
+                    for variant in variants
+                )
+                + "<br><br>"
+            )
+        else:
+            retrieval = await self.retriever.retrieve(query_text, overrides, filter, query_vector, token_budget)
+        results = retrieval.sources
+        content = "\n".join(results)
+
+        # Only show the text query if the retrieval mode uses text
+        searched_for = "<br>".join(query_texts) if has_text else None
+
+        # STEP 3: Generate a contextual and content specific answer using the search results and chat history
         messages = self.get_messages_from_history(
             system_prompt=system_message,
             model_id=self.chatgpt_model,
             history=history,
             # Model does not handle lengthy system messages well. Moving sources to latest user conversation to solve follow up questions prompt.
-            user_content=original_user_query + "\n\nSources:\n" + content,
+            user_content=user_content_prefix + content,
             max_tokens=messages_token_limit,
+            history_token_counts=history_token_counts,
         )
         msg_to_display = "\n\n".join([str(message) for message in messages])
 
-        extra_info = {
+        # The default policy always rewrites, so only report decisions when a policy that can skip is configured
+        rewrite_thoughts = ""
+        if not isinstance(self.rewrite_policy, AlwaysRewritePolicy):
+            action = "rewritten" if should_rewrite else f"skipped, saved about {query_rewrite['estimated_ms_saved']} ms"
+            rewrite_thoughts = f"Query rewrite:<br>{action} ({rewrite_reason})<br><br>"
+
+        extra_info: dict[str, Any] = {
             "data_points": results,
-            "thoughts": f"Searched for:<br>{query_text}<br><br>Conversations:<br>"
+            "thoughts": f"Searched for:<br>{searched_for}<br><br>"
+            + variants_thoughts
+            + self.describe_packing(retrieval)
+            + speculation_thoughts
+            + rewrite_thoughts
+            + "Conversations:<br>"
             + msg_to_display.replace("\n", "<br>"),
         }
+        if not isinstance(self.rewrite_policy, AlwaysRewritePolicy):
+            extra_info["query_rewrite"] = query_rewrite
 
         chat_coroutine = openai.ChatCompletion.acreate(
             **chatgpt_args,
@@ -241,9 +272,10 @@ If you cannot generate a search query, return just the number 0.
         overrides: dict[str, Any],
         auth_claims: dict[str, Any],
         session_state: Any = None,
+        history_token_counts: Optional[list[int]] = None,
     ) -> dict[str, Any]:
         extra_info, chat_coroutine = await self.run_until_final_call(
-            history, overrides, auth_claims, should_stream=False
+            history, overrides, auth_claims, should_stream=False, history_token_counts=history_token_counts
         )
         chat_resp = dict(await chat_coroutine)
         chat_resp["choices"][0]["context"] = extra_info
@@ -260,9 +292,10 @@ If you cannot generate a search query, return just the number 0.
         overrides: dict[str, Any],
         auth_claims: dict[str, Any],
         session_state: Any = None,
+        history_token_counts: Optional[list[int]] = None,
     ) -> AsyncGenerator[dict, None]:
         extra_info, chat_coroutine = await self.run_until_final_call(
-            history, overrides, auth_claims, should_stream=True
+            history, overrides, auth_claims, should_stream=True, history_token_counts=history_token_counts
         )
         yield {
             "choices": [
@@ -314,14 +347,14 @@ If you cannot generate a search query, return just the number 0.
     ) -> Union[dict[str, Any], AsyncGenerator[dict[str, Any], None]]:
         overrides = context.get("overrides", {})
         auth_claims = context.get("auth_claims", {})
+        # Token counts of the first messages, already known when the history is kept on the server
+        history_token_counts = context.get("history_token_counts")
         if stream is False:
-            # Workaround for: https://github.com/openai/openai-python/issues/371
-            async with aiohttp.ClientSession() as s:
-                openai.aiosession.set(s)
-                response = await self.run_without_streaming(messages, overrides, auth_claims, session_state)
-            return response
+            return await self.run_without_streaming(
+                messages, overrides, auth_claims, session_state, history_token_counts
+            )
         else:
-            return self.run_with_streaming(messages, overrides, auth_claims, session_state)
+            return self.run_with_streaming(messages, overrides, auth_claims, session_state, history_token_counts)
 
     def get_messages_from_history(
         self,
@@ -331,27 +364,57 @@ If you cannot generate a search query, return just the number 0.
         user_content: str,
         max_tokens: int,
         few_shots=[],
+        history_token_counts: Optional[list[int]] = None,
     ) -> list:
-        message_builder = MessageBuilder(system_prompt, model_id)
-
-        # Add examples to show the chat what responses we want. It will try to mimic any responses and make sure they match the rules laid out in the system message.
-        for shot in reversed(few_shots):
-            message_builder.insert_message(shot.get("role"), shot.get("content"))
-
-        append_index = len(few_shots) + 1
-
-        message_builder.insert_message(self.USER, user_content, index=append_index)
-        total_token_count = message_builder.count_tokens_for_message(message_builder.messages[-1])
-
-        newest_to_oldest = list(reversed(history[:-1]))
-        for message in newest_to_oldest:
-            potential_message_count = message_builder.count_tokens_for_message(message)
-            if (total_token_count + potential_message_count) > max_tokens:
-                logging.debug("Reached max tokens of %d, history will be truncated", max_tokens)
-                break
-            message_builder.insert_message(message["role"], message["content"], index=append_index)
-            total_token_count += potential_message_count
-        return message_builder.messages
+        history_packer = HistoryPacker(model_id, self.truncation_policy)
+        return history_packer.pack(
+            system_prompt, history[:-1], user_content, max_tokens, few_shots, history_token_counts
+        )
+
+    def discard_speculative_embedding(self, task: asyncio.Task):
+        # Let the call finish rather than cancel it, since other requests may be waiting on the same cached embedding
+        task.add_done_callback(lambda task: task.cancelled() or task.exception())
+
+    def get_search_functions(self, query_variants: int) -> list[dict[str, Any]]:
+        if query_variants == 1:
+            properties: dict[str, Any] = {
+                "search_query": {
+                    "type": "string",
+                    "description": "Query string to retrieve documents from azure search eg: 'Health care plan'",
+                }
+            }
+        else:
+            properties = {
+                "search_queries": {
+                    "type": "array",
+                    "items": {"type": "string"},
+                    "maxItems": query_variants,
+                    "description": "Query strings to retrieve documents from azure search eg: "
+                    + "['Health care plan', 'Medical insurance coverage']",
+                }
+            }
+        return [
+            {
+                "name": "search_sources",
+                "description": "Retrieve sources from the Azure AI Search index",
+                "parameters": {"type": "object", "properties": properties, "required": list(properties)},
+            }
+        ]
+
+    def get_search_queries(self, chat_completion: dict[str, Any], user_query: str, query_variants: int) -> list[str]:
+        response_message = chat_completion["choices"][0]["message"]
+        if function_call := response_message.get("function_call"):
+            if function_call["name"] == "search_sources":
+                search_queries = json.loads(function_call["arguments"]).get("search_queries") or []
+                # Variants are searched once each, in the order they were generated
+                queries = dict.fromkeys(
+                    query.strip()
+                    for query in search_queries
+                    if isinstance(query, str) and query.strip() not in ("", self.NO_RESPONSE)
+                )
+                if queries:
+                    return list(queries)[:query_variants]
+        return [self.get_search_query(chat_completion, user_query)]
 
     def get_search_query(self, chat_completion: dict[str, Any], user_query: str):
         response_message = chat_completion["choices"][0]["message"]
@@ -1,12 +1,11 @@
 from typing import Any, AsyncGenerator, Optional, Union
 
 import openai
-from azure.search.documents.aio import SearchClient
-from azure.search.documents.models import QueryType
 
 from approaches.approach import Approach
 from core.messagebuilder import MessageBuilder
-from text import nonewlines
+from core.modelhelper import get_token_limit, num_tokens_from_messages_batch
+from core.retriever import Retriever
 
 
 class RetrieveThenReadApproach(Approach):
@@ -37,29 +36,19 @@ info4.pdf: In-network institutions include Overlake, Swedish and others in the r
 """
     answer = "In-network deductibles are $500 for employee and $1000 for family [info1.txt] and Overlake is in-network for the employee plan [info2.pdf][info4.pdf]."
 
+    response_token_limit = 1024
+
     def __init__(
         self,
-        search_client: SearchClient,
+        retriever: Retriever,
         openai_host: str,
         chatgpt_deployment: Optional[str],  # Not needed for non-Azure OpenAI
         chatgpt_model: str,
-        embedding_deployment: Optional[str],  # Not needed for non-Azure OpenAI or for retrieval_mode="text"
-        embedding_model: str,
-        sourcepage_field: str,
-        content_field: str,
-        query_language: str,
-        query_speller: str,
     ):
-        self.search_client = search_client
+        self.retriever = retriever
         self.openai_host = openai_host
         self.chatgpt_deployment = chatgpt_deployment
         self.chatgpt_model = chatgpt_model
-        self.embedding_model = embedding_model
-        self.embedding_deployment = embedding_deployment
-        self.sourcepage_field = sourcepage_field
-        self.content_field = content_field
-        self.query_language = query_language
-        self.query_speller = query_speller
 
     async def run(
         self,
@@ -72,83 +61,54 @@ info4.pdf: In-network institutions include Overlake, Swedish and others in the r
         overrides = context.get("overrides", {})
         auth_claims = context.get("auth_claims", {})
         has_text = overrides.get("retrieval_mode") in ["text", "hybrid", None]
-        has_vector = overrides.get("retrieval_mode") in ["vectors", "hybrid", None]
-        use_semantic_captions = True if overrides.get("semantic_captions") and has_text else False
-        top = overrides.get("top", 3)
         filter = self.build_filter(overrides, auth_claims)
 
-        # If retrieval mode includes vectors, compute an embedding for the query
-        if has_vector:
-            embedding_args = {"deployment_id": self.embedding_deployment} if self.openai_host == "azure" else {}
-            embedding = await openai.Embedding.acreate(**embedding_args, model=self.embedding_model, input=q)
-            query_vector = embedding["data"][0]["embedding"]
-        else:
-            query_vector = None
-
-        # Only keep the text query if the retrieval mode uses text, otherwise drop it
+        # Only show the text query if the retrieval mode uses text
         query_text = q if has_text else ""
 
-        # Use semantic ranker if requested and if retrieval mode is text or hybrid (vectors + text)
-        if overrides.get("semantic_ranker") and has_text:
-            r = await self.search_client.search(
-                query_text,
-                filter=filter,
-                query_type=QueryType.SEMANTIC,
-                query_language=self.query_language,
-                query_speller=self.query_speller,
-                semantic_configuration_name="default",
-                top=top,
-                query_caption="extractive|highlight-false" if use_semantic_captions else None,
-                vector=query_vector,
-                top_k=50 if query_vector else None,
-                vector_fields="embedding" if query_vector else None,
-            )
-        else:
-            r = await self.search_client.search(
-                query_text,
-                filter=filter,
-                top=top,
-                vector=query_vector,
-                top_k=50 if query_vector else None,
-                vector_fields="embedding" if query_vector else None,
-            )
-        if use_semantic_captions:
-            results = [
-                doc[self.sourcepage_field] + ": " + nonewlines(" . ".join([c.text for c in doc["@search.captions"]]))
-                async for doc in r
-            ]
-        else:
-            results = [doc[self.sourcepage_field] + ": " + nonewlines(doc[self.content_field]) async for doc in r]
-        content = "\n".join(results)
-
-        message_builder = MessageBuilder(
-            overrides.get("prompt_template") or self.system_chat_template, self.chatgpt_model
-        )
-
-        # add user question
-        user_content = q + "\n" + f"Sources:\n {content}"
-        message_builder.insert_message("user", user_content)
+        # When sources are packed into a token budget, they may take what is left of the prompt once the
+        # instructions, examples and question are counted
+        token_budget = None
+        if self.retriever.source_packer:
+            prompt_tokens = sum(num_tokens_from_messages_batch(self.get_messages(overrides, q, ""), self.chatgpt_model))
+            token_budget = get_token_limit(self.chatgpt_model) - self.response_token_limit - prompt_tokens
 
-        # Add shots/samples. This helps model to mimic response and make sure they match rules laid out in system message.
-        message_builder.insert_message("assistant", self.answer)
-        message_builder.insert_message("user", self.question)
+        retrieval = await self.retriever.retrieve(q, overrides, filter, token_budget=token_budget)
+        results = retrieval.sources
+        content = "\n".join(results)
 
-        messages = message_builder.messages
+        messages = self.get_messages(overrides, q, content)
         chatgpt_args = {"deployment_id": self.chatgpt_deployment} if self.openai_host == "azure" else {}
         chat_completion = await openai.ChatCompletion.acreate(
             **chatgpt_args,
             model=self.chatgpt_model,
             messages=messages,
             temperature=overrides.get("temperature") or 0.3,
-            max_tokens=1024,
+            max_tokens=self.response_token_limit,
             n=1,
         )
 
         extra_info = {
             "data_points": results,
-            "thoughts": f"Question:<br>{query_text}<br><br>Prompt:<br>"
+            "thoughts": f"Question:<br>{query_text}<br><br>"
+            + self.describe_packing(retrieval)
+            + "Prompt:<br>"
             + "\n\n".join([str(message) for message in messages]),
         }
         chat_completion.choices[0]["context"] = extra_info
         chat_completion.choices[0]["session_state"] = session_state
         return chat_completion
+
+    def get_messages(self, overrides: dict[str, Any], q: str, content: str) -> list[dict[str, str]]:
+        message_builder = MessageBuilder(
+            overrides.get("prompt_template") or self.system_chat_template, self.chatgpt_model
+        )
+
+        # add user question
+        user_content = q + "\n" + f"Sources:\n {content}"
+        message_builder.insert_message("user", user_content)
+
+        # Add shots/samples. This helps model to mimic response and make sure they match rules laid out in system message.
+        message_builder.insert_message("assistant", self.answer)
+        message_builder.insert_message("user", self.question)
+        return message_builder.messages
@@ -0,0 +1,138 @@
+import hashlib
+import json
+import re
+import unicodedata
+from collections import OrderedDict
+from typing import Any, AsyncGenerator, Awaitable, Callable, Optional
+
+import numpy as np
+
+from .cache import CacheBackend
+
+# Overrides that change the generated answer. Security and category overrides are captured by the filter instead,
+# and speculative_embedding is left out since it only changes when the query is embedded, not the embedding used.
+ANSWER_OVERRIDES = (
+    "retrieval_mode",
+    "semantic_ranker",
+    "semantic_captions",
+    "top",
+    "temperature",
+    "prompt_template",
+    "suggest_followup_questions",
+    "query_variants",
+)
+
+
+def normalize_question(question: str) -> str:
+    question = unicodedata.normalize("NFC", question).lower()
+    question = re.sub(r"\s+", " ", question).strip()
+    return question.rstrip("?!. ")
+
+
+class AnswerCache:
+    """
+    Caches generated answers keyed on the normalized question, the search filter and the overrides that affect the
+    answer.
+    Lookups first try an exact match and then, if a similarity threshold and an embedding function are configured,
+    the most similar cached question asked with the same filter and overrides.
+    Streamed responses are stored as the list of events that were sent, so they can be replayed as a stream.
+    """
+
+    def __init__(
+        self,
+        backend: CacheBackend,
+        ttl: Optional[float] = 3600,
+        similarity_threshold: Optional[float] = None,
+        embed: Optional[Callable[[str], Awaitable[list[float]]]] = None,
+        max_similarity_entries: int = 1000,
+    ):
+        self.backend = backend
+        self.ttl = ttl
+        self.similarity_threshold = similarity_threshold
+        self.embed = embed
+        self.max_similarity_entries = max_similarity_entries
+        # Normalized question embeddings, grouped by scope (filter, overrides, history and response type)
+        self.similarity_index: dict[str, OrderedDict[str, np.ndarray]] = {}
+        self.hits = 0
+        self.similar_hits = 0
+        self.misses = 0
+
+    @property
+    def use_similarity(self) -> bool:
+        return self.similarity_threshold is not None and self.embed is not None
+
+    def build_scope(self, messages: list[dict], filter: Optional[str], overrides: dict[str, Any], stream: bool) -> str:
+        scope = {
+            "history": [
+                {"role": message["role"], "content": normalize_question(message["content"])}
+                for message in messages[:-1]
+            ],
+            "filter": filter,
+            "overrides": {key: overrides.get(key) for key in ANSWER_OVERRIDES},
+            "stream": stream,
+        }
+        return hashlib.sha256(json.dumps(scope, sort_keys=True).encode()).hexdigest()
+
+    def build_key(self, scope: str, question: str) -> str:
+        return hashlib.sha256(f"{scope}:{normalize_question(question)}".encode()).hexdigest()
+
+    async def get(self, scope: str, question: str) -> tuple[Optional[Any], Optional[str]]:
+        """
+        Returns the cached response and the tier that matched ("exact" or "similar"), or (None, None) on a miss.
+        """
+        cached = await self.backend.get(self.build_key(scope, question))
+        if cached is not None:
+            self.hits += 1
+            return json.loads(cached), "exact"
+        if self.use_similarity and scope in self.similarity_index:
+            key = await self.find_similar(scope, question)
+            if key is not None:
+                cached = await self.backend.get(key)
+                if cached is not None:
+                    self.similar_hits += 1
+                    return json.loads(cached), "similar"
+        self.misses += 1
+        return None, None
+
+    async def set(self, scope: str, question: str, response: Any):
+        key = self.build_key(scope, question)
+        await self.backend.set(key, json.dumps(response), self.ttl)
+        if self.use_similarity:
+            vectors = self.similarity_index.setdefault(scope, OrderedDict())
+            vectors[key] = await self.embed_normalized(question)
+            while len(vectors) > self.max_similarity_entries:
+                vectors.popitem(last=False)
+
+    async def embed_normalized(self, question: str) -> np.ndarray:
+        assert self.embed is not None
+        vector = np.asarray(await self.embed(normalize_question(question)), dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    async def find_similar(self, scope: str, question: str) -> Optional[str]:
+        assert self.similarity_threshold is not None
+        vectors = self.similarity_index[scope]
+        if not vectors:
+            return None
+        query_vector = await self.embed_normalized(question)
+        keys = list(vectors.keys())
+        similarities = np.stack(list(vectors.values())) @ query_vector
+        best = int(np.argmax(similarities))
+        if similarities[best] >= self.similarity_threshold:
+            return keys[best]
+        return None
+
+    async def record_stream(
+        self, scope: str, question: str, events: AsyncGenerator[dict[str, Any], None]
+    ) -> AsyncGenerator[dict[str, Any], None]:
+        """
+        Passes through a streamed response and caches the events once the stream completes without error.
+        """
+        recorded = []
+        async for event in events:
+            recorded.append(json.loads(json.dumps(event)))
+            yield event
+        await self.set(scope, question, recorded)
+
+    def get_stats(self) -> dict[str, Any]:
+        return {"hits": self.hits, "similar_hits": self.similar_hits, "misses": self.misses}
@@ -0,0 +1,104 @@
+from collections import OrderedDict
+from typing import Any, Optional
+
+from azure.search.documents.aio import SearchClient
+
+from .indexversion import IndexVersion
+
+
+class DocumentCache:
+    """
+    Bounded least-recently-used cache of the fields of search documents, keyed on the document key, so that
+    searches only return the keys of their hits and the fields are read from memory. Documents missing from the
+    cache are fetched with a single filtered search. The cache is cleared when the version of the index changes.
+    Attributes:
+        search_client (SearchClient): The client of the index the documents are read from.
+        fields (list): The fields of the documents that are cached.
+        index_version (IndexVersion): The version of the index.
+        key_field (str): The key field of the index.
+        max_entries (int): The number of documents kept in memory.
+    Methods:
+        resolve(self, results): Returns the search results with the cached fields of their documents.
+        get_stats(self): Returns cache statistics.
+    """
+
+    def __init__(
+        self,
+        search_client: SearchClient,
+        fields: list[str],
+        index_version: IndexVersion,
+        key_field: str = "id",
+        max_entries: int = 5000,
+    ):
+        self.search_client = search_client
+        self.fields = fields
+        self.index_version = index_version
+        self.key_field = key_field
+        self.max_entries = max_entries
+        self.entries: OrderedDict[str, dict[str, Any]] = OrderedDict()
+        self.version: Optional[str] = None
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    async def check_version(self):
+        """
+        Clears the cache if the version of the index changed since the last check.
+        """
+        version = await self.index_version.get()
+        if version != self.version:
+            if self.entries:
+                self.invalidations += 1
+            self.entries.clear()
+            self.version = version
+
+    async def resolve(self, results: list[dict[str, Any]]) -> list[dict[str, Any]]:
+        """
+        Returns the search results, in the same order, with the cached fields of their documents added. Results
+        whose documents are not in the index anymore are dropped.
+        """
+        await self.check_version()
+        keys = [result[self.key_field] for result in results]
+        missing = [key for key in dict.fromkeys(keys) if key not in self.entries]
+        self.hits += len(keys) - len(missing)
+        self.misses += len(missing)
+        if missing:
+            version = self.version
+            documents = await self.fetch(missing)
+            # Documents read while the index changed are returned but not cached
+            if version == self.version:
+                self.entries.update(documents)
+        else:
+            documents = {}
+
+        resolved = []
+        for result, key in zip(results, keys):
+            document: Optional[dict[str, Any]] = documents.get(key) or self.entries.get(key)
+            if document is None:
+                continue
+            if key in self.entries:
+                self.entries.move_to_end(key)
+            resolved.append({**result, **document})
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+        return resolved
+
+    async def fetch(self, keys: list[str]) -> dict[str, dict[str, Any]]:
+        # Keys of documents written by prepdocs only hold letters, digits, "_" and "-", so "," separates them
+        values = ",".join(keys).replace("'", "''")
+        results = await self.search_client.search(
+            "",
+            filter=f"search.in({self.key_field}, '{values}', ',')",
+            select=[self.key_field] + self.fields,
+            top=len(keys),
+        )
+        return {result[self.key_field]: {field: result.get(field) for field in self.fields} async for result in results}
+
+    def get_stats(self) -> dict[str, Any]:
+        return {
+            "entries": len(self.entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "invalidations": self.invalidations,
+            "version": self.version,
+        }
@@ -0,0 +1,128 @@
+import asyncio
+import re
+import unicodedata
+from array import array
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable
+
+
+class EmbeddingCache:
+    """
+    Bounded least-recently-used cache of text embeddings, keyed on the embedding model and the normalized text.
+    Vectors are stored as float32 arrays, which take a quarter of the memory of lists of Python floats.
+    Concurrent requests for the same text share a single in-flight embedding call, which keeps running for the
+    others when the request that started it is cancelled.
+    """
+
+    def __init__(self, max_entries: int = 2000):
+        self.max_entries = max_entries
+        self.entries: OrderedDict[tuple[str, str], array] = OrderedDict()
+        self.in_flight: dict[tuple[str, str], asyncio.Future] = {}
+        self.creations: set[asyncio.Task] = set()
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+
+    @staticmethod
+    def normalize_text(text: str) -> str:
+        return re.sub(r"\s+", " ", unicodedata.normalize("NFC", text)).strip()
+
+    async def get_or_create(
+        self, model: str, text: str, create: Callable[[str], Awaitable[list[float]]]
+    ) -> list[float]:
+        """
+        Returns the cached embedding for the text, calling create(text) to compute it on a miss.
+        """
+        text = self.normalize_text(text)
+        key = (model, text)
+        if (vector := self.entries.get(key)) is not None:
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return vector.tolist()
+        if (future := self.in_flight.get(key)) is not None:
+            self.coalesced += 1
+        else:
+            self.misses += 1
+
+            async def create_one() -> list[list[float]]:
+                return [await create(text)]
+
+            future = self.start_creation([key], create_one())[key]
+        return (await asyncio.shield(future)).tolist()
+
+    def start_creation(
+        self, keys: list[tuple[str, str]], create: Awaitable[list[list[float]]]
+    ) -> dict[tuple[str, str], asyncio.Future]:
+        """
+        Computes the embeddings of the keys in a task of their own, and returns the futures of their vectors.
+        The task is not cancelled when the caller that started it is, since other callers may be waiting on it.
+        """
+        loop = asyncio.get_running_loop()
+        futures = {key: loop.create_future() for key in keys}
+        self.in_flight.update(futures)
+
+        async def run():
+            try:
+                vectors = await create
+                if len(vectors) != len(keys):
+                    raise ValueError(f"Expected {len(keys)} embeddings, got {len(vectors)}")
+            except asyncio.CancelledError:
+                for future in futures.values():
+                    future.cancel()
+            except Exception as error:
+                for future in futures.values():
+                    future.set_exception(error)
+                    # Waiters see the exception; retrieve it here so it is not reported as never retrieved
+                    future.exception()
+            else:
+                for key, vector in zip(keys, vectors):
+                    self.entries[key] = array("f", vector)
+                    futures[key].set_result(self.entries[key])
+                while len(self.entries) > self.max_entries:
+                    self.entries.popitem(last=False)
+            finally:
+                for key in keys:
+                    del self.in_flight[key]
+
+        task = loop.create_task(run())
+        # The loop only keeps weak references to tasks
+        self.creations.add(task)
+        task.add_done_callback(self.creations.discard)
+        return futures
+
+    async def get_or_create_many(
+        self, model: str, texts: list[str], create_many: Callable[[list[str]], Awaitable[list[list[float]]]]
+    ) -> list[list[float]]:
+        """
+        Returns the cached embeddings of the texts, calling create_many(texts) once with the texts missing from the
+        cache, so that they are embedded in a single request.
+        """
+        keys = [(model, self.normalize_text(text)) for text in texts]
+        vectors: dict[tuple[str, str], array] = {}
+        futures: dict[tuple[str, str], asyncio.Future] = {}
+        missing = []
+        for key in dict.fromkeys(keys):
+            if (vector := self.entries.get(key)) is not None:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                vectors[key] = vector
+            elif (future := self.in_flight.get(key)) is not None:
+                self.coalesced += 1
+                futures[key] = future
+            else:
+                self.misses += 1
+                missing.append(key)
+
+        if missing:
+            futures.update(self.start_creation(missing, create_many([text for _, text in missing])))
+        for key, future in futures.items():
+            vectors[key] = await asyncio.shield(future)
+        return [vectors[key].tolist() for key in keys]
+
+    def get_stats(self) -> dict[str, Any]:
+        return {
+            "entries": len(self.entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "coalesced": self.coalesced,
+        }
@@ -0,0 +1,39 @@
+import asyncio
+import logging
+import time
+from typing import Awaitable, Callable, Optional
+
+# Name of the blob written by prepdocs every time it changes the index, its ETag is the version of the index
+INDEX_VERSION_BLOB_NAME = "index-version"
+
+
+class IndexVersion:
+    """
+    Version of the search index, shared by the caches of search documents and results so that they are cleared when
+    prepdocs changes the index. The version is read at most every check_interval seconds, and the last version read
+    is kept until the next check when reading fails.
+    Attributes:
+        get_version (Callable): Returns the current version of the index, or None if it is not known.
+        check_interval (float): Seconds between reads of the version.
+    Methods:
+        get(self): Returns the version of the index, reading it if it was last read more than check_interval ago.
+    """
+
+    def __init__(self, get_version: Callable[[], Awaitable[Optional[str]]], check_interval: float = 30):
+        self.get_version = get_version
+        self.check_interval = check_interval
+        self.version: Optional[str] = None
+        self.next_check = 0.0
+        self._lock = asyncio.Lock()
+
+    async def get(self) -> Optional[str]:
+        if time.monotonic() < self.next_check:
+            return self.version
+        async with self._lock:
+            if time.monotonic() >= self.next_check:
+                try:
+                    self.version = await self.get_version()
+                except Exception:
+                    logging.exception("Failed to read the index version, keeping version %s", self.version)
+                self.next_check = time.monotonic() + self.check_interval
+        return self.version
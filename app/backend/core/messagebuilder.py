@@ -1,6 +1,9 @@
+import logging
 import unicodedata
+from abc import ABC
+from typing import Callable, Optional
 
-from .modelhelper import num_tokens_from_messages
+from .modelhelper import num_tokens_from_messages, num_tokens_from_messages_batch
 
 
 class MessageBuilder:
@@ -30,8 +33,187 @@ class MessageBuilder:
         """
         self.messages.insert(index, {"role": role, "content": self.normalize_content(content)})
 
+    def append_message(self, role: str, content: str):
+        """
+        Appends a message to the end of the conversation.
+        Args:
+            role (str): The role of the message sender (either "user", "assistant" or "system").
+            content (str): The content of the message.
+        """
+        self.messages.append({"role": role, "content": self.normalize_content(content)})
+
     def count_tokens_for_message(self, message: dict[str, str]):
         return num_tokens_from_messages(message, self.model)
 
     def normalize_content(self, content: str):
         return unicodedata.normalize("NFC", content)
+
+
+class TruncationPolicy(ABC):
+    """
+    Decides which past messages are sent to the model when the whole history does not fit in the token budget.
+    """
+
+    def select(
+        self, history: list[dict[str, str]], token_counts: list[int], max_tokens: int, model: str
+    ) -> list[dict[str, str]]:
+        """
+        Returns the messages to send, oldest first, whose token counts add up to at most max_tokens.
+        Args:
+            history (list): The past messages, oldest first.
+            token_counts (list): The pre-counted number of tokens of each message in history.
+            max_tokens (int): The number of tokens available for history.
+            model (str): The name of the ChatGPT model, used to count tokens of any new messages.
+        """
+        raise NotImplementedError
+
+
+class NewestFirstPolicy(TruncationPolicy):
+    """
+    Keeps the most recent messages that fit, dropping everything older than the first message that does not fit.
+    """
+
+    def select(
+        self, history: list[dict[str, str]], token_counts: list[int], max_tokens: int, model: str
+    ) -> list[dict[str, str]]:
+        start = len(history)
+        total_token_count = 0
+        while start > 0 and total_token_count + token_counts[start - 1] <= max_tokens:
+            start -= 1
+            total_token_count += token_counts[start]
+        if start > 0:
+            logging.debug("Reached max tokens of %d, history will be truncated", max_tokens)
+        return history[start:]
+
+
+class KeepFirstLastPolicy(TruncationPolicy):
+    """
+    Keeps the first N messages, which usually set up the topic of the conversation, and then the most recent
+    messages up to M, as long as they fit.
+    """
+
+    def __init__(self, keep_first: int = 2, keep_last: int = 8):
+        self.keep_first = keep_first
+        self.keep_last = keep_last
+
+    def select(
+        self, history: list[dict[str, str]], token_counts: list[int], max_tokens: int, model: str
+    ) -> list[dict[str, str]]:
+        first_count = 0
+        total_token_count = 0
+        while (
+            first_count < min(self.keep_first, len(history))
+            and total_token_count + token_counts[first_count] <= max_tokens
+        ):
+            total_token_count += token_counts[first_count]
+            first_count += 1
+        start = len(history)
+        while (
+            start > first_count
+            and len(history) - start < self.keep_last
+            and total_token_count + token_counts[start - 1] <= max_tokens
+        ):
+            start -= 1
+            total_token_count += token_counts[start]
+        return history[:first_count] + history[start:]
+
+
+def summarize_messages(messages: list[dict[str, str]]) -> str:
+    """
+    Extractive summary of messages: the first sentence of each message, prefixed with its role.
+    """
+    lines = []
+    for message in messages:
+        first_sentence = message["content"].strip().split("\n")[0].split(". ")[0]
+        lines.append(f"{message['role']}: {first_sentence}")
+    return "Summary of the earlier conversation:\n" + "\n".join(lines)
+
+
+class SummarizeOldestPolicy(TruncationPolicy):
+    """
+    Keeps the most recent messages that fit, and replaces the older messages with a single summary message
+    if there is budget left for it. The summary covers as many of the most recent dropped messages as fit,
+    found with a binary search so that long histories are summarized O(log n) times.
+    """
+
+    def __init__(self, summarize: Callable[[list[dict[str, str]]], str] = summarize_messages, role: str = "system"):
+        self.summarize = summarize
+        self.role = role
+
+    def select(
+        self, history: list[dict[str, str]], token_counts: list[int], max_tokens: int, model: str
+    ) -> list[dict[str, str]]:
+        kept = NewestFirstPolicy().select(history, token_counts, max_tokens, model)
+        dropped = history[: len(history) - len(kept)]
+        remaining_tokens = max_tokens - sum(token_counts[len(dropped) :])
+        best_summary = None
+        low, high = 0, len(dropped) - 1
+        while low <= high:
+            start = (low + high) // 2
+            summary = {"role": self.role, "content": self.summarize(dropped[start:])}
+            if num_tokens_from_messages(summary, model) <= remaining_tokens:
+                best_summary = summary
+                high = start - 1
+            else:
+                low = start + 1
+        return [best_summary] + kept if best_summary else kept
+
+
+class HistoryPacker:
+    """
+    Builds the list of messages sent to the model from a system prompt, few-shot examples, the conversation
+    history and the new user message, in a single pass over pre-counted token lengths.
+    Attributes:
+        model (str): The name of the ChatGPT model.
+        policy (TruncationPolicy): Decides which history messages to keep when they do not all fit.
+    Methods:
+        pack(self, system_prompt, history, user_content, max_tokens, few_shots): Returns the packed messages.
+    """
+
+    def __init__(self, model: str, policy: Optional[TruncationPolicy] = None):
+        self.model = model
+        self.policy = policy or NewestFirstPolicy()
+
+    def pack(
+        self,
+        system_prompt: str,
+        history: list[dict[str, str]],
+        user_content: str,
+        max_tokens: int,
+        few_shots: list[dict[str, str]] = [],
+        history_token_counts: Optional[list[int]] = None,
+    ) -> list[dict[str, str]]:
+        """
+        Args:
+            system_prompt (str): The system message.
+            history (list): The past messages, oldest first, not including the new user message.
+            user_content (str): The content of the new user message, sent last.
+            max_tokens (int): The token budget for the new user message and the history.
+            few_shots (list): Example messages sent right after the system message.
+            history_token_counts (list): The already known token counts of the first messages of history,
+                only the remaining messages are tokenized.
+        """
+        message_builder = MessageBuilder(system_prompt, self.model)
+        for shot in few_shots:
+            message_builder.append_message(shot["role"], shot["content"])
+
+        user_message = {"role": "user", "content": message_builder.normalize_content(user_content)}
+        known_token_counts = (history_token_counts or [])[: len(history)]
+        user_token_count, *new_token_counts = num_tokens_from_messages_batch(
+            [user_message] + history[len(known_token_counts) :], self.model
+        )
+        token_counts = known_token_counts + new_token_counts
+        for message in self.policy.select(history, token_counts, max_tokens - user_token_count, self.model):
+            message_builder.append_message(message["role"], message["content"])
+        message_builder.messages.append(user_message)
+        return message_builder.messages
+
+
+def create_truncation_policy(name: str, keep_first: int = 2, keep_last: int = 8) -> TruncationPolicy:
+    if name == "newest_first":
+        return NewestFirstPolicy()
+    if name == "summarize_oldest":
+        return SummarizeOldestPolicy()
+    if name == "keep_first_last":
+        return KeepFirstLastPolicy(keep_first=keep_first, keep_last=keep_last)
+    raise ValueError(f"Unknown history truncation policy {name}")
@@ -1,5 +1,8 @@
 from __future__ import annotations
 
+from collections import OrderedDict
+from functools import lru_cache
+
 import tiktoken
 
 MODELS_2_TOKEN_LIMITS = {
@@ -13,6 +16,11 @@ MODELS_2_TOKEN_LIMITS = {
 
 AOAI_2_OAI = {"gpt-35-turbo": "gpt-3.5-turbo", "gpt-35-turbo-16k": "gpt-3.5-turbo-16k"}
 
+# Token counts of recently seen strings (system prompts, few-shots and the history resent every turn), keyed on
+# (model, text)
+TOKEN_COUNT_CACHE_SIZE = 4096
+token_count_cache: OrderedDict[tuple[str, str], int] = OrderedDict()
+
 
 def get_token_limit(model_id: str) -> int:
     if model_id not in MODELS_2_TOKEN_LIMITS:
@@ -20,6 +28,48 @@ def get_token_limit(model_id: str) -> int:
     return MODELS_2_TOKEN_LIMITS[model_id]
 
 
+@lru_cache(maxsize=None)
+def get_encoding(model: str) -> tiktoken.Encoding:
+    """
+    Resolve the tiktoken encoding for a model once, instead of on every token count.
+    """
+    return tiktoken.encoding_for_model(get_oai_chatmodel_tiktok(model))
+
+
+def num_tokens_from_texts(
+    texts: list[str],
+    model: str,
+    cache: OrderedDict[tuple[str, str], int] | None = None,
+    max_entries: int | None = None,
+) -> list[int]:
+    """
+    Calculate the number of tokens in each text, reusing memoized counts and encoding the remaining texts in one batch.
+    Counts are memoized in the shared token count cache, unless another cache and its size are given.
+    """
+    if cache is None:
+        cache, max_entries = token_count_cache, TOKEN_COUNT_CACHE_SIZE
+    counts: dict[str, int] = {}
+    missing: list[str] = []
+    for text in texts:
+        key = (model, text)
+        if key in cache:
+            cache.move_to_end(key)
+            counts[text] = cache[key]
+        elif text not in counts:
+            counts[text] = 0
+            missing.append(text)
+    if missing:
+        encoding = get_encoding(model)
+        # encode_batch encodes in a thread pool, which only pays off for more than one text
+        encoded = encoding.encode_batch(missing) if len(missing) > 1 else [encoding.encode(missing[0])]
+        for text, tokens in zip(missing, encoded):
+            counts[text] = len(tokens)
+            cache[(model, text)] = len(tokens)
+        while max_entries is not None and len(cache) > max_entries:
+            cache.popitem(last=False)
+    return [counts[text] for text in texts]
+
+
 def num_tokens_from_messages(message: dict[str, str], model: str) -> int:
     """
     Calculate the number of tokens required to encode a message.
@@ -34,11 +84,18 @@ def num_tokens_from_messages(message: dict[str, str], model: str) -> int:
         num_tokens_from_messages(message, model)
         output: 11
     """
-    encoding = tiktoken.encoding_for_model(get_oai_chatmodel_tiktok(model))
-    num_tokens = 2  # For "role" and "content" keys
-    for key, value in message.items():
-        num_tokens += len(encoding.encode(value))
-    return num_tokens
+    return num_tokens_from_messages_batch([message], model)[0]
+
+
+def num_tokens_from_messages_batch(messages: list[dict[str, str]], model: str) -> list[int]:
+    """
+    Calculate the number of tokens required to encode each of a list of messages.
+    Only message values that have not been counted recently are encoded.
+    """
+    values = [value for message in messages for value in message.values()]
+    value_counts = iter(num_tokens_from_texts(values, model))
+    # 2 tokens for the "role" and "content" keys
+    return [2 + sum(next(value_counts) for _ in message) for message in messages]
 
 
 def get_oai_chatmodel_tiktok(aoaimodel: str) -> str:
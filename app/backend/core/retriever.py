@@ -0,0 +1,386 @@
+import asyncio
+import logging
+import time
+from typing import Any, NamedTuple, Optional, Protocol
+
+import openai
+from azure.search.documents.models import QueryType
+
+from text import nonewlines
+
+from .documentcache import DocumentCache
+from .embeddingcache import EmbeddingCache
+from .searchcache import SearchResultCache
+from .sourcepacker import SourcePacker
+
+RETRIEVAL_STAGES = ("embedding", "search", "fusion", "documents", "sources", "packing")
+# Constant of reciprocal rank fusion, which keeps the first ranks of a single list from dominating the fused ranking
+RRF_K = 60
+
+
+class SearchBackend(Protocol):
+    """
+    The part of azure.search.documents.aio.SearchClient used for retrieval, also implemented by LocalSearchClient.
+    """
+
+    async def search(self, search_text: Optional[str] = None, **kwargs: Any) -> Any: ...
+
+
+class Retrieval(NamedTuple):
+    """
+    Result of a retrieval: the search results, the sources built from them for the prompt, and the milliseconds
+    spent in each stage. When the sources were packed into a token budget, also the number of candidates they were
+    chosen from, the tokens they take and the budget.
+    """
+
+    docs: list[dict[str, Any]]
+    sources: list[str]
+    timings: dict[str, float]
+    candidates: Optional[int] = None
+    source_tokens: Optional[int] = None
+    token_budget: Optional[int] = None
+
+
+class QueryVariant(NamedTuple):
+    """
+    A variant of a query searched by a fan-out retrieval: how long its search took, how many results it returned
+    and how many of them were kept in the fused results.
+    """
+
+    query: str
+    search_ms: float
+    results: int
+    contributed: int
+
+
+class StageTimer:
+    """
+    Records the milliseconds spent in consecutive stages.
+    """
+
+    def __init__(self):
+        self.timings: dict[str, float] = {}
+        self.start = time.perf_counter()
+
+    def record(self, stage: str):
+        now = time.perf_counter()
+        self.timings[stage] = (now - self.start) * 1000
+        self.start = now
+
+
+class Retriever:
+    """
+    Retrieves the sources of an answer: embeds the query, searches the index, resolves the results through the
+    document cache and formats them as sources, with the ranking options requested in the overrides. The approaches
+    delegate to it, so retrieval changes apply to all of them. The time spent in each stage is logged and aggregated.
+    Attributes:
+        search_client (SearchBackend): The index that is searched.
+        openai_host (str): The OpenAI host, "azure" or "openai".
+        embedding_deployment (Optional[str]): The deployment of the embedding model, not needed for non-Azure OpenAI.
+        embedding_model (str): The embedding model.
+        sourcepage_field (str): The field holding the name of the source.
+        content_field (str): The field holding the content of the source.
+        query_language (str): The query language of the semantic ranker.
+        query_speller (str): The query speller of the semantic ranker.
+        embedding_cache (Optional[EmbeddingCache]): Cache of query embeddings.
+        document_cache (Optional[DocumentCache]): Cache of the fields of the search results.
+        search_cache (Optional[SearchResultCache]): Cache of the search results.
+        key_field (str): The key field of the index, used to deduplicate the results of query variants.
+        source_packer (Optional[SourcePacker]): Packs the sources into a token budget instead of keeping the top
+            results.
+    Methods:
+        compute_embedding(self, text): Returns the embedding of the text.
+        compute_timed_embedding(self, text): Returns the embedding of the text and the milliseconds it took.
+        compute_embeddings(self, texts): Returns the embeddings of the texts, computed in a single request.
+        retrieve(self, query_text, overrides, filter, query_vector=None, token_budget=None): Returns the results of
+            the query.
+        retrieve_variants(self, query_texts, overrides, filter, token_budget=None): Searches variants of a query
+            concurrently and returns their results merged with reciprocal rank fusion.
+        get_stats(self): Returns timing statistics of each stage.
+    """
+
+    def __init__(
+        self,
+        search_client: SearchBackend,
+        openai_host: str,
+        embedding_deployment: Optional[str],  # Not needed for non-Azure OpenAI or for retrieval_mode="text"
+        embedding_model: str,
+        sourcepage_field: str,
+        content_field: str,
+        query_language: str,
+        query_speller: str,
+        embedding_cache: Optional[EmbeddingCache] = None,
+        document_cache: Optional[DocumentCache] = None,
+        search_cache: Optional[SearchResultCache] = None,
+        key_field: str = "id",
+        source_packer: Optional[SourcePacker] = None,
+    ):
+        self.search_client = search_client
+        self.openai_host = openai_host
+        self.embedding_deployment = embedding_deployment
+        self.embedding_model = embedding_model
+        self.sourcepage_field = sourcepage_field
+        self.content_field = content_field
+        self.query_language = query_language
+        self.query_speller = query_speller
+        self.embedding_cache = embedding_cache
+        self.document_cache = document_cache
+        self.search_cache = search_cache
+        self.key_field = document_cache.key_field if document_cache else key_field
+        self.source_packer = source_packer
+        self.retrievals = 0
+        self.stage_counts = {stage: 0 for stage in RETRIEVAL_STAGES}
+        self.stage_total_ms = {stage: 0.0 for stage in RETRIEVAL_STAGES}
+        self.stage_max_ms = {stage: 0.0 for stage in RETRIEVAL_STAGES}
+
+    async def compute_embedding(self, text: str) -> list[float]:
+        embedding_args = {"deployment_id": self.embedding_deployment} if self.openai_host == "azure" else {}
+
+        async def create_embedding(text: str) -> list[float]:
+            embedding = await openai.Embedding.acreate(**embedding_args, model=self.embedding_model, input=text)
+            return embedding["data"][0]["embedding"]
+
+        if self.embedding_cache is None:
+            return await create_embedding(text)
+        return await self.embedding_cache.get_or_create(self.embedding_model, text, create_embedding)
+
+    async def compute_timed_embedding(self, text: str) -> tuple[list[float], float]:
+        start = time.perf_counter()
+        embedding = await self.compute_embedding(text)
+        return embedding, (time.perf_counter() - start) * 1000
+
+    async def compute_embeddings(self, texts: list[str]) -> list[list[float]]:
+        embedding_args = {"deployment_id": self.embedding_deployment} if self.openai_host == "azure" else {}
+
+        async def create_embeddings(texts: list[str]) -> list[list[float]]:
+            embedding = await openai.Embedding.acreate(**embedding_args, model=self.embedding_model, input=texts)
+            return [item["embedding"] for item in sorted(embedding["data"], key=lambda item: item["index"])]
+
+        if self.embedding_cache is None:
+            return await create_embeddings(texts)
+        return await self.embedding_cache.get_or_create_many(self.embedding_model, texts, create_embeddings)
+
+    async def search(
+        self,
+        query_text: Optional[str],
+        query_vector: Optional[list[float]],
+        filter: Optional[str],
+        top: int,
+        use_semantic_ranker: bool,
+        use_semantic_captions: bool,
+        select_key: bool = False,
+    ) -> list[dict[str, Any]]:
+        # Only return the fields used to build the sources, or only the keys of the hits if the document cache
+        # holds the fields
+        if self.document_cache:
+            select = [self.key_field]
+        elif select_key:
+            select = [self.key_field, self.sourcepage_field, self.content_field]
+        else:
+            select = [self.sourcepage_field, self.content_field]
+
+        async def search() -> list[dict[str, Any]]:
+            if use_semantic_ranker:
+                r = await self.search_client.search(
+                    query_text,
+                    filter=filter,
+                    query_type=QueryType.SEMANTIC,
+                    query_language=self.query_language,
+                    query_speller=self.query_speller,
+                    semantic_configuration_name="default",
+                    top=top,
+                    query_caption="extractive|highlight-false" if use_semantic_captions else None,
+                    vector=query_vector,
+                    top_k=50 if query_vector else None,
+                    vector_fields="embedding" if query_vector else None,
+                    select=select,
+                )
+            else:
+                r = await self.search_client.search(
+                    query_text,
+                    filter=filter,
+                    top=top,
+                    vector=query_vector,
+                    top_k=50 if query_vector else None,
+                    vector_fields="embedding" if query_vector else None,
+                    select=select,
+                )
+            return [doc async for doc in r]
+
+        if self.search_cache is None:
+            return await search()
+        options = {
+            "semantic_ranker": use_semantic_ranker,
+            "semantic_captions": use_semantic_captions,
+            "query_language": self.query_language,
+            "query_speller": self.query_speller,
+            "select": select,
+        }
+        return await self.search_cache.get_or_search(search, query_text, query_vector, filter, top, options)
+
+    def get_sources(self, docs: list[dict[str, Any]], use_semantic_captions: bool) -> list[str]:
+        if use_semantic_captions:
+            return [
+                doc[self.sourcepage_field] + ": " + nonewlines(" . ".join([c.text for c in doc["@search.captions"]]))
+                for doc in docs
+            ]
+        return [doc[self.sourcepage_field] + ": " + nonewlines(doc[self.content_field]) for doc in docs]
+
+    async def retrieve(
+        self,
+        query_text: str,
+        overrides: dict[str, Any],
+        filter: Optional[str],
+        query_vector: Optional[list[float]] = None,
+        token_budget: Optional[int] = None,
+    ) -> Retrieval:
+        """
+        Searches for the query with the retrieval mode, top and ranking options of the overrides. The query is
+        embedded if the retrieval mode includes vectors, unless its embedding is given. If there is a source packer,
+        more candidates are fetched and the sources are packed into the token budget, the tokens left in the prompt.
+        """
+        has_text = overrides.get("retrieval_mode") in ["text", "hybrid", None]
+        has_vector = overrides.get("retrieval_mode") in ["vectors", "hybrid", None]
+        # Use semantic ranker if requested and if retrieval mode is text or hybrid (vectors + text)
+        use_semantic_ranker = bool(overrides.get("semantic_ranker") and has_text)
+        use_semantic_captions = bool(overrides.get("semantic_captions") and has_text)
+        top = self.get_top(overrides)
+        timer = StageTimer()
+
+        if not has_vector:
+            query_vector = None
+        elif query_vector is None:
+            query_vector = await self.compute_embedding(query_text)
+            timer.record("embedding")
+
+        # Only keep the text query if the retrieval mode uses text, otherwise drop it
+        docs = await self.search(
+            query_text if has_text else None, query_vector, filter, top, use_semantic_ranker, use_semantic_captions
+        )
+        timer.record("search")
+        return await self.finish(docs, use_semantic_captions, timer, token_budget)
+
+    async def retrieve_variants(
+        self,
+        query_texts: list[str],
+        overrides: dict[str, Any],
+        filter: Optional[str],
+        token_budget: Optional[int] = None,
+    ) -> tuple[Retrieval, list[QueryVariant]]:
+        """
+        Searches for variants of a query, like retrieve does for a single query. The variants are embedded in a
+        single request and searched concurrently, and their results are merged with reciprocal rank fusion, keeping
+        the top results of the overrides once each.
+        """
+        has_text = overrides.get("retrieval_mode") in ["text", "hybrid", None]
+        has_vector = overrides.get("retrieval_mode") in ["vectors", "hybrid", None]
+        use_semantic_ranker = bool(overrides.get("semantic_ranker") and has_text)
+        use_semantic_captions = bool(overrides.get("semantic_captions") and has_text)
+        top = self.get_top(overrides)
+        timer = StageTimer()
+
+        query_vectors: list[Optional[list[float]]] = [None] * len(query_texts)
+        if has_vector:
+            query_vectors = list(await self.compute_embeddings(query_texts))
+            timer.record("embedding")
+
+        async def timed_search(query_text: str, query_vector: Optional[list[float]]) -> tuple[list[dict], float]:
+            start = time.perf_counter()
+            docs = await self.search(
+                query_text if has_text else None,
+                query_vector,
+                filter,
+                top,
+                use_semantic_ranker,
+                use_semantic_captions,
+                select_key=True,
+            )
+            return docs, (time.perf_counter() - start) * 1000
+
+        searches = await asyncio.gather(*map(timed_search, query_texts, query_vectors))
+        timer.record("search")
+
+        scores: dict[Any, float] = {}
+        fused: dict[Any, dict[str, Any]] = {}
+        sources: dict[Any, list[int]] = {}
+        for variant, (docs, _) in enumerate(searches):
+            for rank, doc in enumerate(docs, start=1):
+                key = doc[self.key_field]
+                scores[key] = scores.get(key, 0.0) + 1 / (RRF_K + rank)
+                fused.setdefault(key, doc)
+                sources.setdefault(key, []).append(variant)
+        # Sorting is stable, so results with equal scores keep the order they were first found in
+        keys = sorted(scores, key=lambda key: scores[key], reverse=True)[:top]
+        contributions = [0] * len(query_texts)
+        for key in keys:
+            for variant in sources[key]:
+                contributions[variant] += 1
+        timer.record("fusion")
+
+        variants = [
+            QueryVariant(query_text, search_ms, len(docs), contributed)
+            for query_text, (docs, search_ms), contributed in zip(query_texts, searches, contributions)
+        ]
+        retrieval = await self.finish([fused[key] for key in keys], use_semantic_captions, timer, token_budget)
+        return retrieval, variants
+
+    def get_top(self, overrides: dict[str, Any]) -> int:
+        top = overrides.get("top", 3)
+        # Fetch more candidates than the top results when the sources are packed into a token budget
+        return max(top, self.source_packer.candidates) if self.source_packer else top
+
+    async def finish(
+        self,
+        docs: list[dict[str, Any]],
+        use_semantic_captions: bool,
+        timer: StageTimer,
+        token_budget: Optional[int],
+    ) -> Retrieval:
+        if self.document_cache:
+            docs = await self.document_cache.resolve(docs)
+            timer.record("documents")
+        sources = self.get_sources(docs, use_semantic_captions)
+        timer.record("sources")
+
+        if self.source_packer is None:
+            self.record_timings(timer.timings)
+            return Retrieval(docs, sources, timer.timings)
+        token_budget = self.source_packer.get_budget(token_budget)
+        kept, source_tokens = self.source_packer.pack(sources, token_budget)
+        timer.record("packing")
+        self.record_timings(timer.timings)
+        return Retrieval(
+            [docs[index] for index in kept],
+            [sources[index] for index in kept],
+            timer.timings,
+            candidates=len(docs),
+            source_tokens=source_tokens,
+            token_budget=token_budget,
+        )
+
+    def record_timings(self, timings: dict[str, float]):
+        self.retrievals += 1
+        for stage, ms in timings.items():
+            self.stage_counts[stage] += 1
+            self.stage_total_ms[stage] += ms
+            self.stage_max_ms[stage] = max(self.stage_max_ms[stage], ms)
+        logging.debug(
+            "Retrieval took %.1f ms (%s)",
+            sum(timings.values()),
+            ", ".join(f"{stage} {ms:.1f} ms" for stage, ms in timings.items()),
+            extra={"retrieval_timings": timings},
+        )
+
+    def get_stats(self) -> dict[str, Any]:
+        return {
+            "retrievals": self.retrievals,
+            "stages": {
+                stage: {
+                    "count": self.stage_counts[stage],
+                    "mean_ms": round(self.stage_total_ms[stage] / self.stage_counts[stage], 3),
+                    "max_ms": round(self.stage_max_ms[stage], 3),
+                }
+                for stage in RETRIEVAL_STAGES
+                if self.stage_counts[stage]
+            },
+        }
@@ -0,0 +1,126 @@
+import re
+from abc import ABC
+from typing import Any
+
+# Words that usually refer back to earlier turns, so the question can't be searched for on its own
+REFERRING_WORDS = {
+    "it",
+    "its",
+    "they",
+    "them",
+    "their",
+    "that",
+    "this",
+    "those",
+    "these",
+    "he",
+    "she",
+    "him",
+    "her",
+    "one",
+    "ones",
+    "same",
+    "above",
+    "previous",
+    "else",
+}
+
+
+class QueryRewritePolicy(ABC):
+    """
+    Decides for each request whether to ask the model to rewrite the user's question into a search query,
+    and keeps a moving average of how long the rewrite takes, to estimate the time saved when it is skipped.
+    """
+
+    name = ""
+
+    def __init__(self):
+        self.average_latency_ms: float = 0.0
+        self.latency_samples = 0
+
+    def should_rewrite(self, history: list[dict[str, str]]) -> tuple[bool, str]:
+        """
+        Returns whether to rewrite the last user message in the history, and the reason for the decision.
+        """
+        raise NotImplementedError
+
+    def record_latency(self, latency_ms: float, weight: float = 0.1):
+        self.latency_samples += 1
+        if self.latency_samples == 1:
+            self.average_latency_ms = latency_ms
+        else:
+            self.average_latency_ms += weight * (latency_ms - self.average_latency_ms)
+
+    def describe(self, rewritten: bool, reason: str) -> dict[str, Any]:
+        return {
+            "policy": self.name,
+            "rewritten": rewritten,
+            "reason": reason,
+            "estimated_ms_saved": 0 if rewritten else round(self.average_latency_ms),
+        }
+
+    @staticmethod
+    def is_follow_up(history: list[dict[str, str]]) -> bool:
+        return any(message["role"] != "system" for message in history[:-1])
+
+
+class AlwaysRewritePolicy(QueryRewritePolicy):
+    name = "always"
+
+    def should_rewrite(self, history: list[dict[str, str]]) -> tuple[bool, str]:
+        return True, "always rewrite"
+
+
+class SkipFirstTurnPolicy(QueryRewritePolicy):
+    """
+    Rewrites follow-up questions, which need the history to be understood, and searches for first questions as asked.
+    """
+
+    name = "skip_first_turn"
+
+    def should_rewrite(self, history: list[dict[str, str]]) -> tuple[bool, str]:
+        if self.is_follow_up(history):
+            return True, "follow-up question"
+        return False, "first question"
+
+
+class HeuristicRewritePolicy(QueryRewritePolicy):
+    """
+    Rewrites questions that are likely to search badly as asked: follow-ups that refer back to earlier turns or
+    are too short to stand alone, questions that are too long and chatty for a keyword search, and questions
+    that are mostly non-ASCII, which the rewrite translates to English.
+    """
+
+    name = "heuristic"
+
+    def __init__(self, min_follow_up_words: int = 4, max_words: int = 25, max_non_ascii_ratio: float = 0.3):
+        super().__init__()
+        self.min_follow_up_words = min_follow_up_words
+        self.max_words = max_words
+        self.max_non_ascii_ratio = max_non_ascii_ratio
+
+    def should_rewrite(self, history: list[dict[str, str]]) -> tuple[bool, str]:
+        question = history[-1]["content"]
+        words = re.findall(r"\w+", question.lower())
+        letters = [character for character in question if character.isalpha()]
+        if letters and sum(not character.isascii() for character in letters) / len(letters) > self.max_non_ascii_ratio:
+            return True, "question may not be in English"
+        if len(words) > self.max_words:
+            return True, "long question"
+        if self.is_follow_up(history):
+            if REFERRING_WORDS.intersection(words):
+                return True, "follow-up question refers to earlier turns"
+            if len(words) < self.min_follow_up_words:
+                return True, "short follow-up question"
+            return False, "follow-up question stands alone"
+        return False, "first question"
+
+
+def create_rewrite_policy(name: str) -> QueryRewritePolicy:
+    if name == "always":
+        return AlwaysRewritePolicy()
+    if name == "skip_first_turn":
+        return SkipFirstTurnPolicy()
+    if name == "heuristic":
+        return HeuristicRewritePolicy()
+    raise ValueError(f"Unknown query rewrite policy {name}")
@@ -0,0 +1,133 @@
+import hashlib
+import json
+from typing import Any, Awaitable, Callable, NamedTuple, Optional
+
+import numpy as np
+
+from .cache import CacheBackend
+from .indexversion import IndexVersion
+
+
+class CachedCaption(NamedTuple):
+    """
+    Caption of a cached search result, read like the captions of the results returned by the search client.
+    """
+
+    text: Optional[str]
+    highlights: Optional[str]
+
+
+class SearchResultCache:
+    """
+    Caches the results of search queries, so that repeated questions do not query the search service (and its
+    semantic ranker) again. Results are keyed on the query text, a hash of the query vector rounded to vector_decimals
+    decimals, the filter, top and the ranking options. The filter holds the security filter of the user, so results
+    are never shared between users with different access. Keys include the version of the index, and the backend is
+    cleared when the version changes.
+    Attributes:
+        backend (CacheBackend): The store of the cached results.
+        index_version (IndexVersion): The version of the index.
+        ttl (float): Seconds the results are cached for.
+        vector_decimals (int): The number of decimals the query vector is rounded to before it is hashed.
+    Methods:
+        get_or_search(self, search, query_text, query_vector, filter, top, options): Returns the cached results of
+            the query, or runs the search and caches its results.
+        get_stats(self): Returns cache statistics.
+    """
+
+    def __init__(
+        self,
+        backend: CacheBackend,
+        index_version: IndexVersion,
+        ttl: Optional[float] = 3600,
+        vector_decimals: int = 4,
+    ):
+        self.backend = backend
+        self.index_version = index_version
+        self.ttl = ttl
+        self.vector_decimals = vector_decimals
+        self.version: Optional[str] = None
+        self.version_read = False
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def hash_vector(self, vector: Optional[list[float]]) -> Optional[str]:
+        if vector is None:
+            return None
+        # Adding 0.0 turns the -0.0 left by rounding small negative values into 0.0
+        rounded = np.round(np.asarray(vector, dtype=np.float32), self.vector_decimals) + np.float32(0.0)
+        return hashlib.sha256(rounded.tobytes()).hexdigest()
+
+    def build_key(
+        self,
+        version: Optional[str],
+        query_text: Optional[str],
+        query_vector: Optional[list[float]],
+        filter: Optional[str],
+        top: int,
+        options: dict[str, Any],
+    ) -> str:
+        query = {
+            "text": query_text,
+            "vector": self.hash_vector(query_vector),
+            "filter": filter,
+            "top": top,
+            "options": options,
+        }
+        return f"{version}:{hashlib.sha256(json.dumps(query, sort_keys=True).encode()).hexdigest()}"
+
+    async def check_version(self) -> Optional[str]:
+        version = await self.index_version.get()
+        if self.version_read and version != self.version:
+            self.invalidations += 1
+            await self.backend.clear()
+        self.version = version
+        self.version_read = True
+        return version
+
+    async def get_or_search(
+        self,
+        search: Callable[[], Awaitable[list[dict[str, Any]]]],
+        query_text: Optional[str],
+        query_vector: Optional[list[float]],
+        filter: Optional[str],
+        top: int,
+        options: dict[str, Any],
+    ) -> list[dict[str, Any]]:
+        """
+        Returns the cached results of the query, or runs search and caches the results it returns.
+        """
+        version = await self.check_version()
+        key = self.build_key(version, query_text, query_vector, filter, top, options)
+        cached = await self.backend.get(key)
+        if cached is not None:
+            self.hits += 1
+            return self.load(cached)
+        self.misses += 1
+        results = await search()
+        await self.backend.set(key, self.dump(results), self.ttl)
+        return results
+
+    def dump(self, results: list[dict[str, Any]]) -> str:
+        return json.dumps(
+            [
+                {
+                    **result,
+                    "@search.captions": [
+                        {"text": caption.text, "highlights": caption.highlights}
+                        for caption in result.get("@search.captions") or []
+                    ],
+                }
+                for result in results
+            ]
+        )
+
+    def load(self, cached: str) -> list[dict[str, Any]]:
+        return [
+            {**result, "@search.captions": [CachedCaption(**caption) for caption in result["@search.captions"]]}
+            for result in json.loads(cached)
+        ]
+
+    def get_stats(self) -> dict[str, Any]:
+        return {"hits": self.hits, "misses": self.misses, "invalidations": self.invalidations, "version": self.version}
@@ -0,0 +1,88 @@
+from types import SimpleNamespace
+from typing import Any, Optional
+
+import aiohttp
+
+
+class ClientSessionPool:
+    """
+    Owns a single aiohttp.ClientSession (and its TCP connection pool) for the lifetime of the app,
+    so that requests to the same host reuse keep-alive connections instead of paying TCP+TLS setup each time.
+    Attributes:
+        limit (int): The total number of simultaneous connections in the pool (0 means no limit).
+        limit_per_host (int): The number of simultaneous connections to a single host (0 means no limit).
+        keepalive_timeout (float): Seconds to keep an idle connection open for reuse.
+        dns_cache_ttl (int): Seconds to cache resolved DNS entries.
+    Methods:
+        open(self): Creates the underlying session. Must be called from within a running event loop.
+        close(self): Closes the session and all pooled connections.
+        get_stats(self): Returns connection reuse statistics for the pool.
+    """
+
+    def __init__(
+        self,
+        limit: int = 100,
+        limit_per_host: int = 0,
+        keepalive_timeout: float = 30,
+        dns_cache_ttl: int = 300,
+    ):
+        self.limit = limit
+        self.limit_per_host = limit_per_host
+        self.keepalive_timeout = keepalive_timeout
+        self.dns_cache_ttl = dns_cache_ttl
+        self.requests = 0
+        self.connections_created = 0
+        self.connections_reused = 0
+        self._session: Optional[aiohttp.ClientSession] = None
+
+    @property
+    def session(self) -> aiohttp.ClientSession:
+        if self._session is None or self._session.closed:
+            raise RuntimeError("ClientSessionPool is not open")
+        return self._session
+
+    def open(self) -> aiohttp.ClientSession:
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=self.limit,
+                limit_per_host=self.limit_per_host,
+                keepalive_timeout=self.keepalive_timeout,
+                use_dns_cache=True,
+                ttl_dns_cache=self.dns_cache_ttl,
+            )
+            self._session = aiohttp.ClientSession(connector=connector, trace_configs=[self._create_trace_config()])
+        return self._session
+
+    async def close(self):
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
+
+    def get_stats(self) -> dict[str, Any]:
+        connections = self.connections_created + self.connections_reused
+        return {
+            "open": self._session is not None and not self._session.closed,
+            "limit": self.limit,
+            "limit_per_host": self.limit_per_host,
+            "requests": self.requests,
+            "connections_created": self.connections_created,
+            "connections_reused": self.connections_reused,
+            "reuse_ratio": self.connections_reused / connections if connections else 0.0,
+        }
+
+    def _create_trace_config(self) -> aiohttp.TraceConfig:
+        trace_config = aiohttp.TraceConfig()
+
+        async def on_request_start(session: aiohttp.ClientSession, context: SimpleNamespace, params: Any):
+            self.requests += 1
+
+        async def on_connection_create_end(session: aiohttp.ClientSession, context: SimpleNamespace, params: Any):
+            self.connections_created += 1
+
+        async def on_connection_reuseconn(session: aiohttp.ClientSession, context: SimpleNamespace, params: Any):
+            self.connections_reused += 1
+
+        trace_config.on_request_start.append(on_request_start)
+        trace_config.on_connection_create_end.append(on_connection_create_end)
+        trace_config.on_connection_reuseconn.append(on_connection_reuseconn)
+        return trace_config
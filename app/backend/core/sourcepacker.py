@@ -0,0 +1,76 @@
+from collections import OrderedDict
+from typing import Any, Optional
+
+from .modelhelper import num_tokens_from_texts
+
+# Sources are joined with newlines, which take a token each
+SEPARATOR_TOKENS = 1
+
+
+class SourcePacker:
+    """
+    Packs the sources of an answer into a token budget, instead of using a fixed number of sources. The retriever
+    fetches more candidates than needed, and the packer keeps them in order of relevance as long as they fit, skipping
+    the ones that do not. The budget left over is not spent on sources, so the history can use it.
+    Token counts of sources are kept in their own bounded cache, since the same sections are found again and again.
+    Attributes:
+        model (str): The model the tokens are counted for.
+        token_budget (int): The largest number of tokens the sources may take.
+        candidates (int): The number of results fetched to choose the sources from.
+        max_entries (int): The largest number of token counts that are cached.
+    Methods:
+        count_tokens(self, sources): Returns the number of tokens of each source.
+        get_budget(self, token_budget=None): Returns the budget of the sources, given the tokens left in the prompt.
+        pack(self, sources, token_budget): Returns the indexes of the sources that fit in the budget and the tokens
+            they take.
+        get_stats(self): Returns packing and cache statistics.
+    """
+
+    def __init__(self, model: str, token_budget: int, candidates: int = 10, max_entries: int = 10000):
+        self.model = model
+        self.token_budget = token_budget
+        self.candidates = candidates
+        self.max_entries = max_entries
+        self.token_counts: OrderedDict[tuple[str, str], int] = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.packed = 0
+        self.skipped = 0
+
+    def count_tokens(self, sources: list[str]) -> list[int]:
+        for source in dict.fromkeys(sources):
+            if (self.model, source) in self.token_counts:
+                self.hits += 1
+            else:
+                self.misses += 1
+        return num_tokens_from_texts(sources, self.model, self.token_counts, self.max_entries)
+
+    def get_budget(self, token_budget: Optional[int] = None) -> int:
+        """
+        Returns the smaller of the configured budget and the given one, which is what is left of the prompt.
+        """
+        return self.token_budget if token_budget is None else max(min(self.token_budget, token_budget), 0)
+
+    def pack(self, sources: list[str], token_budget: int) -> tuple[list[int], int]:
+        """
+        Returns the indexes of the sources kept, in order, and the tokens they take.
+        """
+        kept: list[int] = []
+        used = 0
+        for index, tokens in enumerate(self.count_tokens(sources)):
+            cost = tokens + (SEPARATOR_TOKENS if kept else 0)
+            if used + cost <= token_budget:
+                kept.append(index)
+                used += cost
+        self.packed += len(kept)
+        self.skipped += len(sources) - len(kept)
+        return kept, used
+
+    def get_stats(self) -> dict[str, Any]:
+        return {
+            "entries": len(self.token_counts),
+            "hits": self.hits,
+            "misses": self.misses,
+            "packed": self.packed,
+            "skipped": self.skipped,
+        }
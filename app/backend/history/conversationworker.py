@@ -0,0 +1,126 @@
+import asyncio
+import logging
+from typing import Any, Optional
+
+from history.storage import ConversationStorage
+
+
+class ConversationWorker:
+    """
+    Runs a job per conversation in the background, so that responses to the user do not wait on it. Conversations
+    are queued, at most once at a time, and their jobs are run by a fixed number of worker tasks.
+    Subclasses implement run(user_id, conversation_id) and name the job in job_name, for logs.
+    Attributes:
+        max_concurrency (int): The number of jobs run at the same time.
+        max_retries (int): The number of times a failed job is retried before it is given up.
+        retry_delay (float): Seconds to wait before the first retry, doubled for every following retry.
+        max_queue_size (int): The number of conversations waiting for their job, further ones are dropped.
+    Methods:
+        start(self): Starts the worker tasks. Must be called from within a running event loop.
+        submit(self, user_id, conversation_id): Queues a conversation for its job, unless it is already queued.
+        join(self): Waits until all the queued jobs have been run or given up.
+        close(self): Stops the worker tasks.
+        get_stats(self): Returns statistics for the queue.
+    """
+
+    job_name = "job"
+
+    def __init__(
+        self,
+        conversation_client: ConversationStorage,
+        max_concurrency: int = 2,
+        max_retries: int = 3,
+        retry_delay: float = 1.0,
+        max_queue_size: int = 1000,
+    ):
+        self.conversation_client = conversation_client
+        self.max_concurrency = max_concurrency
+        self.max_retries = max_retries
+        self.retry_delay = retry_delay
+        self.max_queue_size = max_queue_size
+        self.submitted = 0
+        self.deduplicated = 0
+        self.dropped = 0
+        self.completed = 0
+        self.retried = 0
+        self.failed = 0
+        self._pending: set[tuple[str, str]] = set()
+        self._queue: Optional[asyncio.Queue[tuple[str, str]]] = None
+        self._workers: list[asyncio.Task] = []
+
+    def start(self):
+        if self._queue is None:
+            self._queue = asyncio.Queue(maxsize=self.max_queue_size)
+        if not self._workers:
+            self._workers = [asyncio.create_task(self._work()) for _ in range(self.max_concurrency)]
+
+    def submit(self, user_id: str, conversation_id: str) -> bool:
+        """
+        Queues the conversation for its job and returns immediately. Returns False if the conversation is already
+        queued or the queue is full.
+        """
+        if self._queue is None:
+            raise RuntimeError(f"{type(self).__name__} is not started")
+        key = (user_id, conversation_id)
+        if key in self._pending:
+            self.deduplicated += 1
+            return False
+        try:
+            self._queue.put_nowait(key)
+        except asyncio.QueueFull:
+            self.dropped += 1
+            logging.warning("Queue is full, no %s will be run for conversation %s", self.job_name, conversation_id)
+            return False
+        self._pending.add(key)
+        self.submitted += 1
+        return True
+
+    async def join(self):
+        if self._queue is not None:
+            await self._queue.join()
+
+    async def close(self):
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+
+    async def run(self, user_id: str, conversation_id: str):
+        raise NotImplementedError
+
+    def get_stats(self) -> dict[str, Any]:
+        return {
+            "queued": self._queue.qsize() if self._queue is not None else 0,
+            "submitted": self.submitted,
+            "deduplicated": self.deduplicated,
+            "dropped": self.dropped,
+            "completed": self.completed,
+            "retried": self.retried,
+            "failed": self.failed,
+        }
+
+    async def _work(self):
+        assert self._queue is not None
+        while True:
+            user_id, conversation_id = await self._queue.get()
+            try:
+                await self._run_with_retries(user_id, conversation_id)
+            finally:
+                self._pending.discard((user_id, conversation_id))
+                self._queue.task_done()
+
+    async def _run_with_retries(self, user_id: str, conversation_id: str):
+        for attempt in range(self.max_retries + 1):
+            try:
+                await self.run(user_id, conversation_id)
+                self.completed += 1
+                return
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                if attempt == self.max_retries:
+                    self.failed += 1
+                    logging.exception("Failed to run %s for conversation %s", self.job_name, conversation_id)
+                    return
+                self.retried += 1
+                await asyncio.sleep(self.retry_delay * 2**attempt)
@@ -1,117 +1,342 @@
-import os
+import asyncio
 import uuid
 from datetime import datetime
-from flask import Flask, request
-from azure.identity import DefaultAzureCredential  
-from azure.cosmos import CosmosClient, PartitionKey  
+from typing import Any, Optional, Union, cast
 
-class CosmosConversationClient():
+from azure.core.async_paging import AsyncPageIterator
+from azure.core.credentials_async import AsyncTokenCredential
+from azure.cosmos.aio import ContainerProxy, CosmosClient
+from azure.cosmos.exceptions import CosmosResourceNotFoundError
 
-    def __init__(self, cosmosdb_endpoint: str, credential: any, database_name: str, container_name: str):
+from history.storage import (
+    CONVERSATION_LIST_FIELDS,
+    MESSAGE_FIELDS,
+    ConversationStorage,
+    create_conversation_document,
+    create_message_documents,
+)
+
+# Cosmos DB limits a transactional batch to 100 operations
+MAX_BATCH_OPERATIONS = 100
+
+
+class CosmosConversationClient(ConversationStorage):
+    """
+    Stores conversations and their messages in a Cosmos DB container partitioned on userId, so that all the
+    documents of a user live in one logical partition. Every read is a point read or a parameterized query
+    scoped to the user's partition, ordered on fields covered by the container's composite indexes.
+    Uses the asyncio Cosmos client, so that requests to Cosmos DB do not block the event loop, and holds a single
+    client (and its connection pool) that is shared by all requests for the lifetime of the app.
+    Attributes:
+        cosmosdb_endpoint (str): The URL of the Cosmos DB account.
+        database_name (str): The name of the database.
+        container_name (str): The name of the container holding conversations and messages.
+    Methods:
+        close(self): Closes the underlying Cosmos client and its connections.
+    """
+
+    def __init__(
+        self,
+        cosmosdb_endpoint: str,
+        credential: Union[str, AsyncTokenCredential],
+        database_name: str,
+        container_name: str,
+        container_client: Optional[ContainerProxy] = None,
+    ):
         self.cosmosdb_endpoint = cosmosdb_endpoint
-        self.credential = credential
         self.database_name = database_name
         self.container_name = container_name
-        self.cosmosdb_client = CosmosClient(self.cosmosdb_endpoint, credential=credential)
-        self.database_client = self.cosmosdb_client.get_database_client(database_name)
-        self.container_client = self.database_client.get_container_client(container_name)
+        self.cosmosdb_client: Optional[CosmosClient] = None
+        if container_client is None:
+            self.cosmosdb_client = CosmosClient(self.cosmosdb_endpoint, credential=credential)
+            container_client = self.cosmosdb_client.get_database_client(database_name).get_container_client(
+                container_name
+            )
+        self.container_client = container_client
 
-    def create_conversation(self, user_id, title = ''):
+    async def close(self):
+        if self.cosmosdb_client is not None:
+            await self.cosmosdb_client.close()
+
+    async def create_conversation(self, user_id: str, title: str = "") -> Union[dict[str, Any], bool]:
         conversation = {
-            'id': str(uuid.uuid4()),  
-            'type': 'conversation',
-            'createdAt': datetime.utcnow().isoformat(),  
-            'updatedAt': datetime.utcnow().isoformat(),  
-            'userId': user_id,
-            'title': title
+            "id": str(uuid.uuid4()),
+            "type": "conversation",
+            "createdAt": datetime.utcnow().isoformat(),
+            "updatedAt": datetime.utcnow().isoformat(),
+            "userId": user_id,
+            "title": title,
         }
-        ## TODO: add some error handling based on the output of the upsert_item call
-        resp = self.container_client.upsert_item(conversation)  
-        if resp:
-            return resp
-        else:
-            return False
+        resp = await self.container_client.upsert_item(conversation)
+        return resp or False
 
-    def upsert_conversation(self, conversation):
-        resp = self.container_client.upsert_item(conversation)
-        if resp:
-            return resp
-        else:
-            return False
-
-    def delete_conversation(self, user_id, conversation_id):
-        conversation = self.container_client.read_item(item=conversation_id, partition_key=user_id)        
-        if conversation:
-            print("Item exists")
-            resp = self.container_client.delete_item(item=conversation_id, partition_key=user_id)
-            return resp
-        else:
-            print("Item doesn't exist")
-            return True
-
-
-    def delete_messages(self, conversation_id, user_id):
-        ## get a list of all the messages in the conversation
-        messages = self.get_messages(user_id, conversation_id)
-        response_list = []
-        if messages:
-            for message in messages:
-                resp = self.container_client.delete_item(item=message['id'], partition_key=user_id)
-                response_list.append(resp)
-            return response_list
-
-
-    def get_conversations(self, user_id, sort_order = 'DESC'):
-        query = f"SELECT * FROM c where c.userId = '{user_id}' and c.type='conversation' order by c.updatedAt {sort_order}"
-        conversations = list(self.container_client.query_items(query=query,
-                                                                               enable_cross_partition_query =True))
-        ## if no conversations are found, return None
-        if len(conversations) == 0:
+    async def upsert_conversation(self, conversation: dict[str, Any]) -> Union[dict[str, Any], bool]:
+        resp = await self.container_client.upsert_item(conversation)
+        return resp or False
+
+    async def delete_conversation(self, user_id: str, conversation_id: str) -> bool:
+        try:
+            await self.container_client.delete_item(item=conversation_id, partition_key=user_id)
+        except CosmosResourceNotFoundError:
+            pass
+        return True
+
+    async def delete_messages(self, conversation_id: str, user_id: str) -> Optional[list[str]]:
+        messages = await self.get_messages(user_id, conversation_id)
+        if not messages:
             return None
-        else:
-            return conversations
-
-    def get_conversation(self, user_id, conversation_id):
-        query = f"SELECT * FROM c where c.id = '{conversation_id}' and c.type='conversation' and c.userId = '{user_id}'"
-        conversation = list(self.container_client.query_items(query=query,
-                                                                               enable_cross_partition_query =True))
-        ## if no conversations are found, return None
-        if len(conversation) == 0:
+        message_ids = [message["id"] for message in messages]
+        await self.delete_items(user_id, message_ids)
+        return message_ids
+
+    async def get_conversations(self, user_id: str, sort_order: str = "DESC") -> Optional[list[dict[str, Any]]]:
+        if sort_order.upper() not in ("ASC", "DESC"):
+            raise ValueError(f"Invalid sort order {sort_order}")
+        query = f"SELECT * FROM c WHERE c.type = @type ORDER BY c.updatedAt {sort_order.upper()}"
+        parameters: list[dict[str, Any]] = [{"name": "@type", "value": "conversation"}]
+        conversations = [
+            conversation
+            async for conversation in self.container_client.query_items(
+                query=query, parameters=parameters, partition_key=user_id
+            )
+        ]
+        return conversations or None
+
+    async def get_conversation(self, user_id: str, conversation_id: str) -> Optional[dict[str, Any]]:
+        # The id and partition key are known, so this is a point read rather than a query
+        try:
+            conversation = await self.container_client.read_item(item=conversation_id, partition_key=user_id)
+        except CosmosResourceNotFoundError:
             return None
-        else:
-            return conversation[0]
-
-    def create_message(self, conversation_id, user_id, input_message: dict):
-        message = {
-            'id': str(uuid.uuid4()),
-            'type': 'message',
-            'userId' : user_id,
-            'createdAt': datetime.utcnow().isoformat(),
-            'updatedAt': datetime.utcnow().isoformat(),
-            'conversationId' : conversation_id,
-            'role': input_message['role'],
-            'content': input_message['content']
-        }
-        print(self.credential)
-
-        resp = self.container_client.upsert_item(message)  
-        if resp:
-            ## update the parent conversations's updatedAt field with the current message's createdAt datetime value
-            conversation = self.get_conversation(user_id, conversation_id)
-            conversation['updatedAt'] = message['createdAt']
-            self.upsert_conversation(conversation)
-            return resp
-        else:
-            return False
+        return conversation if conversation.get("type") == "conversation" else None
 
+    async def query_page(
+        self,
+        user_id: str,
+        query: str,
+        parameters: list[dict[str, Any]],
+        page_size: int,
+        continuation: Optional[str] = None,
+    ) -> tuple[list[dict[str, Any]], Optional[str]]:
+        """
+        Returns one page of results of a query in the user's partition, and the continuation token of the next
+        page, or None if this is the last page. Only the requested page is fetched from Cosmos DB.
+        """
+        # by_page is typed as a plain AsyncIterator, but returns an AsyncPageIterator that has the continuation token
+        pages = cast(
+            AsyncPageIterator[dict[str, Any]],
+            self.container_client.query_items(
+                query=query, parameters=parameters, partition_key=user_id, max_item_count=page_size
+            ).by_page(continuation),
+        )
+        items: list[dict[str, Any]] = []
+        async for page in pages:
+            items = [item async for item in page]
+            # Cosmos DB may return empty pages with a continuation token, those are skipped
+            if items:
+                break
+        return items, pages.continuation_token
 
+    async def get_conversations_page(
+        self, user_id: str, page_size: int = 20, continuation: Optional[str] = None
+    ) -> dict[str, Any]:
+        """
+        Returns a page of the user's conversations, most recently updated first, with only the fields needed to
+        list them, and the continuation token of the next page.
+        """
+        fields = ", ".join(f"c.{field}" for field in CONVERSATION_LIST_FIELDS)
+        conversations, continuation = await self.query_page(
+            user_id,
+            f"SELECT {fields} FROM c WHERE c.type = @type ORDER BY c.updatedAt DESC",
+            [{"name": "@type", "value": "conversation"}],
+            page_size,
+            continuation,
+        )
+        return {"conversations": conversations, "continuation": continuation}
 
-    def get_messages(self, user_id, conversation_id):
-        query = f"SELECT * FROM c WHERE c.conversationId = '{conversation_id}' AND c.type='message' AND c.userId = '{user_id}' ORDER BY c.timestamp ASC"
-        messages = list(self.container_client.query_items(query=query,
-                                                                     enable_cross_partition_query =True))
-        ## if no messages are found, return false
-        if len(messages) == 0:
-            return None
+    async def get_messages_page(
+        self, user_id: str, conversation_id: str, page_size: int = 20, continuation: Optional[str] = None
+    ) -> dict[str, Any]:
+        """
+        Returns a page of the most recent messages of a conversation in chronological order, and the continuation
+        token of the page of older messages, so that older turns can be loaded as the user scrolls back.
+        """
+        fields = ", ".join(f"c.{field}" for field in MESSAGE_FIELDS)
+        messages, continuation = await self.query_page(
+            user_id,
+            f"SELECT {fields} FROM c WHERE c.conversationId = @conversationId AND c.type = @type "
+            "ORDER BY c.createdAt DESC",
+            [{"name": "@conversationId", "value": conversation_id}, {"name": "@type", "value": "message"}],
+            page_size,
+            continuation,
+        )
+        return {"messages": messages[::-1], "continuation": continuation}
+
+    async def get_first_messages(
+        self, user_id: str, conversation_id: str, count: int, after: Optional[str] = None
+    ) -> list[dict[str, Any]]:
+        """
+        Returns the first messages of a conversation in chronological order, reading only a single page of them.
+        """
+        fields = ", ".join(f"c.{field}" for field in MESSAGE_FIELDS)
+        parameters = [{"name": "@conversationId", "value": conversation_id}, {"name": "@type", "value": "message"}]
+        condition = ""
+        if after is not None:
+            condition = " AND c.createdAt > @after"
+            parameters.append({"name": "@after", "value": after})
+        messages, _ = await self.query_page(
+            user_id,
+            f"SELECT {fields} FROM c WHERE c.conversationId = @conversationId AND c.type = @type{condition} "
+            "ORDER BY c.createdAt ASC",
+            parameters,
+            count,
+        )
+        return messages[:count]
+
+    async def update_conversation_title(self, user_id: str, conversation_id: str, title: str) -> dict[str, Any]:
+        # A patch only sends the changed field, instead of reading and replacing the whole conversation
+        return await self.container_client.patch_item(
+            item=conversation_id,
+            partition_key=user_id,
+            patch_operations=[{"op": "set", "path": "/title", "value": title}],
+        )
+
+    async def update_conversation_summary(
+        self, user_id: str, conversation_id: str, summary: dict[str, str]
+    ) -> dict[str, Any]:
+        return await self.container_client.patch_item(
+            item=conversation_id,
+            partition_key=user_id,
+            patch_operations=[{"op": "set", "path": "/summary", "value": summary}],
+        )
+
+    async def create_message(
+        self, conversation_id: str, user_id: str, input_message: dict[str, str]
+    ) -> Union[dict[str, Any], bool]:
+        turn = await self.create_turn(user_id, conversation_id, [input_message])
+        return turn["messages"][0]
+
+    async def create_turn(
+        self,
+        user_id: str,
+        conversation_id: Optional[str],
+        input_messages: list[dict[str, str]],
+        title: str = "",
+        create_conversation: bool = False,
+    ) -> dict[str, Any]:
+        """
+        Writes the messages of a turn (usually the user message and the assistant answer) and sets the conversation's
+        updatedAt in one transactional batch in the user's partition: either all of them are written or none are.
+        If conversation_id is None or create_conversation is set, the conversation is created in the same batch.
+        Returns the conversation id, the created messages and the request units charged for the batch.
+        """
+        now = datetime.utcnow()
+        messages = create_message_documents(user_id, conversation_id, input_messages, now)
+        updated_at = messages[-1]["createdAt"] if messages else now.isoformat()
+
+        batch_operations: list[tuple[str, tuple[Any, ...]]] = []
+        if conversation_id is None or create_conversation:
+            conversation_id = conversation_id or str(uuid.uuid4())
+            conversation = create_conversation_document(user_id, conversation_id, title, now.isoformat(), updated_at)
+            batch_operations.append(("create", (conversation,)))
         else:
-            return messages
+            batch_operations.append(
+                ("patch", (conversation_id, [{"op": "set", "path": "/updatedAt", "value": updated_at}]))
+            )
+        for message in messages:
+            message["conversationId"] = conversation_id
+            batch_operations.append(("create", (message,)))
+
+        request_charge = await self.execute_batch(user_id, batch_operations)
+        return {"conversation_id": conversation_id, "messages": messages, "request_charge": request_charge}
+
+    async def execute_batch(self, user_id: str, batch_operations: list[tuple[str, tuple[Any, ...]]]) -> float:
+        """
+        Runs the operations as one transactional batch in the user's partition and returns its request charge.
+        """
+        response_headers: dict[str, Any] = {}
+        await self.container_client.execute_item_batch(
+            batch_operations,
+            partition_key=user_id,
+            response_hook=lambda headers, _: response_headers.update(headers),
+        )
+        return float(response_headers.get("x-ms-request-charge", 0))
+
+    async def delete_items(self, user_id: str, item_ids: list[str], max_concurrency: int = 4) -> float:
+        """
+        Deletes the items from the user's partition in transactional batches of up to MAX_BATCH_OPERATIONS,
+        running at most max_concurrency batches at a time, and returns the total request charge.
+        """
+        semaphore = asyncio.Semaphore(max_concurrency)
+
+        async def delete_batch(batch_ids: list[str]) -> float:
+            async with semaphore:
+                return await self.execute_batch(user_id, [("delete", (item_id,)) for item_id in batch_ids])
+
+        charges = await asyncio.gather(
+            *(
+                delete_batch(item_ids[start : start + MAX_BATCH_OPERATIONS])
+                for start in range(0, len(item_ids), MAX_BATCH_OPERATIONS)
+            )
+        )
+        return sum(charges)
+
+    async def delete_conversation_and_messages(
+        self, user_id: str, conversation_id: str, max_concurrency: int = 4
+    ) -> dict[str, Any]:
+        """
+        Deletes a conversation and all its messages. Messages are deleted first, so that if a batch fails the
+        conversation is still listed and can be deleted again.
+        Returns the number of deleted items and the request charge of the deletes.
+        """
+        query = "SELECT c.id FROM c WHERE c.conversationId = @conversationId AND c.type = @type"
+        parameters: list[dict[str, Any]] = [
+            {"name": "@conversationId", "value": conversation_id},
+            {"name": "@type", "value": "message"},
+        ]
+        message_ids = [
+            item["id"]
+            async for item in self.container_client.query_items(
+                query=query, parameters=parameters, partition_key=user_id
+            )
+        ]
+        request_charge = await self.delete_items(user_id, message_ids, max_concurrency)
+        deleted_items = len(message_ids)
+        if await self.get_conversation(user_id, conversation_id):
+            request_charge += await self.execute_batch(user_id, [("delete", (conversation_id,))])
+            deleted_items += 1
+        return {"deleted_items": deleted_items, "request_charge": request_charge}
+
+    async def delete_all_conversations(self, user_id: str, max_concurrency: int = 4) -> dict[str, Any]:
+        """
+        Deletes all the conversations and messages of a user, messages first.
+        Returns the number of deleted conversations and items, and the request charge of the deletes.
+        """
+        message_ids = []
+        conversation_ids = []
+        async for item in self.container_client.query_items(query="SELECT c.id, c.type FROM c", partition_key=user_id):
+            if item.get("type") == "conversation":
+                conversation_ids.append(item["id"])
+            else:
+                message_ids.append(item["id"])
+        request_charge = await self.delete_items(user_id, message_ids, max_concurrency)
+        request_charge += await self.delete_items(user_id, conversation_ids, max_concurrency)
+        return {
+            "deleted_conversations": len(conversation_ids),
+            "deleted_items": len(message_ids) + len(conversation_ids),
+            "request_charge": request_charge,
+        }
+
+    async def get_messages(self, user_id: str, conversation_id: str) -> Optional[list[dict[str, Any]]]:
+        query = "SELECT * FROM c WHERE c.conversationId = @conversationId AND c.type = @type ORDER BY c.createdAt ASC"
+        parameters: list[dict[str, Any]] = [
+            {"name": "@conversationId", "value": conversation_id},
+            {"name": "@type", "value": "message"},
+        ]
+        messages = [
+            message
+            async for message in self.container_client.query_items(
+                query=query, parameters=parameters, partition_key=user_id
+            )
+        ]
+        return messages or None
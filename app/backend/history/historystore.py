@@ -0,0 +1,257 @@
+import asyncio
+import uuid
+from abc import ABC
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Any, Optional, Union
+
+from core.modelhelper import num_tokens_from_messages_batch
+from history.storage import ConversationStorage
+from history.summaryworker import SummaryWorker
+from history.writebehind import WriteBehindQueue
+
+
+def create_summary_message(content: str) -> dict[str, str]:
+    return {"role": "system", "content": f"Summary of the earlier conversation:\n{content}"}
+
+
+@dataclass
+class ConversationHistory:
+    """
+    The most recent messages of a conversation, in the chat/completions format, with the token count of each message.
+    The version changes whenever messages are added to the conversation, in any process.
+    If the older messages are summarized, the summary is a {"content", "through"} dict and messages only holds the
+    messages created after the summary's through.
+    """
+
+    messages: list[dict[str, str]]
+    token_counts: list[int]
+    version: Optional[str] = None
+    # The write of the latest messages, when they are written behind
+    pending_write: Optional[asyncio.Future] = None
+    summary: Optional[dict[str, str]] = None
+    summary_token_count: int = 0
+
+    def get_prompt_messages(self) -> tuple[list[dict[str, str]], list[int]]:
+        """
+        Returns the messages to send to the model, starting with the summary if there is one, and their token counts.
+        """
+        if not self.summary:
+            return self.messages, self.token_counts
+        return (
+            [create_summary_message(self.summary["content"])] + self.messages,
+            [self.summary_token_count] + self.token_counts,
+        )
+
+
+class HistoryBackend(ABC):
+    """
+    Durable storage of conversation messages behind the ConversationHistoryStore.
+    """
+
+    async def get_state(self, user_id: str, conversation_id: str) -> Optional[tuple[str, Optional[dict[str, str]]]]:
+        """
+        Returns the current version of the conversation and its summary, or None if it does not exist.
+        """
+        raise NotImplementedError
+
+    async def load(
+        self, user_id: str, conversation_id: str, max_messages: int, after: Optional[str] = None
+    ) -> list[dict[str, str]]:
+        """
+        Returns the most recent messages of the conversation, oldest first, only those created after the given
+        createdAt if one is given.
+        """
+        raise NotImplementedError
+
+    async def flush(self, user_id: str, conversation_id: str):
+        """
+        Writes the messages of the conversation that are not written yet, if writes happen later.
+        """
+        pass
+
+    async def append(
+        self, user_id: str, conversation_id: Optional[str], messages: list[dict[str, str]]
+    ) -> tuple[str, Union[str, asyncio.Future]]:
+        """
+        Adds the messages to the conversation, creating it if conversation_id is None.
+        Returns the conversation id and its new version, or a future of the write if it happens later,
+        which resolves with a dict holding the version.
+        """
+        raise NotImplementedError
+
+
+class StorageHistoryBackend(HistoryBackend):
+    """
+    Stores messages in a ConversationStorage. The version of a conversation is its updatedAt,
+    which every write of a turn sets atomically with the messages.
+    If a write-behind queue is given, messages are queued on it instead of being written on the request path.
+    """
+
+    def __init__(self, conversation_client: ConversationStorage, write_queue: Optional[WriteBehindQueue] = None):
+        self.conversation_client = conversation_client
+        self.write_queue = write_queue
+
+    async def get_state(self, user_id: str, conversation_id: str) -> Optional[tuple[str, Optional[dict[str, str]]]]:
+        conversation = await self.conversation_client.get_conversation(user_id, conversation_id)
+        return (conversation["updatedAt"], conversation.get("summary")) if conversation else None
+
+    async def load(
+        self, user_id: str, conversation_id: str, max_messages: int, after: Optional[str] = None
+    ) -> list[dict[str, str]]:
+        page = await self.conversation_client.get_messages_page(user_id, conversation_id, max_messages)
+        return [
+            {"role": message["role"], "content": message["content"]}
+            for message in page["messages"]
+            if after is None or message["createdAt"] > after
+        ]
+
+    async def flush(self, user_id: str, conversation_id: str):
+        if self.write_queue:
+            await self.write_queue.flush(user_id, conversation_id)
+
+    async def append(
+        self, user_id: str, conversation_id: Optional[str], messages: list[dict[str, str]]
+    ) -> tuple[str, Union[str, asyncio.Future]]:
+        if self.write_queue:
+            create_conversation = conversation_id is None
+            conversation_id = conversation_id or str(uuid.uuid4())
+            return conversation_id, self.write_queue.enqueue(user_id, conversation_id, messages, create_conversation)
+        turn = await self.conversation_client.create_turn(user_id, conversation_id, messages)
+        return turn["conversation_id"], turn["messages"][-1]["createdAt"]
+
+
+class ConversationHistoryStore:
+    """
+    Least-recently-used cache of the recent history of conversations in front of a HistoryBackend, so that
+    clients send only the new message of a turn instead of the whole transcript, and each message is tokenized
+    once when it is added rather than on every turn.
+    A cached conversation is checked against the version and summary in the backend before it is used, so that
+    turns and summaries written by other worker processes are not missed. Turns of the same conversation written
+    at the same time by different processes are not detected, as a conversation is expected to be driven by one
+    client at a time.
+    Attributes:
+        backend (HistoryBackend): The durable store of the messages.
+        model (str): The name of the ChatGPT model, used to count tokens.
+        max_conversations (int): The number of conversations kept in memory.
+        max_messages (int): The number of most recent messages kept for each conversation.
+        summary_worker (SummaryWorker): If given, conversations with more messages after their summary than its
+            threshold are submitted to it, to fold their older messages into the summary.
+    Methods:
+        get(self, user_id, conversation_id): Returns the recent history of a conversation.
+        append(self, user_id, conversation_id, messages): Adds messages to a conversation.
+        get_stats(self): Returns cache statistics.
+    """
+
+    def __init__(
+        self,
+        backend: HistoryBackend,
+        model: str,
+        max_conversations: int = 1000,
+        max_messages: int = 50,
+        summary_worker: Optional[SummaryWorker] = None,
+    ):
+        self.backend = backend
+        self.model = model
+        self.max_conversations = max_conversations
+        self.max_messages = max_messages
+        self.summary_worker = summary_worker
+        self.entries: OrderedDict[tuple[str, str], ConversationHistory] = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.tokenized_messages = 0
+
+    async def get(self, user_id: str, conversation_id: str) -> Optional[ConversationHistory]:
+        """
+        Returns the recent history of the conversation, or None if it does not exist.
+        """
+        key = (user_id, conversation_id)
+        if (history := self.entries.get(key)) is not None and history.pending_write is not None:
+            # Wait for the latest messages to be written, so that the version can be compared
+            pending_write = history.pending_write
+            await self.backend.flush(user_id, conversation_id)
+            try:
+                history.version = (await pending_write)["version"]
+            except Exception:
+                self.entries.pop(key, None)
+            if history.pending_write is pending_write:
+                history.pending_write = None
+        state = await self.backend.get_state(user_id, conversation_id)
+        if state is None:
+            self.entries.pop(key, None)
+            return None
+        version, summary = state
+        if (history := self.entries.get(key)) is not None and history.version == version and history.summary == summary:
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return history
+
+        self.misses += 1
+        messages = await self.backend.load(
+            user_id, conversation_id, self.max_messages, after=summary["through"] if summary else None
+        )
+        history = ConversationHistory(
+            messages=messages, token_counts=self.count_tokens(messages), version=version, summary=summary
+        )
+        if summary:
+            history.summary_token_count = self.count_tokens([create_summary_message(summary["content"])])[0]
+        self.put(key, history)
+        return history
+
+    async def append(self, user_id: str, conversation_id: Optional[str], messages: list[dict[str, str]]) -> str:
+        """
+        Adds the messages to the conversation, creating it if conversation_id is None, and returns its id.
+        Only the new messages are tokenized.
+        """
+        history = self.entries.get((user_id, conversation_id)) if conversation_id else None
+        new_conversation = conversation_id is None
+        conversation_id, version = await self.backend.append(user_id, conversation_id, messages)
+        if new_conversation:
+            history = ConversationHistory(messages=[], token_counts=[])
+            self.put((user_id, conversation_id), history)
+        if history is None:
+            # The conversation is not cached, it is loaded from the backend the next time it is used
+            return conversation_id
+        history.messages = (history.messages + messages)[-self.max_messages :]
+        history.token_counts = (history.token_counts + self.count_tokens(messages))[-self.max_messages :]
+        if isinstance(version, asyncio.Future):
+            history.pending_write = version
+        else:
+            history.version = version
+        if self.summary_worker and len(history.messages) >= self.summary_worker.threshold:
+            self.submit_summary(user_id, conversation_id, version)
+        return conversation_id
+
+    def submit_summary(self, user_id: str, conversation_id: str, version: Union[str, asyncio.Future]):
+        """
+        Submits the conversation to the summary worker, once its latest messages are written.
+        """
+        assert self.summary_worker is not None
+        summary_worker = self.summary_worker
+        if not isinstance(version, asyncio.Future):
+            summary_worker.submit(user_id, conversation_id)
+            return
+
+        def submit(written: asyncio.Future):
+            if not written.cancelled() and written.exception() is None:
+                summary_worker.submit(user_id, conversation_id)
+
+        version.add_done_callback(submit)
+
+    def put(self, key: tuple[str, str], history: ConversationHistory):
+        self.entries[key] = history
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_conversations:
+            self.entries.popitem(last=False)
+
+    def count_tokens(self, messages: list[dict[str, str]]) -> list[int]:
+        self.tokenized_messages += len(messages)
+        return num_tokens_from_messages_batch(messages, self.model) if messages else []
+
+    def get_stats(self) -> dict[str, Any]:
+        return {
+            "conversations": len(self.entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "tokenized_messages": self.tokenized_messages,
+        }
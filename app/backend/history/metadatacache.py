@@ -0,0 +1,133 @@
+import time
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import Any, Awaitable, Optional, TypeVar
+
+from history.storage import ConversationStorage
+
+T = TypeVar("T")
+
+
+@dataclass
+class UserConversations:
+    """
+    The cached pages of a user's conversation list, keyed on (page_size, continuation), with the time they expire.
+    The generation changes on every write of the user's conversations, so that a page read while a write happens
+    is not cached.
+    """
+
+    pages: dict[tuple[int, Optional[str]], tuple[dict[str, Any], float]] = field(default_factory=dict)
+    generation: int = 0
+
+
+class ConversationMetadataCache(ConversationStorage):
+    """
+    Caches the pages of each user's conversation list in front of a ConversationStorage, so that refreshing the list
+    does not query the storage again until one of the user's conversations changes. Every write that goes through
+    this storage (turns, titles and deletes) invalidates the user's cached pages. Writes done by other worker
+    processes are picked up once the cached pages expire, after ttl seconds.
+    Attributes:
+        storage (ConversationStorage): The storage the reads and writes are sent to.
+        ttl (float): Seconds a cached page is used for.
+        max_users (int): The number of users whose pages are cached, least recently used users are evicted first.
+    Methods:
+        get_stats(self): Returns cache statistics.
+    """
+
+    def __init__(self, storage: ConversationStorage, ttl: float = 30, max_users: int = 1000):
+        self.storage = storage
+        self.ttl = ttl
+        self.max_users = max_users
+        self.users: OrderedDict[str, UserConversations] = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def invalidate(self, user_id: str):
+        if (user := self.users.get(user_id)) is not None:
+            user.pages.clear()
+            user.generation += 1
+
+    async def write(self, user_id: str, write: Awaitable[T]) -> T:
+        """
+        Runs a write of the user's conversations, invalidating their cached pages before it, so that pages being
+        read are not cached, and after it, so that pages read during the write are dropped.
+        """
+        self.invalidations += 1
+        self.invalidate(user_id)
+        try:
+            return await write
+        finally:
+            self.invalidate(user_id)
+
+    async def get_conversations_page(
+        self, user_id: str, page_size: int = 20, continuation: Optional[str] = None
+    ) -> dict[str, Any]:
+        user = self.users.get(user_id)
+        if user is None:
+            user = self.users[user_id] = UserConversations()
+            while len(self.users) > self.max_users:
+                self.users.popitem(last=False)
+        self.users.move_to_end(user_id)
+        key = (page_size, continuation)
+        if (cached := user.pages.get(key)) is not None and cached[1] > time.monotonic():
+            self.hits += 1
+            return cached[0]
+
+        self.misses += 1
+        generation = user.generation
+        page = await self.storage.get_conversations_page(user_id, page_size, continuation)
+        if user.generation == generation:
+            user.pages[key] = (page, time.monotonic() + self.ttl)
+        return page
+
+    async def create_turn(
+        self,
+        user_id: str,
+        conversation_id: Optional[str],
+        input_messages: list[dict[str, str]],
+        title: str = "",
+        create_conversation: bool = False,
+    ) -> dict[str, Any]:
+        return await self.write(
+            user_id, self.storage.create_turn(user_id, conversation_id, input_messages, title, create_conversation)
+        )
+
+    async def update_conversation_title(self, user_id: str, conversation_id: str, title: str) -> dict[str, Any]:
+        return await self.write(user_id, self.storage.update_conversation_title(user_id, conversation_id, title))
+
+    async def delete_conversation_and_messages(self, user_id: str, conversation_id: str) -> dict[str, Any]:
+        return await self.write(user_id, self.storage.delete_conversation_and_messages(user_id, conversation_id))
+
+    async def delete_all_conversations(self, user_id: str) -> dict[str, Any]:
+        return await self.write(user_id, self.storage.delete_all_conversations(user_id))
+
+    async def get_conversation(self, user_id: str, conversation_id: str) -> Optional[dict[str, Any]]:
+        return await self.storage.get_conversation(user_id, conversation_id)
+
+    async def get_messages_page(
+        self, user_id: str, conversation_id: str, page_size: int = 20, continuation: Optional[str] = None
+    ) -> dict[str, Any]:
+        return await self.storage.get_messages_page(user_id, conversation_id, page_size, continuation)
+
+    async def get_first_messages(
+        self, user_id: str, conversation_id: str, count: int, after: Optional[str] = None
+    ) -> list[dict[str, Any]]:
+        return await self.storage.get_first_messages(user_id, conversation_id, count, after)
+
+    async def update_conversation_summary(
+        self, user_id: str, conversation_id: str, summary: dict[str, str]
+    ) -> dict[str, Any]:
+        # The summary is not listed, so the cached pages are kept
+        return await self.storage.update_conversation_summary(user_id, conversation_id, summary)
+
+    async def close(self):
+        await self.storage.close()
+
+    def get_stats(self) -> dict[str, Any]:
+        return {
+            "users": len(self.users),
+            "hits": self.hits,
+            "misses": self.misses,
+            "invalidations": self.invalidations,
+        }
@@ -0,0 +1,488 @@
+import asyncio
+import json
+import sqlite3
+import uuid
+from abc import ABC
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from typing import Any, Iterator, Optional
+
+# Fields returned when listing conversations and reading messages page by page
+CONVERSATION_LIST_FIELDS = ("id", "title", "updatedAt")
+MESSAGE_FIELDS = ("id", "role", "content", "createdAt")
+
+
+def create_message_documents(
+    user_id: str, conversation_id: Optional[str], input_messages: list[dict[str, str]], now: datetime
+) -> list[dict[str, Any]]:
+    """
+    Returns the documents of the messages of a turn, each created a microsecond after the previous one,
+    so that messages of the same turn keep their order on createdAt.
+    """
+    messages = []
+    for index, input_message in enumerate(input_messages):
+        created_at = (now + timedelta(microseconds=index)).isoformat()
+        messages.append(
+            {
+                "id": str(uuid.uuid4()),
+                "type": "message",
+                "userId": user_id,
+                "createdAt": created_at,
+                "updatedAt": created_at,
+                "conversationId": conversation_id,
+                "role": input_message["role"],
+                "content": input_message["content"],
+            }
+        )
+    return messages
+
+
+class ConversationStorage(ABC):
+    """
+    Storage of the conversations of users and their messages. Every operation is scoped to a single user.
+    Conversations are listed most recently updated first, and messages are read most recent page first,
+    with an opaque continuation token to read the next page.
+    """
+
+    async def create_turn(
+        self,
+        user_id: str,
+        conversation_id: Optional[str],
+        input_messages: list[dict[str, str]],
+        title: str = "",
+        create_conversation: bool = False,
+    ) -> dict[str, Any]:
+        """
+        Atomically writes the messages and sets the conversation's updatedAt to the time of the last message.
+        If conversation_id is None or create_conversation is set, the conversation is created with the messages.
+        Returns the conversation id, the created messages and the request units charged for the write.
+        """
+        raise NotImplementedError
+
+    async def get_conversation(self, user_id: str, conversation_id: str) -> Optional[dict[str, Any]]:
+        raise NotImplementedError
+
+    async def get_conversations_page(
+        self, user_id: str, page_size: int = 20, continuation: Optional[str] = None
+    ) -> dict[str, Any]:
+        """
+        Returns {"conversations", "continuation"}, with only the CONVERSATION_LIST_FIELDS of each conversation.
+        """
+        raise NotImplementedError
+
+    async def get_messages_page(
+        self, user_id: str, conversation_id: str, page_size: int = 20, continuation: Optional[str] = None
+    ) -> dict[str, Any]:
+        """
+        Returns {"messages", "continuation"}, with the most recent messages in chronological order and only
+        their MESSAGE_FIELDS. The continuation token reads the page of older messages.
+        """
+        raise NotImplementedError
+
+    async def get_first_messages(
+        self, user_id: str, conversation_id: str, count: int, after: Optional[str] = None
+    ) -> list[dict[str, Any]]:
+        """
+        Returns the first count messages of the conversation in chronological order, only those created after
+        the given createdAt if one is given.
+        """
+        raise NotImplementedError
+
+    async def update_conversation_title(self, user_id: str, conversation_id: str, title: str) -> dict[str, Any]:
+        raise NotImplementedError
+
+    async def update_conversation_summary(
+        self, user_id: str, conversation_id: str, summary: dict[str, str]
+    ) -> dict[str, Any]:
+        """
+        Sets the running summary of the older messages of the conversation, a {"content", "through"} dict where
+        through is the createdAt of the last summarized message. Does not change the conversation's updatedAt.
+        """
+        raise NotImplementedError
+
+    async def delete_conversation_and_messages(self, user_id: str, conversation_id: str) -> dict[str, Any]:
+        """
+        Returns the number of deleted items and the request charge of the deletes.
+        """
+        raise NotImplementedError
+
+    async def delete_all_conversations(self, user_id: str) -> dict[str, Any]:
+        """
+        Returns the number of deleted conversations and items, and the request charge of the deletes.
+        """
+        raise NotImplementedError
+
+    async def close(self):
+        pass
+
+
+def create_conversation_document(user_id: str, conversation_id: str, title: str, created_at: str, updated_at: str):
+    return {
+        "id": conversation_id,
+        "type": "conversation",
+        "createdAt": created_at,
+        "updatedAt": updated_at,
+        "userId": user_id,
+        "title": title,
+    }
+
+
+class InMemoryConversationStorage(ConversationStorage):
+    """
+    Conversations kept in process memory, for development and for measuring the history layer without a database.
+    Continuation tokens are offsets.
+    """
+
+    def __init__(self):
+        self.conversations: dict[str, dict[str, dict[str, Any]]] = {}
+        self.messages: dict[tuple[str, str], list[dict[str, Any]]] = {}
+
+    async def create_turn(
+        self,
+        user_id: str,
+        conversation_id: Optional[str],
+        input_messages: list[dict[str, str]],
+        title: str = "",
+        create_conversation: bool = False,
+    ) -> dict[str, Any]:
+        now = datetime.utcnow()
+        conversations = self.conversations.setdefault(user_id, {})
+        if conversation_id is None or create_conversation:
+            conversation_id = conversation_id or str(uuid.uuid4())
+            if conversation_id in conversations:
+                raise ValueError(f"Conversation {conversation_id} already exists")
+            conversation = create_conversation_document(
+                user_id, conversation_id, title, now.isoformat(), now.isoformat()
+            )
+        elif (conversation := conversations.get(conversation_id)) is None:
+            raise ValueError(f"Conversation {conversation_id} was not found")
+        messages = create_message_documents(user_id, conversation_id, input_messages, now)
+        if messages:
+            conversation["updatedAt"] = messages[-1]["createdAt"]
+        conversations[conversation_id] = conversation
+        self.messages.setdefault((user_id, conversation_id), []).extend(messages)
+        return {
+            "conversation_id": conversation_id,
+            "messages": [dict(message) for message in messages],
+            "request_charge": 0.0,
+        }
+
+    async def get_conversation(self, user_id: str, conversation_id: str) -> Optional[dict[str, Any]]:
+        conversation = self.conversations.get(user_id, {}).get(conversation_id)
+        return dict(conversation) if conversation else None
+
+    async def get_conversations_page(
+        self, user_id: str, page_size: int = 20, continuation: Optional[str] = None
+    ) -> dict[str, Any]:
+        conversations = sorted(
+            self.conversations.get(user_id, {}).values(),
+            key=lambda conversation: conversation["updatedAt"],
+            reverse=True,
+        )
+        start = int(continuation or 0)
+        end = start + page_size
+        return {
+            "conversations": [
+                {field: conversation[field] for field in CONVERSATION_LIST_FIELDS}
+                for conversation in conversations[start:end]
+            ],
+            "continuation": str(end) if end < len(conversations) else None,
+        }
+
+    async def get_messages_page(
+        self, user_id: str, conversation_id: str, page_size: int = 20, continuation: Optional[str] = None
+    ) -> dict[str, Any]:
+        messages = self.messages.get((user_id, conversation_id), [])
+        # The offset counts messages from the most recent one
+        end = len(messages) - int(continuation or 0)
+        start = max(end - page_size, 0)
+        return {
+            "messages": [{field: message[field] for field in MESSAGE_FIELDS} for message in messages[start:end]],
+            "continuation": str(len(messages) - start) if start > 0 else None,
+        }
+
+    async def get_first_messages(
+        self, user_id: str, conversation_id: str, count: int, after: Optional[str] = None
+    ) -> list[dict[str, Any]]:
+        messages = [
+            message
+            for message in self.messages.get((user_id, conversation_id), [])
+            if after is None or message["createdAt"] > after
+        ]
+        return [{field: message[field] for field in MESSAGE_FIELDS} for message in messages[:count]]
+
+    async def update_conversation_title(self, user_id: str, conversation_id: str, title: str) -> dict[str, Any]:
+        conversation = self.conversations.get(user_id, {}).get(conversation_id)
+        if conversation is None:
+            raise ValueError(f"Conversation {conversation_id} was not found")
+        conversation["title"] = title
+        return dict(conversation)
+
+    async def update_conversation_summary(
+        self, user_id: str, conversation_id: str, summary: dict[str, str]
+    ) -> dict[str, Any]:
+        conversation = self.conversations.get(user_id, {}).get(conversation_id)
+        if conversation is None:
+            raise ValueError(f"Conversation {conversation_id} was not found")
+        conversation["summary"] = dict(summary)
+        return dict(conversation)
+
+    async def delete_conversation_and_messages(self, user_id: str, conversation_id: str) -> dict[str, Any]:
+        deleted_items = len(self.messages.pop((user_id, conversation_id), []))
+        if self.conversations.get(user_id, {}).pop(conversation_id, None) is not None:
+            deleted_items += 1
+        return {"deleted_items": deleted_items, "request_charge": 0.0}
+
+    async def delete_all_conversations(self, user_id: str) -> dict[str, Any]:
+        conversations = self.conversations.pop(user_id, {})
+        deleted_messages = sum(
+            len(self.messages.pop((user_id, conversation_id), [])) for conversation_id in conversations
+        )
+        return {
+            "deleted_conversations": len(conversations),
+            "deleted_items": len(conversations) + deleted_messages,
+            "request_charge": 0.0,
+        }
+
+
+class SQLiteConversationStorage(ConversationStorage):
+    """
+    Conversations stored in a SQLite database file in WAL mode, so that they are shared by all worker processes
+    on the same host and reads do not block on writes. Messages are indexed on (userId, conversationId, createdAt)
+    and conversations on (userId, updatedAt), and pages are read with keyset pagination on those indexes.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        with self._connect() as connection:
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS conversations (user_id TEXT NOT NULL, id TEXT NOT NULL, "
+                "title TEXT NOT NULL, created_at TEXT NOT NULL, updated_at TEXT NOT NULL, PRIMARY KEY (user_id, id))"
+            )
+            connection.execute(
+                "CREATE INDEX IF NOT EXISTS conversations_updated_at ON conversations (user_id, updated_at, id)"
+            )
+            # The summary column was added after the table, so databases created before it are migrated
+            columns = {row["name"] for row in connection.execute("PRAGMA table_info(conversations)")}
+            if "summary" not in columns:
+                connection.execute("ALTER TABLE conversations ADD COLUMN summary TEXT")
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS messages (user_id TEXT NOT NULL, conversation_id TEXT NOT NULL, "
+                "id TEXT NOT NULL, role TEXT NOT NULL, content TEXT NOT NULL, created_at TEXT NOT NULL, "
+                "PRIMARY KEY (user_id, id))"
+            )
+            connection.execute(
+                "CREATE INDEX IF NOT EXISTS messages_created_at ON messages (user_id, conversation_id, created_at, id)"
+            )
+
+    @contextmanager
+    def _connect(self) -> Iterator[sqlite3.Connection]:
+        connection = sqlite3.connect(self.path, timeout=5)
+        connection.row_factory = sqlite3.Row
+        try:
+            with connection:
+                yield connection
+        finally:
+            connection.close()
+
+    @staticmethod
+    def _conversation(row: sqlite3.Row, user_id: str) -> dict[str, Any]:
+        conversation = create_conversation_document(
+            user_id, row["id"], row["title"], row["created_at"], row["updated_at"]
+        )
+        if row["summary"]:
+            conversation["summary"] = json.loads(row["summary"])
+        return conversation
+
+    @staticmethod
+    def _message(row: sqlite3.Row) -> dict[str, Any]:
+        return {"id": row["id"], "role": row["role"], "content": row["content"], "createdAt": row["created_at"]}
+
+    def _create_turn(
+        self,
+        user_id: str,
+        conversation_id: Optional[str],
+        input_messages: list[dict[str, str]],
+        title: str,
+        create_conversation: bool,
+    ) -> dict[str, Any]:
+        now = datetime.utcnow()
+        if conversation_id is None or create_conversation:
+            conversation_id = conversation_id or str(uuid.uuid4())
+            create_conversation = True
+        messages = create_message_documents(user_id, conversation_id, input_messages, now)
+        updated_at = messages[-1]["createdAt"] if messages else now.isoformat()
+        with self._connect() as connection:
+            if create_conversation:
+                try:
+                    connection.execute(
+                        "INSERT INTO conversations (user_id, id, title, created_at, updated_at) VALUES (?, ?, ?, ?, ?)",
+                        (user_id, conversation_id, title, now.isoformat(), updated_at),
+                    )
+                except sqlite3.IntegrityError as error:
+                    raise ValueError(f"Conversation {conversation_id} already exists") from error
+            elif (
+                connection.execute(
+                    "UPDATE conversations SET updated_at = ? WHERE user_id = ? AND id = ?",
+                    (updated_at, user_id, conversation_id),
+                ).rowcount
+                == 0
+            ):
+                raise ValueError(f"Conversation {conversation_id} was not found")
+            connection.executemany(
+                "INSERT INTO messages (user_id, conversation_id, id, role, content, created_at) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                [
+                    (user_id, conversation_id, message["id"], message["role"], message["content"], message["createdAt"])
+                    for message in messages
+                ],
+            )
+        return {"conversation_id": conversation_id, "messages": messages, "request_charge": 0.0}
+
+    def _get_conversation(self, user_id: str, conversation_id: str) -> Optional[dict[str, Any]]:
+        with self._connect() as connection:
+            row = connection.execute(
+                "SELECT id, title, created_at, updated_at, summary FROM conversations WHERE user_id = ? AND id = ?",
+                (user_id, conversation_id),
+            ).fetchone()
+        return self._conversation(row, user_id) if row else None
+
+    def _get_conversations_page(self, user_id: str, page_size: int, continuation: Optional[str]) -> dict[str, Any]:
+        query = "SELECT id, title, updated_at FROM conversations WHERE user_id = ?"
+        parameters: list[Any] = [user_id]
+        if continuation:
+            updated_at, conversation_id = json.loads(continuation)
+            query += " AND (updated_at, id) < (?, ?)"
+            parameters += [updated_at, conversation_id]
+        query += " ORDER BY updated_at DESC, id DESC LIMIT ?"
+        with self._connect() as connection:
+            rows = connection.execute(query, parameters + [page_size + 1]).fetchall()
+        conversations = [
+            {"id": row["id"], "title": row["title"], "updatedAt": row["updated_at"]} for row in rows[:page_size]
+        ]
+        last = conversations[-1] if len(rows) > page_size else None
+        return {
+            "conversations": conversations,
+            "continuation": json.dumps([last["updatedAt"], last["id"]]) if last else None,
+        }
+
+    def _get_messages_page(
+        self, user_id: str, conversation_id: str, page_size: int, continuation: Optional[str]
+    ) -> dict[str, Any]:
+        query = "SELECT id, role, content, created_at FROM messages WHERE user_id = ? AND conversation_id = ?"
+        parameters: list[Any] = [user_id, conversation_id]
+        if continuation:
+            created_at, message_id = json.loads(continuation)
+            query += " AND (created_at, id) < (?, ?)"
+            parameters += [created_at, message_id]
+        query += " ORDER BY created_at DESC, id DESC LIMIT ?"
+        with self._connect() as connection:
+            rows = connection.execute(query, parameters + [page_size + 1]).fetchall()
+        messages = [self._message(row) for row in rows[:page_size]]
+        last = messages[-1] if len(rows) > page_size else None
+        return {
+            "messages": messages[::-1],
+            "continuation": json.dumps([last["createdAt"], last["id"]]) if last else None,
+        }
+
+    def _get_first_messages(
+        self, user_id: str, conversation_id: str, count: int, after: Optional[str]
+    ) -> list[dict[str, Any]]:
+        with self._connect() as connection:
+            rows = connection.execute(
+                "SELECT id, role, content, created_at FROM messages WHERE user_id = ? AND conversation_id = ? "
+                "AND created_at > ? ORDER BY created_at, id LIMIT ?",
+                (user_id, conversation_id, after or "", count),
+            ).fetchall()
+        return [self._message(row) for row in rows]
+
+    def _update_conversation_title(self, user_id: str, conversation_id: str, title: str) -> dict[str, Any]:
+        with self._connect() as connection:
+            row = connection.execute(
+                "UPDATE conversations SET title = ? WHERE user_id = ? AND id = ? "
+                "RETURNING id, title, created_at, updated_at, summary",
+                (title, user_id, conversation_id),
+            ).fetchone()
+        if row is None:
+            raise ValueError(f"Conversation {conversation_id} was not found")
+        return self._conversation(row, user_id)
+
+    def _update_conversation_summary(
+        self, user_id: str, conversation_id: str, summary: dict[str, str]
+    ) -> dict[str, Any]:
+        with self._connect() as connection:
+            row = connection.execute(
+                "UPDATE conversations SET summary = ? WHERE user_id = ? AND id = ? "
+                "RETURNING id, title, created_at, updated_at, summary",
+                (json.dumps(summary), user_id, conversation_id),
+            ).fetchone()
+        if row is None:
+            raise ValueError(f"Conversation {conversation_id} was not found")
+        return self._conversation(row, user_id)
+
+    def _delete_conversation_and_messages(self, user_id: str, conversation_id: str) -> dict[str, Any]:
+        with self._connect() as connection:
+            deleted_items = connection.execute(
+                "DELETE FROM messages WHERE user_id = ? AND conversation_id = ?", (user_id, conversation_id)
+            ).rowcount
+            deleted_items += connection.execute(
+                "DELETE FROM conversations WHERE user_id = ? AND id = ?", (user_id, conversation_id)
+            ).rowcount
+        return {"deleted_items": deleted_items, "request_charge": 0.0}
+
+    def _delete_all_conversations(self, user_id: str) -> dict[str, Any]:
+        with self._connect() as connection:
+            deleted_messages = connection.execute("DELETE FROM messages WHERE user_id = ?", (user_id,)).rowcount
+            deleted_conversations = connection.execute(
+                "DELETE FROM conversations WHERE user_id = ?", (user_id,)
+            ).rowcount
+        return {
+            "deleted_conversations": deleted_conversations,
+            "deleted_items": deleted_conversations + deleted_messages,
+            "request_charge": 0.0,
+        }
+
+    async def create_turn(
+        self,
+        user_id: str,
+        conversation_id: Optional[str],
+        input_messages: list[dict[str, str]],
+        title: str = "",
+        create_conversation: bool = False,
+    ) -> dict[str, Any]:
+        return await asyncio.to_thread(
+            self._create_turn, user_id, conversation_id, input_messages, title, create_conversation
+        )
+
+    async def get_conversation(self, user_id: str, conversation_id: str) -> Optional[dict[str, Any]]:
+        return await asyncio.to_thread(self._get_conversation, user_id, conversation_id)
+
+    async def get_conversations_page(
+        self, user_id: str, page_size: int = 20, continuation: Optional[str] = None
+    ) -> dict[str, Any]:
+        return await asyncio.to_thread(self._get_conversations_page, user_id, page_size, continuation)
+
+    async def get_messages_page(
+        self, user_id: str, conversation_id: str, page_size: int = 20, continuation: Optional[str] = None
+    ) -> dict[str, Any]:
+        return await asyncio.to_thread(self._get_messages_page, user_id, conversation_id, page_size, continuation)
+
+    async def get_first_messages(
+        self, user_id: str, conversation_id: str, count: int, after: Optional[str] = None
+    ) -> list[dict[str, Any]]:
+        return await asyncio.to_thread(self._get_first_messages, user_id, conversation_id, count, after)
+
+    async def update_conversation_title(self, user_id: str, conversation_id: str, title: str) -> dict[str, Any]:
+        return await asyncio.to_thread(self._update_conversation_title, user_id, conversation_id, title)
+
+    async def update_conversation_summary(
+        self, user_id: str, conversation_id: str, summary: dict[str, str]
+    ) -> dict[str, Any]:
+        return await asyncio.to_thread(self._update_conversation_summary, user_id, conversation_id, summary)
+
+    async def delete_conversation_and_messages(self, user_id: str, conversation_id: str) -> dict[str, Any]:
+        return await asyncio.to_thread(self._delete_conversation_and_messages, user_id, conversation_id)
+
+    async def delete_all_conversations(self, user_id: str) -> dict[str, Any]:
+        return await asyncio.to_thread(self._delete_all_conversations, user_id)
@@ -0,0 +1,64 @@
+from typing import Any, Awaitable, Callable, Optional
+
+from history.conversationworker import ConversationWorker
+from history.storage import ConversationStorage
+
+
+class SummaryWorker(ConversationWorker):
+    """
+    Folds the older messages of long conversations into a running summary stored with the conversation, in the
+    background, so that the prompt of each turn holds the summary and the recent messages instead of the whole
+    conversation. A conversation is summarized once it has threshold messages after its summary, keeping the
+    keep_recent most recent messages as they are.
+    Attributes:
+        threshold (int): The number of messages after the summary that triggers a new summary.
+        keep_recent (int): The number of most recent messages that are not summarized.
+        max_messages (int): The number of messages folded into the summary at once.
+    Methods:
+        summarize(self, user_id, conversation_id): Folds the older messages into the summary of a conversation.
+    """
+
+    job_name = "summarization"
+
+    def __init__(
+        self,
+        conversation_client: ConversationStorage,
+        create_summary: Callable[[Optional[str], list[dict[str, Any]]], Awaitable[str]],
+        threshold: int = 20,
+        keep_recent: int = 6,
+        max_messages: int = 40,
+        max_concurrency: int = 2,
+        max_retries: int = 3,
+        retry_delay: float = 1.0,
+        max_queue_size: int = 1000,
+    ):
+        super().__init__(conversation_client, max_concurrency, max_retries, retry_delay, max_queue_size)
+        if keep_recent >= threshold:
+            raise ValueError("keep_recent must be lower than threshold")
+        self.create_summary = create_summary
+        self.threshold = threshold
+        self.keep_recent = keep_recent
+        self.max_messages = max(max_messages, threshold - keep_recent)
+
+    async def summarize(self, user_id: str, conversation_id: str) -> Optional[dict[str, Any]]:
+        """
+        Folds the messages after the current summary, except the most recent ones, into a new summary.
+        Returns the updated conversation, or None if the conversation does not need a new summary yet.
+        """
+        conversation = await self.conversation_client.get_conversation(user_id, conversation_id)
+        if conversation is None:
+            return None
+        summary = conversation.get("summary") or {}
+        messages = await self.conversation_client.get_first_messages(
+            user_id, conversation_id, self.max_messages + self.keep_recent, after=summary.get("through")
+        )
+        if len(messages) < self.threshold:
+            return None
+        folded = messages[: len(messages) - self.keep_recent]
+        content = await self.create_summary(summary.get("content"), folded)
+        return await self.conversation_client.update_conversation_summary(
+            user_id, conversation_id, {"content": content, "through": folded[-1]["createdAt"]}
+        )
+
+    async def run(self, user_id: str, conversation_id: str):
+        await self.summarize(user_id, conversation_id)
@@ -0,0 +1,45 @@
+from typing import Any, Awaitable, Callable
+
+from history.conversationworker import ConversationWorker
+from history.storage import ConversationStorage
+
+
+class TitleWorker(ConversationWorker):
+    """
+    Generates conversation titles in the background, so that responses to the user do not wait on the extra
+    completion call. Titles are queued per conversation and generated by a fixed number of worker tasks.
+    Attributes:
+        max_messages (int): The number of messages from the start of the conversation used to generate the title.
+    Methods:
+        generate_title(self, user_id, conversation_id): Generates and writes the title of a conversation.
+    """
+
+    job_name = "title generation"
+
+    def __init__(
+        self,
+        conversation_client: ConversationStorage,
+        create_title: Callable[[list[dict[str, Any]]], Awaitable[str]],
+        max_concurrency: int = 2,
+        max_retries: int = 3,
+        retry_delay: float = 1.0,
+        max_messages: int = 4,
+        max_queue_size: int = 1000,
+    ):
+        super().__init__(conversation_client, max_concurrency, max_retries, retry_delay, max_queue_size)
+        self.create_title = create_title
+        self.max_messages = max_messages
+
+    async def generate_title(self, user_id: str, conversation_id: str) -> dict[str, Any]:
+        """
+        Generates a title from the first messages of the conversation and writes it to the conversation.
+        Returns the updated conversation.
+        """
+        messages = await self.conversation_client.get_first_messages(user_id, conversation_id, self.max_messages)
+        if not messages:
+            raise ValueError(f"No messages for {conversation_id} were found")
+        title = await self.create_title(messages)
+        return await self.conversation_client.update_conversation_title(user_id, conversation_id, title)
+
+    async def run(self, user_id: str, conversation_id: str):
+        await self.generate_title(user_id, conversation_id)
@@ -0,0 +1,237 @@
+import asyncio
+import logging
+import time
+from dataclasses import dataclass, field
+from typing import Any, Callable, Optional
+
+from history.cosmosdbservice import MAX_BATCH_OPERATIONS
+from history.storage import ConversationStorage
+
+
+@dataclass
+class PendingTurns:
+    """
+    Messages of a conversation waiting to be written, the futures of the callers that queued them, and the failed
+    attempts to write them so far.
+    """
+
+    messages: list[dict[str, str]] = field(default_factory=list)
+    create_conversation: bool = False
+    futures: list[asyncio.Future] = field(default_factory=list)
+    attempts: int = 0
+    retry_at: float = 0.0
+
+
+class WriteBehindQueue:
+    """
+    Queues conversation turns in memory and writes them to the conversation storage in the background, so that
+    requests do not wait on the write. Turns queued for the same conversation before a flush are coalesced into a
+    single transactional batch. Pending turns are flushed every flush_interval seconds, as soon as max_pending_messages
+    messages are waiting, and when the queue is closed. Turns that fail to be written are queued again, ahead of the
+    turns queued since, and retried with exponential backoff until max_attempts writes have failed.
+    Attributes:
+        flush_interval (float): Seconds between flushes of the pending turns.
+        max_pending_messages (int): The number of waiting messages that triggers a flush before the interval.
+        max_concurrency (int): The number of conversations written at the same time during a flush.
+        max_attempts (int): The number of failed writes of a turn after which it is dropped.
+        retry_delay (float): Seconds before the first retry of a failed write, doubled on every retry.
+    Methods:
+        start(self): Starts the flush task. Must be called from within a running event loop.
+        enqueue(self, user_id, conversation_id, messages, create_conversation): Queues messages to be written.
+        flush(self, user_id, conversation_id): Writes the pending turns, optionally only those of a user or a
+            conversation, so that they can be read back.
+        close(self): Stops the flush task and writes all the pending turns, retrying the failed ones.
+        get_stats(self): Returns queue depth and flush statistics.
+    """
+
+    def __init__(
+        self,
+        conversation_client: ConversationStorage,
+        flush_interval: float = 0.1,
+        max_pending_messages: int = 100,
+        max_concurrency: int = 4,
+        max_attempts: int = 5,
+        retry_delay: float = 0.5,
+    ):
+        self.conversation_client = conversation_client
+        self.flush_interval = flush_interval
+        self.max_pending_messages = max_pending_messages
+        self.max_concurrency = max_concurrency
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.pending: dict[tuple[str, str], PendingTurns] = {}
+        self.pending_messages = 0
+        self.enqueued = 0
+        self.coalesced = 0
+        self.flushes = 0
+        self.written_batches = 0
+        self.written_messages = 0
+        self.failed_batches = 0
+        self.retried_batches = 0
+        self.flush_latency_ms = 0.0
+        self.max_flush_latency_ms = 0.0
+        self._flush_lock = asyncio.Lock()
+        self._wake = asyncio.Event()
+        self._closing = False
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    def enqueue(
+        self,
+        user_id: str,
+        conversation_id: str,
+        messages: list[dict[str, str]],
+        create_conversation: bool = False,
+    ) -> asyncio.Future:
+        """
+        Queues the messages to be written to the conversation and returns immediately. The returned future
+        resolves with the conversation id, version and request charge of the write, once it has happened.
+        """
+        key = (user_id, conversation_id)
+        if key in self.pending:
+            self.coalesced += 1
+        turns = self.pending.setdefault(key, PendingTurns())
+        turns.messages.extend(messages)
+        turns.create_conversation = turns.create_conversation or create_conversation
+        future = asyncio.get_running_loop().create_future()
+        turns.futures.append(future)
+        self.enqueued += 1
+        self.pending_messages += len(messages)
+        if self.pending_messages >= self.max_pending_messages:
+            self._wake.set()
+        return future
+
+    async def flush(self, user_id: Optional[str] = None, conversation_id: Optional[str] = None):
+        """
+        Writes the pending turns, of all conversations or only those of the user or conversation, including the
+        turns waiting to be retried.
+        """
+        await self._flush(
+            lambda key, turns: (user_id is None or key[0] == user_id)
+            and (conversation_id is None or key[1] == conversation_id)
+        )
+
+    async def _flush(self, select: Callable[[tuple[str, str], PendingTurns], bool]):
+        async with self._flush_lock:
+            keys = [key for key, turns in self.pending.items() if select(key, turns)]
+            if not keys:
+                return
+            start = time.perf_counter()
+            semaphore = asyncio.Semaphore(self.max_concurrency)
+
+            async def write(key: tuple[str, str], turns: PendingTurns):
+                async with semaphore:
+                    await self._write(key, turns)
+
+            pending = [(key, self.pending.pop(key)) for key in keys]
+            self.pending_messages -= sum(len(turns.messages) for _, turns in pending)
+            await asyncio.gather(*(write(key, turns) for key, turns in pending))
+            self.flushes += 1
+            self.flush_latency_ms = (time.perf_counter() - start) * 1000
+            self.max_flush_latency_ms = max(self.max_flush_latency_ms, self.flush_latency_ms)
+
+    async def close(self):
+        if self._task is not None:
+            # The flush task is stopped between flushes rather than cancelled, since cancelling it in the middle of a
+            # flush would lose the turns that flush already took from the pending ones
+            self._closing = True
+            self._wake.set()
+            await self._task
+            self._task = None
+        await self.flush()
+        # Failed writes are retried after their delay, until they are written or run out of attempts
+        while self.pending:
+            retry_at = min(turns.retry_at for turns in self.pending.values())
+            await asyncio.sleep(max(retry_at - time.monotonic(), 0))
+            await self._flush(lambda key, turns: turns.retry_at <= time.monotonic())
+
+    def get_stats(self) -> dict[str, Any]:
+        return {
+            "queue_depth": self.pending_messages,
+            "pending_conversations": len(self.pending),
+            "enqueued": self.enqueued,
+            "coalesced": self.coalesced,
+            "flushes": self.flushes,
+            "written_batches": self.written_batches,
+            "written_messages": self.written_messages,
+            "failed_batches": self.failed_batches,
+            "retried_batches": self.retried_batches,
+            "flush_latency_ms": self.flush_latency_ms,
+            "max_flush_latency_ms": self.max_flush_latency_ms,
+        }
+
+    async def _run(self):
+        while not self._closing:
+            try:
+                await asyncio.wait_for(self._wake.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wake.clear()
+            try:
+                await self._flush(lambda key, turns: turns.retry_at <= time.monotonic())
+            except Exception:
+                logging.exception("Failed to flush conversation history")
+
+    async def _write(self, key: tuple[str, str], turns: PendingTurns):
+        user_id, conversation_id = key
+        result: dict[str, Any] = {"conversation_id": conversation_id, "version": None, "request_charge": 0.0}
+        # A batch holds the update of the conversation and up to MAX_BATCH_OPERATIONS - 1 messages
+        batch_size = MAX_BATCH_OPERATIONS - 1
+        written = 0
+        try:
+            for written in range(0, len(turns.messages), batch_size):
+                turn = await self.conversation_client.create_turn(
+                    user_id,
+                    conversation_id,
+                    turns.messages[written : written + batch_size],
+                    create_conversation=turns.create_conversation and written == 0,
+                )
+                self.written_batches += 1
+                self.written_messages += len(turn["messages"])
+                result["version"] = turn["messages"][-1]["createdAt"]
+                result["request_charge"] += turn["request_charge"]
+        except Exception as error:
+            self.failed_batches += 1
+            turns.attempts += 1
+            if turns.attempts < self.max_attempts:
+                logging.warning(
+                    "Failed to write %d messages of conversation %s, retrying: %s",
+                    len(turns.messages) - written,
+                    conversation_id,
+                    error,
+                )
+                self._retry(key, turns, written)
+                return
+            logging.exception("Failed to write %d messages of conversation %s", len(turns.messages), conversation_id)
+            for future in turns.futures:
+                if not future.done():
+                    future.set_exception(error)
+                    # Callers may not wait for the write, so the exception is retrieved here after being logged
+                    future.exception()
+            return
+        for future in turns.futures:
+            if not future.done():
+                future.set_result(result)
+
+    def _retry(self, key: tuple[str, str], turns: PendingTurns, written: int):
+        """
+        Queues the messages of the turns that were not written again, ahead of the turns queued since the flush.
+        """
+        retry = PendingTurns(
+            messages=turns.messages[written:],
+            # The batches written before the failure created the conversation
+            create_conversation=turns.create_conversation and written == 0,
+            futures=turns.futures,
+            attempts=turns.attempts,
+            retry_at=time.monotonic() + self.retry_delay * 2 ** (turns.attempts - 1),
+        )
+        self.retried_batches += 1
+        self.pending_messages += len(retry.messages)
+        if (newer := self.pending.get(key)) is not None:
+            retry.messages.extend(newer.messages)
+            retry.create_conversation = retry.create_conversation or newer.create_conversation
+            retry.futures.extend(newer.futures)
+        self.pending[key] = retry
@@ -0,0 +1,120 @@
+import asyncio
+from typing import Any, NamedTuple, Optional
+
+import numpy as np
+
+from .index import LocalSearchIndex
+
+
+class LocalCaption(NamedTuple):
+    """
+    Caption of a local search result, read like the captions of the results returned by the search client.
+    """
+
+    text: Optional[str]
+    highlights: Optional[str]
+
+
+class LocalSearchResults:
+    """
+    Search results, iterated asynchronously like the results returned by the search client.
+    """
+
+    def __init__(self, results: list[dict[str, Any]], count: int):
+        self.results = iter(results)
+        self.count = count
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self) -> dict[str, Any]:
+        try:
+            return next(self.results)
+        except StopIteration:
+            raise StopAsyncIteration
+
+    async def get_count(self) -> int:
+        return self.count
+
+
+class LocalSearchClient:
+    """
+    Implements the part of azure.search.documents.aio.SearchClient used by the approaches and the search caches on
+    top of a LocalSearchIndex, so that retrieval does not leave the process. Text, vector and hybrid queries are
+    supported with the filters built by the approaches. There is no semantic ranker: semantic queries are ranked like
+    other queries, and the caption of a result is its content.
+    Attributes:
+        index (LocalSearchIndex): The index that is searched.
+    Methods:
+        open(cls, directory): Opens the index in the directory, compiling the documents written by prepdocs if needed.
+        search(self, search_text, ...): Searches the index, with the arguments of SearchClient.search.
+        close(self): Closes the index.
+    """
+
+    def __init__(self, index: LocalSearchIndex):
+        self.index = index
+
+    @classmethod
+    async def open(cls, directory: str) -> "LocalSearchClient":
+        return cls(await asyncio.to_thread(LocalSearchIndex.open, directory))
+
+    @property
+    def version(self) -> str:
+        return self.index.version
+
+    def _search(
+        self,
+        search_text: Optional[str],
+        mask: Optional[np.ndarray],
+        top: Optional[int],
+        vector: Optional[list[float]],
+        top_k: Optional[int],
+        select: Optional[list[str]],
+        query_caption: Optional[str],
+    ) -> LocalSearchResults:
+        # Azure AI Search returns 50 results unless top is given
+        rows, count = self.index.search(search_text, vector, top or 50, top_k, mask)
+        results = []
+        for row, score in rows:
+            document = self.index.get_document(row)
+            result = {field: document.get(field) for field in select} if select else document
+            result.update(
+                {
+                    "@search.score": score,
+                    "@search.reranker_score": None,
+                    "@search.highlights": None,
+                    "@search.captions": (
+                        [LocalCaption(text=document.get("content"), highlights=None)] if query_caption else None
+                    ),
+                }
+            )
+            results.append(result)
+        return LocalSearchResults(results, count)
+
+    async def search(
+        self,
+        search_text: Optional[str] = None,
+        *,
+        filter: Optional[str] = None,
+        top: Optional[int] = None,
+        vector: Optional[list[float]] = None,
+        top_k: Optional[int] = None,
+        vector_fields: Optional[str] = None,
+        select: Optional[list[str]] = None,
+        query_caption: Optional[str] = None,
+        **kwargs: Any,
+    ) -> LocalSearchResults:
+        if vector is not None and vector_fields not in (None, "embedding"):
+            raise ValueError(f"Vector field {vector_fields} is not supported")
+        # Filter masks are cached, so they are evaluated on the event loop rather than in the search threads
+        mask = self.index.filter(filter)
+        return await asyncio.to_thread(self._search, search_text, mask, top, vector, top_k, select, query_caption)
+
+    async def close(self):
+        self.index.close()
+
+    async def __aenter__(self) -> "LocalSearchClient":
+        return self
+
+    async def __aexit__(self, *args):
+        await self.close()
@@ -0,0 +1,109 @@
+import re
+from typing import Callable, Optional, Sequence
+
+import numpy as np
+
+# The subset of OData filters built by the approaches, the document cache and prepdocs:
+#   field eq 'value', field ne 'value', field eq null, field ne null
+#   collection/any(g:search.in(g, 'value1, value2'))
+#   search.in(field, 'value1,value2', ',')
+# combined with "and", "or" and parentheses
+COMPARISON = re.compile(r"^(\w+) (eq|ne) (?:'((?:[^']|'')*)'|(null))$")
+ANY_SEARCH_IN = re.compile(r"^(\w+)/any\((\w+):\s*search\.in\(\2,\s*'((?:[^']|'')*)'(?:,\s*'((?:[^']|'')*)')?\)\)$")
+SEARCH_IN = re.compile(r"^search\.in\((\w+),\s*'((?:[^']|'')*)'(?:,\s*'((?:[^']|'')*)')?\)$")
+
+
+def unquote(value: str) -> str:
+    return value.replace("''", "'")
+
+
+def split_values(values: str, delimiters: Optional[str]) -> list[str]:
+    # search.in splits on spaces and commas unless other delimiters are given
+    pattern = "[" + re.escape(unquote(delimiters) if delimiters else " ,") + "]"
+    return [value for value in re.split(pattern, unquote(values)) if value]
+
+
+def split_top_level(expression: str, separator: str) -> list[str]:
+    """
+    Splits the expression on the separator, ignoring separators inside quotes or parentheses.
+    """
+    parts = []
+    depth = 0
+    quoted = False
+    start = 0
+    index = 0
+    while index < len(expression):
+        char = expression[index]
+        if char == "'":
+            quoted = not quoted
+        elif not quoted:
+            if char == "(":
+                depth += 1
+            elif char == ")":
+                depth -= 1
+            elif depth == 0 and expression.startswith(separator, index):
+                parts.append(expression[start:index].strip())
+                index += len(separator)
+                start = index
+                continue
+        index += 1
+    parts.append(expression[start:].strip())
+    return parts
+
+
+def strip_parentheses(expression: str) -> str:
+    """
+    Removes the parentheses around the whole expression, if any.
+    """
+    while expression.startswith("(") and expression.endswith(")"):
+        depth = 0
+        quoted = False
+        for index, char in enumerate(expression):
+            if char == "'":
+                quoted = not quoted
+            elif not quoted and char == "(":
+                depth += 1
+            elif not quoted and char == ")":
+                depth -= 1
+                if depth == 0 and index < len(expression) - 1:
+                    return expression
+        expression = expression[1:-1].strip()
+    return expression
+
+
+def evaluate_filter(
+    expression: str, count: int, find_rows: Callable[[str, Sequence[Optional[str]]], np.ndarray]
+) -> np.ndarray:
+    """
+    Returns the mask of the rows matching the filter expression. find_rows returns the rows whose field holds one
+    of the values, None standing for a null field.
+    Raises ValueError for expressions outside of the supported subset.
+    """
+    expression = strip_parentheses(expression.strip())
+    alternatives = split_top_level(expression, " or ")
+    if len(alternatives) > 1:
+        mask = np.zeros(count, dtype=bool)
+        for alternative in alternatives:
+            mask |= evaluate_filter(alternative, count, find_rows)
+        return mask
+    conditions = split_top_level(expression, " and ")
+    if len(conditions) > 1:
+        mask = np.ones(count, dtype=bool)
+        for condition in conditions:
+            mask &= evaluate_filter(condition, count, find_rows)
+        return mask
+
+    mask = np.zeros(count, dtype=bool)
+    if match := COMPARISON.match(expression):
+        field, operator, value, null = match.groups()
+        mask[find_rows(field, [None if null else unquote(value)])] = True
+        return ~mask if operator == "ne" else mask
+    if match := ANY_SEARCH_IN.match(expression):
+        field, _, values, delimiters = match.groups()
+        mask[find_rows(field, split_values(values, delimiters))] = True
+        return mask
+    if match := SEARCH_IN.match(expression):
+        field, values, delimiters = match.groups()
+        mask[find_rows(field, split_values(values, delimiters))] = True
+        return mask
+    raise ValueError(f"Unsupported filter: {expression}")
@@ -0,0 +1,341 @@
+import json
+import math
+import mmap
+import os
+import re
+import uuid
+from collections import OrderedDict
+from typing import Any, Iterable, Iterator, Optional, Sequence
+
+import numpy as np
+
+from .filter import evaluate_filter
+
+DOCUMENTS_FILE_NAME = "documents.jsonl"
+MANIFEST_FILE_NAME = "manifest.json"
+# Fields that can be used in filters, collections (oids and groups) hold lists of values
+FILTERABLE_FIELDS = ("id", "category", "sourcepage", "sourcefile", "oids", "groups")
+TOKEN_PATTERN = re.compile(r"\w+")
+# BM25 parameters, the defaults of Azure AI Search
+K1 = 1.2
+B = 0.75
+RRF_K = 60
+MAX_FILTER_MASKS = 256
+
+
+def tokenize(text: str) -> list[str]:
+    return TOKEN_PATTERN.findall(text.lower())
+
+
+def read_documents(path: str) -> Iterator[dict[str, Any]]:
+    """
+    Reads the documents of a JSON lines file, keeping the last line written for each document key.
+    """
+    latest: dict[str, int] = {}
+    with open(path, "rb") as file:
+        for number, line in enumerate(file):
+            if line.strip():
+                latest[json.loads(line)["id"]] = number
+    rows = set(latest.values())
+    with open(path, "rb") as file:
+        for number, line in enumerate(file):
+            if number in rows:
+                yield json.loads(line)
+
+
+class LocalSearchIndex:
+    """
+    Search index stored in a directory and searched without leaving the process. The documents written by prepdocs
+    to documents.jsonl are compiled into:
+        embeddings.f32: the normalized embeddings, a float32 matrix that is memory-mapped and searched exhaustively
+        terms.json, term_offsets.npy, posting_rows.npy, posting_counts.npy and row_lengths.npy: the inverted index of
+            the content field, used to rank documents with BM25
+        fields.jsonl and field_offsets.npy: the other fields of the documents, read when they are returned
+        filters.json: the rows holding each value of the filterable fields
+    Attributes:
+        directory (str): The directory of the index.
+        count (int): The number of documents.
+        dimensions (int): The number of dimensions of the embeddings, or None if the documents have none.
+        version (str): Identifies the build of the index.
+    Methods:
+        build(cls, directory, documents, source): Compiles documents into an index in the directory.
+        open(cls, directory): Opens the index in the directory, compiling documents.jsonl first if it changed.
+        filter(self, expression): Returns the mask of the documents matching a filter.
+        search(self, text, vector, top, vector_k, mask): Returns the rows and scores of the best documents.
+        get_document(self, row): Returns the fields of a document.
+    """
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        with open(self.path(MANIFEST_FILE_NAME)) as file:
+            manifest = json.load(file)
+        self.count: int = manifest["count"]
+        self.dimensions: Optional[int] = manifest["dimensions"]
+        self.average_length: float = manifest["average_length"]
+        self.version: str = manifest["version"]
+        self.embeddings: Optional[np.ndarray] = None
+        if self.count and self.dimensions:
+            self.embeddings = np.memmap(
+                self.path("embeddings.f32"), dtype=np.float32, mode="r", shape=(self.count, self.dimensions)
+            )
+        self.embedded = np.load(self.path("embedded.npy"))
+        with open(self.path("terms.json")) as file:
+            self.vocabulary = {term: term_id for term_id, term in enumerate(json.load(file))}
+        self.term_offsets = np.load(self.path("term_offsets.npy"), mmap_mode="r")
+        self.posting_rows = np.load(self.path("posting_rows.npy"), mmap_mode="r")
+        self.posting_counts = np.load(self.path("posting_counts.npy"), mmap_mode="r")
+        self.row_lengths = np.load(self.path("row_lengths.npy"))
+        self.field_offsets = np.load(self.path("field_offsets.npy"))
+        self._fields_file = open(self.path("fields.jsonl"), "rb")
+        self._fields = mmap.mmap(self._fields_file.fileno(), 0, access=mmap.ACCESS_READ) if self.count else None
+        with open(self.path("filters.json")) as file:
+            self.filters = {
+                field: {value: np.asarray(rows, dtype=np.int64) for value, rows in postings}
+                for field, postings in json.load(file).items()
+            }
+        self.filter_masks: OrderedDict[str, np.ndarray] = OrderedDict()
+
+    def path(self, name: str) -> str:
+        return os.path.join(self.directory, name)
+
+    @classmethod
+    def open(cls, directory: str) -> "LocalSearchIndex":
+        source = os.path.join(directory, DOCUMENTS_FILE_NAME)
+        stat = os.stat(source)
+        state = {"size": stat.st_size, "modified": stat.st_mtime_ns}
+        try:
+            with open(os.path.join(directory, MANIFEST_FILE_NAME)) as file:
+                built = json.load(file).get("source") == state
+        except FileNotFoundError:
+            built = False
+        if not built:
+            cls.build(directory, read_documents(source), state)
+        return cls(directory)
+
+    @classmethod
+    def build(
+        cls, directory: str, documents: Iterable[dict[str, Any]], source: Optional[dict[str, Any]] = None
+    ) -> "LocalSearchIndex":
+        """
+        Compiles the documents into an index in the directory, replacing the index already there.
+        The files are written next to the current ones and then renamed, the manifest last.
+        """
+        version = uuid.uuid4().hex
+
+        def temporary_path(name: str) -> str:
+            return os.path.join(directory, f"{name}.{version}.tmp")
+
+        os.makedirs(directory, exist_ok=True)
+        vocabulary: dict[str, int] = {}
+        term_chunks: list[np.ndarray] = []
+        row_chunks: list[np.ndarray] = []
+        count_chunks: list[np.ndarray] = []
+        row_lengths: list[int] = []
+        field_offsets = [0]
+        embedded: list[bool] = []
+        filters: dict[str, dict[Any, list[int]]] = {field: {} for field in FILTERABLE_FIELDS}
+        dimensions: Optional[int] = None
+        count = 0
+        with open(temporary_path("embeddings.f32"), "wb") as embeddings_file, open(
+            temporary_path("fields.jsonl"), "wb"
+        ) as fields_file:
+            for row, document in enumerate(documents):
+                count += 1
+                embedding = document.get("embedding")
+                has_embedding = embedding is not None and len(embedding) > 0
+                embedded.append(has_embedding)
+                if has_embedding:
+                    vector = np.asarray(embedding, dtype=np.float32)
+                    dimensions = dimensions or len(vector)
+                    if len(vector) != dimensions:
+                        raise ValueError(
+                            f"Embedding of {document['id']} has {len(vector)} dimensions, not {dimensions}"
+                        )
+                    norm = np.linalg.norm(vector)
+                    # Rows without embeddings are left as zeros
+                    embeddings_file.seek(row * dimensions * 4)
+                    embeddings_file.write((vector / norm if norm else vector).tobytes())
+
+                tokens = tokenize(document.get("content") or "")
+                row_lengths.append(len(tokens))
+                if tokens:
+                    term_ids = np.fromiter(
+                        (vocabulary.setdefault(token, len(vocabulary)) for token in tokens), np.int32, len(tokens)
+                    )
+                    terms, counts = np.unique(term_ids, return_counts=True)
+                    term_chunks.append(terms)
+                    row_chunks.append(np.full(len(terms), row, dtype=np.int32))
+                    count_chunks.append(counts.astype(np.float32))
+
+                fields = {key: value for key, value in document.items() if key != "embedding"}
+                line = json.dumps(fields).encode() + b"\n"
+                fields_file.write(line)
+                field_offsets.append(field_offsets[-1] + len(line))
+                for field in FILTERABLE_FIELDS:
+                    value = fields.get(field)
+                    for item in value if isinstance(value, list) else [value]:
+                        filters[field].setdefault(item, []).append(row)
+            embeddings_file.truncate(count * (dimensions or 0) * 4)
+
+        if term_chunks:
+            terms = np.concatenate(term_chunks)
+            order = np.argsort(terms, kind="stable")
+            posting_rows = np.concatenate(row_chunks)[order]
+            posting_counts = np.concatenate(count_chunks)[order]
+            term_offsets = np.concatenate([[0], np.cumsum(np.bincount(terms, minlength=len(vocabulary)))])
+        else:
+            posting_rows = np.zeros(0, dtype=np.int32)
+            posting_counts = np.zeros(0, dtype=np.float32)
+            term_offsets = np.zeros(1, dtype=np.int64)
+
+        arrays = {
+            "embedded.npy": np.asarray(embedded, dtype=bool),
+            "term_offsets.npy": term_offsets.astype(np.int64),
+            "posting_rows.npy": posting_rows,
+            "posting_counts.npy": posting_counts,
+            "row_lengths.npy": np.asarray(row_lengths, dtype=np.float32),
+            "field_offsets.npy": np.asarray(field_offsets, dtype=np.int64),
+        }
+        for name, array in arrays.items():
+            with open(temporary_path(name), "wb") as array_file:
+                np.save(array_file, array)
+        with open(temporary_path("terms.json"), "w") as terms_file:
+            json.dump(sorted(vocabulary, key=vocabulary.__getitem__), terms_file)
+        with open(temporary_path("filters.json"), "w") as filters_file:
+            json.dump({field: list(postings.items()) for field, postings in filters.items()}, filters_file)
+        with open(temporary_path(MANIFEST_FILE_NAME), "w") as manifest_file:
+            manifest = {
+                "count": count,
+                "dimensions": dimensions,
+                "average_length": sum(row_lengths) / count if count else 0.0,
+                "version": version,
+                "source": source,
+            }
+            json.dump(manifest, manifest_file)
+
+        names = ["embeddings.f32", "fields.jsonl", "terms.json", "filters.json", *arrays, MANIFEST_FILE_NAME]
+        for name in names:
+            os.replace(temporary_path(name), os.path.join(directory, name))
+        return cls(directory)
+
+    def close(self):
+        if self._fields is not None:
+            self._fields.close()
+        self._fields_file.close()
+
+    def find_rows(self, field: str, values: Sequence[Optional[str]]) -> np.ndarray:
+        if field not in self.filters:
+            raise ValueError(f"Field {field} is not filterable")
+        postings = self.filters[field]
+        rows = [postings[value] for value in values if value in postings]
+        return np.concatenate(rows) if rows else np.zeros(0, dtype=np.int64)
+
+    def filter(self, expression: Optional[str]) -> Optional[np.ndarray]:
+        """
+        Returns the mask of the documents matching the filter, or None if there is no filter.
+        Masks of recent filters are kept, as the same security filters are used by every query of a user.
+        """
+        if not expression:
+            return None
+        mask = self.filter_masks.get(expression)
+        if mask is None:
+            mask = evaluate_filter(expression, self.count, self.find_rows)
+            self.filter_masks[expression] = mask
+            while len(self.filter_masks) > MAX_FILTER_MASKS:
+                self.filter_masks.popitem(last=False)
+        else:
+            self.filter_masks.move_to_end(expression)
+        return mask
+
+    def best(self, scores: np.ndarray, k: int) -> list[tuple[int, float]]:
+        """
+        Returns the k rows with the highest scores, ignoring rows scored -inf.
+        """
+        if k <= 0:
+            return []
+        candidates = np.argpartition(-scores, k)[:k] if k < len(scores) else np.arange(len(scores))
+        candidates = candidates[np.isfinite(scores[candidates])]
+        candidates = candidates[np.argsort(-scores[candidates], kind="stable")]
+        return [(int(row), float(scores[row])) for row in candidates]
+
+    def text_search(self, text: str, k: int, mask: Optional[np.ndarray] = None) -> tuple[list[tuple[int, float]], int]:
+        """
+        Ranks the documents holding any of the terms of the text with BM25.
+        Returns the k best rows with their scores, and the number of matching documents.
+        """
+        scores = np.zeros(self.count, dtype=np.float32)
+        matched = np.zeros(self.count, dtype=bool)
+        for term in set(tokenize(text)):
+            term_id = self.vocabulary.get(term)
+            if term_id is None:
+                continue
+            start, end = self.term_offsets[term_id], self.term_offsets[term_id + 1]
+            rows = self.posting_rows[start:end]
+            counts = self.posting_counts[start:end]
+            idf = math.log(1 + (self.count - len(rows) + 0.5) / (len(rows) + 0.5))
+            lengths = self.row_lengths[rows]
+            scores[rows] += idf * counts * (K1 + 1) / (counts + K1 * (1 - B + B * lengths / self.average_length))
+            matched[rows] = True
+        if mask is not None:
+            matched &= mask
+        return self.best(np.where(matched, scores, -np.inf), k), int(matched.sum())
+
+    def vector_search(
+        self, vector: list[float], k: int, mask: Optional[np.ndarray] = None
+    ) -> tuple[list[tuple[int, float]], int]:
+        """
+        Ranks the documents by the cosine similarity of their embedding to the vector, scored like Azure AI Search.
+        Returns the k nearest rows with their scores, and the number of rows returned.
+        """
+        if self.embeddings is None:
+            return [], 0
+        query = np.asarray(vector, dtype=np.float32)
+        norm = np.linalg.norm(query)
+        query = query / norm if norm else query
+        allowed = self.embedded if mask is None else self.embedded & mask
+        scores = np.full(self.count, -np.inf, dtype=np.float32)
+        rows = np.flatnonzero(allowed)
+        if len(rows) < self.count // 2:
+            # Selective filters only read the embeddings of the rows they match
+            scores[rows] = self.embeddings[rows] @ query
+        else:
+            scores = np.where(allowed, self.embeddings @ query, scores)
+        # Azure AI Search scores cosine similarity as 1 / (1 + cosine distance)
+        nearest = [(row, 1 / (2 - similarity)) for row, similarity in self.best(scores, k)]
+        return nearest, len(nearest)
+
+    def search(
+        self,
+        text: Optional[str],
+        vector: Optional[list[float]],
+        top: int,
+        vector_k: Optional[int] = None,
+        mask: Optional[np.ndarray] = None,
+    ) -> tuple[list[tuple[int, float]], int]:
+        """
+        Returns the top rows with their scores, and the number of matching documents. Text and vector queries are
+        combined with Reciprocal Rank Fusion, like the hybrid queries of Azure AI Search. Without either query, all
+        the documents matching the mask are returned in index order.
+        """
+        has_text = bool(text) and text != "*"
+        k = vector_k or top
+        if has_text and vector is not None:
+            text_results, _ = self.text_search(text or "", max(top, k), mask)
+            vector_results, _ = self.vector_search(vector, k, mask)
+            fused: dict[int, float] = {}
+            for results in (text_results, vector_results):
+                for rank, (row, _) in enumerate(results, start=1):
+                    fused[row] = fused.get(row, 0.0) + 1 / (RRF_K + rank)
+            ranked = sorted(fused.items(), key=lambda item: item[1], reverse=True)
+            return ranked[:top], len(fused)
+        if has_text:
+            return self.text_search(text or "", top, mask)
+        if vector is not None:
+            results, count = self.vector_search(vector, k, mask)
+            return results[:top], count
+        rows = np.flatnonzero(mask) if mask is not None else np.arange(self.count)
+        return [(int(row), 1.0) for row in rows[:top]], len(rows)
+
+    def get_document(self, row: int) -> dict[str, Any]:
+        assert self._fields is not None
+        return json.loads(self._fields[self.field_offsets[row] : self.field_offsets[row + 1]])
@@ -61,6 +61,8 @@ export async function chatConversationApi(options: ChatRequest): Promise<AskResp
 
     return parsedResponse;
 }
+const conversationEtagCache = new Map<string, { etag: string; response: any }>();
+
 //BDL proposed updated conversationApi...
 // TODO: need to figure out how to better return types as an enum or switch statement or something.
 export async function conversationApi(options: any): Promise<any> {
@@ -76,11 +78,11 @@ export async function conversationApi(options: any): Promise<any> {
             break;
         case "/read":
             route = `${options.baseroute}/read`;
-            body = JSON.stringify({ conversation_id: options.conversation_id });
+            body = JSON.stringify({ conversation_id: options.conversation_id, continuation: options.continuation });
             break;
         case "/list":
             route = `${options.baseroute}/list`;
-            body = JSON.stringify({});
+            body = JSON.stringify({ continuation: options.continuation });
             break;
         case "/delete":
             route = `${options.baseroute}/delete`;
@@ -91,20 +93,34 @@ export async function conversationApi(options: any): Promise<any> {
             throw Error("Invalid route");
     }
 
+    // Lists and conversations are revalidated with their ETag, the backend answers 304 if they did not change
+    const cacheKey = `${route} ${body}`;
+    const cached = conversationEtagCache.get(cacheKey);
     const response = await fetch(route, {
         method: "POST",
         headers: {
-            "Content-Type": "application/json"
+            "Content-Type": "application/json",
+            ...(cached ? { "If-None-Match": cached.etag } : {})
         },
         body: body
     });
 
+    if (response.status === 304 && cached) {
+        return cached.response;
+    }
+
     const parsedResponse: any = await response.json();
 
     if (response.status > 299 || !response.ok) {
+        conversationEtagCache.delete(cacheKey);
         throw Error(parsedResponse.error || "Unknown error");
     }
 
+    const etag = response.headers.get("ETag");
+    if (etag) {
+        conversationEtagCache.set(cacheKey, { etag: etag, response: parsedResponse });
+    }
+
     return parsedResponse;
 }
 
@@ -65,6 +65,7 @@ export type ResponseContext = {
     thoughts: string | null;
     data_points: string[];
     followup_questions: string[] | null;
+    conversation_id?: string;
 };
 
 export type ResponseChoice = {
@@ -100,6 +101,8 @@ export type ChatAppRequest = {
     context?: ChatAppRequestContext;
     stream?: boolean;
     session_state: any;
+    // When set, the history is kept on the server and messages only holds the new message. null starts a new conversation
+    conversation_id?: string | null;
 };
 
 //BDL: for interacting with conversations
@@ -116,25 +119,24 @@ export type ConversationRequest = {
     route: "/add" | "/read" | "/delete" | "/update" | "/list";
     conversation_id?: string | null;
     approach?: Approaches;
+    // Continuation token of the previous page of /list or /read, to fetch the page after it
+    continuation?: string | null;
 };
 
 export type ConversationResponse = {
     conversation_id: string;
     messages: BotFrontendFormat;
+    continuation: string | null;
     error?: string;
 };
 
 export type ConversationListResponse = {
-    _attachments: string;
-    _etag: string;
-    _rid: string;
-    _self: string;
-    _ts: Number;
-    createdAt: string;
     id: string;
-    summary: string;
     title: string;
-    type: "conversation";
     updatedAt: string;
-    userId: string;
 }[];
+
+export type ConversationListPage = {
+    conversations: ConversationListResponse;
+    continuation: string | null;
+};
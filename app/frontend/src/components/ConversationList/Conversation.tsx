@@ -5,14 +5,12 @@ import { Stack, IStackProps, IStackTokens, Alignment } from "@fluentui/react";
 interface Props {
     conversation_id: string;
     conversation_title: string;
-    userId: string;
     updatedAt: string;
-    createdAt: string;
     onClick: (value: string) => void;
     onDeleteClick: (value: string) => void;
 }
 
-export const Conversation = ({ conversation_id, conversation_title, createdAt, updatedAt, userId, onClick, onDeleteClick }: Props) => {
+export const Conversation = ({ conversation_id, conversation_title, updatedAt, onClick, onDeleteClick }: Props) => {
     //check if the conversation title is undefined
     if (conversation_title === "") {
         conversation_title = "New Conversation";
@@ -15,6 +15,7 @@ import {
     ConversationResponse,
     BotFrontendFormat,
     ConversationListResponse,
+    ConversationListPage,
     ChatAppResponse,
     ResponseMessage,
     ResponseContext,
@@ -42,6 +43,8 @@ const ChatConversation = () => {
 
     const lastQuestionRef = useRef<string>("");
     const chatMessageStreamEnd = useRef<HTMLDivElement | null>(null);
+    // Lets a page of earlier messages arriving after another conversation was opened be dropped
+    const currentConversationIdRef = useRef<string>("");
 
     const [isLoading, setIsLoading] = useState<boolean>(false);
     const [error, setError] = useState<unknown>();
@@ -55,6 +58,11 @@ const ChatConversation = () => {
 
     const [currentConversationId, setCurrentConversationId] = useState<string>("");
     const [conversationList, setConversationList] = useState<ConversationListResponse | null>(null);
+    // Continuation tokens of the next page of conversations, and of the messages before the ones shown
+    const [conversationListContinuation, setConversationListContinuation] = useState<string | null>(null);
+    const [messagesContinuation, setMessagesContinuation] = useState<string | null>(null);
+    const [isLoadingMoreConversations, setIsLoadingMoreConversations] = useState<boolean>(false);
+    const [isLoadingEarlierMessages, setIsLoadingEarlierMessages] = useState<boolean>(false);
     const [conversationListFetched, setConversationListFetched] = useState(false);
     const [conversationDeleteModalClosed, setConversationDeleteModalClosed] = useState(true);
     const [conversationToDeleteId, setConversationToDeleteId] = useState<string>("");
@@ -99,9 +107,7 @@ const ChatConversation = () => {
             })
             .then(() => {
                 // refresh the conversation list
-                listConversations().then(result => {
-                    setConversationList(result || null);
-                });
+                refreshConversationList();
             });
     };
 
@@ -120,17 +126,22 @@ const ChatConversation = () => {
         );
     };
 
+    async function readConversation(conversation_id: string, continuation: string | null = null) {
+        const request: ConversationRequest = {
+            conversation_id: conversation_id,
+            baseroute: "/conversation",
+            route: "/read",
+            approach: Approaches.ChatConversation,
+            continuation: continuation
+        };
+        const result: ConversationResponse = await conversationApi(request);
+        return result;
+    }
+
     async function getConversationMessages(conversation_id: string) {
         setIsLoading(true);
         try {
-            const request: ConversationRequest = {
-                conversation_id: conversation_id,
-                baseroute: "/conversation",
-                route: "/read",
-                approach: Approaches.ChatConversation
-            };
-            const result = await conversationApi(request);
-            return result;
+            return await readConversation(conversation_id);
         } catch (e) {
             setError(e);
         } finally {
@@ -152,6 +163,7 @@ const ChatConversation = () => {
                 console.log("messages", messages);
                 console.log("fomattedMessages", formattedAnswers);
                 setAnswers(formattedAnswers);
+                setMessagesContinuation(result.continuation);
                 lastQuestionRef.current = formattedAnswers[formattedAnswers.length - 1][0];
             } else {
                 //log an error
@@ -162,14 +174,36 @@ const ChatConversation = () => {
         // trigger a refresh of the chat window with the new conversation
     };
 
-    // list all the conversations for the user
-    async function listConversations() {
+    // the conversation is read from its most recent messages, so the earlier ones are put before those shown
+    const loadEarlierMessages = () => {
+        if (!messagesContinuation) {
+            return;
+        }
+        const conversation_id = currentConversationId;
+        setIsLoadingEarlierMessages(true);
+        readConversation(conversation_id, messagesContinuation)
+            .then(result => {
+                if (currentConversationIdRef.current !== conversation_id) {
+                    return;
+                }
+                const formattedAnswers = renderConverationMessageHistory(result.messages);
+                setAnswers(shownAnswers => [...formattedAnswers, ...shownAnswers]);
+                setSelectedAnswer(index => index + formattedAnswers.length);
+                setMessagesContinuation(result.continuation);
+            })
+            .catch(e => setError(e))
+            .finally(() => setIsLoadingEarlierMessages(false));
+    };
+
+    // list a page of the conversations for the user, the continuation of the previous page fetches the next one
+    async function listConversations(continuation: string | null = null) {
         try {
             const request: ConversationRequest = {
                 baseroute: "/conversation",
-                route: "/list"
+                route: "/list",
+                continuation: continuation
             };
-            const result: ConversationListResponse = await conversationApi(request);
+            const result: ConversationListPage = await conversationApi(request);
             return result;
         } catch (e) {
             setError(e);
@@ -217,11 +251,16 @@ const ChatConversation = () => {
         setActiveCitation(undefined);
         setActiveAnalysisPanelTab(undefined);
         setAnswers([]);
+        setMessagesContinuation(null);
         setCurrentConversationId("");
     };
 
     useEffect(() => chatMessageStreamEnd.current?.scrollIntoView({ behavior: "smooth" }), [isLoading]);
 
+    useEffect(() => {
+        currentConversationIdRef.current = currentConversationId;
+    }, [currentConversationId]);
+
     const onPromptTemplateChange = (_ev?: React.FormEvent<HTMLInputElement | HTMLTextAreaElement>, newValue?: string) => {
         setPromptTemplate(newValue || "");
     };
@@ -272,15 +311,30 @@ const ChatConversation = () => {
     };
 
     const refreshConversationList = () => {
-        listConversations().then(result => {
-            setConversationList(result || null);
+        return listConversations().then(result => {
+            setConversationList(result?.conversations || null);
+            setConversationListContinuation(result?.continuation || null);
         });
     };
 
+    const loadMoreConversations = () => {
+        if (!conversationListContinuation) {
+            return;
+        }
+        setIsLoadingMoreConversations(true);
+        listConversations(conversationListContinuation)
+            .then(result => {
+                if (result) {
+                    setConversationList(conversationList => [...(conversationList || []), ...result.conversations]);
+                    setConversationListContinuation(result.continuation);
+                }
+            })
+            .finally(() => setIsLoadingMoreConversations(false));
+    };
+
     const handleConversationListButtonClick = () => {
         setIsConversationListPanelOpen(!isConversationListPanelOpen);
-        listConversations().then(result => {
-            setConversationList(result || null);
+        refreshConversationList().then(() => {
             setConversationListFetched(true); // Set this state to trigger the useEffect
         });
     };
@@ -340,6 +394,11 @@ const ChatConversation = () => {
                         </div>
                     ) : (
                         <div className={styles.chatMessageStream}>
+                            {messagesContinuation && (
+                                <DefaultButton className={styles.loadEarlierMessages} onClick={loadEarlierMessages} disabled={isLoadingEarlierMessages}>
+                                    {isLoadingEarlierMessages ? "Loading..." : "Load earlier messages"}
+                                </DefaultButton>
+                            )}
                             {answers.map((answer, index) => (
                                 <div key={index}>
                                     <UserChatMessage message={answer[0]} />
@@ -473,6 +532,9 @@ const ChatConversation = () => {
                         listOfConversations={conversationList}
                         onConversationClicked={loadConversation}
                         onDeleteClick={handleConversationDeleteButtonClicked}
+                        hasMore={!!conversationListContinuation}
+                        isLoadingMore={isLoadingMoreConversations}
+                        onLoadMoreClick={loadMoreConversations}
                     />
                 </Panel>
             </div>
@@ -0,0 +1,83 @@
+"""
+Micro-benchmark of chat history packing, comparing the previous insert-based implementation of
+get_messages_from_history with HistoryPacker over 10, 100 and 1000-turn histories.
+
+Run from the repository root:
+    PYTHONPATH=app/backend python benchmarks/bench_history_packing.py
+"""
+
+import argparse
+import statistics
+import time
+
+from core.messagebuilder import HistoryPacker, MessageBuilder
+from core.modelhelper import token_count_cache
+
+MODEL = "gpt-35-turbo-16k"
+SYSTEM_PROMPT = "Assistant helps the company employees with their healthcare plan questions. Be brief in your answers."
+QUESTION = "What is the deductible for the employee plan for a visit to Overlake in Bellevue?"
+ANSWER = (
+    "In-network deductibles are $500 for employee and $1000 for family [info1.txt] and Overlake is in-network "
+    "for the employee plan [info2.pdf][info4.pdf]."
+)
+
+
+def build_history(turns: int) -> list[dict[str, str]]:
+    history = []
+    for turn in range(turns):
+        history.append({"role": "user", "content": f"{QUESTION} (turn {turn})"})
+        history.append({"role": "assistant", "content": f"{ANSWER} (turn {turn})"})
+    history.append({"role": "user", "content": QUESTION})
+    return history
+
+
+def legacy_get_messages_from_history(
+    system_prompt: str, model_id: str, history: list[dict[str, str]], user_content: str, max_tokens: int
+) -> list:
+    message_builder = MessageBuilder(system_prompt, model_id)
+    append_index = 1
+    message_builder.insert_message("user", user_content, index=append_index)
+    total_token_count = message_builder.count_tokens_for_message(message_builder.messages[-1])
+    for message in reversed(history[:-1]):
+        potential_message_count = message_builder.count_tokens_for_message(message)
+        if (total_token_count + potential_message_count) > max_tokens:
+            break
+        message_builder.insert_message(message["role"], message["content"], index=append_index)
+        total_token_count += potential_message_count
+    return message_builder.messages
+
+
+def packed_get_messages_from_history(
+    system_prompt: str, model_id: str, history: list[dict[str, str]], user_content: str, max_tokens: int
+) -> list:
+    return HistoryPacker(model_id).pack(system_prompt, history[:-1], user_content, max_tokens)
+
+
+def measure(function, history: list[dict[str, str]], max_tokens: int, repeat: int, warm: bool) -> float:
+    timings = []
+    for _ in range(repeat):
+        if not warm:
+            token_count_cache.clear()
+        start = time.perf_counter()
+        function(SYSTEM_PROMPT, MODEL, history, QUESTION, max_tokens)
+        timings.append(time.perf_counter() - start)
+    return statistics.median(timings) * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark chat history packing")
+    parser.add_argument("--repeat", type=int, default=20, help="Number of runs per measurement")
+    parser.add_argument("--max-tokens", type=int, default=1_000_000, help="Token budget for history")
+    args = parser.parse_args()
+
+    print(f"{'turns':>6} {'legacy (ms)':>12} {'packer cold (ms)':>17} {'packer warm (ms)':>17}")
+    for turns in (10, 100, 1000):
+        history = build_history(turns)
+        legacy = measure(legacy_get_messages_from_history, history, args.max_tokens, args.repeat, warm=False)
+        cold = measure(packed_get_messages_from_history, history, args.max_tokens, args.repeat, warm=False)
+        warm = measure(packed_get_messages_from_history, history, args.max_tokens, args.repeat, warm=True)
+        print(f"{turns:>6} {legacy:>12.2f} {cold:>17.2f} {warm:>17.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,103 @@
+"""
+Benchmark of the conversation history storage backends, timing the create, append, list, read and delete
+operations of the history routes against the in-memory and SQLite storages, and Cosmos DB if an account is given.
+
+Run from the repository root:
+    PYTHONPATH=app/backend python benchmarks/bench_history_storage.py
+    PYTHONPATH=app/backend python benchmarks/bench_history_storage.py --cosmos-account <account> --cosmos-key <key>
+"""
+
+import argparse
+import asyncio
+import os
+import statistics
+import tempfile
+import time
+from typing import Awaitable, Callable
+
+from history.cosmosdbservice import CosmosConversationClient
+from history.storage import (
+    ConversationStorage,
+    InMemoryConversationStorage,
+    SQLiteConversationStorage,
+)
+
+QUESTION = "What is the deductible for the employee plan for a visit to Overlake in Bellevue?"
+ANSWER = (
+    "In-network deductibles are $500 for employee and $1000 for family [info1.txt] and Overlake is in-network "
+    "for the employee plan [info2.pdf][info4.pdf]."
+)
+TURN = [{"role": "user", "content": QUESTION}, {"role": "assistant", "content": ANSWER}]
+
+
+async def measure(operation: Callable[[int], Awaitable], repeat: int) -> float:
+    timings = []
+    for index in range(repeat):
+        start = time.perf_counter()
+        await operation(index)
+        timings.append(time.perf_counter() - start)
+    return statistics.median(timings) * 1000
+
+
+async def run(storage: ConversationStorage, conversations: int, turns: int) -> dict[str, float]:
+    user_id = "benchmark-user"
+    conversation_ids: list[str] = []
+
+    async def create(index: int):
+        conversation_ids.append((await storage.create_turn(user_id, None, TURN))["conversation_id"])
+
+    async def append(index: int):
+        await storage.create_turn(user_id, conversation_ids[index % len(conversation_ids)], TURN)
+
+    async def list_page(index: int):
+        await storage.get_conversations_page(user_id)
+
+    async def read_page(index: int):
+        await storage.get_messages_page(user_id, conversation_ids[index % len(conversation_ids)])
+
+    async def delete(index: int):
+        await storage.delete_conversation_and_messages(user_id, conversation_ids[index])
+
+    timings = {
+        "create": await measure(create, conversations),
+        "append": await measure(append, conversations * (turns - 1)),
+        "list": await measure(list_page, conversations),
+        "read": await measure(read_page, conversations),
+        "delete": await measure(delete, conversations),
+    }
+    await storage.close()
+    return timings
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark conversation history storage backends")
+    parser.add_argument("--conversations", type=int, default=100, help="Number of conversations created")
+    parser.add_argument("--turns", type=int, default=10, help="Number of turns in each conversation")
+    parser.add_argument("--cosmos-account", help="Cosmos DB account to also benchmark, its data is deleted after")
+    parser.add_argument("--cosmos-key", default=os.getenv("AZURE_COSMOSDB_ACCOUNT_KEY"), help="Cosmos DB account key")
+    parser.add_argument("--cosmos-database", default="db_conversation_history")
+    parser.add_argument("--cosmos-container", default="conversations")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        backends: dict[str, ConversationStorage] = {
+            "memory": InMemoryConversationStorage(),
+            "sqlite": SQLiteConversationStorage(os.path.join(directory, "history.db")),
+        }
+        if args.cosmos_account:
+            backends["cosmos"] = CosmosConversationClient(
+                cosmosdb_endpoint=f"https://{args.cosmos_account}.documents.azure.com:443/",
+                credential=args.cosmos_key,
+                database_name=args.cosmos_database,
+                container_name=args.cosmos_container,
+            )
+
+        operations = ("create", "append", "list", "read", "delete")
+        print(f"{'backend':>8} " + " ".join(f"{operation + ' (ms)':>12}" for operation in operations))
+        for name, storage in backends.items():
+            timings = asyncio.run(run(storage, args.conversations, args.turns))
+            print(f"{name:>8} " + " ".join(f"{timings[operation]:>12.3f}" for operation in operations))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,110 @@
+"""
+Benchmark of the local search index, reporting the p50 and p99 latency of text, vector, hybrid and filtered hybrid
+queries on synthetic indexes of increasing size. Sections have a 1536-dimension embedding and about 60 words drawn
+from a Zipf-distributed vocabulary, and a third of them are restricted to a group, for the filtered queries.
+
+The embeddings of 1M sections take 6 GB of disk, pass --directory to build the indexes on a large enough disk.
+
+Run from the repository root:
+    PYTHONPATH=app/backend python benchmarks/bench_local_search.py
+    PYTHONPATH=app/backend python benchmarks/bench_local_search.py --sizes 10000,100000 --queries 200
+"""
+
+import argparse
+import asyncio
+import statistics
+import tempfile
+import time
+from typing import Any, Iterator
+
+import numpy as np
+
+from localsearch.client import LocalSearchClient
+from localsearch.index import LocalSearchIndex
+
+VOCABULARY_SIZE = 20000
+SECTION_WORDS = 60
+FILTER = "category ne 'excluded' and (oids/any(g:search.in(g, 'OID_X')) or groups/any(g:search.in(g, 'GROUP_1')))"
+
+
+def create_vocabulary(rng: np.random.Generator) -> list[str]:
+    letters = np.array(list("abcdefghijklmnopqrstuvwxyz"))
+    return ["".join(rng.choice(letters, size=rng.integers(3, 10))) for _ in range(VOCABULARY_SIZE)]
+
+
+def sample_words(rng: np.random.Generator, vocabulary: list[str], count: int) -> str:
+    ranks = np.minimum(rng.zipf(1.2, size=count), VOCABULARY_SIZE) - 1
+    return " ".join(vocabulary[rank] for rank in ranks)
+
+
+def create_sections(count: int, dimensions: int, seed: int) -> Iterator[dict[str, Any]]:
+    rng = np.random.default_rng(seed)
+    vocabulary = create_vocabulary(rng)
+    for row in range(count):
+        yield {
+            "id": f"file-benchmark_pdf-page-{row}",
+            "content": sample_words(rng, vocabulary, SECTION_WORDS),
+            "category": None,
+            "sourcepage": f"benchmark-{row // 10}.pdf#page={row % 10 + 1}",
+            "sourcefile": f"benchmark-{row // 10}.pdf",
+            "oids": [],
+            "groups": [f"GROUP_{row % 3}"],
+            "embedding": rng.standard_normal(dimensions, dtype=np.float32),
+        }
+
+
+def percentiles(timings: list[float]) -> tuple[float, float]:
+    quantiles = statistics.quantiles(timings, n=100, method="inclusive")
+    return quantiles[49] * 1000, quantiles[98] * 1000
+
+
+async def run(client: LocalSearchClient, queries: int, dimensions: int, seed: int) -> dict[str, tuple[float, float]]:
+    rng = np.random.default_rng(seed + 1)
+    vocabulary = create_vocabulary(np.random.default_rng(seed))
+    texts = [sample_words(rng, vocabulary, 6) for _ in range(queries)]
+    vectors = [rng.standard_normal(dimensions, dtype=np.float32).tolist() for _ in range(queries)]
+    modes = {
+        "text": lambda i: {"search_text": texts[i]},
+        "vector": lambda i: {"vector": vectors[i], "top_k": 50},
+        "hybrid": lambda i: {"search_text": texts[i], "vector": vectors[i], "top_k": 50},
+        "hybrid+filter": lambda i: {"search_text": texts[i], "vector": vectors[i], "top_k": 50, "filter": FILTER},
+    }
+    timings: dict[str, tuple[float, float]] = {}
+    for name, arguments in modes.items():
+        durations = []
+        for index in range(queries):
+            start = time.perf_counter()
+            results = await client.search(top=3, select=["sourcepage", "content"], **arguments(index))
+            [result async for result in results]
+            durations.append(time.perf_counter() - start)
+        timings[name] = percentiles(durations)
+    return timings
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the local search index")
+    parser.add_argument("--sizes", default="10000,100000,1000000", help="Comma-separated numbers of sections")
+    parser.add_argument("--dimensions", type=int, default=1536, help="Number of dimensions of the embeddings")
+    parser.add_argument("--queries", type=int, default=100, help="Number of queries of each mode")
+    parser.add_argument("--directory", help="Directory the indexes are built in, a temporary directory by default")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    modes = ("text", "vector", "hybrid", "hybrid+filter")
+    print(f"{'sections':>9} {'build (s)':>10} " + " ".join(f"{mode + ' p50/p99 (ms)':>27}" for mode in modes))
+    for size in (int(size) for size in args.sizes.split(",")):
+        with tempfile.TemporaryDirectory(dir=args.directory) as directory:
+            start = time.perf_counter()
+            index = LocalSearchIndex.build(directory, create_sections(size, args.dimensions, args.seed))
+            build = time.perf_counter() - start
+            client = LocalSearchClient(index)
+            timings = asyncio.run(run(client, args.queries, args.dimensions, args.seed))
+            index.close()
+        print(
+            f"{size:>9} {build:>10.1f} "
+            + " ".join(f"{f'{timings[mode][0]:.2f} / {timings[mode][1]:.2f}':>27}" for mode in modes)
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,125 @@
+"""
+Benchmark of the fields returned by search queries, comparing the size and parse time of the results when all the
+fields of the documents are returned (including their 1536-dimension embedding), when only the fields used to build
+the sources are selected, and when only the keys of the hits are selected and their content is read from the document
+cache. Synthetic documents shaped like the ones written by prepdocs are always measured, and a live index if a search
+service is given, in which case the latency of the queries is measured too.
+
+Run from the repository root:
+    PYTHONPATH=app/backend python benchmarks/bench_search_projection.py
+    PYTHONPATH=app/backend python benchmarks/bench_search_projection.py --search-service <service> --index <index>
+"""
+
+import argparse
+import asyncio
+import json
+import random
+import statistics
+import time
+from typing import Any, Optional
+
+from azure.core.credentials import AzureKeyCredential
+from azure.identity.aio import DefaultAzureCredential
+from azure.search.documents.aio import SearchClient
+
+from core.documentcache import DocumentCache
+from core.indexversion import IndexVersion
+
+SECTION = (
+    "Northwind Health Plus covers in-network and out-of-network providers, including hospitals, primary care "
+    "physicians, specialists and urgent care centers. Deductibles depend on whether you are in-network or "
+    "out-of-network. In-network deductibles are $500 for employee and $1000 for family. "
+) * 4
+
+
+def create_document(index: int) -> dict[str, Any]:
+    return {
+        "id": f"file-Benefit_Options_pdf-42656E656669745F4F7074696F6E732E706466-page-{index}",
+        "content": SECTION,
+        "embedding": [random.uniform(-0.1, 0.1) for _ in range(1536)],
+        "category": None,
+        "sourcepage": f"Benefit_Options.pdf#page={index + 1}",
+        "sourcefile": "Benefit_Options.pdf",
+        "@search.score": random.random(),
+    }
+
+
+def project(results: list[dict[str, Any]], select: Optional[list[str]]) -> list[dict[str, Any]]:
+    if select is None:
+        return results
+    return [{field: result[field] for field in select + ["@search.score"]} for result in results]
+
+
+def measure_payload(results: list[dict[str, Any]], repeat: int) -> tuple[int, float]:
+    """Returns the size in bytes of the JSON of the results and the median time to parse it in milliseconds."""
+    payload = json.dumps({"value": results})
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        json.loads(payload)
+        timings.append(time.perf_counter() - start)
+    return len(payload.encode()), statistics.median(timings) * 1000
+
+
+async def search(search_client: SearchClient, query: str, top: int, select: Optional[list[str]]) -> list[dict]:
+    results = await search_client.search(query, top=top, select=select)
+    return [result async for result in results]
+
+
+async def measure_live(args: argparse.Namespace, modes: dict[str, Optional[list[str]]]) -> dict[str, tuple]:
+    credential = AzureKeyCredential(args.search_key) if args.search_key else DefaultAzureCredential()
+    measurements: dict[str, tuple] = {}
+    async with SearchClient(f"https://{args.search_service}.search.windows.net", args.index, credential) as client:
+
+        async def get_version() -> Optional[str]:
+            return None
+
+        document_cache = DocumentCache(client, ["sourcepage", "content"], IndexVersion(get_version))
+        for name, select in modes.items():
+            timings, size = [], 0
+            for _ in range(args.repeat):
+                start = time.perf_counter()
+                results = await search(client, args.query, args.top, select)
+                if name == "ids + cache":
+                    await document_cache.resolve(results)
+                timings.append(time.perf_counter() - start)
+                size = len(json.dumps(results, default=str).encode())
+            measurements[name] = (size, statistics.median(timings) * 1000)
+        print(f"document cache: {document_cache.get_stats()}")
+    if isinstance(credential, DefaultAzureCredential):
+        await credential.close()
+    return measurements
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the fields returned by search queries")
+    parser.add_argument("--top", type=int, default=3, help="Number of hits returned by each query")
+    parser.add_argument("--repeat", type=int, default=200, help="Number of times each measurement is repeated")
+    parser.add_argument("--search-service", help="Search service to also benchmark")
+    parser.add_argument("--search-key", help="Key of the search service, the Azure identity is used by default")
+    parser.add_argument("--index", default="gptkbindex", help="Index of the search service")
+    parser.add_argument("--query", default="What is the deductible for the employee plan?", help="Query text")
+    args = parser.parse_args()
+
+    modes: dict[str, Optional[list[str]]] = {
+        "all fields": None,
+        "sources": ["sourcepage", "content"],
+        "ids + cache": ["id"],
+    }
+
+    print("synthetic results")
+    print(f"{'fields':>12} {'bytes':>10} {'parse (ms)':>12}")
+    results = [create_document(index) for index in range(args.top)]
+    for name, select in modes.items():
+        size, parse = measure_payload(project(results, select), args.repeat)
+        print(f"{name:>12} {size:>10} {parse:>12.3f}")
+
+    if args.search_service:
+        print(f"\nindex {args.index} on {args.search_service}")
+        print(f"{'fields':>12} {'bytes':>10} {'query (ms)':>12}")
+        for name, (size, latency) in asyncio.run(measure_live(args, modes)).items():
+            print(f"{name:>12} {size:>10} {latency:>12.3f}")
+
+
+if __name__ == "__main__":
+    main()
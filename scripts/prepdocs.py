@@ -111,6 +111,7 @@ def setup_file_strategy(credential: AsyncTokenCredential, args: Any) -> FileStra
         search_analyzer_name=args.searchanalyzername,
         use_acls=args.useacls,
         category=args.category,
+        local_index=args.localindex,
     )
 
 
@@ -181,6 +182,11 @@ if __name__ == "__main__":
         "--index",
         help="Name of the Azure AI Search index where content should be indexed (will be created if it doesn't exist)",
     )
+    parser.add_argument(
+        "--localindex",
+        required=False,
+        help="Optional. Write sections to a local search index in this directory instead of Azure AI Search, for the app to use with LOCAL_SEARCH_INDEX",
+    )
     parser.add_argument(
         "--searchkey",
         required=False,
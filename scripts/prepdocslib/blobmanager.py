@@ -1,5 +1,6 @@
 import os
 import re
+import uuid
 from typing import Optional, Union
 
 from azure.core.credentials_async import AsyncTokenCredential
@@ -7,6 +8,10 @@ from azure.storage.blob.aio import BlobServiceClient
 
 from .listfilestrategy import File
 
+# Must match INDEX_VERSION_BLOB_NAME in app/backend/core/indexversion.py, the app clears its document and search
+# caches when this blob changes
+INDEX_VERSION_BLOB_NAME = "index-version"
+
 
 class BlobManager:
     """
@@ -60,6 +65,19 @@ class BlobManager:
                     print(f"\tRemoving blob {blob_path}")
                 await container_client.delete_blob(blob_path)
 
+    async def update_index_version(self):
+        """
+        Writes a new version of the index to the container, so that the app stops using documents it cached
+        """
+        async with BlobServiceClient(
+            account_url=self.endpoint, credential=self.credential
+        ) as service_client, service_client.get_container_client(self.container) as container_client:
+            if not await container_client.exists():
+                await container_client.create_container()
+            if self.verbose:
+                print(f"\tUpdating index version -> {INDEX_VERSION_BLOB_NAME}")
+            await container_client.upload_blob(INDEX_VERSION_BLOB_NAME, str(uuid.uuid4()), overwrite=True)
+
     @classmethod
     def sourcepage_from_file_page(cls, filename, page=0) -> str:
         if os.path.splitext(filename)[1].lower() == ".pdf":
@@ -4,6 +4,7 @@ from typing import Optional
 from .blobmanager import BlobManager
 from .embeddings import OpenAIEmbeddings
 from .listfilestrategy import ListFileStrategy
+from .localsearchmanager import LocalSearchManager
 from .pdfparser import PdfParser
 from .searchmanager import SearchManager, Section
 from .strategy import SearchInfo, Strategy
@@ -32,6 +33,7 @@ class FileStrategy(Strategy):
         search_analyzer_name: Optional[str] = None,
         use_acls: bool = False,
         category: Optional[str] = None,
+        local_index: Optional[str] = None,
     ):
         self.list_file_strategy = list_file_strategy
         self.blob_manager = blob_manager
@@ -42,13 +44,19 @@ class FileStrategy(Strategy):
         self.search_analyzer_name = search_analyzer_name
         self.use_acls = use_acls
         self.category = category
+        self.local_index = local_index
+
+    def create_search_manager(self, search_info: SearchInfo) -> SearchManager:
+        if self.local_index:
+            return LocalSearchManager(search_info, self.local_index, self.use_acls, self.embeddings)
+        return SearchManager(search_info, self.search_analyzer_name, self.use_acls, self.embeddings)
 
     async def setup(self, search_info: SearchInfo):
-        search_manager = SearchManager(search_info, self.search_analyzer_name, self.use_acls, self.embeddings)
+        search_manager = self.create_search_manager(search_info)
         await search_manager.create_index()
 
     async def run(self, search_info: SearchInfo):
-        search_manager = SearchManager(search_info, self.search_analyzer_name, self.use_acls, self.embeddings)
+        search_manager = self.create_search_manager(search_info)
         if self.document_action == DocumentAction.Add:
             files = self.list_file_strategy.list()
             async for file in files:
@@ -73,3 +81,4 @@ class FileStrategy(Strategy):
         elif self.document_action == DocumentAction.RemoveAll:
             await self.blob_manager.remove_blob()
             await search_manager.remove_content()
+        await self.blob_manager.update_index_version()
@@ -0,0 +1,58 @@
+import json
+import os
+from typing import List, Optional
+
+from .embeddings import OpenAIEmbeddings
+from .searchmanager import MAX_BATCH_SIZE, SearchManager, Section
+from .strategy import SearchInfo
+
+# Must match DOCUMENTS_FILE_NAME in app/backend/localsearch/index.py, the app compiles this file into its local index
+DOCUMENTS_FILE_NAME = "documents.jsonl"
+
+
+class LocalSearchManager(SearchManager):
+    """
+    Class to manage a local search index, searched by the app without a search service when LOCAL_SEARCH_INDEX is set.
+    Sections are written to a JSON lines file in the index directory, which the app compiles into its index
+    """
+
+    def __init__(
+        self,
+        search_info: SearchInfo,
+        directory: str,
+        use_acls: bool = False,
+        embeddings: Optional[OpenAIEmbeddings] = None,
+    ):
+        super().__init__(search_info, use_acls=use_acls, embeddings=embeddings)
+        self.directory = directory
+        self.path = os.path.join(directory, DOCUMENTS_FILE_NAME)
+
+    async def create_index(self):
+        if self.search_info.verbose:
+            print(f"Ensuring local search index {self.directory} exists")
+        os.makedirs(self.directory, exist_ok=True)
+        open(self.path, "a").close()
+
+    async def update_content(self, sections: List[Section]):
+        # Documents are appended, the app keeps the last line written for each document key
+        with open(self.path, "a") as file:
+            for batch_index in range(0, len(sections), MAX_BATCH_SIZE):
+                documents = await self.create_documents(
+                    sections[batch_index : batch_index + MAX_BATCH_SIZE], batch_index
+                )
+                for document in documents:
+                    file.write(json.dumps(document) + "\n")
+
+    async def remove_content(self, path: Optional[str] = None):
+        if self.search_info.verbose:
+            print(f"Removing sections from '{path or '<all>'}' from local search index '{self.directory}'")
+        if not os.path.exists(self.path):
+            return
+        kept = []
+        if path is not None:
+            with open(self.path) as file:
+                kept = [
+                    line for line in file if line.strip() and json.loads(line)["sourcefile"] != os.path.basename(path)
+                ]
+        with open(self.path, "w") as file:
+            file.writelines(kept)
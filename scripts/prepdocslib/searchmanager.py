@@ -23,6 +23,8 @@ from .listfilestrategy import File
 from .strategy import SearchInfo
 from .textsplitter import SplitPage
 
+MAX_BATCH_SIZE = 1000
+
 
 class Section:
     """
@@ -117,32 +119,34 @@ class SearchManager:
                 if self.search_info.verbose:
                     print(f"Search index {self.search_info.index_name} already exists")
 
+    async def create_documents(self, sections: List[Section], first_index: int = 0) -> List[dict]:
+        documents = [
+            {
+                "id": f"{section.content.filename_to_id()}-page-{first_index + section_index}",
+                "content": section.split_page.text,
+                "category": section.category,
+                "sourcepage": BlobManager.sourcepage_from_file_page(
+                    filename=section.content.filename(), page=section.split_page.page_num
+                ),
+                "sourcefile": section.content.filename(),
+                **section.content.acls,
+            }
+            for section_index, section in enumerate(sections)
+        ]
+        if self.embeddings:
+            embeddings = await self.embeddings.create_embeddings(
+                texts=[section.split_page.text for section in sections]
+            )
+            for i, document in enumerate(documents):
+                document["embedding"] = embeddings[i]
+        return documents
+
     async def update_content(self, sections: List[Section]):
-        MAX_BATCH_SIZE = 1000
         section_batches = [sections[i : i + MAX_BATCH_SIZE] for i in range(0, len(sections), MAX_BATCH_SIZE)]
 
         async with self.search_info.create_search_client() as search_client:
             for batch_index, batch in enumerate(section_batches):
-                documents = [
-                    {
-                        "id": f"{section.content.filename_to_id()}-page-{section_index + batch_index * MAX_BATCH_SIZE}",
-                        "content": section.split_page.text,
-                        "category": section.category,
-                        "sourcepage": BlobManager.sourcepage_from_file_page(
-                            filename=section.content.filename(), page=section.split_page.page_num
-                        ),
-                        "sourcefile": section.content.filename(),
-                        **section.content.acls,
-                    }
-                    for section_index, section in enumerate(batch)
-                ]
-                if self.embeddings:
-                    embeddings = await self.embeddings.create_embeddings(
-                        texts=[section.split_page.text for section in batch]
-                    )
-                    for i, document in enumerate(documents):
-                        document["embedding"] = embeddings[i]
-
+                documents = await self.create_documents(batch, batch_index * MAX_BATCH_SIZE)
                 await search_client.upload_documents(documents)
 
     async def remove_content(self, path: Optional[str] = None):
@@ -151,7 +155,9 @@ class SearchManager:
         async with self.search_info.create_search_client() as search_client:
             while True:
                 filter = None if path is None else f"sourcefile eq '{os.path.basename(path)}'"
-                result = await search_client.search("", filter=filter, top=1000, include_total_count=True)
+                result = await search_client.search(
+                    "", filter=filter, top=1000, include_total_count=True, select=["id"]
+                )
                 if await result.get_count() == 0:
                     break
                 removed_docs = await search_client.delete_documents(
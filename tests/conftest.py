@@ -1,7 +1,11 @@
 import argparse
+import contextlib
+import copy
 import json
 import os
+import re
 from collections import namedtuple
+from typing import Optional
 from unittest import mock
 
 import aiohttp
@@ -11,11 +15,24 @@ import msal
 import openai
 import pytest
 import pytest_asyncio
+import tiktoken
 from azure.core.credentials_async import AsyncTokenCredential
+from azure.core.exceptions import ResourceNotFoundError
+from azure.cosmos.exceptions import (
+    CosmosBatchOperationError,
+    CosmosHttpResponseError,
+    CosmosResourceExistsError,
+    CosmosResourceNotFoundError,
+)
 from azure.search.documents.aio import SearchClient
+from azure.storage.blob import BlobProperties
+from azure.storage.blob.aio import BlobClient
 
 import app
 from core.authentication import AuthenticationHelper
+from core.modelhelper import get_encoding, token_count_cache
+from history.cosmosdbservice import CosmosConversationClient
+from history.writebehind import WriteBehindQueue
 
 MockToken = namedtuple("MockToken", ["token", "expires_on"])
 
@@ -25,6 +42,147 @@ class MockAzureCredential(AsyncTokenCredential):
         return MockToken("mock_token", 9999999999)
 
 
+class MockCosmosContainer:
+    """
+    In-memory stand-in for an azure.cosmos.aio.ContainerProxy partitioned on userId. Queries support projections
+    of top-level fields, = and > conditions (on literals or parameters) joined with AND, and ORDER BY one field.
+    Transactional batches are applied to a copy of the items and only kept if every operation succeeds.
+    Every request is charged request_charge request units per item written or returned.
+    """
+
+    def __init__(self, request_charge: float = 1.0):
+        self.items: dict[tuple[str, str], dict] = {}
+        self.queries: list[dict] = []
+        self.batches: list[list] = []
+        self.request_charge = request_charge
+
+    async def create_item(self, body, **kwargs):
+        if (body["userId"], body["id"]) in self.items:
+            raise CosmosResourceExistsError(status_code=409, message=f"Item {body['id']} already exists")
+        return await self.upsert_item(body)
+
+    async def upsert_item(self, body, **kwargs):
+        self.items[(body["userId"], body["id"])] = copy.deepcopy(body)
+        return copy.deepcopy(body)
+
+    async def read_item(self, item, partition_key, **kwargs):
+        if (partition_key, item) not in self.items:
+            raise CosmosResourceNotFoundError(status_code=404, message=f"Item {item} not found")
+        return copy.deepcopy(self.items[(partition_key, item)])
+
+    async def delete_item(self, item, partition_key, **kwargs):
+        if (partition_key, item) not in self.items:
+            raise CosmosResourceNotFoundError(status_code=404, message=f"Item {item} not found")
+        del self.items[(partition_key, item)]
+
+    async def patch_item(self, item, partition_key, patch_operations, **kwargs):
+        patched = await self.read_item(item, partition_key)
+        for operation in patch_operations:
+            assert operation["op"] in ("set", "replace", "add")
+            patched[operation["path"].lstrip("/")] = operation["value"]
+        return await self.upsert_item(patched)
+
+    async def execute_item_batch(self, batch_operations, partition_key, response_hook=None, **kwargs):
+        self.batches.append(batch_operations)
+        items = copy.deepcopy(self.items)
+        results = []
+        for index, (operation, args, *_) in enumerate(batch_operations):
+            try:
+                if operation == "create":
+                    assert args[0]["userId"] == partition_key
+                    resource = await self.create_item(args[0])
+                elif operation == "upsert":
+                    assert args[0]["userId"] == partition_key
+                    resource = await self.upsert_item(args[0])
+                elif operation == "patch":
+                    resource = await self.patch_item(args[0], partition_key, args[1])
+                elif operation == "delete":
+                    resource = await self.delete_item(args[0], partition_key)
+                else:
+                    raise ValueError(f"Unsupported batch operation {operation}")
+            except CosmosHttpResponseError as error:
+                self.items = items
+                raise CosmosBatchOperationError(
+                    error_index=index,
+                    headers={},
+                    status_code=error.status_code,
+                    message=str(error),
+                    operation_responses=results,
+                )
+            results.append({"statusCode": 200, "resourceBody": resource})
+        if response_hook:
+            response_hook({"x-ms-request-charge": str(self.request_charge * len(batch_operations))}, results)
+        return results
+
+    def query_items(self, query, parameters=None, partition_key=None, **kwargs):
+        self.queries.append({"query": query, "parameters": parameters, "partition_key": partition_key})
+        values = {parameter["name"]: parameter["value"] for parameter in parameters or []}
+        conditions = []
+        if where := re.search(r"\bwhere\b(.*?)(\border by\b|$)", query, re.IGNORECASE | re.DOTALL):
+            for condition in re.split(r"\band\b", where.group(1), flags=re.IGNORECASE):
+                field, operator, value = re.match(r"\s*c\.(\w+)\s*(=|>)\s*(\S+)\s*$", condition).groups()
+                conditions.append((field, operator, values[value] if value.startswith("@") else value.strip("'")))
+        items = [
+            copy.deepcopy(item)
+            for (user_id, _), item in self.items.items()
+            if (partition_key is None or user_id == partition_key)
+            and all(
+                item.get(field) == value if operator == "=" else field in item and item[field] > value
+                for field, operator, value in conditions
+            )
+        ]
+        if order_by := re.search(r"\border by c\.(\w+)\s*(asc|desc)?", query, re.IGNORECASE):
+            field, direction = order_by.groups()
+            items.sort(key=lambda item: item.get(field, ""), reverse=(direction or "").lower() == "desc")
+        projection = re.match(r"\s*select\s+(.*?)\s+from\b", query, re.IGNORECASE | re.DOTALL).group(1)
+        if projection != "*":
+            fields = [field.strip().removeprefix("c.") for field in projection.split(",")]
+            items = [{field: item[field] for field in fields if field in item} for item in items]
+        return MockCosmosItemPaged(items, kwargs.get("max_item_count"))
+
+
+class MockCosmosItemPaged:
+    """
+    Iterates over query results either item by item or, with by_page, in pages of max_item_count items whose
+    continuation token is the offset of the next page.
+    """
+
+    def __init__(self, items, max_item_count=None):
+        self.items = items
+        self.max_item_count = max_item_count or len(items) or 1
+
+    async def __aiter__(self):
+        for item in self.items:
+            yield item
+
+    def by_page(self, continuation_token=None):
+        return MockCosmosPageIterator(self, continuation_token)
+
+
+class MockCosmosPageIterator:
+    def __init__(self, item_paged, continuation_token=None):
+        self.item_paged = item_paged
+        self.continuation_token = continuation_token
+        self.started = False
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if self.continuation_token is None and self.started:
+            raise StopAsyncIteration
+        self.started = True
+        start = int(self.continuation_token or 0)
+        end = start + self.item_paged.max_item_count
+        self.continuation_token = str(end) if end < len(self.item_paged.items) else None
+        return MockCosmosItemPaged(self.item_paged.items[start:end])
+
+
+@pytest.fixture
+def mock_cosmos_container():
+    return MockCosmosContainer()
+
+
 @pytest.fixture
 def mock_openai_embedding(monkeypatch):
     async def mock_acreate(*args, **kwargs):
@@ -104,6 +262,7 @@ def mock_acs_search(monkeypatch):
     class Caption:
         def __init__(self, text):
             self.text = text
+            self.highlights = None
 
     class AsyncSearchResultsIterator:
         def __init__(self):
@@ -155,6 +314,38 @@ def mock_acs_search_filter(monkeypatch):
     monkeypatch.setattr(SearchClient, "search", mock_search)
 
 
+@pytest.fixture
+def mock_encoding(monkeypatch):
+    """
+    Replaces the tiktoken encoding with one token per whitespace-separated word, and records what was encoded.
+    """
+
+    class MockEncoding:
+        def __init__(self):
+            self.encoded = []
+            self.resolved = []
+
+        def encode(self, text):
+            self.encoded.append(text)
+            return text.split()
+
+        def encode_batch(self, texts):
+            return [self.encode(text) for text in texts]
+
+    encoding = MockEncoding()
+
+    def mock_encoding_for_model(model):
+        encoding.resolved.append(model)
+        return encoding
+
+    monkeypatch.setattr(tiktoken, "encoding_for_model", mock_encoding_for_model)
+    get_encoding.cache_clear()
+    token_count_cache.clear()
+    yield encoding
+    get_encoding.cache_clear()
+    token_count_cache.clear()
+
+
 envs = [
     {
         "OPENAI_HOST": "openai",
@@ -213,6 +404,99 @@ async def client(monkeypatch, mock_env, mock_openai_chatcompletion, mock_openai_
         yield test_app.test_client()
 
 
+@pytest.fixture
+def conversation_client(mock_cosmos_container):
+    return CosmosConversationClient(
+        cosmosdb_endpoint="https://test-cosmos-account.documents.azure.com:443/",
+        credential="dGVzdC1rZXk=",
+        database_name="db_conversation_history",
+        container_name="conversations",
+        container_client=mock_cosmos_container,
+    )
+
+
+def turn(question: str, answer: str) -> list[dict[str, str]]:
+    return [{"role": "user", "content": question}, {"role": "assistant", "content": answer}]
+
+
+async def create_conversation(conversation_client, messages=4):
+    turn = await conversation_client.create_turn(
+        "user1",
+        None,
+        [
+            {"role": "user" if index % 2 == 0 else "assistant", "content": f"Message {index}"}
+            for index in range(messages)
+        ],
+    )
+    return turn["conversation_id"]
+
+
+@pytest_asyncio.fixture()
+async def create_client(
+    monkeypatch, tmp_path, mock_env, mock_openai_chatcompletion, mock_openai_embedding, mock_acs_search
+):
+    """
+    Returns a function that starts the app with the given environment variables set on top of those of mock_env, or
+    removed when set to None, and returns its test client. SQLite history is stored in the test's temporary directory.
+    """
+    monkeypatch.setenv("HISTORY_SQLITE_PATH", str(tmp_path / "history.db"))
+    async with contextlib.AsyncExitStack() as stack:
+
+        async def create(**env: Optional[str]):
+            for key, value in env.items():
+                if value is None:
+                    monkeypatch.delenv(key)
+                else:
+                    monkeypatch.setenv(key, value)
+            quart_app = app.create_app()
+            test_app = await stack.enter_async_context(quart_app.test_app())
+            quart_app.config.update({"TESTING": True})
+            return test_app.test_client()
+
+        yield create
+
+
+@pytest_asyncio.fixture()
+async def history_client(create_client, mock_cosmos_container):
+    client = await create_client(
+        AZURE_COSMOSDB_ACCOUNT="test-cosmos-account", AZURE_COSMOSDB_ACCOUNT_KEY="dGVzdC1rZXk="
+    )
+    # The Cosmos DB client is wrapped by the conversation list cache
+    client.app.config[app.CONFIG_CONVERSATION_STORAGE].storage.container_client = mock_cosmos_container
+    client.container = mock_cosmos_container
+    return client
+
+
+@pytest.fixture
+def mock_index_version_blob(monkeypatch):
+    async def mock_get_blob_properties(self, *args, **kwargs):
+        assert self.blob_name == "index-version"
+        properties = BlobProperties()
+        properties.etag = "0x1"
+        return properties
+
+    monkeypatch.setattr(BlobClient, "get_blob_properties", mock_get_blob_properties)
+
+
+@pytest.fixture
+def mock_index_version_blob_missing(monkeypatch):
+    async def mock_get_blob_properties(self, *args, **kwargs):
+        raise ResourceNotFoundError("The specified blob does not exist.")
+
+    monkeypatch.setattr(BlobClient, "get_blob_properties", mock_get_blob_properties)
+
+
+@pytest_asyncio.fixture()
+async def write_behind_client(history_client):
+    write_queue = history_client.app.config[app.CONFIG_WRITE_BEHIND_QUEUE] = WriteBehindQueue(
+        history_client.app.config[app.CONFIG_CONVERSATION_STORAGE], flush_interval=60
+    )
+    history_client.app.config[app.CONFIG_HISTORY_STORE].backend.write_queue = write_queue
+    write_queue.start()
+    yield history_client
+    await write_queue.close()
+
+
 @pytest_asyncio.fixture(params=auth_envs)
 async def auth_client(
     monkeypatch,
@@ -0,0 +1,97 @@
+import pytest
+
+from approaches.approach import Approach
+from approaches.cachedapproach import CachedApproach
+from core.answercache import AnswerCache, normalize_question
+from core.cache import InMemoryCacheBackend
+
+
+class MockApproach(Approach):
+    def __init__(self):
+        self.calls = 0
+
+    async def run(self, messages, stream=False, session_state=None, context={}):
+        self.calls += 1
+        if stream:
+            return self.stream(session_state)
+        return {"choices": [{"message": {"content": "Paris"}, "context": {}, "session_state": session_state}]}
+
+    async def stream(self, session_state):
+        yield {"choices": [{"delta": {"role": "assistant"}, "context": {}, "session_state": session_state}]}
+        yield {"choices": [{"delta": {"content": "Paris"}}]}
+
+
+def test_normalize_question():
+    assert normalize_question("  What is the  capital of\nFrance? ") == "what is the capital of france"
+
+
+@pytest.mark.asyncio
+async def test_cached_approach_exact_hit():
+    approach = MockApproach()
+    cached_approach = CachedApproach(approach, AnswerCache(InMemoryCacheBackend()))
+    messages = [{"role": "user", "content": "What is the capital of France?"}]
+
+    first = await cached_approach.run(messages, session_state="one", context={"overrides": {}})
+    second = await cached_approach.run(
+        [{"role": "user", "content": "what is the capital of france"}], session_state="two", context={"overrides": {}}
+    )
+    assert approach.calls == 1
+    assert first["choices"][0]["session_state"] == "one"
+    assert second["choices"][0]["session_state"] == "two"
+    assert second["choices"][0]["context"]["answer_cache"] == "exact"
+    assert cached_approach.answer_cache.get_stats() == {"hits": 1, "similar_hits": 0, "misses": 1}
+
+
+@pytest.mark.asyncio
+async def test_cached_approach_scope_includes_filter_and_overrides():
+    approach = MockApproach()
+    cached_approach = CachedApproach(approach, AnswerCache(InMemoryCacheBackend()))
+    messages = [{"role": "user", "content": "What is the capital of France?"}]
+
+    await cached_approach.run(messages, context={"overrides": {}})
+    await cached_approach.run(messages, context={"overrides": {"exclude_category": "x"}})
+    await cached_approach.run(messages, context={"overrides": {"temperature": 0.1}})
+    await cached_approach.run(
+        messages, context={"overrides": {"use_oid_security_filter": True}, "auth_claims": {"oid": "A"}}
+    )
+    await cached_approach.run(
+        messages, context={"overrides": {"use_oid_security_filter": True}, "auth_claims": {"oid": "B"}}
+    )
+    assert approach.calls == 5
+
+
+@pytest.mark.asyncio
+async def test_cached_approach_stream_replay():
+    approach = MockApproach()
+    cached_approach = CachedApproach(approach, AnswerCache(InMemoryCacheBackend()))
+    messages = [{"role": "user", "content": "What is the capital of France?"}]
+
+    first = [event async for event in await cached_approach.run(messages, stream=True, session_state="one")]
+    second = [event async for event in await cached_approach.run(messages, stream=True, session_state="two")]
+    assert approach.calls == 1
+    assert first[0]["choices"][0]["session_state"] == "one"
+    assert second[0]["choices"][0]["session_state"] == "two"
+    assert second[0]["choices"][0]["context"]["answer_cache"] == "exact"
+    assert second[1] == {"choices": [{"delta": {"content": "Paris"}}]}
+
+    # Non-streaming requests are cached separately
+    await cached_approach.run(messages, session_state="three")
+    assert approach.calls == 2
+
+
+@pytest.mark.asyncio
+async def test_cached_approach_similarity_hit():
+    async def mock_embed(text):
+        return [1.0, 0.0] if "france" in text else [0.0, 1.0]
+
+    approach = MockApproach()
+    cached_approach = CachedApproach(
+        approach, AnswerCache(InMemoryCacheBackend(), similarity_threshold=0.9, embed=mock_embed)
+    )
+    await cached_approach.run([{"role": "user", "content": "What is the capital of France?"}])
+    similar = await cached_approach.run([{"role": "user", "content": "Which city is the capital of France?"}])
+    assert approach.calls == 1
+    assert similar["choices"][0]["context"]["answer_cache"] == "similar"
+
+    await cached_approach.run([{"role": "user", "content": "What is the capital of Spain?"}])
+    assert approach.calls == 2
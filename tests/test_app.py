@@ -1,3 +1,4 @@
+import asyncio
 import json
 import logging
 import os
@@ -6,8 +7,11 @@ from unittest import mock
 import openai
 import pytest
 import quart.testing.app
+from conftest import create_conversation
 
 import app
+from approaches.chatconversation import ChatConversationReadApproach
+from approaches.chatreadretrieveread import ChatReadRetrieveReadApproach
 
 
 @pytest.mark.asyncio
@@ -39,6 +43,16 @@ async def test_cors_allowed(client) -> None:
     assert "Access-Control-Allow-Origin" in response.headers
 
 
+@pytest.mark.asyncio
+async def test_metrics(client):
+    response = await client.get("/metrics")
+    assert response.status_code == 200
+    result = await response.get_json()
+    assert result["openai_session_pool"]["open"] is True
+    assert result["openai_session_pool"]["limit"] == 100
+    assert result["retrieval"] == {"retrievals": 0, "stages": {}}
+
+
 @pytest.mark.asyncio
 async def test_ask_request_must_be_json(client):
     response = await client.post("/ask")
@@ -181,6 +195,18 @@ async def test_chat_request_must_be_json(client):
     assert result["error"] == "request must be json"
 
 
+@pytest.mark.asyncio
+async def test_chat_invalid_query_variants(client):
+    response = await client.post(
+        "/chat",
+        json={
+            "messages": [{"content": "What is the capital of France?", "role": "user"}],
+            "context": {"overrides": {"query_variants": "many"}},
+        },
+    )
+    assert response.status_code == 400
+
+
 @pytest.mark.asyncio
 async def test_chat_handle_exception(client, monkeypatch, snapshot, caplog):
     monkeypatch.setattr(
@@ -586,3 +612,661 @@ def test_error_dict(caplog):
     assert error == {
         "error": "The app encountered an error processing your request.\nIf you are an administrator of the app, view the full error in the logs. See aka.ms/appservice-logs for more information.\nError type: <class 'Exception'>\n"
     }
+
+
+@pytest.mark.asyncio
+async def test_conversation_history_not_configured(client):
+    response = await client.post("/conversation/list", json={})
+    assert response.status_code == 501
+
+
+@pytest.mark.asyncio
+async def test_conversation_list_and_read(history_client):
+    container = history_client.container
+    await container.upsert_item(
+        {"id": "conv1", "type": "conversation", "userId": "00000000-0000-0000-0000-000000000000", "title": "Plans"}
+    )
+    for index, (role, content) in enumerate([("user", "What plans are there?"), ("assistant", "Two plans.")]):
+        await container.upsert_item(
+            {
+                "id": f"message{index}",
+                "type": "message",
+                "userId": "00000000-0000-0000-0000-000000000000",
+                "conversationId": "conv1",
+                "createdAt": f"2023-11-0{index + 1}T00:00:00",
+                "role": role,
+                "content": content,
+            }
+        )
+
+    response = await history_client.post("/conversation/list", json={})
+    assert response.status_code == 200
+    assert await response.get_json() == {
+        "conversations": [{"id": "conv1", "title": "Plans"}],
+        "continuation": None,
+    }
+
+    response = await history_client.post("/conversation/read", json={"conversation_id": "conv1"})
+    assert response.status_code == 200
+    assert await response.get_json() == {
+        "conversation_id": "conv1",
+        "messages": [{"user": "What plans are there?", "bot": "Two plans."}],
+        "continuation": None,
+    }
+
+
+@pytest.mark.asyncio
+async def test_conversation_list_and_read_etag(history_client):
+    container = history_client.container
+    user_id = "00000000-0000-0000-0000-000000000000"
+    await container.upsert_item({"id": "conv1", "type": "conversation", "userId": user_id, "updatedAt": "2023-11-01"})
+    await container.upsert_item(
+        {
+            "id": "message0",
+            "type": "message",
+            "userId": user_id,
+            "conversationId": "conv1",
+            "createdAt": "2023-11-01T00:00:00",
+            "role": "user",
+            "content": "What plans are there?",
+        }
+    )
+
+    response = await history_client.post("/conversation/list", json={})
+    etag = response.headers["ETag"]
+    queries = len(container.queries)
+    response = await history_client.post("/conversation/list", json={}, headers={"If-None-Match": etag})
+    assert response.status_code == 304
+    # The list is answered from the cache when polled again
+    assert len(container.queries) == queries
+    assert await response.get_data() == b""
+    assert response.headers["ETag"] == etag
+
+    response = await history_client.post("/conversation/read", json={"conversation_id": "conv1"})
+    etag = response.headers["ETag"]
+    queries = len(container.queries)
+    response = await history_client.post(
+        "/conversation/read", json={"conversation_id": "conv1"}, headers={"If-None-Match": etag}
+    )
+    assert response.status_code == 304
+    # The messages are not read when the client already has them
+    assert len(container.queries) == queries
+
+    await history_client.app.config[app.CONFIG_CONVERSATION_STORAGE].create_turn(
+        user_id, "conv1", [{"role": "assistant", "content": "Two plans."}]
+    )
+    response = await history_client.post(
+        "/conversation/read", json={"conversation_id": "conv1"}, headers={"If-None-Match": etag}
+    )
+    assert response.status_code == 200
+    assert response.headers["ETag"] != etag
+    assert (await response.get_json())["messages"] == [{"user": "What plans are there?", "bot": "Two plans."}]
+
+
+@pytest.mark.asyncio
+async def test_conversation_list_cache(create_client):
+    list_cache_client = await create_client(HISTORY_STORAGE="sqlite")
+    response = await list_cache_client.post(
+        "/conversation/add", json={"approach": "chatconversation", "history": [{"user": "What plans are there?"}]}
+    )
+    conversation_id = (await response.get_json())["conversation_id"]
+    await list_cache_client.app.config[app.CONFIG_TITLE_WORKER].join()
+
+    for _ in range(2):
+        response = await list_cache_client.post("/conversation/list", json={})
+        assert [conversation["id"] for conversation in (await response.get_json())["conversations"]] == [
+            conversation_id
+        ]
+    stats = (await (await list_cache_client.get("/metrics")).get_json())["conversation_metadata_cache"]
+    assert stats["hits"] == 1
+
+    response = await list_cache_client.post("/conversation/delete", json={"conversation_id": conversation_id})
+    assert response.status_code == 200
+    response = await list_cache_client.post("/conversation/list", json={})
+    assert response.status_code == 404
+
+
+@pytest.mark.asyncio
+async def test_conversation_list_and_read_pages(history_client):
+    container = history_client.container
+    user_id = "00000000-0000-0000-0000-000000000000"
+    for index in range(3):
+        await container.upsert_item(
+            {"id": f"conv{index}", "type": "conversation", "userId": user_id, "updatedAt": f"2023-11-0{index + 1}"}
+        )
+    for index in range(6):
+        await container.upsert_item(
+            {
+                "id": f"message{index}",
+                "type": "message",
+                "userId": user_id,
+                "conversationId": "conv0",
+                "createdAt": f"2023-11-01T00:00:0{index}",
+                "role": "user" if index % 2 == 0 else "assistant",
+                "content": f"Message {index}",
+            }
+        )
+
+    response = await history_client.post("/conversation/list", json={"page_size": 2})
+    page = await response.get_json()
+    assert [conversation["id"] for conversation in page["conversations"]] == ["conv2", "conv1"]
+    response = await history_client.post(
+        "/conversation/list", json={"page_size": 2, "continuation": page["continuation"]}
+    )
+    page = await response.get_json()
+    assert [conversation["id"] for conversation in page["conversations"]] == ["conv0"]
+    assert page["continuation"] is None
+
+    response = await history_client.post("/conversation/read", json={"conversation_id": "conv0", "page_size": 2})
+    page = await response.get_json()
+    assert page["messages"] == [
+        {"user": "Message 2", "bot": "Message 3"},
+        {"user": "Message 4", "bot": "Message 5"},
+    ]
+    response = await history_client.post(
+        "/conversation/read", json={"conversation_id": "conv0", "page_size": 2, "continuation": page["continuation"]}
+    )
+    page = await response.get_json()
+    assert page == {
+        "conversation_id": "conv0",
+        "messages": [{"user": "Message 0", "bot": "Message 1"}],
+        "continuation": None,
+    }
+
+
+@pytest.mark.asyncio
+async def test_conversation_list_invalid_page_size(history_client):
+    response = await history_client.post("/conversation/list", json={"page_size": 0})
+    assert response.status_code == 400
+
+
+@pytest.mark.asyncio
+async def test_conversation_read_missing(history_client):
+    response = await history_client.post("/conversation/read", json={"conversation_id": "missing"})
+    assert response.status_code == 404
+
+
+@pytest.mark.asyncio
+async def test_conversation_delete(history_client):
+    container = history_client.container
+    await container.upsert_item(
+        {"id": "conv1", "type": "conversation", "userId": "00000000-0000-0000-0000-000000000000"}
+    )
+    await container.upsert_item(
+        {
+            "id": "message1",
+            "type": "message",
+            "userId": "00000000-0000-0000-0000-000000000000",
+            "conversationId": "conv1",
+            "role": "user",
+            "content": "Hi",
+        }
+    )
+    response = await history_client.post("/conversation/delete", json={"conversation_id": "conv1"})
+    assert response.status_code == 200
+    result = await response.get_json()
+    assert result["deleted_items"] == 2
+    assert result["request_charge"] == 2.0
+    assert container.items == {}
+
+
+@pytest.mark.asyncio
+async def test_conversation_delete_all(history_client):
+    container = history_client.container
+    for conversation_id in ["conv1", "conv2"]:
+        await container.upsert_item(
+            {"id": conversation_id, "type": "conversation", "userId": "00000000-0000-0000-0000-000000000000"}
+        )
+    response = await history_client.post("/conversation/delete_all", json={})
+    assert response.status_code == 200
+    result = await response.get_json()
+    assert result["deleted_conversations"] == 2
+    assert container.items == {}
+
+
+@pytest.mark.asyncio
+async def test_conversation_add(history_client, monkeypatch):
+    async def mock_run(self, history, stream=False, session_state=None, context={}):
+        return {"data_points": "", "answer": "Two plans.", "thoughts": ""}
+
+    monkeypatch.setattr(ChatConversationReadApproach, "run", mock_run)
+    response = await history_client.post(
+        "/conversation/add", json={"approach": "chatconversation", "history": [{"user": "What plans are there?"}]}
+    )
+    assert response.status_code == 200
+    result = await response.get_json()
+    assert result["answer"] == "Two plans."
+    assert result["request_charge"] == 3.0
+    assert len(history_client.container.batches) == 1
+
+    response = await history_client.post("/conversation/read", json={"conversation_id": result["conversation_id"]})
+    assert (await response.get_json())["messages"] == [{"user": "What plans are there?", "bot": "Two plans."}]
+
+    # The title is generated in the background, after the answer was returned
+    await history_client.app.config[app.CONFIG_TITLE_WORKER].join()
+    response = await history_client.post("/conversation/list", json={})
+    conversations = (await response.get_json())["conversations"]
+    assert conversations[0]["title"] == "The capital of France is Paris. [Benefit_Options-2.pdf]."
+
+
+@pytest.mark.asyncio
+async def test_conversation_add_sqlite(create_client):
+    sqlite_history_client = await create_client(HISTORY_STORAGE="sqlite")
+    response = await sqlite_history_client.post(
+        "/conversation/add",
+        json={"approach": "chatconversation", "history": [{"user": "What is the capital of France?"}]},
+    )
+    assert response.status_code == 200
+    result = await response.get_json()
+    # Local storage is not charged in request units
+    assert result["request_charge"] == 0.0
+    conversation_id = result["conversation_id"]
+
+    await sqlite_history_client.app.config[app.CONFIG_TITLE_WORKER].join()
+    response = await sqlite_history_client.post("/conversation/list", json={})
+    conversations = (await response.get_json())["conversations"]
+    assert [conversation["id"] for conversation in conversations] == [conversation_id]
+    assert conversations[0]["title"] == "The capital of France is Paris. [Benefit_Options-2.pdf]."
+
+    response = await sqlite_history_client.post("/conversation/read", json={"conversation_id": conversation_id})
+    assert (await response.get_json())["messages"] == [
+        {"user": "What is the capital of France?", "bot": "The capital of France is Paris. [Benefit_Options-2.pdf]."}
+    ]
+
+    response = await sqlite_history_client.post("/conversation/delete", json={"conversation_id": conversation_id})
+    assert response.status_code == 200
+    response = await sqlite_history_client.post("/conversation/read", json={"conversation_id": conversation_id})
+    assert response.status_code == 404
+
+
+@pytest.mark.asyncio
+async def test_conversation_add_stream(history_client):
+    response = await history_client.post(
+        "/conversation/add",
+        json={"approach": "chatconversation", "stream": True, "history": [{"user": "What is the capital of France?"}]},
+    )
+    assert response.status_code == 200
+    assert response.mimetype == "application/json-lines"
+    events = [json.loads(line) for line in (await response.get_data(as_text=True)).splitlines()]
+    conversation_id = events[0]["choices"][0]["context"]["conversation_id"]
+    answer = "".join(event["choices"][0]["delta"].get("content") or "" for event in events)
+    assert answer == "The capital of France is Paris. [Benefit_Options-2.pdf]."
+    # The user message is written with the new conversation while the answer streams, then the assistant message
+    assert events[-1]["choices"][0]["context"] == {"conversation_id": conversation_id, "request_charge": 4.0}
+    assert len(history_client.container.batches) == 2
+
+    response = await history_client.post("/conversation/read", json={"conversation_id": conversation_id})
+    assert (await response.get_json())["messages"] == [
+        {"user": "What is the capital of France?", "bot": "The capital of France is Paris. [Benefit_Options-2.pdf]."}
+    ]
+
+
+@pytest.mark.asyncio
+async def test_conversation_gen_title(history_client):
+    response = await history_client.post(
+        "/conversation/add", json={"approach": "chatconversation", "history": [{"user": "What plans are there?"}]}
+    )
+    conversation_id = (await response.get_json())["conversation_id"]
+    await history_client.app.config[app.CONFIG_TITLE_WORKER].join()
+
+    response = await history_client.post("/conversation/gen_title", json={"conversation_id": conversation_id})
+    assert response.status_code == 500
+    assert "already has a title" in (await response.get_json())["error"]
+
+    response = await history_client.post(
+        "/conversation/gen_title", json={"conversation_id": conversation_id, "overwrite_existing_title": True}
+    )
+    assert response.status_code == 200
+    assert (await response.get_json())["title"] == "The capital of France is Paris. [Benefit_Options-2.pdf]."
+    # Only the title is written back, with a patch rather than replacing the conversation
+    assert len(history_client.container.batches) == 1
+
+
+@pytest.mark.asyncio
+async def test_chat_history_store_not_configured(client):
+    response = await client.post(
+        "/chat",
+        json={"conversation_id": None, "messages": [{"content": "What is the capital of France?", "role": "user"}]},
+    )
+    assert response.status_code == 501
+
+
+@pytest.mark.asyncio
+async def test_chat_with_conversation_id(history_client):
+    response = await history_client.post(
+        "/chat",
+        json={"conversation_id": None, "messages": [{"content": "What is the capital of France?", "role": "user"}]},
+    )
+    assert response.status_code == 200
+    conversation_id = (await response.get_json())["choices"][0]["context"]["conversation_id"]
+
+    # The next turn only sends the new message, the history is loaded on the server
+    response = await history_client.post(
+        "/chat",
+        json={
+            "conversation_id": conversation_id,
+            "stream": True,
+            "messages": [{"content": "And of Spain?", "role": "user"}],
+        },
+    )
+    assert response.status_code == 200
+    events = [json.loads(line) for line in (await response.get_data(as_text=True)).splitlines()]
+    assert events[-1]["choices"][0]["context"] == {"conversation_id": conversation_id}
+    thoughts = events[0]["choices"][0]["context"]["thoughts"]
+    assert "What is the capital of France?" in thoughts
+
+    history_store = history_client.app.config[app.CONFIG_HISTORY_STORE]
+    assert [message["role"] for message in history_store.entries[next(iter(history_store.entries))].messages] == [
+        "user",
+        "assistant",
+        "user",
+        "assistant",
+    ]
+    # Each message was tokenized once, when it was added
+    assert history_store.get_stats()["tokenized_messages"] == 4
+
+    response = await history_client.post("/conversation/read", json={"conversation_id": conversation_id})
+    assert len((await response.get_json())["messages"]) == 2
+
+
+@pytest.mark.asyncio
+async def test_chat_with_conversation_summary(history_client, monkeypatch):
+    prompts = []
+
+    async def mock_run(self, messages, stream=False, session_state=None, context={}):
+        prompts.append((messages, context["history_token_counts"]))
+        return {"choices": [{"message": {"role": "assistant", "content": "Madrid."}, "context": {}}]}
+
+    storage = history_client.app.config[app.CONFIG_CONVERSATION_STORAGE]
+    turn = await storage.create_turn(
+        "00000000-0000-0000-0000-000000000000",
+        None,
+        [{"role": "user", "content": "What is the capital of France?"}, {"role": "assistant", "content": "Paris."}],
+    )
+    conversation_id = turn["conversation_id"]
+    await storage.update_conversation_summary(
+        "00000000-0000-0000-0000-000000000000",
+        conversation_id,
+        {"content": "The user asked about the capital of France.", "through": turn["messages"][-1]["createdAt"]},
+    )
+    monkeypatch.setattr(ChatReadRetrieveReadApproach, "run", mock_run)
+
+    response = await history_client.post(
+        "/chat",
+        json={"conversation_id": conversation_id, "messages": [{"content": "And of Spain?", "role": "user"}]},
+    )
+    assert response.status_code == 200
+    # The summarized messages are replaced by their summary
+    messages, token_counts = prompts[0]
+    assert messages == [
+        {
+            "role": "system",
+            "content": "Summary of the earlier conversation:\nThe user asked about the capital of France.",
+        },
+        {"role": "user", "content": "And of Spain?"},
+    ]
+    assert len(token_counts) == 1
+
+
+@pytest.mark.asyncio
+async def test_chat_with_missing_conversation_id(history_client):
+    response = await history_client.post(
+        "/chat", json={"conversation_id": "missing", "messages": [{"content": "And of Spain?", "role": "user"}]}
+    )
+    assert response.status_code == 404
+
+
+@pytest.mark.asyncio
+async def test_conversation_add_write_behind(write_behind_client):
+    response = await write_behind_client.post(
+        "/conversation/add", json={"approach": "chatconversation", "history": [{"user": "What plans are there?"}]}
+    )
+    assert response.status_code == 200
+    result = await response.get_json()
+    # The turn is acknowledged before it is written, so its request charge is not known
+    assert "request_charge" not in result
+    assert not write_behind_client.container.batches
+    write_queue = write_behind_client.app.config[app.CONFIG_WRITE_BEHIND_QUEUE]
+    assert write_queue.get_stats()["queue_depth"] == 2
+
+    # Reading the conversation writes its pending turns first
+    response = await write_behind_client.post("/conversation/read", json={"conversation_id": result["conversation_id"]})
+    assert (await response.get_json())["messages"] == [
+        {"user": "What plans are there?", "bot": "The capital of France is Paris. [Benefit_Options-2.pdf]."}
+    ]
+    assert len(write_behind_client.container.batches) == 1
+
+    # The title is generated once the turn is written
+    await asyncio.sleep(0)
+    await write_behind_client.app.config[app.CONFIG_TITLE_WORKER].join()
+    response = await write_behind_client.post("/conversation/list", json={})
+    assert (await response.get_json())["conversations"][0]["title"] != ""
+
+
+@pytest.mark.asyncio
+async def test_conversation_add_stream_write_behind(write_behind_client):
+    response = await write_behind_client.post(
+        "/conversation/add",
+        json={"approach": "chatconversation", "stream": True, "history": [{"user": "What is the capital of France?"}]},
+    )
+    events = [json.loads(line) for line in (await response.get_data(as_text=True)).splitlines()]
+    conversation_id = events[0]["choices"][0]["context"]["conversation_id"]
+    assert events[-1]["choices"][0]["context"] == {"conversation_id": conversation_id}
+
+    # The user message and the answer are coalesced into one batch
+    await write_behind_client.app.config[app.CONFIG_WRITE_BEHIND_QUEUE].flush()
+    assert len(write_behind_client.container.batches) == 1
+    response = await write_behind_client.post("/conversation/read", json={"conversation_id": conversation_id})
+    assert len((await response.get_json())["messages"]) == 1
+
+
+@pytest.mark.asyncio
+async def test_chat_with_conversation_id_write_behind(write_behind_client):
+    response = await write_behind_client.post(
+        "/chat",
+        json={"conversation_id": None, "messages": [{"content": "What is the capital of France?", "role": "user"}]},
+    )
+    conversation_id = (await response.get_json())["choices"][0]["context"]["conversation_id"]
+    assert not write_behind_client.container.batches
+
+    response = await write_behind_client.post(
+        "/chat", json={"conversation_id": conversation_id, "messages": [{"content": "And of Spain?", "role": "user"}]}
+    )
+    assert response.status_code == 200
+    history_store = write_behind_client.app.config[app.CONFIG_HISTORY_STORE]
+    assert history_store.get_stats()["hits"] == 1
+
+
+@pytest.mark.asyncio
+async def test_ask_document_cache(create_client, mock_index_version_blob, monkeypatch):
+    document_cache_client = await create_client(SEARCH_DOCUMENT_CACHE="true")
+    searches = []
+    mock_search = app.SearchClient.search
+
+    async def record_search(self, *args, **kwargs):
+        searches.append(kwargs)
+        return await mock_search(self, *args, **kwargs)
+
+    monkeypatch.setattr(app.SearchClient, "search", record_search)
+
+    for _ in range(2):
+        response = await document_cache_client.post(
+            "/ask",
+            json={"messages": [{"content": "What is the capital of France?", "role": "user"}]},
+        )
+        assert response.status_code == 200
+        result = await response.get_json()
+        assert result["choices"][0]["context"]["data_points"] == [
+            "Benefit_Options-2.pdf: There is a whistleblower policy."
+        ]
+
+    # The hits only hold their keys, the content is fetched once and then read from the cache
+    assert [search.get("select") for search in searches] == [["id"], ["id", "sourcepage", "content"], ["id"]]
+    response = await document_cache_client.get("/metrics")
+    stats = (await response.get_json())["document_cache"]
+    assert stats == {"entries": 1, "hits": 1, "misses": 1, "invalidations": 0, "version": "0x1"}
+
+
+@pytest.mark.asyncio
+async def test_ask_selects_source_fields(client, monkeypatch):
+    searches = []
+    mock_search = app.SearchClient.search
+
+    async def record_search(self, *args, **kwargs):
+        searches.append(kwargs)
+        return await mock_search(self, *args, **kwargs)
+
+    monkeypatch.setattr(app.SearchClient, "search", record_search)
+
+    response = await client.post(
+        "/ask",
+        json={"messages": [{"content": "What is the capital of France?", "role": "user"}]},
+    )
+    assert response.status_code == 200
+    assert searches[0]["select"] == ["sourcepage", "content"]
+
+
+@pytest.mark.asyncio
+async def test_ask_chat_search_cache(create_client, mock_index_version_blob_missing, monkeypatch):
+    search_cache_client = await create_client(SEARCH_RESULT_CACHE_BACKEND="memory")
+    searches = []
+    mock_search = app.SearchClient.search
+
+    async def record_search(self, *args, **kwargs):
+        searches.append(kwargs)
+        return await mock_search(self, *args, **kwargs)
+
+    monkeypatch.setattr(app.SearchClient, "search", record_search)
+
+    for _ in range(2):
+        response = await search_cache_client.post(
+            "/ask",
+            json={
+                "messages": [{"content": "What is the capital of France?", "role": "user"}],
+                "context": {"overrides": {"semantic_ranker": True, "semantic_captions": True}},
+            },
+        )
+        assert response.status_code == 200
+        result = await response.get_json()
+        assert result["choices"][0]["context"]["data_points"] == [
+            "Benefit_Options-2.pdf: Caption: A whistleblower policy."
+        ]
+    assert len(searches) == 1
+
+    response = await search_cache_client.post(
+        "/ask",
+        json={
+            "messages": [{"content": "What is the capital of France?", "role": "user"}],
+            "context": {"overrides": {"semantic_ranker": True, "semantic_captions": True, "exclude_category": "x"}},
+        },
+    )
+    assert response.status_code == 200
+    assert len(searches) == 2
+
+    response = await search_cache_client.get("/metrics")
+    stats = (await response.get_json())["search_result_cache"]
+    assert stats == {"hits": 1, "misses": 2, "invalidations": 0, "version": None}
+
+
+@pytest.mark.asyncio
+async def test_ask_chat_local_search_index(create_client, tmp_path):
+    document = {
+        "id": "file-Benefit_Options_pdf-42656E656669745F4F7074696F6E732E706466-page-2",
+        "content": "There is a whistleblower policy.",
+        "category": None,
+        "sourcepage": "Benefit_Options-2.pdf",
+        "sourcefile": "Benefit_Options.pdf",
+        "embedding": [0.0023064255, -0.009327292, -0.0028842222],
+    }
+    (tmp_path / "documents.jsonl").write_text(json.dumps(document) + "\n")
+    local_index_client = await create_client(LOCAL_SEARCH_INDEX=str(tmp_path), AZURE_SEARCH_SERVICE=None)
+    response = await local_index_client.post(
+        "/ask",
+        json={
+            "messages": [{"content": "Is there a whistleblower policy?", "role": "user"}],
+            "context": {"overrides": {"retrieval_mode": "hybrid", "exclude_category": "other"}},
+        },
+    )
+    assert response.status_code == 200
+    result = await response.get_json()
+    assert result["choices"][0]["context"]["data_points"] == ["Benefit_Options-2.pdf: There is a whistleblower policy."]
+
+    response = await local_index_client.post(
+        "/chat",
+        json={
+            "messages": [{"content": "Is there a whistleblower policy?", "role": "user"}],
+            "context": {"overrides": {"retrieval_mode": "vectors", "semantic_ranker": True}},
+        },
+    )
+    assert response.status_code == 200
+    result = await response.get_json()
+    assert result["choices"][0]["context"]["data_points"] == ["Benefit_Options-2.pdf: There is a whistleblower policy."]
+
+
+@pytest.mark.asyncio
+async def test_ask_chat_source_packer(create_client, monkeypatch, mock_encoding):
+    source_packer_client = await create_client(SOURCE_TOKEN_BUDGET="500", SOURCE_CANDIDATES="5")
+    searches = []
+    mock_search = app.SearchClient.search
+
+    async def record_search(self, *args, **kwargs):
+        searches.append(kwargs)
+        return await mock_search(self, *args, **kwargs)
+
+    monkeypatch.setattr(app.SearchClient, "search", record_search)
+
+    for path in ("/ask", "/chat"):
+        response = await source_packer_client.post(
+            path,
+            json={
+                "messages": [{"content": "What is the capital of France?", "role": "user"}],
+                "context": {"overrides": {"retrieval_mode": "text"}},
+            },
+        )
+        assert response.status_code == 200
+        context = (await response.get_json())["choices"][0]["context"]
+        assert context["data_points"] == ["Benefit_Options-2.pdf: There is a whistleblower policy."]
+        # One word per token with the mock encoding
+        assert "Sources:<br>packed 1 of 1 candidates into 6 of 500 tokens<br><br>" in context["thoughts"]
+
+    # More candidates than the default top of 3 are fetched to pack the sources from
+    assert [search["top"] for search in searches] == [5, 5]
+    response = await source_packer_client.get("/metrics")
+    stats = (await response.get_json())["source_packer"]
+    assert stats == {"entries": 1, "hits": 1, "misses": 1, "packed": 2, "skipped": 0}
+
+
+@pytest.mark.asyncio
+async def test_close_clients_closes_session_pool_last(monkeypatch, mock_env, mock_acs_search):
+    monkeypatch.setenv("HISTORY_STORAGE", "memory")
+    quart_app = app.create_app()
+    pool_open_while_closing_workers = []
+    async with quart_app.test_app():
+        pool = quart_app.config[app.CONFIG_OPENAI_SESSION_POOL]
+        title_worker = quart_app.config[app.CONFIG_TITLE_WORKER]
+        close_title_worker = title_worker.close
+
+        async def close():
+            pool_open_while_closing_workers.append(pool.get_stats()["open"])
+            await close_title_worker()
+
+        title_worker.close = close
+    assert pool_open_while_closing_workers == [True]
+    assert not pool.get_stats()["open"]
+
+
+@pytest.mark.asyncio
+async def test_title_worker_uses_session_pool(create_client):
+    client = await create_client(HISTORY_STORAGE="memory")
+    title_worker = client.app.config[app.CONFIG_TITLE_WORKER]
+    sessions = []
+
+    async def create_title(messages):
+        sessions.append(openai.aiosession.get())
+        return "Title"
+
+    title_worker.create_title = create_title
+    conversation_id = await create_conversation(client.app.config[app.CONFIG_CONVERSATION_STORAGE])
+    title_worker.submit("user1", conversation_id)
+    await title_worker.join()
+    assert sessions == [client.app.config[app.CONFIG_OPENAI_SESSION_POOL].session]
@@ -163,6 +163,28 @@ async def test_dont_remove_if_no_container(monkeypatch, mock_env, blob_manager):
     await blob_manager.remove_blob()
 
 
+@pytest.mark.asyncio
+@pytest.mark.skipif(sys.version_info.minor < 10, reason="requires Python 3.10 or higher")
+async def test_update_index_version(monkeypatch, mock_env, blob_manager):
+    async def mock_exists(*args, **kwargs):
+        return True
+
+    monkeypatch.setattr("azure.storage.blob.aio.ContainerClient.exists", mock_exists)
+
+    uploads = []
+
+    async def mock_upload_blob(self, name, data, *args, **kwargs):
+        uploads.append((name, data, kwargs.get("overwrite")))
+        return True
+
+    monkeypatch.setattr("azure.storage.blob.aio.ContainerClient.upload_blob", mock_upload_blob)
+
+    await blob_manager.update_index_version()
+    await blob_manager.update_index_version()
+    assert [(name, overwrite) for name, _, overwrite in uploads] == [("index-version", True), ("index-version", True)]
+    assert uploads[0][1] != uploads[1][1]
+
+
 def test_sourcepage_from_file_page():
     assert BlobManager.sourcepage_from_file_page("test.pdf", 0) == "test.pdf#page=1"
     assert BlobManager.sourcepage_from_file_page("test.html", 0) == "test.html"
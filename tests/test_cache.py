@@ -0,0 +1,55 @@
+import pytest
+
+from core.cache import InMemoryCacheBackend, SQLiteCacheBackend
+
+
+@pytest.mark.asyncio
+async def test_inmemory_cache_lru_eviction():
+    cache = InMemoryCacheBackend(max_entries=2)
+    await cache.set("a", 1)
+    await cache.set("b", 2)
+    assert await cache.get("a") == 1
+    await cache.set("c", 3)
+    assert await cache.get("b") is None
+    assert await cache.get("a") == 1
+    assert await cache.get("c") == 3
+    assert len(cache) == 2
+
+
+@pytest.mark.asyncio
+async def test_inmemory_cache_ttl(monkeypatch):
+    now = 1000.0
+    monkeypatch.setattr("core.cache.time.monotonic", lambda: now)
+    cache = InMemoryCacheBackend(default_ttl=10)
+    await cache.set("a", 1)
+    await cache.set("b", 2, ttl=100)
+    now = 1050.0
+    assert await cache.get("a") is None
+    assert await cache.get("b") == 2
+    await cache.delete("b")
+    assert await cache.get("b") is None
+
+
+@pytest.mark.asyncio
+async def test_sqlite_cache(tmp_path, monkeypatch):
+    now = 1000.0
+    monkeypatch.setattr("core.cache.time.time", lambda: now)
+    path = str(tmp_path / "cache.db")
+    cache = SQLiteCacheBackend(path, max_entries=2)
+    await cache.set("a", {"answer": "one"}, ttl=10)
+    now = 1001.0
+    await cache.set("b", [1, 2])
+    now = 1002.0
+    assert await cache.get("a") == {"answer": "one"}
+    now = 1003.0
+    await cache.set("c", "three")
+    assert await cache.get("b") is None
+
+    # A second instance on the same file sees the same entries, like another worker process would
+    other = SQLiteCacheBackend(path, max_entries=2)
+    assert await other.get("c") == "three"
+
+    now = 1020.0
+    assert await cache.get("a") is None
+    await other.clear()
+    assert await cache.get("c") is None
@@ -1,12 +1,15 @@
 import json
 
+import openai
+import pytest
+
 from approaches.chatreadretrieveread import ChatReadRetrieveReadApproach
+from core.retriever import Retriever
+from core.rewritepolicy import HeuristicRewritePolicy, SkipFirstTurnPolicy
 
 
 def test_get_search_query():
-    chat_approach = ChatReadRetrieveReadApproach(
-        None, "", "gpt-35-turbo", "gpt-35-turbo", "", "", "", "", "en-us", "lexicon"
-    )
+    chat_approach = ChatReadRetrieveReadApproach(None, "", "gpt-35-turbo", "gpt-35-turbo")
 
     payload = '{"id":"chatcmpl-81JkxYqYppUkPtOAia40gki2vJ9QM","object":"chat.completion","created":1695324963,"model":"gpt-35-turbo","prompt_filter_results":[{"prompt_index":0,"content_filter_results":{"hate":{"filtered":false,"severity":"safe"},"self_harm":{"filtered":false,"severity":"safe"},"sexual":{"filtered":false,"severity":"safe"},"violence":{"filtered":false,"severity":"safe"}}}],"choices":[{"index":0,"finish_reason":"function_call","message":{"role":"assistant","function_call":{"name":"search_sources","arguments":"{\\n\\"search_query\\":\\"accesstelemedicineservices\\"\\n}"}},"content_filter_results":{}}],"usage":{"completion_tokens":19,"prompt_tokens":425,"total_tokens":444}}'
     default_query = "hello"
@@ -16,9 +19,7 @@ def test_get_search_query():
 
 
 def test_get_search_query_returns_default():
-    chat_approach = ChatReadRetrieveReadApproach(
-        None, "", "gpt-35-turbo", "gpt-35-turbo", "", "", "", "", "en-us", "lexicon"
-    )
+    chat_approach = ChatReadRetrieveReadApproach(None, "", "gpt-35-turbo", "gpt-35-turbo")
 
     payload = '{"id":"chatcmpl-81JkxYqYppUkPtOAia40gki2vJ9QM","object":"chat.completion","created":1695324963,"model":"gpt-35-turbo","prompt_filter_results":[{"prompt_index":0,"content_filter_results":{"hate":{"filtered":false,"severity":"safe"},"self_harm":{"filtered":false,"severity":"safe"},"sexual":{"filtered":false,"severity":"safe"},"violence":{"filtered":false,"severity":"safe"}}}],"choices":[{"index":0,"finish_reason":"function_call","message":{"role":"assistant"},"content_filter_results":{}}],"usage":{"completion_tokens":19,"prompt_tokens":425,"total_tokens":444}}'
     default_query = "hello"
@@ -28,9 +29,7 @@ def test_get_search_query_returns_default():
 
 
 def test_get_messages_from_history():
-    chat_approach = ChatReadRetrieveReadApproach(
-        None, "", "gpt-35-turbo", "gpt-35-turbo", "", "", "", "", "en-us", "lexicon"
-    )
+    chat_approach = ChatReadRetrieveReadApproach(None, "", "gpt-35-turbo", "gpt-35-turbo")
 
     messages = chat_approach.get_messages_from_history(
         system_prompt="You are a bot.",
@@ -58,9 +57,7 @@ def test_get_messages_from_history():
 
 
 def test_get_messages_from_history_truncated():
-    chat_approach = ChatReadRetrieveReadApproach(
-        None, "", "gpt-35-turbo", "gpt-35-turbo", "", "", "", "", "en-us", "lexicon"
-    )
+    chat_approach = ChatReadRetrieveReadApproach(None, "", "gpt-35-turbo", "gpt-35-turbo")
 
     messages = chat_approach.get_messages_from_history(
         system_prompt="You are a bot.",
@@ -83,9 +80,7 @@ def test_get_messages_from_history_truncated():
 
 
 def test_get_messages_from_history_truncated_longer():
-    chat_approach = ChatReadRetrieveReadApproach(
-        None, "", "gpt-35-turbo", "gpt-35-turbo", "", "", "", "", "en-us", "lexicon"
-    )
+    chat_approach = ChatReadRetrieveReadApproach(None, "", "gpt-35-turbo", "gpt-35-turbo")
 
     messages = chat_approach.get_messages_from_history(
         system_prompt="You are a bot.",  # 8 tokens
@@ -119,9 +114,7 @@ def test_get_messages_from_history_truncated_longer():
 
 def test_get_messages_from_history_truncated_break_pair():
     """Tests that the truncation breaks the pair of messages."""
-    chat_approach = ChatReadRetrieveReadApproach(
-        None, "", "gpt-35-turbo", "gpt-35-turbo", "", "", "", "", "en-us", "lexicon"
-    )
+    chat_approach = ChatReadRetrieveReadApproach(None, "", "gpt-35-turbo", "gpt-35-turbo")
 
     messages = chat_approach.get_messages_from_history(
         system_prompt="You are a bot.",  # 8 tokens
@@ -158,9 +151,7 @@ def test_get_messages_from_history_truncated_break_pair():
 
 
 def test_extract_followup_questions():
-    chat_approach = ChatReadRetrieveReadApproach(
-        None, "", "gpt-35-turbo", "gpt-35-turbo", "", "", "", "", "en-us", "lexicon"
-    )
+    chat_approach = ChatReadRetrieveReadApproach(None, "", "gpt-35-turbo", "gpt-35-turbo")
 
     content = "Here is answer to your question.<<What is the dress code?>>"
     pre_content, followup_questions = chat_approach.extract_followup_questions(content)
@@ -169,9 +160,7 @@ def test_extract_followup_questions():
 
 
 def test_extract_followup_questions_three():
-    chat_approach = ChatReadRetrieveReadApproach(
-        None, "", "gpt-35-turbo", "gpt-35-turbo", "", "", "", "", "en-us", "lexicon"
-    )
+    chat_approach = ChatReadRetrieveReadApproach(None, "", "gpt-35-turbo", "gpt-35-turbo")
 
     content = """Here is answer to your question.
 
@@ -188,9 +177,7 @@ def test_extract_followup_questions_three():
 
 
 def test_extract_followup_questions_no_followup():
-    chat_approach = ChatReadRetrieveReadApproach(
-        None, "", "gpt-35-turbo", "gpt-35-turbo", "", "", "", "", "en-us", "lexicon"
-    )
+    chat_approach = ChatReadRetrieveReadApproach(None, "", "gpt-35-turbo", "gpt-35-turbo")
 
     content = "Here is answer to your question."
     pre_content, followup_questions = chat_approach.extract_followup_questions(content)
@@ -199,9 +186,7 @@ def test_extract_followup_questions_no_followup():
 
 
 def test_extract_followup_questions_no_pre_content():
-    chat_approach = ChatReadRetrieveReadApproach(
-        None, "", "gpt-35-turbo", "gpt-35-turbo", "", "", "", "", "en-us", "lexicon"
-    )
+    chat_approach = ChatReadRetrieveReadApproach(None, "", "gpt-35-turbo", "gpt-35-turbo")
 
     content = "<<What is the dress code?>>"
     pre_content, followup_questions = chat_approach.extract_followup_questions(content)
@@ -210,9 +195,7 @@ def test_extract_followup_questions_no_pre_content():
 
 
 def test_get_messages_from_history_few_shots():
-    chat_approach = ChatReadRetrieveReadApproach(
-        None, "", "gpt-35-turbo", "gpt-35-turbo", "", "", "", "", "en-us", "lexicon"
-    )
+    chat_approach = ChatReadRetrieveReadApproach(None, "", "gpt-35-turbo", "gpt-35-turbo")
 
     user_query_request = "What does a Product manager do?"
     messages = chat_approach.get_messages_from_history(
@@ -231,3 +214,228 @@ def test_get_messages_from_history_few_shots():
     assert messages[4]["role"] == "assistant"
     assert messages[5]["role"] == "user"
     assert messages[5]["content"] == user_query_request
+
+
+def create_chat_approach_with_search(monkeypatch, rewritten_query, rewrite_policy=None):
+    embedded = []
+
+    async def mock_embedding_acreate(*args, **kwargs):
+        embedded.append(kwargs["input"])
+        return {"data": [{"embedding": [0.1, 0.2, 0.3]}]}
+
+    async def mock_chatcompletion_acreate(*args, **kwargs):
+        return {"choices": [{"message": {"role": "assistant", "content": rewritten_query}}]}
+
+    class MockSearchClient:
+        async def search(self, *args, **kwargs):
+            self.vector = kwargs.get("vector")
+            return AsyncSearchResults()
+
+    class AsyncSearchResults:
+        def __aiter__(self):
+            return self
+
+        async def __anext__(self):
+            raise StopAsyncIteration
+
+    monkeypatch.setattr(openai.Embedding, "acreate", mock_embedding_acreate)
+    monkeypatch.setattr(openai.ChatCompletion, "acreate", mock_chatcompletion_acreate)
+    retriever = Retriever(MockSearchClient(), "azure", "test-ada", "ada", "sourcepage", "content", "en-us", "lexicon")
+    chat_approach = ChatReadRetrieveReadApproach(
+        retriever, "azure", "test-chatgpt", "gpt-35-turbo", rewrite_policy=rewrite_policy
+    )
+    return chat_approach, embedded
+
+
+@pytest.mark.asyncio
+async def test_speculative_embedding_used(monkeypatch, mock_encoding):
+    chat_approach, embedded = create_chat_approach_with_search(monkeypatch, ChatReadRetrieveReadApproach.NO_RESPONSE)
+    extra_info, chat_coroutine = await chat_approach.run_until_final_call(
+        [{"role": "user", "content": "What is the deductible?"}],
+        {"retrieval_mode": "hybrid", "speculative_embedding": True},
+        {},
+    )
+    chat_coroutine.close()
+    assert embedded == ["What is the deductible?"]
+    assert chat_approach.retriever.search_client.vector == [0.1, 0.2, 0.3]
+    assert "Speculative embedding:<br>used, saved" in extra_info["thoughts"]
+
+
+@pytest.mark.asyncio
+async def test_speculative_embedding_discarded(monkeypatch, mock_encoding):
+    chat_approach, embedded = create_chat_approach_with_search(monkeypatch, "deductible amount")
+    extra_info, chat_coroutine = await chat_approach.run_until_final_call(
+        [{"role": "user", "content": "What is the deductible?"}],
+        {"retrieval_mode": "hybrid", "speculative_embedding": True},
+        {},
+    )
+    chat_coroutine.close()
+    assert embedded[-1] == "deductible amount"
+    assert "Speculative embedding:<br>discarded, search query was rewritten" in extra_info["thoughts"]
+
+
+@pytest.mark.asyncio
+async def test_speculative_embedding_failed(monkeypatch, mock_encoding):
+    chat_approach, embedded = create_chat_approach_with_search(monkeypatch, ChatReadRetrieveReadApproach.NO_RESPONSE)
+    calls = 0
+
+    async def mock_embedding_acreate(*args, **kwargs):
+        nonlocal calls
+        calls += 1
+        if calls == 1:
+            raise openai.error.APIError("The server is busy")
+        return {"data": [{"embedding": [0.1, 0.2, 0.3]}]}
+
+    monkeypatch.setattr(openai.Embedding, "acreate", mock_embedding_acreate)
+    extra_info, chat_coroutine = await chat_approach.run_until_final_call(
+        [{"role": "user", "content": "What is the deductible?"}],
+        {"retrieval_mode": "hybrid", "speculative_embedding": True},
+        {},
+    )
+    chat_coroutine.close()
+    assert calls == 2
+    assert chat_approach.retriever.search_client.vector == [0.1, 0.2, 0.3]
+    assert "Speculative embedding:<br>failed" in extra_info["thoughts"]
+
+
+@pytest.mark.asyncio
+async def test_speculative_embedding_off_by_default(monkeypatch, mock_encoding):
+    chat_approach, embedded = create_chat_approach_with_search(monkeypatch, ChatReadRetrieveReadApproach.NO_RESPONSE)
+    extra_info, chat_coroutine = await chat_approach.run_until_final_call(
+        [{"role": "user", "content": "What is the deductible?"}], {"retrieval_mode": "hybrid"}, {}
+    )
+    chat_coroutine.close()
+    assert embedded == ["What is the deductible?"]
+    assert "Speculative embedding" not in extra_info["thoughts"]
+
+
+@pytest.mark.asyncio
+async def test_rewrite_skipped_for_first_question(monkeypatch, mock_encoding):
+    chat_approach, embedded = create_chat_approach_with_search(
+        monkeypatch, "deductible amount", rewrite_policy=SkipFirstTurnPolicy()
+    )
+    extra_info, chat_coroutine = await chat_approach.run_until_final_call(
+        [{"role": "user", "content": "What is the deductible?"}], {"retrieval_mode": "hybrid"}, {}
+    )
+    chat_coroutine.close()
+    assert embedded == ["What is the deductible?"]
+    assert "Searched for:<br>What is the deductible?<br><br>" in extra_info["thoughts"]
+    assert "Query rewrite:<br>skipped" in extra_info["thoughts"]
+    assert extra_info["query_rewrite"] == {
+        "policy": "skip_first_turn",
+        "rewritten": False,
+        "reason": "first question",
+        "estimated_ms_saved": 0,
+    }
+
+
+@pytest.mark.asyncio
+async def test_rewrite_runs_for_follow_up(monkeypatch, mock_encoding):
+    rewrite_policy = HeuristicRewritePolicy()
+    chat_approach, embedded = create_chat_approach_with_search(
+        monkeypatch, "deductible amount", rewrite_policy=rewrite_policy
+    )
+    history = [
+        {"role": "user", "content": "What is included in my Northwind Health Plus plan?"},
+        {"role": "assistant", "content": "Hospital and emergency services [Benefit_Options-2.pdf]."},
+        {"role": "user", "content": "What is its deductible?"},
+    ]
+    extra_info, chat_coroutine = await chat_approach.run_until_final_call(history, {"retrieval_mode": "hybrid"}, {})
+    chat_coroutine.close()
+    assert embedded == ["deductible amount"]
+    assert extra_info["query_rewrite"]["rewritten"] is True
+    assert extra_info["query_rewrite"]["reason"] == "follow-up question refers to earlier turns"
+    assert rewrite_policy.latency_samples == 1
+
+
+@pytest.mark.asyncio
+async def test_rewrite_not_reported_by_default(monkeypatch, mock_encoding):
+    chat_approach, _ = create_chat_approach_with_search(monkeypatch, "deductible amount")
+    extra_info, chat_coroutine = await chat_approach.run_until_final_call(
+        [{"role": "user", "content": "What is the deductible?"}], {"retrieval_mode": "hybrid"}, {}
+    )
+    chat_coroutine.close()
+    assert "Searched for:<br>deductible amount<br><br>" in extra_info["thoughts"]
+    assert "query_rewrite" not in extra_info
+    assert "Query rewrite" not in extra_info["thoughts"]
+
+
+def test_get_search_queries():
+    chat_approach = ChatReadRetrieveReadApproach(None, "", "gpt-35-turbo", "gpt-35-turbo")
+
+    def completion(message):
+        return {"choices": [{"message": {"role": "assistant", **message}}]}
+
+    arguments = json.dumps({"search_queries": ["deductible", " deductible ", "0", "plan cost", "copay"]})
+    function_call = {"function_call": {"name": "search_sources", "arguments": arguments}}
+    assert chat_approach.get_search_queries(completion(function_call), "hello", 2) == ["deductible", "plan cost"]
+    # Falls back to a single query when no variants are returned
+    assert chat_approach.get_search_queries(completion({"content": "deductible"}), "hello", 3) == ["deductible"]
+    assert chat_approach.get_search_queries(completion({"content": "0"}), "hello", 3) == ["hello"]
+
+
+@pytest.mark.asyncio
+async def test_query_variants(monkeypatch, mock_encoding):
+    requests = {}
+
+    async def mock_embedding_acreate(*args, **kwargs):
+        requests.setdefault("embeddings", []).append(kwargs["input"])
+        return {"data": [{"index": index, "embedding": [float(index)]} for index in range(len(kwargs["input"]))]}
+
+    async def mock_chatcompletion_acreate(*args, **kwargs):
+        requests["functions"] = kwargs["functions"]
+        arguments = json.dumps({"search_queries": ["deductible", "plan cost"]})
+        function_call = {"name": "search_sources", "arguments": arguments}
+        return {"choices": [{"message": {"role": "assistant", "function_call": function_call}}]}
+
+    class MockSearchClient:
+        async def search(self, search_text, **kwargs):
+            ids = {"deductible": ["a", "b"], "plan cost": ["b", "c"]}[search_text]
+            return MockSearchResults([{"id": id, "sourcepage": f"{id}.pdf", "content": id} for id in ids])
+
+    class MockSearchResults:
+        def __init__(self, results):
+            self.results = iter(results)
+
+        def __aiter__(self):
+            return self
+
+        async def __anext__(self):
+            try:
+                return next(self.results)
+            except StopIteration:
+                raise StopAsyncIteration
+
+    monkeypatch.setattr(openai.Embedding, "acreate", mock_embedding_acreate)
+    monkeypatch.setattr(openai.ChatCompletion, "acreate", mock_chatcompletion_acreate)
+    retriever = Retriever(MockSearchClient(), "azure", "test-ada", "ada", "sourcepage", "content", "en-us", "lexicon")
+    chat_approach = ChatReadRetrieveReadApproach(retriever, "azure", "test-chatgpt", "gpt-35-turbo", query_variants=3)
+    extra_info, chat_coroutine = await chat_approach.run_until_final_call(
+        [{"role": "user", "content": "What is the deductible?"}], {"retrieval_mode": "hybrid", "top": 2}, {}
+    )
+    chat_coroutine.close()
+    assert requests["functions"][0]["parameters"]["properties"]["search_queries"]["maxItems"] == 3
+    assert requests["embeddings"] == [["deductible", "plan cost"]]
+    assert extra_info["data_points"] == ["b.pdf: b", "a.pdf: a"]
+    assert "Searched for:<br>deductible<br>plan cost<br><br>" in extra_info["thoughts"]
+    assert "Query variants:<br>deductible: " in extra_info["thoughts"]
+    assert "2 results, 2 in sources<br>plan cost: " in extra_info["thoughts"]
+    assert extra_info["thoughts"].count("2 results, 1 in sources") == 1
+
+
+@pytest.mark.asyncio
+async def test_query_variants_are_clamped(monkeypatch, mock_encoding):
+    chat_approach, embedded = create_chat_approach_with_search(monkeypatch, "deductible")
+    chat_approach.max_query_variants = 4
+    requests = {}
+
+    async def mock_chatcompletion_acreate(*args, **kwargs):
+        requests["functions"] = kwargs["functions"]
+        return {"choices": [{"message": {"role": "assistant", "content": "deductible"}}]}
+
+    monkeypatch.setattr(openai.ChatCompletion, "acreate", mock_chatcompletion_acreate)
+    extra_info, chat_coroutine = await chat_approach.run_until_final_call(
+        [{"role": "user", "content": "What is the deductible?"}], {"query_variants": 1000}, {}
+    )
+    chat_coroutine.close()
+    assert requests["functions"][0]["parameters"]["properties"]["search_queries"]["maxItems"] == 4
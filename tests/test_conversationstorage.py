@@ -0,0 +1,151 @@
+import sqlite3
+
+import pytest
+from conftest import turn
+
+from history.storage import InMemoryConversationStorage, SQLiteConversationStorage
+
+
+@pytest.fixture(params=["memory", "sqlite", "cosmos"])
+def storage(request, tmp_path):
+    if request.param == "memory":
+        return InMemoryConversationStorage()
+    if request.param == "sqlite":
+        return SQLiteConversationStorage(str(tmp_path / "history.db"))
+    return request.getfixturevalue("conversation_client")
+
+
+@pytest.mark.asyncio
+async def test_create_and_read_turns(storage):
+    created = await storage.create_turn("user1", None, turn("What is included?", "Eye exams."), title="Plans")
+    conversation_id = created["conversation_id"]
+    await storage.create_turn("user1", conversation_id, turn("And dental?", "Yes."))
+
+    conversation = await storage.get_conversation("user1", conversation_id)
+    assert conversation["title"] == "Plans"
+    page = await storage.get_messages_page("user1", conversation_id)
+    assert [message["content"] for message in page["messages"]] == [
+        "What is included?",
+        "Eye exams.",
+        "And dental?",
+        "Yes.",
+    ]
+    assert conversation["updatedAt"] == page["messages"][-1]["createdAt"]
+    assert page["continuation"] is None
+    assert await storage.get_conversation("user2", conversation_id) is None
+
+
+@pytest.mark.asyncio
+async def test_create_turn_with_conversation_id(storage):
+    created = await storage.create_turn("user1", "conversation1", turn("Hi", "Hello"), create_conversation=True)
+    assert created["conversation_id"] == "conversation1"
+    assert (await storage.get_conversation("user1", "conversation1"))["id"] == "conversation1"
+
+
+@pytest.mark.asyncio
+async def test_messages_pages(storage):
+    conversation_id = (await storage.create_turn("user1", None, turn("q0", "a0")))["conversation_id"]
+    for index in range(1, 5):
+        await storage.create_turn("user1", conversation_id, turn(f"q{index}", f"a{index}"))
+
+    contents = []
+    continuation = None
+    while True:
+        page = await storage.get_messages_page("user1", conversation_id, page_size=4, continuation=continuation)
+        assert set(page["messages"][0]) == {"id", "role", "content", "createdAt"}
+        contents = [message["content"] for message in page["messages"]] + contents
+        if not (continuation := page["continuation"]):
+            break
+    assert contents == [content for index in range(5) for content in (f"q{index}", f"a{index}")]
+
+    first = await storage.get_first_messages("user1", conversation_id, 3)
+    assert [message["content"] for message in first] == ["q0", "a0", "q1"]
+
+
+@pytest.mark.asyncio
+async def test_conversations_pages(storage):
+    conversation_ids = [(await storage.create_turn("user1", None, turn("q", "a")))["conversation_id"] for _ in range(5)]
+    await storage.create_turn("user1", conversation_ids[0], turn("again", "a"))
+    await storage.create_turn("user2", None, turn("q", "a"))
+
+    listed = []
+    continuation = None
+    while True:
+        page = await storage.get_conversations_page("user1", page_size=2, continuation=continuation)
+        assert all(set(conversation) == {"id", "title", "updatedAt"} for conversation in page["conversations"])
+        listed += [conversation["id"] for conversation in page["conversations"]]
+        if not (continuation := page["continuation"]):
+            break
+    # Most recently updated first
+    assert listed == [conversation_ids[0]] + conversation_ids[:0:-1]
+
+
+@pytest.mark.asyncio
+async def test_update_conversation_title(storage):
+    conversation_id = (await storage.create_turn("user1", None, turn("q", "a")))["conversation_id"]
+    await storage.update_conversation_title("user1", conversation_id, "Health plans")
+    assert (await storage.get_conversation("user1", conversation_id))["title"] == "Health plans"
+
+
+@pytest.mark.asyncio
+async def test_update_conversation_summary(storage):
+    conversation_id = (await storage.create_turn("user1", None, turn("q0", "a0")))["conversation_id"]
+    await storage.create_turn("user1", conversation_id, turn("q1", "a1"))
+    updated_at = (await storage.get_conversation("user1", conversation_id))["updatedAt"]
+    through = (await storage.get_first_messages("user1", conversation_id, 2))[-1]["createdAt"]
+
+    await storage.update_conversation_summary("user1", conversation_id, {"content": "Summary", "through": through})
+    conversation = await storage.get_conversation("user1", conversation_id)
+    assert conversation["summary"] == {"content": "Summary", "through": through}
+    assert conversation["updatedAt"] == updated_at
+    after = await storage.get_first_messages("user1", conversation_id, 10, after=through)
+    assert [message["content"] for message in after] == ["q1", "a1"]
+
+
+@pytest.mark.asyncio
+async def test_delete_conversation(storage):
+    conversation_id = (await storage.create_turn("user1", None, turn("q", "a")))["conversation_id"]
+    other_id = (await storage.create_turn("user1", None, turn("q", "a")))["conversation_id"]
+
+    deleted = await storage.delete_conversation_and_messages("user1", conversation_id)
+    assert deleted["deleted_items"] == 3
+    assert await storage.get_conversation("user1", conversation_id) is None
+    assert (await storage.get_messages_page("user1", conversation_id))["messages"] == []
+    assert await storage.get_conversation("user1", other_id)
+
+
+@pytest.mark.asyncio
+async def test_delete_all_conversations(storage):
+    for _ in range(3):
+        await storage.create_turn("user1", None, turn("q", "a"))
+    kept_id = (await storage.create_turn("user2", None, turn("q", "a")))["conversation_id"]
+
+    deleted = await storage.delete_all_conversations("user1")
+    assert deleted["deleted_conversations"] == 3
+    assert deleted["deleted_items"] == 9
+    assert (await storage.get_conversations_page("user1"))["conversations"] == []
+    assert await storage.get_conversation("user2", kept_id)
+
+
+@pytest.mark.asyncio
+async def test_create_turn_in_missing_conversation(storage):
+    with pytest.raises(Exception):
+        await storage.create_turn("user1", "missing", turn("q", "a"))
+
+
+@pytest.mark.asyncio
+async def test_sqlite_adds_summary_column(tmp_path):
+    path = str(tmp_path / "history.db")
+    connection = sqlite3.connect(path)
+    connection.execute(
+        "CREATE TABLE conversations (user_id TEXT NOT NULL, id TEXT NOT NULL, title TEXT NOT NULL, "
+        "created_at TEXT NOT NULL, updated_at TEXT NOT NULL, PRIMARY KEY (user_id, id))"
+    )
+    connection.execute("INSERT INTO conversations VALUES ('user1', 'conversation1', 'Plans', '2023', '2023')")
+    connection.commit()
+    connection.close()
+
+    storage = SQLiteConversationStorage(path)
+    assert (await storage.get_conversation("user1", "conversation1"))["title"] == "Plans"
+    await storage.update_conversation_summary("user1", "conversation1", {"content": "Summary", "through": "2023"})
+    assert (await storage.get_conversation("user1", "conversation1"))["summary"]["content"] == "Summary"
@@ -0,0 +1,240 @@
+import pytest
+from azure.cosmos.exceptions import CosmosBatchOperationError
+
+from history.cosmosdbservice import CosmosConversationClient
+
+
+@pytest.mark.asyncio
+async def test_create_and_get_conversation(conversation_client):
+    conversation = await conversation_client.create_conversation("user1", title="Health plans")
+    assert conversation["type"] == "conversation"
+    assert await conversation_client.get_conversation("user1", conversation["id"]) == conversation
+    assert await conversation_client.get_conversations("user1") == [conversation]
+
+
+@pytest.mark.asyncio
+async def test_conversations_are_scoped_to_user(conversation_client):
+    conversation = await conversation_client.create_conversation("user1")
+    assert await conversation_client.get_conversation("user2", conversation["id"]) is None
+    assert await conversation_client.get_conversations("user2") is None
+
+
+@pytest.mark.asyncio
+async def test_create_message_updates_conversation(conversation_client):
+    conversation = await conversation_client.create_conversation("user1")
+    message = await conversation_client.create_message(
+        conversation["id"], "user1", {"role": "user", "content": "What is the deductible?"}
+    )
+    assert message["conversationId"] == conversation["id"]
+    assert message["role"] == "user"
+    updated = await conversation_client.get_conversation("user1", conversation["id"])
+    assert updated["updatedAt"] == message["createdAt"]
+    assert await conversation_client.get_messages("user1", conversation["id"]) == [message]
+
+
+@pytest.mark.asyncio
+async def test_delete_conversation_and_messages(conversation_client, mock_cosmos_container):
+    conversation = await conversation_client.create_conversation("user1")
+    for role, content in [("user", "What is the deductible?"), ("assistant", "$2000 [Benefit_Options-2.pdf].")]:
+        await conversation_client.create_message(conversation["id"], "user1", {"role": role, "content": content})
+
+    assert len(await conversation_client.delete_messages(conversation["id"], "user1")) == 2
+    assert await conversation_client.delete_conversation("user1", conversation["id"]) is True
+    assert mock_cosmos_container.items == {}
+
+
+@pytest.mark.asyncio
+async def test_delete_missing_conversation(conversation_client):
+    assert await conversation_client.delete_messages("missing", "user1") is None
+    assert await conversation_client.delete_conversation("user1", "missing") is True
+
+
+@pytest.mark.asyncio
+async def test_close_shared_client():
+    conversation_client = CosmosConversationClient(
+        cosmosdb_endpoint="https://test-cosmos-account.documents.azure.com:443/",
+        credential="dGVzdC1rZXk=",
+        database_name="db_conversation_history",
+        container_name="conversations",
+    )
+    assert conversation_client.cosmosdb_client is not None
+    assert conversation_client.container_client.id == "conversations"
+    await conversation_client.close()
+
+
+@pytest.mark.asyncio
+async def test_queries_are_parameterized_and_single_partition(conversation_client, mock_cosmos_container):
+    user_id = "user1' OR 1=1 --"
+    conversation = await conversation_client.create_conversation(user_id)
+    await conversation_client.get_conversations(user_id)
+    await conversation_client.get_messages(user_id, conversation["id"])
+    assert mock_cosmos_container.queries
+    for query in mock_cosmos_container.queries:
+        assert query["partition_key"] == user_id
+        assert user_id not in query["query"]
+        assert conversation["id"] not in query["query"]
+
+
+@pytest.mark.asyncio
+async def test_get_conversation_is_point_read(conversation_client, mock_cosmos_container):
+    conversation = await conversation_client.create_conversation("user1")
+    assert await conversation_client.get_conversation("user1", conversation["id"]) == conversation
+    assert mock_cosmos_container.queries == []
+
+
+@pytest.mark.asyncio
+async def test_get_conversation_ignores_messages(conversation_client):
+    conversation = await conversation_client.create_conversation("user1")
+    message = await conversation_client.create_message(conversation["id"], "user1", {"role": "user", "content": "Hi"})
+    assert await conversation_client.get_conversation("user1", message["id"]) is None
+
+
+@pytest.mark.asyncio
+async def test_messages_ordered_by_created_at(conversation_client, mock_cosmos_container):
+    for index in [2, 0, 1]:
+        await mock_cosmos_container.upsert_item(
+            {
+                "id": f"message{index}",
+                "type": "message",
+                "userId": "user1",
+                "conversationId": "conv1",
+                "createdAt": f"2023-11-0{index + 1}T00:00:00",
+                "role": "user",
+                "content": str(index),
+            }
+        )
+    messages = await conversation_client.get_messages("user1", "conv1")
+    assert [message["id"] for message in messages] == ["message0", "message1", "message2"]
+
+
+@pytest.mark.asyncio
+async def test_get_conversations_sort_order(conversation_client, mock_cosmos_container):
+    for index in range(3):
+        await mock_cosmos_container.upsert_item(
+            {"id": f"conv{index}", "type": "conversation", "userId": "user1", "updatedAt": f"2023-11-0{index + 1}"}
+        )
+    conversations = await conversation_client.get_conversations("user1")
+    assert [conversation["id"] for conversation in conversations] == ["conv2", "conv1", "conv0"]
+    conversations = await conversation_client.get_conversations("user1", sort_order="asc")
+    assert [conversation["id"] for conversation in conversations] == ["conv0", "conv1", "conv2"]
+    with pytest.raises(ValueError):
+        await conversation_client.get_conversations("user1", sort_order="DESC; DROP")
+
+
+TURN = [
+    {"role": "user", "content": "What is the deductible?"},
+    {"role": "assistant", "content": "$2000 [Benefit_Options-2.pdf]."},
+]
+
+
+@pytest.mark.asyncio
+async def test_create_turn_in_one_batch(conversation_client, mock_cosmos_container):
+    conversation = await conversation_client.create_conversation("user1")
+    turn = await conversation_client.create_turn("user1", conversation["id"], TURN)
+
+    assert len(mock_cosmos_container.batches) == 1
+    assert [operation for operation, _ in mock_cosmos_container.batches[0]] == ["patch", "create", "create"]
+    assert turn["conversation_id"] == conversation["id"]
+    assert turn["request_charge"] == 3.0
+    messages = await conversation_client.get_messages("user1", conversation["id"])
+    assert [(message["role"], message["content"]) for message in messages] == [
+        (message["role"], message["content"]) for message in TURN
+    ]
+    updated = await conversation_client.get_conversation("user1", conversation["id"])
+    assert updated["updatedAt"] == messages[-1]["createdAt"]
+
+
+@pytest.mark.asyncio
+async def test_create_turn_new_conversation(conversation_client, mock_cosmos_container):
+    turn = await conversation_client.create_turn("user1", None, TURN)
+    assert [operation for operation, _ in mock_cosmos_container.batches[0]] == ["create", "create", "create"]
+    conversation = await conversation_client.get_conversation("user1", turn["conversation_id"])
+    assert conversation["updatedAt"] == turn["messages"][-1]["createdAt"]
+    assert all(message["conversationId"] == turn["conversation_id"] for message in turn["messages"])
+
+
+@pytest.mark.asyncio
+async def test_create_turn_is_transactional(conversation_client, mock_cosmos_container):
+    with pytest.raises(CosmosBatchOperationError):
+        await conversation_client.create_turn("user1", "missing", TURN)
+    assert mock_cosmos_container.items == {}
+
+
+async def create_conversation_with_messages(mock_cosmos_container, user_id, conversation_id, message_count):
+    await mock_cosmos_container.upsert_item({"id": conversation_id, "type": "conversation", "userId": user_id})
+    for index in range(message_count):
+        await mock_cosmos_container.upsert_item(
+            {
+                "id": f"{conversation_id}-message{index}",
+                "type": "message",
+                "userId": user_id,
+                "conversationId": conversation_id,
+                "createdAt": f"2023-11-01T00:00:00.{index:06d}",
+                "role": "user",
+                "content": str(index),
+            }
+        )
+
+
+@pytest.mark.asyncio
+async def test_delete_conversation_and_messages_in_batches(conversation_client, mock_cosmos_container):
+    await create_conversation_with_messages(mock_cosmos_container, "user1", "conv1", 250)
+    await create_conversation_with_messages(mock_cosmos_container, "user1", "conv2", 1)
+
+    deleted = await conversation_client.delete_conversation_and_messages("user1", "conv1")
+
+    assert deleted == {"deleted_items": 251, "request_charge": 251.0}
+    assert [len(batch) for batch in mock_cosmos_container.batches] == [100, 100, 50, 1]
+    assert mock_cosmos_container.batches[-1] == [("delete", ("conv1",))]
+    assert set(mock_cosmos_container.items) == {("user1", "conv2"), ("user1", "conv2-message0")}
+
+
+@pytest.mark.asyncio
+async def test_delete_conversation_and_messages_missing(conversation_client):
+    assert await conversation_client.delete_conversation_and_messages("user1", "missing") == {
+        "deleted_items": 0,
+        "request_charge": 0,
+    }
+
+
+@pytest.mark.asyncio
+async def test_delete_all_conversations(conversation_client, mock_cosmos_container):
+    await create_conversation_with_messages(mock_cosmos_container, "user1", "conv1", 3)
+    await create_conversation_with_messages(mock_cosmos_container, "user1", "conv2", 2)
+    await create_conversation_with_messages(mock_cosmos_container, "user2", "conv3", 2)
+
+    deleted = await conversation_client.delete_all_conversations("user1")
+
+    assert deleted == {"deleted_conversations": 2, "deleted_items": 7, "request_charge": 7.0}
+    assert all(user_id == "user2" for user_id, _ in mock_cosmos_container.items)
+    assert len(mock_cosmos_container.items) == 3
+
+
+@pytest.mark.asyncio
+async def test_get_conversations_page_projects_list_fields(conversation_client, mock_cosmos_container):
+    for index in range(3):
+        await conversation_client.create_conversation("user1", title=f"Conversation {index}")
+
+    page = await conversation_client.get_conversations_page("user1", page_size=2)
+    assert len(page["conversations"]) == 2
+    assert all(set(conversation) == {"id", "title", "updatedAt"} for conversation in page["conversations"])
+    assert page["continuation"] is not None
+    assert "SELECT c.id, c.title, c.updatedAt FROM c" in mock_cosmos_container.queries[-1]["query"]
+
+    page = await conversation_client.get_conversations_page("user1", page_size=2, continuation=page["continuation"])
+    assert len(page["conversations"]) == 1
+    assert page["continuation"] is None
+
+
+@pytest.mark.asyncio
+async def test_get_messages_page_reads_newest_first(conversation_client, mock_cosmos_container):
+    await create_conversation_with_messages(mock_cosmos_container, "user1", "conv1", 5)
+
+    page = await conversation_client.get_messages_page("user1", "conv1", page_size=2)
+    assert [message["content"] for message in page["messages"]] == ["3", "4"]
+    assert set(page["messages"][0]) == {"id", "role", "content", "createdAt"}
+    page = await conversation_client.get_messages_page("user1", "conv1", page_size=2, continuation=page["continuation"])
+    assert [message["content"] for message in page["messages"]] == ["1", "2"]
+    page = await conversation_client.get_messages_page("user1", "conv1", page_size=2, continuation=page["continuation"])
+    assert [message["content"] for message in page["messages"]] == ["0"]
+    assert page["continuation"] is None
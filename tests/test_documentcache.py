@@ -0,0 +1,144 @@
+import pytest
+
+from core.documentcache import DocumentCache
+from core.indexversion import IndexVersion
+
+
+class MockSearchResults:
+    def __init__(self, results):
+        self.results = iter(results)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        try:
+            return next(self.results)
+        except StopIteration:
+            raise StopAsyncIteration
+
+
+class MockSearchClient:
+    def __init__(self, documents):
+        self.documents = documents
+        self.searches = []
+
+    async def search(self, search_text, filter, select, top):
+        self.searches.append({"filter": filter, "select": select, "top": top})
+        keys = filter.split("'")[1].split(",")
+        return MockSearchResults(
+            [{field: self.documents[key][field] for field in select} for key in keys if key in self.documents]
+        )
+
+
+def create_cache(documents, versions=None, **kwargs):
+    versions = versions if versions is not None else ["v1"]
+
+    async def get_version():
+        return versions[0]
+
+    search_client = MockSearchClient(documents)
+    index_version = IndexVersion(get_version, check_interval=0)
+    return DocumentCache(search_client, ["sourcepage", "content"], index_version, **kwargs), search_client
+
+
+DOCUMENTS = {
+    "a": {"id": "a", "sourcepage": "a.pdf#page=1", "content": "Content of a", "embedding": [0.1]},
+    "b": {"id": "b", "sourcepage": "b.pdf#page=1", "content": "Content of b", "embedding": [0.2]},
+    "c": {"id": "c", "sourcepage": "c.pdf#page=1", "content": "Content of c", "embedding": [0.3]},
+}
+
+
+@pytest.mark.asyncio
+async def test_document_cache_resolve_fetches_missing_documents_once():
+    cache, search_client = create_cache(DOCUMENTS)
+
+    resolved = await cache.resolve([{"id": "b", "@search.score": 2.0}, {"id": "a", "@search.score": 1.0}])
+    assert resolved == [
+        {"id": "b", "@search.score": 2.0, "sourcepage": "b.pdf#page=1", "content": "Content of b"},
+        {"id": "a", "@search.score": 1.0, "sourcepage": "a.pdf#page=1", "content": "Content of a"},
+    ]
+    assert search_client.searches == [
+        {"filter": "search.in(id, 'b,a', ',')", "select": ["id", "sourcepage", "content"], "top": 2}
+    ]
+
+    resolved = await cache.resolve([{"id": "a"}, {"id": "c"}])
+    assert [doc["content"] for doc in resolved] == ["Content of a", "Content of c"]
+    assert search_client.searches[1]["filter"] == "search.in(id, 'c', ',')"
+    assert cache.get_stats() == {"entries": 3, "hits": 1, "misses": 3, "invalidations": 0, "version": "v1"}
+
+
+@pytest.mark.asyncio
+async def test_document_cache_drops_removed_documents():
+    cache, _ = create_cache(DOCUMENTS)
+
+    resolved = await cache.resolve([{"id": "a"}, {"id": "removed"}])
+    assert [doc["id"] for doc in resolved] == ["a"]
+    assert "removed" not in cache.entries
+
+
+@pytest.mark.asyncio
+async def test_document_cache_cleared_when_index_version_changes():
+    versions = ["v1"]
+    cache, search_client = create_cache(DOCUMENTS, versions)
+
+    await cache.resolve([{"id": "a"}])
+    documents_v2 = {**DOCUMENTS, "a": {**DOCUMENTS["a"], "content": "New content of a"}}
+    search_client.documents = documents_v2
+    assert (await cache.resolve([{"id": "a"}]))[0]["content"] == "Content of a"
+
+    versions[0] = "v2"
+    assert (await cache.resolve([{"id": "a"}]))[0]["content"] == "New content of a"
+    assert cache.get_stats()["invalidations"] == 1
+    assert cache.get_stats()["version"] == "v2"
+
+
+@pytest.mark.asyncio
+async def test_index_version_read_at_interval():
+    calls = 0
+
+    async def get_version():
+        nonlocal calls
+        calls += 1
+        return f"v{calls}"
+
+    index_version = IndexVersion(get_version, check_interval=60)
+    assert await index_version.get() == "v1"
+    assert await index_version.get() == "v1"
+    index_version.next_check = 0
+    assert await index_version.get() == "v2"
+    assert calls == 2
+
+
+@pytest.mark.asyncio
+async def test_index_version_kept_when_read_fails():
+    versions = ["v1", ConnectionError("blob storage unavailable"), "v2"]
+    calls = 0
+
+    async def get_version():
+        nonlocal calls
+        calls += 1
+        version = versions.pop(0)
+        if isinstance(version, Exception):
+            raise version
+        return version
+
+    index_version = IndexVersion(get_version, check_interval=60)
+    assert await index_version.get() == "v1"
+    index_version.next_check = 0
+    assert await index_version.get() == "v1"
+    # The failed read backs off until the next check instead of retrying on every call
+    assert await index_version.get() == "v1"
+    assert calls == 2
+    index_version.next_check = 0
+    assert await index_version.get() == "v2"
+
+
+@pytest.mark.asyncio
+async def test_document_cache_eviction():
+    cache, _ = create_cache(DOCUMENTS, max_entries=2)
+
+    await cache.resolve([{"id": "a"}, {"id": "b"}])
+    await cache.resolve([{"id": "a"}])
+    await cache.resolve([{"id": "c"}])
+    assert list(cache.entries.keys()) == ["a", "c"]
@@ -0,0 +1,129 @@
+import asyncio
+from array import array
+
+import pytest
+
+from core.embeddingcache import EmbeddingCache
+
+
+@pytest.mark.asyncio
+async def test_embedding_cache_hit_and_miss():
+    calls = []
+
+    async def create(text):
+        calls.append(text)
+        return [0.5, 0.25]
+
+    cache = EmbeddingCache()
+    assert await cache.get_or_create("ada", "health plans", create) == [0.5, 0.25]
+    assert await cache.get_or_create("ada", " health   plans ", create) == [0.5, 0.25]
+    assert await cache.get_or_create("other-model", "health plans", create) == [0.5, 0.25]
+    assert calls == ["health plans", "health plans"]
+    assert cache.get_stats() == {"entries": 2, "hits": 1, "misses": 2, "coalesced": 0}
+    assert isinstance(cache.entries[("ada", "health plans")], array)
+    assert cache.entries[("ada", "health plans")].typecode == "f"
+
+
+@pytest.mark.asyncio
+async def test_embedding_cache_eviction():
+    async def create(text):
+        return [float(len(text))]
+
+    cache = EmbeddingCache(max_entries=2)
+    await cache.get_or_create("ada", "a", create)
+    await cache.get_or_create("ada", "bb", create)
+    await cache.get_or_create("ada", "a", create)
+    await cache.get_or_create("ada", "ccc", create)
+    assert list(cache.entries.keys()) == [("ada", "a"), ("ada", "ccc")]
+
+
+@pytest.mark.asyncio
+async def test_embedding_cache_coalesces_concurrent_requests():
+    calls = 0
+    release = asyncio.Event()
+
+    async def create(text):
+        nonlocal calls
+        calls += 1
+        await release.wait()
+        return [1.0, 2.0]
+
+    cache = EmbeddingCache()
+    tasks = [asyncio.create_task(cache.get_or_create("ada", "dental", create)) for _ in range(5)]
+    await asyncio.sleep(0)
+    release.set()
+    results = await asyncio.gather(*tasks)
+    assert results == [[1.0, 2.0]] * 5
+    assert calls == 1
+    assert cache.get_stats()["coalesced"] == 4
+
+
+@pytest.mark.asyncio
+async def test_embedding_cache_error_is_shared_and_not_cached():
+    release = asyncio.Event()
+
+    async def failing_create(text):
+        await release.wait()
+        raise ValueError("rate limited")
+
+    cache = EmbeddingCache()
+    tasks = [asyncio.create_task(cache.get_or_create("ada", "vision", failing_create)) for _ in range(2)]
+    await asyncio.sleep(0)
+    release.set()
+    results = await asyncio.gather(*tasks, return_exceptions=True)
+    assert all(isinstance(result, ValueError) for result in results)
+    assert cache.entries == {}
+    assert cache.in_flight == {}
+
+
+@pytest.mark.asyncio
+async def test_embedding_cache_get_or_create_many():
+    calls = []
+
+    async def create_many(texts):
+        calls.append(texts)
+        return [[float(len(text))] for text in texts]
+
+    async def create(text):
+        return [float(len(text))]
+
+    cache = EmbeddingCache()
+    await cache.get_or_create("ada", "a", create)
+    vectors = await cache.get_or_create_many("ada", ["a", "bb", " bb ", "ccc"], create_many)
+    assert vectors == [[1.0], [2.0], [2.0], [3.0]]
+    # Only the texts missing from the cache are embedded, once each and in a single call
+    assert calls == [["bb", "ccc"]]
+    assert cache.get_stats() == {"entries": 3, "hits": 1, "misses": 3, "coalesced": 0}
+
+
+@pytest.mark.asyncio
+async def test_embedding_cache_cancelled_caller_does_not_cancel_waiters():
+    release = asyncio.Event()
+
+    async def create(text):
+        await release.wait()
+        return [1.0]
+
+    cache = EmbeddingCache()
+    first = asyncio.create_task(cache.get_or_create("ada", "dental", create))
+    await asyncio.sleep(0)
+    second = asyncio.create_task(cache.get_or_create("ada", "dental", create))
+    await asyncio.sleep(0)
+    first.cancel()
+    release.set()
+    assert await second == [1.0]
+    with pytest.raises(asyncio.CancelledError):
+        await first
+    assert cache.entries[("ada", "dental")].tolist() == [1.0]
+
+
+@pytest.mark.asyncio
+async def test_embedding_cache_get_or_create_many_too_few_vectors():
+    async def create_many(texts):
+        return [[1.0]]
+
+    cache = EmbeddingCache()
+    with pytest.raises(ValueError, match="Expected 2 embeddings, got 1"):
+        await asyncio.wait_for(cache.get_or_create_many("ada", ["a", "b"], create_many), timeout=1)
+    assert cache.entries == {}
+    assert cache.in_flight == {}
@@ -0,0 +1,119 @@
+import pytest
+from conftest import turn
+
+from history.historystore import ConversationHistoryStore, StorageHistoryBackend
+from history.summaryworker import SummaryWorker
+
+
+@pytest.fixture
+def history_store(conversation_client):
+    return ConversationHistoryStore(StorageHistoryBackend(conversation_client), "gpt-35-turbo", max_messages=4)
+
+
+@pytest.mark.asyncio
+async def test_history_store_new_conversation(history_store):
+    conversation_id = await history_store.append("user1", None, turn("What is included?", "Dental."))
+    history = await history_store.get("user1", conversation_id)
+    assert history.messages == turn("What is included?", "Dental.")
+    assert len(history.token_counts) == 2
+    assert history_store.get_stats()["hits"] == 1
+
+
+@pytest.mark.asyncio
+async def test_history_store_tokenizes_new_messages_only(history_store):
+    conversation_id = await history_store.append("user1", None, turn("What is included?", "Dental."))
+    await history_store.get("user1", conversation_id)
+    await history_store.append("user1", conversation_id, turn("And vision?", "Yes."))
+    history = await history_store.get("user1", conversation_id)
+    assert [message["content"] for message in history.messages] == [
+        "What is included?",
+        "Dental.",
+        "And vision?",
+        "Yes.",
+    ]
+    assert history_store.get_stats()["tokenized_messages"] == 4
+
+
+@pytest.mark.asyncio
+async def test_history_store_keeps_recent_messages(history_store):
+    conversation_id = await history_store.append("user1", None, turn("First?", "One."))
+    for index in range(3):
+        await history_store.append("user1", conversation_id, turn(f"Question {index}?", f"Answer {index}."))
+    history = await history_store.get("user1", conversation_id)
+    assert [message["content"] for message in history.messages] == [
+        "Question 1?",
+        "Answer 1.",
+        "Question 2?",
+        "Answer 2.",
+    ]
+    assert len(history.token_counts) == 4
+
+
+@pytest.mark.asyncio
+async def test_history_store_reloads_stale_conversation(history_store, conversation_client):
+    conversation_id = await history_store.append("user1", None, turn("What is included?", "Dental."))
+    # Another process adds a turn to the conversation
+    await conversation_client.create_turn("user1", conversation_id, turn("And vision?", "Yes."))
+    history = await history_store.get("user1", conversation_id)
+    assert len(history.messages) == 4
+    assert history_store.get_stats()["misses"] == 1
+
+
+@pytest.mark.asyncio
+async def test_history_store_missing_conversation(history_store):
+    assert await history_store.get("user1", "missing") is None
+    conversation_id = await history_store.append("user1", None, turn("What is included?", "Dental."))
+    assert await history_store.get("user2", conversation_id) is None
+
+
+@pytest.mark.asyncio
+async def test_history_store_evicts_least_recently_used(conversation_client):
+    history_store = ConversationHistoryStore(
+        StorageHistoryBackend(conversation_client), "gpt-35-turbo", max_conversations=2
+    )
+    conversation_ids = [await history_store.append("user1", None, turn("Question?", "Answer.")) for _ in range(3)]
+    assert list(history_store.entries) == [("user1", conversation_id) for conversation_id in conversation_ids[1:]]
+    # An evicted conversation is loaded again from the backend
+    history = await history_store.get("user1", conversation_ids[0])
+    assert history.messages == turn("Question?", "Answer.")
+
+
+@pytest.mark.asyncio
+async def test_history_store_summary(history_store, conversation_client):
+    conversation_id = await history_store.append("user1", None, turn("What is included?", "Dental."))
+    await history_store.append("user1", conversation_id, turn("And vision?", "Yes."))
+    messages = await conversation_client.get_first_messages("user1", conversation_id, 2)
+    await conversation_client.update_conversation_summary(
+        "user1", conversation_id, {"content": "Dental is included.", "through": messages[-1]["createdAt"]}
+    )
+
+    # The summary changed, so the conversation is loaded again with only the messages after it
+    history = await history_store.get("user1", conversation_id)
+    assert history.messages == turn("And vision?", "Yes.")
+    messages, token_counts = history.get_prompt_messages()
+    assert messages[0] == {"role": "system", "content": "Summary of the earlier conversation:\nDental is included."}
+    assert messages[1:] == turn("And vision?", "Yes.")
+    assert token_counts[0] == history.summary_token_count > 0
+    assert len(token_counts) == 3
+    assert history_store.get_stats()["misses"] == 1
+
+
+@pytest.mark.asyncio
+async def test_history_store_submits_long_conversations(conversation_client):
+    async def create_summary(previous_summary, messages):
+        return f"{len(messages)} messages"
+
+    summary_worker = SummaryWorker(conversation_client, create_summary, threshold=4, keep_recent=2)
+    summary_worker.start()
+    history_store = ConversationHistoryStore(
+        StorageHistoryBackend(conversation_client), "gpt-35-turbo", summary_worker=summary_worker
+    )
+    conversation_id = await history_store.append("user1", None, turn("What is included?", "Dental."))
+    assert summary_worker.get_stats()["submitted"] == 0
+    await history_store.append("user1", conversation_id, turn("And vision?", "Yes."))
+    await summary_worker.join()
+    await summary_worker.close()
+
+    history = await history_store.get("user1", conversation_id)
+    assert history.summary["content"] == "2 messages"
+    assert history.messages == turn("And vision?", "Yes.")
@@ -0,0 +1,228 @@
+import io
+import json
+import os
+
+import numpy as np
+import pytest
+from azure.core.credentials import AzureKeyCredential
+
+from localsearch.client import LocalSearchClient
+from localsearch.filter import evaluate_filter, split_top_level
+from localsearch.index import LocalSearchIndex
+
+from scripts.prepdocslib.listfilestrategy import File
+from scripts.prepdocslib.localsearchmanager import LocalSearchManager
+from scripts.prepdocslib.searchmanager import Section
+from scripts.prepdocslib.strategy import SearchInfo
+from scripts.prepdocslib.textsplitter import SplitPage
+
+DOCUMENTS = [
+    {
+        "id": "file-Benefit_Options_pdf-page-0",
+        "content": "Northwind Standard covers medical, vision and dental services.",
+        "category": "benefits",
+        "sourcepage": "Benefit_Options.pdf#page=1",
+        "sourcefile": "Benefit_Options.pdf",
+        "oids": ["OID_X"],
+        "groups": [],
+        "embedding": [1.0, 0.0, 0.0],
+    },
+    {
+        "id": "file-Benefit_Options_pdf-page-1",
+        "content": "The deductible of Northwind Plus is $500 for employees and $1000 for families.",
+        "category": "benefits",
+        "sourcepage": "Benefit_Options.pdf#page=2",
+        "sourcefile": "Benefit_Options.pdf",
+        "oids": [],
+        "groups": ["GROUP_Y"],
+        "embedding": [0.0, 1.0, 0.0],
+    },
+    {
+        "id": "file-employee_handbook_pdf-page-0",
+        "content": "The whistleblower policy protects employees who report unethical behavior.",
+        "category": None,
+        "sourcepage": "employee_handbook.pdf#page=1",
+        "sourcefile": "employee_handbook.pdf",
+        "oids": ["OID_X", "OID_Z"],
+        "groups": ["GROUP_Y"],
+        "embedding": [0.0, 0.6, 0.8],
+    },
+]
+
+
+def write_documents(directory, documents):
+    with open(os.path.join(directory, "documents.jsonl"), "a") as file:
+        for document in documents:
+            file.write(json.dumps(document) + "\n")
+
+
+@pytest.fixture
+def local_search_client(tmp_path):
+    write_documents(tmp_path, DOCUMENTS)
+    client = LocalSearchClient(LocalSearchIndex.open(str(tmp_path)))
+    yield client
+    client.index.close()
+
+
+async def search(client, *args, **kwargs):
+    return [result async for result in await client.search(*args, **kwargs)]
+
+
+def test_split_top_level():
+    assert split_top_level("a eq 'x or y' or (b eq 'z' or c eq 'w') or d", " or ") == [
+        "a eq 'x or y'",
+        "(b eq 'z' or c eq 'w')",
+        "d",
+    ]
+
+
+def test_evaluate_filter():
+    rows = {
+        ("category", None): [2],
+        ("category", "benefits"): [0, 1],
+        ("oids", "OID_X"): [0, 2],
+        ("groups", "GROUP_Y"): [1, 2],
+        ("id", "a"): [0],
+        ("id", "c"): [2],
+    }
+
+    def find_rows(field, values):
+        return np.asarray([row for value in values for row in rows.get((field, value), [])], dtype=np.int64)
+
+    def matching(expression):
+        return np.flatnonzero(evaluate_filter(expression, 3, find_rows)).tolist()
+
+    assert matching("category ne 'benefits'") == [2]
+    assert matching("category eq null") == [2]
+    assert matching("oids/any(g:search.in(g, 'OID_X'))") == [0, 2]
+    assert matching("groups/any(g:search.in(g, 'GROUP_Z, GROUP_Y'))") == [1, 2]
+    assert matching("oids/any(g:search.in(g, ''))") == []
+    assert matching("search.in(id, 'a,c', ',')") == [0, 2]
+    assert matching(
+        "category ne 'other' and (oids/any(g:search.in(g, 'OID_Z')) or groups/any(g:search.in(g, 'GROUP_Y')))"
+    ) == [1, 2]
+    with pytest.raises(ValueError):
+        matching("search.ismatch('policy')")
+
+
+@pytest.mark.asyncio
+async def test_local_search_text(local_search_client):
+    results = await search(local_search_client, "deductible for employees", top=3)
+    assert [result["id"] for result in results] == [
+        "file-Benefit_Options_pdf-page-1",
+        "file-employee_handbook_pdf-page-0",
+    ]
+    assert results[0]["@search.score"] > results[1]["@search.score"]
+    assert "embedding" not in results[0]
+
+
+@pytest.mark.asyncio
+async def test_local_search_vector(local_search_client):
+    results = await search(local_search_client, None, vector=[0.0, 1.0, 0.1], top=2, top_k=50)
+    assert [result["id"] for result in results] == [
+        "file-Benefit_Options_pdf-page-1",
+        "file-employee_handbook_pdf-page-0",
+    ]
+    similarity = 1 / np.linalg.norm([0.0, 1.0, 0.1])
+    assert results[0]["@search.score"] == pytest.approx(1 / (2 - similarity), 1e-5)
+
+
+@pytest.mark.asyncio
+async def test_local_search_hybrid(local_search_client):
+    results = await search(local_search_client, "whistleblower", vector=[1.0, 0.0, 0.0], top=3, top_k=50)
+    assert [result["id"] for result in results][:2] == [
+        "file-employee_handbook_pdf-page-0",
+        "file-Benefit_Options_pdf-page-0",
+    ]
+    assert results[0]["@search.score"] == pytest.approx(1 / 61 + 1 / 63)
+
+
+@pytest.mark.asyncio
+async def test_local_search_filter(local_search_client):
+    security_filter = "(oids/any(g:search.in(g, 'OID_Z')) or groups/any(g:search.in(g, 'GROUP_Y')))"
+    results = await search(local_search_client, "Northwind", filter=f"category ne 'other' and {security_filter}")
+    assert [result["id"] for result in results] == ["file-Benefit_Options_pdf-page-1"]
+    results = await search(local_search_client, "", filter="category ne 'benefits'", include_total_count=True)
+    assert [result["id"] for result in results] == ["file-employee_handbook_pdf-page-0"]
+
+
+@pytest.mark.asyncio
+async def test_local_search_select_and_captions(local_search_client):
+    results = await search(
+        local_search_client,
+        "whistleblower",
+        select=["sourcepage", "content"],
+        query_type="semantic",
+        query_caption="extractive|highlight-false",
+    )
+    assert set(results[0]) == {
+        "sourcepage",
+        "content",
+        "@search.score",
+        "@search.reranker_score",
+        "@search.highlights",
+        "@search.captions",
+    }
+    assert results[0]["@search.captions"][0].text == DOCUMENTS[2]["content"]
+
+
+@pytest.mark.asyncio
+async def test_local_search_count(local_search_client):
+    results = await local_search_client.search("", filter="sourcefile eq 'Benefit_Options.pdf'", top=1)
+    assert await results.get_count() == 2
+    assert len([result async for result in results]) == 1
+
+
+def test_local_search_index_rebuilt_when_documents_change(tmp_path):
+    write_documents(tmp_path, DOCUMENTS)
+    index = LocalSearchIndex.open(str(tmp_path))
+    assert index.count == 3
+    version = index.version
+    index.close()
+
+    index = LocalSearchIndex.open(str(tmp_path))
+    assert index.version == version
+    index.close()
+
+    # Later lines replace the documents with the same key
+    write_documents(tmp_path, [{**DOCUMENTS[0], "content": "Updated content"}])
+    index = LocalSearchIndex.open(str(tmp_path))
+    assert index.version != version
+    assert index.count == 3
+    assert [index.get_document(row)["content"] for row in range(3)].count("Updated content") == 1
+    index.close()
+
+
+def test_local_search_index_without_embeddings(tmp_path):
+    index = LocalSearchIndex.build(
+        str(tmp_path), [{key: value for key, value in document.items() if key != "embedding"} for document in DOCUMENTS]
+    )
+    assert index.embeddings is None
+    assert index.search(None, [1.0, 0.0, 0.0], 3) == ([], 0)
+    assert len(index.search("policy", None, 3)[0]) == 1
+    index.close()
+
+
+@pytest.mark.asyncio
+async def test_local_search_manager(tmp_path):
+    search_info = SearchInfo(endpoint="", credential=AzureKeyCredential("test"), index_name="test")
+    manager = LocalSearchManager(search_info, str(tmp_path / "index"))
+    await manager.create_index()
+
+    for name, text in (("foo.pdf", "The whistleblower policy"), ("bar.pdf", "The deductible is $500")):
+        content = io.BytesIO(text.encode())
+        content.name = f"test/{name}"
+        await manager.update_content(
+            [Section(split_page=SplitPage(page_num=0, text=text), content=File(content), category="test")]
+        )
+    await manager.remove_content("test/foo.pdf")
+
+    client = await LocalSearchClient.open(str(tmp_path / "index"))
+    results = await search(client, "whistleblower deductible")
+    assert [(result["id"], result["sourcepage"]) for result in results] == [
+        ("file-bar_pdf-6261722E706466-page-0", "bar.pdf#page=1")
+    ]
+    await client.close()
+
+    await manager.remove_content()
+    assert os.path.getsize(tmp_path / "index" / "documents.jsonl") == 0
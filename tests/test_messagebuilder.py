@@ -1,4 +1,14 @@
-from core.messagebuilder import MessageBuilder
+import pytest
+
+from core.messagebuilder import (
+    HistoryPacker,
+    KeepFirstLastPolicy,
+    MessageBuilder,
+    NewestFirstPolicy,
+    SummarizeOldestPolicy,
+    create_truncation_policy,
+    summarize_messages,
+)
 
 
 def test_messagebuilder():
@@ -47,3 +57,161 @@ def test_messagebuilder_unicode_append():
     assert builder.model == "gpt-35-turbo"
     assert builder.count_tokens_for_message(builder.messages[0]) == 4
     assert builder.count_tokens_for_message(builder.messages[1]) == 4
+
+
+def test_messagebuilder_append_message():
+    builder = MessageBuilder("You are a bot.", "gpt-35-turbo")
+    builder.append_message("user", "á")
+    builder.append_message("assistant", "Hi")
+    assert builder.messages == [
+        {"role": "system", "content": "You are a bot."},
+        {"role": "user", "content": "á"},
+        {"role": "assistant", "content": "Hi"},
+    ]
+
+
+# With the mock encoding, each message is 3 tokens plus one token per word of content
+HISTORY = [
+    {"role": "user", "content": "one"},
+    {"role": "assistant", "content": "two two"},
+    {"role": "user", "content": "three three three"},
+    {"role": "assistant", "content": "four four four four"},
+]
+
+
+def test_history_packer_newest_first(mock_encoding):
+    packer = HistoryPacker("gpt-35-turbo")
+    messages = packer.pack("You are a bot.", HISTORY, "question", max_tokens=4 + 7 + 6, few_shots=[])
+    assert messages == [
+        {"role": "system", "content": "You are a bot."},
+        {"role": "user", "content": "three three three"},
+        {"role": "assistant", "content": "four four four four"},
+        {"role": "user", "content": "question"},
+    ]
+
+
+def test_history_packer_stops_at_first_message_that_does_not_fit(mock_encoding):
+    packer = HistoryPacker("gpt-35-turbo", NewestFirstPolicy())
+    # "two two" does not fit, so "one" is dropped too even though it would fit
+    messages = packer.pack("You are a bot.", HISTORY, "question", max_tokens=4 + 7 + 6 + 4)
+    assert [message["content"] for message in messages] == [
+        "You are a bot.",
+        "three three three",
+        "four four four four",
+        "question",
+    ]
+
+
+def test_history_packer_few_shots(mock_encoding):
+    packer = HistoryPacker("gpt-35-turbo")
+    few_shots = [{"role": "user", "content": "shot one"}, {"role": "assistant", "content": "shot two"}]
+    messages = packer.pack("You are a bot.", HISTORY, "question", max_tokens=1000, few_shots=few_shots)
+    assert [message["content"] for message in messages] == [
+        "You are a bot.",
+        "shot one",
+        "shot two",
+        "one",
+        "two two",
+        "three three three",
+        "four four four four",
+        "question",
+    ]
+
+
+def test_history_packer_only_tokenizes_new_messages(mock_encoding):
+    packer = HistoryPacker("gpt-35-turbo")
+    packer.pack("You are a bot.", HISTORY, "question", max_tokens=1000)
+    mock_encoding.encoded.clear()
+    history = HISTORY + [{"role": "user", "content": "question"}, {"role": "assistant", "content": "answer"}]
+    packer.pack("You are a bot.", history, "follow up", max_tokens=1000)
+    assert mock_encoding.encoded == ["follow up", "answer"]
+
+
+def test_history_packer_known_token_counts(mock_encoding):
+    packer = HistoryPacker("gpt-35-turbo")
+    # Token counts of the first messages are given, so only the last message and the question are tokenized
+    messages = packer.pack("You are a bot.", HISTORY, "follow up", max_tokens=12, history_token_counts=[100, 100, 100])
+    assert mock_encoding.encoded == ["user", "follow up", "assistant", "four four four four"]
+    assert [message["content"] for message in messages] == ["You are a bot.", "four four four four", "follow up"]
+
+
+def test_keep_first_last_policy(mock_encoding):
+    packer = HistoryPacker("gpt-35-turbo", KeepFirstLastPolicy(keep_first=1, keep_last=1))
+    messages = packer.pack("You are a bot.", HISTORY, "question", max_tokens=1000)
+    assert [message["content"] for message in messages] == [
+        "You are a bot.",
+        "one",
+        "four four four four",
+        "question",
+    ]
+
+
+def test_keep_first_last_policy_over_budget(mock_encoding):
+    packer = HistoryPacker("gpt-35-turbo", KeepFirstLastPolicy(keep_first=2, keep_last=2))
+    messages = packer.pack("You are a bot.", HISTORY, "question", max_tokens=4 + 4 + 5 + 7)
+    assert [message["content"] for message in messages] == [
+        "You are a bot.",
+        "one",
+        "two two",
+        "four four four four",
+        "question",
+    ]
+
+
+LONG_HISTORY = [
+    {
+        "role": "user",
+        "content": "Tell me about plans. I want all the details about every single plan option available.",
+    },
+    {
+        "role": "assistant",
+        "content": "There are two plans. The standard plan covers basics and the plus plan covers much more than that.",
+    },
+    {"role": "user", "content": "Is there a dress code?"},
+]
+
+
+def test_summarize_oldest_policy(mock_encoding):
+    packer = HistoryPacker("gpt-35-turbo", SummarizeOldestPolicy())
+    messages = packer.pack("You are a bot.", LONG_HISTORY, "question", max_tokens=4 + 8 + 18)
+    assert messages == [
+        {"role": "system", "content": "You are a bot."},
+        {
+            "role": "system",
+            "content": "Summary of the earlier conversation:\nuser: Tell me about plans\nassistant: There are two plans",
+        },
+        {"role": "user", "content": "Is there a dress code?"},
+        {"role": "user", "content": "question"},
+    ]
+
+
+def test_summarize_oldest_policy_summary_shortened(mock_encoding):
+    packer = HistoryPacker("gpt-35-turbo", SummarizeOldestPolicy())
+    messages = packer.pack("You are a bot.", LONG_HISTORY, "question", max_tokens=4 + 8 + 13)
+    assert messages[1] == {
+        "role": "system",
+        "content": "Summary of the earlier conversation:\nassistant: There are two plans",
+    }
+
+
+def test_summarize_oldest_policy_no_room_for_summary(mock_encoding):
+    packer = HistoryPacker("gpt-35-turbo", SummarizeOldestPolicy())
+    messages = packer.pack("You are a bot.", LONG_HISTORY, "question", max_tokens=4 + 8 + 12)
+    assert [message["content"] for message in messages] == ["You are a bot.", "Is there a dress code?", "question"]
+
+
+def test_summarize_messages():
+    assert (
+        summarize_messages([{"role": "assistant", "content": "First sentence. Second sentence.\nMore"}])
+        == "Summary of the earlier conversation:\nassistant: First sentence"
+    )
+
+
+def test_create_truncation_policy():
+    assert isinstance(create_truncation_policy("newest_first"), NewestFirstPolicy)
+    assert isinstance(create_truncation_policy("summarize_oldest"), SummarizeOldestPolicy)
+    policy = create_truncation_policy("keep_first_last", keep_first=1, keep_last=3)
+    assert isinstance(policy, KeepFirstLastPolicy)
+    assert (policy.keep_first, policy.keep_last) == (1, 3)
+    with pytest.raises(ValueError, match="Unknown history truncation policy"):
+        create_truncation_policy("oldest_first")
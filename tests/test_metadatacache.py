@@ -0,0 +1,96 @@
+import asyncio
+
+import pytest
+
+from history.metadatacache import ConversationMetadataCache
+from history.storage import InMemoryConversationStorage
+
+TURN = [{"role": "user", "content": "What is included?"}, {"role": "assistant", "content": "Eye exams."}]
+
+
+class CountingStorage(InMemoryConversationStorage):
+    def __init__(self):
+        super().__init__()
+        self.list_calls = 0
+
+    async def get_conversations_page(self, user_id, page_size=20, continuation=None):
+        self.list_calls += 1
+        return await super().get_conversations_page(user_id, page_size, continuation)
+
+
+@pytest.mark.asyncio
+async def test_metadata_cache_hit():
+    storage = CountingStorage()
+    cache = ConversationMetadataCache(storage)
+    await cache.create_turn("user1", None, TURN)
+
+    first = await cache.get_conversations_page("user1")
+    assert await cache.get_conversations_page("user1") == first
+    assert storage.list_calls == 1
+    # Pages of different sizes are cached separately
+    await cache.get_conversations_page("user1", page_size=5)
+    assert storage.list_calls == 2
+    assert cache.get_stats() == {"users": 1, "hits": 1, "misses": 2, "invalidations": 1}
+
+
+@pytest.mark.asyncio
+async def test_metadata_cache_invalidated_by_writes():
+    storage = CountingStorage()
+    cache = ConversationMetadataCache(storage)
+    conversation_id = (await cache.create_turn("user1", None, TURN))["conversation_id"]
+    other_id = (await cache.create_turn("user2", None, TURN))["conversation_id"]
+    await cache.get_conversations_page("user1")
+    await cache.get_conversations_page("user2")
+
+    await cache.update_conversation_title("user1", conversation_id, "Plans")
+    assert (await cache.get_conversations_page("user1"))["conversations"][0]["title"] == "Plans"
+    # Writes of a user do not invalidate the pages of other users
+    await cache.get_conversations_page("user2")
+    assert storage.list_calls == 3
+
+    await cache.delete_conversation_and_messages("user2", other_id)
+    assert (await cache.get_conversations_page("user2"))["conversations"] == []
+
+
+@pytest.mark.asyncio
+async def test_metadata_cache_expires():
+    storage = CountingStorage()
+    cache = ConversationMetadataCache(storage, ttl=0)
+    await cache.get_conversations_page("user1")
+    await cache.get_conversations_page("user1")
+    assert storage.list_calls == 2
+
+
+@pytest.mark.asyncio
+async def test_metadata_cache_does_not_cache_page_read_during_write():
+    storage = CountingStorage()
+    cache = ConversationMetadataCache(storage)
+    await cache.get_conversations_page("user1")
+    list_started = asyncio.Event()
+    write_done = asyncio.Event()
+    get_conversations_page = storage.get_conversations_page
+
+    async def slow_get_conversations_page(user_id, page_size=20, continuation=None):
+        page = await get_conversations_page(user_id, page_size, continuation)
+        list_started.set()
+        await write_done.wait()
+        return page
+
+    storage.get_conversations_page = slow_get_conversations_page
+    await cache.create_turn("user1", None, TURN)
+    read = asyncio.create_task(cache.get_conversations_page("user1"))
+    await list_started.wait()
+    await cache.create_turn("user1", None, TURN)
+    write_done.set()
+    assert len((await read)["conversations"]) == 1
+
+    storage.get_conversations_page = get_conversations_page
+    assert len((await cache.get_conversations_page("user1"))["conversations"]) == 2
+
+
+@pytest.mark.asyncio
+async def test_metadata_cache_evicts_least_recently_used():
+    cache = ConversationMetadataCache(CountingStorage(), max_users=2)
+    for user_id in ("user1", "user2", "user1", "user3"):
+        await cache.get_conversations_page(user_id)
+    assert list(cache.users) == ["user1", "user3"]
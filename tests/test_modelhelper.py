@@ -4,6 +4,9 @@ from core.modelhelper import (
     get_oai_chatmodel_tiktok,
     get_token_limit,
     num_tokens_from_messages,
+    num_tokens_from_messages_batch,
+    num_tokens_from_texts,
+    token_count_cache,
 )
 
 
@@ -59,3 +62,38 @@ def test_get_oai_chatmodel_tiktok_error():
         get_oai_chatmodel_tiktok(None)
     with pytest.raises(ValueError, match="Expected Azure OpenAI ChatGPT model name"):
         get_oai_chatmodel_tiktok("gpt-3")
+
+
+def test_get_encoding_resolved_once(mock_encoding):
+    num_tokens_from_messages({"role": "user", "content": "one two"}, "gpt-35-turbo")
+    num_tokens_from_messages({"role": "user", "content": "three"}, "gpt-35-turbo")
+    assert mock_encoding.resolved == ["gpt-3.5-turbo"]
+
+
+def test_num_tokens_from_messages_memoized(mock_encoding):
+    message = {"role": "user", "content": "What does a Product Manager do?"}
+    assert num_tokens_from_messages(message, "gpt-35-turbo") == 9
+    assert num_tokens_from_messages(message, "gpt-35-turbo") == 9
+    assert mock_encoding.encoded == ["user", "What does a Product Manager do?"]
+
+
+def test_num_tokens_from_messages_batch(mock_encoding):
+    messages = [
+        {"role": "system", "content": "You are a bot."},
+        {"role": "user", "content": "Hello there"},
+        {"role": "assistant", "content": "Hi"},
+        {"role": "user", "content": "Hello there"},
+    ]
+    assert num_tokens_from_messages_batch(messages, "gpt-35-turbo") == [7, 5, 4, 5]
+    assert mock_encoding.encoded == ["system", "You are a bot.", "user", "Hello there", "assistant", "Hi"]
+
+    # Only the new message is encoded on the next turn
+    messages.append({"role": "assistant", "content": "How can I help?"})
+    assert num_tokens_from_messages_batch(messages, "gpt-35-turbo") == [7, 5, 4, 5, 7]
+    assert mock_encoding.encoded[6:] == ["How can I help?"]
+
+
+def test_token_count_cache_bounded(mock_encoding, monkeypatch):
+    monkeypatch.setattr("core.modelhelper.TOKEN_COUNT_CACHE_SIZE", 2)
+    assert num_tokens_from_texts(["a", "b b", "c c c"], "gpt-4") == [1, 2, 3]
+    assert list(token_count_cache.keys()) == [("gpt-4", "b b"), ("gpt-4", "c c c")]
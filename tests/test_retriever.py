@@ -0,0 +1,170 @@
+import openai
+import pytest
+
+from core.retriever import Retriever
+from core.sourcepacker import SourcePacker
+
+
+class Caption:
+    def __init__(self, text):
+        self.text = text
+        self.highlights = None
+
+
+class MockSearchResults:
+    def __init__(self, results):
+        self.results = iter(results)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        try:
+            return next(self.results)
+        except StopIteration:
+            raise StopAsyncIteration
+
+
+class MockSearchClient:
+    def __init__(self):
+        self.searches = []
+
+    async def search(self, search_text, **kwargs):
+        self.searches.append({"search_text": search_text, **kwargs})
+        return MockSearchResults(
+            [
+                {
+                    "sourcepage": "Benefit_Options.pdf#page=2",
+                    "content": "The deductible is $500\nper employee.",
+                    "@search.captions": [Caption("The deductible is $500"), Caption("per employee.")],
+                }
+            ]
+        )
+
+
+@pytest.fixture
+def retriever(monkeypatch):
+    async def mock_acreate(*args, **kwargs):
+        return {"data": [{"embedding": [0.1, 0.2, 0.3]}]}
+
+    monkeypatch.setattr(openai.Embedding, "acreate", mock_acreate)
+    return Retriever(MockSearchClient(), "openai", None, "ada", "sourcepage", "content", "en-us", "lexicon")
+
+
+@pytest.mark.asyncio
+async def test_retrieve_hybrid(retriever):
+    retrieval = await retriever.retrieve("deductible", {"top": 2}, "category ne 'x'")
+    search = retriever.search_client.searches[0]
+    assert search["search_text"] == "deductible"
+    assert search["vector"] == [0.1, 0.2, 0.3]
+    assert search["top"] == 2
+    assert search["filter"] == "category ne 'x'"
+    assert search["select"] == ["sourcepage", "content"]
+    assert "query_type" not in search
+    assert retrieval.sources == ["Benefit_Options.pdf#page=2: The deductible is $500 per employee."]
+    assert list(retrieval.timings) == ["embedding", "search", "sources"]
+
+
+@pytest.mark.asyncio
+async def test_retrieve_text_with_semantic_captions(retriever):
+    overrides = {"retrieval_mode": "text", "semantic_ranker": True, "semantic_captions": True}
+    retrieval = await retriever.retrieve("deductible", overrides, None, query_vector=[1.0, 0.0, 0.0])
+    search = retriever.search_client.searches[0]
+    assert search["vector"] is None
+    assert search["query_type"] == "semantic"
+    assert search["query_caption"] == "extractive|highlight-false"
+    assert retrieval.sources == ["Benefit_Options.pdf#page=2: The deductible is $500 . per employee."]
+    assert "embedding" not in retrieval.timings
+
+
+@pytest.mark.asyncio
+async def test_retrieve_vectors_with_given_embedding(retriever):
+    retrieval = await retriever.retrieve(
+        "deductible", {"retrieval_mode": "vectors", "semantic_ranker": True}, None, query_vector=[1.0, 0.0, 0.0]
+    )
+    search = retriever.search_client.searches[0]
+    assert search["search_text"] is None
+    assert search["vector"] == [1.0, 0.0, 0.0]
+    assert "query_type" not in search
+    assert "embedding" not in retrieval.timings
+
+
+@pytest.mark.asyncio
+async def test_retriever_stats(retriever):
+    assert retriever.get_stats() == {"retrievals": 0, "stages": {}}
+    await retriever.retrieve("deductible", {}, None)
+    await retriever.retrieve("deductible", {"retrieval_mode": "text"}, None)
+    stats = retriever.get_stats()
+    assert stats["retrievals"] == 2
+    assert stats["stages"]["embedding"]["count"] == 1
+    assert stats["stages"]["search"]["count"] == 2
+    assert stats["stages"]["search"]["max_ms"] >= stats["stages"]["search"]["mean_ms"]
+
+
+@pytest.mark.asyncio
+async def test_retrieve_variants(monkeypatch):
+    embedding_inputs = []
+
+    async def mock_acreate(*args, **kwargs):
+        embedding_inputs.append(kwargs["input"])
+        return {"data": [{"index": index, "embedding": [float(index)]} for index in range(len(kwargs["input"]))]}
+
+    class MockVariantSearchClient:
+        def __init__(self):
+            self.searches = []
+
+        async def search(self, search_text, **kwargs):
+            self.searches.append({"search_text": search_text, **kwargs})
+            ids = {"deductible": ["a", "b", "c"], "plan cost": ["c", "a", "d"], "copay": ["e"]}[search_text]
+            return MockSearchResults(
+                [{"id": id, "sourcepage": f"{id}.pdf", "content": f"Content of {id}"} for id in ids]
+            )
+
+    monkeypatch.setattr(openai.Embedding, "acreate", mock_acreate)
+    search_client = MockVariantSearchClient()
+    retriever = Retriever(search_client, "openai", None, "ada", "sourcepage", "content", "en-us", "lexicon")
+    retrieval, variants = await retriever.retrieve_variants(["deductible", "plan cost", "copay"], {"top": 3}, None)
+
+    # The variants are embedded in a single call and searched with their own embedding
+    assert embedding_inputs == [["deductible", "plan cost", "copay"]]
+    assert [search["vector"] for search in search_client.searches] == [[0.0], [1.0], [2.0]]
+    assert all(search["select"] == ["id", "sourcepage", "content"] for search in search_client.searches)
+    # a and c were found by two variants, then e ranks before b since it was found at a better rank
+    assert [doc["id"] for doc in retrieval.docs] == ["a", "c", "e"]
+    assert retrieval.sources[0] == "a.pdf: Content of a"
+    assert [(variant.query, variant.results, variant.contributed) for variant in variants] == [
+        ("deductible", 3, 2),
+        ("plan cost", 3, 2),
+        ("copay", 1, 1),
+    ]
+    assert list(retrieval.timings) == ["embedding", "search", "fusion", "sources"]
+
+
+@pytest.mark.asyncio
+async def test_retrieve_packs_sources(monkeypatch, mock_encoding):
+    class MockManySearchClient:
+        async def search(self, search_text, **kwargs):
+            self.top = kwargs["top"]
+            contents = ["one two three", "a much longer section that does not fit", "four", "five six"]
+            return MockSearchResults(
+                [{"sourcepage": f"{index}.pdf", "content": content} for index, content in enumerate(contents)]
+            )
+
+    search_client = MockManySearchClient()
+    retriever = Retriever(
+        search_client,
+        "openai",
+        None,
+        "ada",
+        "sourcepage",
+        "content",
+        "en-us",
+        "lexicon",
+        source_packer=SourcePacker("gpt-35-turbo", token_budget=20, candidates=10),
+    )
+    retrieval = await retriever.retrieve("deductible", {"retrieval_mode": "text", "top": 3}, None, token_budget=12)
+    assert search_client.top == 10
+    assert retrieval.sources == ["0.pdf: one two three", "2.pdf: four", "3.pdf: five six"]
+    assert [doc["sourcepage"] for doc in retrieval.docs] == ["0.pdf", "2.pdf", "3.pdf"]
+    assert (retrieval.candidates, retrieval.source_tokens, retrieval.token_budget) == (4, 11, 12)
+    assert list(retrieval.timings) == ["search", "sources", "packing"]
@@ -0,0 +1,70 @@
+import pytest
+
+from core.rewritepolicy import (
+    AlwaysRewritePolicy,
+    HeuristicRewritePolicy,
+    SkipFirstTurnPolicy,
+    create_rewrite_policy,
+)
+
+FIRST_TURN = [{"role": "user", "content": "What is the deductible for the employee plan?"}]
+
+
+def follow_up(question):
+    return [
+        {"role": "user", "content": "What is included in my Northwind Health Plus plan?"},
+        {"role": "assistant", "content": "Hospital and emergency services [Benefit_Options-2.pdf]."},
+        {"role": "user", "content": question},
+    ]
+
+
+def test_always_rewrite():
+    assert AlwaysRewritePolicy().should_rewrite(FIRST_TURN) == (True, "always rewrite")
+
+
+def test_skip_first_turn():
+    policy = SkipFirstTurnPolicy()
+    assert policy.should_rewrite(FIRST_TURN) == (False, "first question")
+    assert policy.should_rewrite(follow_up("Does the plan cover eye exams?")) == (True, "follow-up question")
+
+
+def test_skip_first_turn_ignores_system_messages():
+    history = [{"role": "system", "content": "You are a helpful assistant."}] + FIRST_TURN
+    assert SkipFirstTurnPolicy().should_rewrite(history) == (False, "first question")
+
+
+@pytest.mark.parametrize(
+    "history, expected",
+    [
+        (FIRST_TURN, (False, "first question")),
+        (follow_up("What is its deductible?"), (True, "follow-up question refers to earlier turns")),
+        (follow_up("And dental?"), (True, "short follow-up question")),
+        (follow_up("Does Northwind Standard cover eye exams?"), (False, "follow-up question stands alone")),
+        (
+            [{"role": "user", "content": "¿Cuál es el deducible?"}],
+            (False, "first question"),
+        ),
+        ([{"role": "user", "content": "健康保险的免赔额是多少"}], (True, "question may not be in English")),
+        ([{"role": "user", "content": " ".join(["word"] * 30)}], (True, "long question")),
+    ],
+)
+def test_heuristic(history, expected):
+    assert HeuristicRewritePolicy().should_rewrite(history) == expected
+
+
+def test_record_latency_moving_average():
+    policy = SkipFirstTurnPolicy()
+    policy.record_latency(500)
+    assert policy.average_latency_ms == 500
+    policy.record_latency(1000, weight=0.5)
+    assert policy.average_latency_ms == 750
+    assert policy.describe(False, "first question")["estimated_ms_saved"] == 750
+    assert policy.describe(True, "follow-up question")["estimated_ms_saved"] == 0
+
+
+def test_create_rewrite_policy():
+    assert isinstance(create_rewrite_policy("always"), AlwaysRewritePolicy)
+    assert isinstance(create_rewrite_policy("skip_first_turn"), SkipFirstTurnPolicy)
+    assert isinstance(create_rewrite_policy("heuristic"), HeuristicRewritePolicy)
+    with pytest.raises(ValueError):
+        create_rewrite_policy("never")
@@ -0,0 +1,128 @@
+import pytest
+
+from core.cache import InMemoryCacheBackend, SQLiteCacheBackend
+from core.indexversion import IndexVersion
+from core.searchcache import SearchResultCache
+
+
+class Caption:
+    def __init__(self, text):
+        self.text = text
+        self.highlights = None
+
+
+RESULTS = [
+    {
+        "id": "file-Benefit_Options_pdf-page-2",
+        "sourcepage": "Benefit_Options-2.pdf",
+        "content": "There is a whistleblower policy.",
+        "@search.score": 0.03,
+        "@search.captions": [Caption("A whistleblower policy.")],
+    }
+]
+
+
+def create_cache(backend=None, versions=None):
+    versions = versions if versions is not None else ["v1"]
+
+    async def get_version():
+        return versions[0]
+
+    return SearchResultCache(
+        backend if backend is not None else InMemoryCacheBackend(), IndexVersion(get_version, check_interval=0)
+    )
+
+
+def create_search(calls):
+    async def search():
+        calls.append(1)
+        return RESULTS
+
+    return search
+
+
+@pytest.mark.asyncio
+async def test_search_cache_hit_and_miss():
+    cache = create_cache()
+    calls = []
+    options = {"semantic_ranker": True, "semantic_captions": True}
+
+    first = await cache.get_or_search(create_search(calls), "whistleblower", [0.1, 0.2], None, 3, options)
+    second = await cache.get_or_search(create_search(calls), "whistleblower", [0.1, 0.2], None, 3, options)
+    assert first == RESULTS
+    assert second[0]["content"] == "There is a whistleblower policy."
+    assert [caption.text for caption in second[0]["@search.captions"]] == ["A whistleblower policy."]
+    assert len(calls) == 1
+    assert cache.get_stats() == {"hits": 1, "misses": 1, "invalidations": 0, "version": "v1"}
+
+
+@pytest.mark.asyncio
+async def test_search_cache_key_includes_query_options():
+    cache = create_cache()
+    calls = []
+    search = create_search(calls)
+
+    await cache.get_or_search(search, "whistleblower", None, None, 3, {"semantic_ranker": False})
+    await cache.get_or_search(search, "whistleblower", None, None, 5, {"semantic_ranker": False})
+    await cache.get_or_search(search, "whistleblower", None, None, 3, {"semantic_ranker": True})
+    await cache.get_or_search(search, "whistleblower", None, "category ne 'x'", 3, {"semantic_ranker": False})
+    await cache.get_or_search(search, "whistleblower", [0.1, 0.2], None, 3, {"semantic_ranker": False})
+    await cache.get_or_search(search, "whistleblower policy", None, None, 3, {"semantic_ranker": False})
+    assert len(calls) == 6
+
+
+@pytest.mark.asyncio
+async def test_search_cache_never_shares_results_across_security_filters():
+    cache = create_cache()
+    calls = []
+    search = create_search(calls)
+    user_filter = "(oids/any(g:search.in(g, 'OID_X')) or groups/any(g:search.in(g, 'GROUP_Y')))"
+    other_filter = "(oids/any(g:search.in(g, 'OID_Z')) or groups/any(g:search.in(g, 'GROUP_Y')))"
+
+    await cache.get_or_search(search, "whistleblower", None, user_filter, 3, {})
+    await cache.get_or_search(search, "whistleblower", None, other_filter, 3, {})
+    await cache.get_or_search(search, "whistleblower", None, None, 3, {})
+    assert len(calls) == 3
+    await cache.get_or_search(search, "whistleblower", None, user_filter, 3, {})
+    assert len(calls) == 3
+
+
+@pytest.mark.asyncio
+async def test_search_cache_quantizes_query_vector():
+    cache = create_cache()
+    calls = []
+    search = create_search(calls)
+
+    await cache.get_or_search(search, None, [0.12341, -0.00001], None, 3, {})
+    await cache.get_or_search(search, None, [0.12339, 0.00002], None, 3, {})
+    assert len(calls) == 1
+    await cache.get_or_search(search, None, [0.1240, 0.0], None, 3, {})
+    assert len(calls) == 2
+
+
+@pytest.mark.asyncio
+async def test_search_cache_cleared_when_index_version_changes():
+    backend = InMemoryCacheBackend()
+    versions = ["v1"]
+    cache = create_cache(backend, versions)
+    calls = []
+    search = create_search(calls)
+
+    await cache.get_or_search(search, "whistleblower", None, None, 3, {})
+    versions[0] = "v2"
+    await cache.get_or_search(search, "whistleblower", None, None, 3, {})
+    assert len(calls) == 2
+    assert len(backend) == 1
+    assert cache.get_stats()["invalidations"] == 1
+
+
+@pytest.mark.asyncio
+async def test_search_cache_sqlite_backend(tmp_path):
+    backend = SQLiteCacheBackend(str(tmp_path / "search_cache.db"))
+    calls = []
+
+    await create_cache(backend).get_or_search(create_search(calls), "whistleblower", None, None, 3, {})
+    # Another worker process sharing the database reads the results
+    cached = await create_cache(backend).get_or_search(create_search(calls), "whistleblower", None, None, 3, {})
+    assert len(calls) == 1
+    assert cached[0]["@search.captions"][0].text == "A whistleblower policy."
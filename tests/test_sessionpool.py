@@ -0,0 +1,63 @@
+import pytest
+import pytest_asyncio
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+
+from core.sessionpool import ClientSessionPool
+
+
+@pytest_asyncio.fixture
+async def server():
+    async def handler(request):
+        return web.Response(text="ok")
+
+    web_app = web.Application()
+    web_app.router.add_get("/", handler)
+    test_server = TestServer(web_app)
+    await test_server.start_server()
+    yield test_server
+    await test_server.close()
+
+
+@pytest.mark.asyncio
+async def test_session_pool_reuses_connections(server):
+    pool = ClientSessionPool(limit=10, limit_per_host=2, keepalive_timeout=30, dns_cache_ttl=60)
+    pool.open()
+    for _ in range(3):
+        async with pool.session.get(server.make_url("/")) as resp:
+            assert await resp.text() == "ok"
+
+    stats = pool.get_stats()
+    assert stats["open"] is True
+    assert stats["limit"] == 10
+    assert stats["limit_per_host"] == 2
+    assert stats["requests"] == 3
+    assert stats["connections_created"] == 1
+    assert stats["connections_reused"] == 2
+    assert stats["reuse_ratio"] == pytest.approx(2 / 3)
+    await pool.close()
+
+
+@pytest.mark.asyncio
+async def test_session_pool_open_is_idempotent():
+    pool = ClientSessionPool()
+    session = pool.open()
+    assert pool.open() is session
+    await pool.close()
+    assert pool.get_stats()["open"] is False
+    with pytest.raises(RuntimeError, match="ClientSessionPool is not open"):
+        pool.session
+
+
+@pytest.mark.asyncio
+async def test_session_pool_stats_empty():
+    pool = ClientSessionPool()
+    assert pool.get_stats() == {
+        "open": False,
+        "limit": 100,
+        "limit_per_host": 0,
+        "requests": 0,
+        "connections_created": 0,
+        "connections_reused": 0,
+        "reuse_ratio": 0.0,
+    }
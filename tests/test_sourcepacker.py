@@ -0,0 +1,27 @@
+from core.sourcepacker import SourcePacker
+
+
+def test_source_packer_packs_greedily_by_relevance(mock_encoding):
+    packer = SourcePacker("gpt-35-turbo", token_budget=100)
+    sources = ["a.pdf: one two three", "b.pdf: " + "word " * 10, "c.pdf: four", "d.pdf: five six"]
+    # 4 tokens, then 11 + 1 for the separator do not fit, then 2 + 1 and 3 + 1 do
+    assert packer.pack(sources, packer.get_budget(12)) == ([0, 2, 3], 11)
+    assert packer.get_stats() == {"entries": 4, "hits": 0, "misses": 4, "packed": 3, "skipped": 1}
+
+
+def test_source_packer_budget():
+    packer = SourcePacker("gpt-35-turbo", token_budget=100)
+    assert packer.get_budget() == 100
+    assert packer.get_budget(50) == 50
+    assert packer.get_budget(500) == 100
+    assert packer.get_budget(-5) == 0
+
+
+def test_source_packer_caches_token_counts(mock_encoding):
+    packer = SourcePacker("gpt-35-turbo", token_budget=100, max_entries=2)
+    assert packer.count_tokens(["a.pdf: one", "b.pdf: one two", "a.pdf: one"]) == [2, 3, 2]
+    assert mock_encoding.encoded == ["a.pdf: one", "b.pdf: one two"]
+    assert packer.count_tokens(["b.pdf: one two", "c.pdf: x"]) == [3, 2]
+    assert mock_encoding.encoded == ["a.pdf: one", "b.pdf: one two", "c.pdf: x"]
+    assert list(packer.token_counts) == [("gpt-35-turbo", "b.pdf: one two"), ("gpt-35-turbo", "c.pdf: x")]
+    assert packer.get_stats()["hits"] == 1
@@ -0,0 +1,50 @@
+import pytest
+from conftest import create_conversation
+
+from history.summaryworker import SummaryWorker
+
+
+@pytest.mark.asyncio
+async def test_summary_worker_folds_older_messages(conversation_client):
+    summarized = []
+
+    async def create_summary(previous_summary, messages):
+        summarized.append((previous_summary, [message["content"] for message in messages]))
+        return f"Summary {len(summarized)}"
+
+    conversation_id = await create_conversation(conversation_client, 8)
+    worker = SummaryWorker(conversation_client, create_summary, threshold=6, keep_recent=2)
+    conversation = await worker.summarize("user1", conversation_id)
+    assert summarized == [(None, [f"Message {index}" for index in range(6)])]
+    messages = await conversation_client.get_first_messages("user1", conversation_id, 8)
+    assert conversation["summary"] == {"content": "Summary 1", "through": messages[5]["createdAt"]}
+
+    # Only the messages after the summary count towards the next one
+    assert await worker.summarize("user1", conversation_id) is None
+    await conversation_client.create_turn(
+        "user1", conversation_id, [{"role": "user", "content": f"Message {index}"} for index in range(8, 12)]
+    )
+    conversation = await worker.summarize("user1", conversation_id)
+    assert summarized[1] == ("Summary 1", ["Message 6", "Message 7", "Message 8", "Message 9"])
+    assert conversation["summary"]["content"] == "Summary 2"
+
+
+@pytest.mark.asyncio
+async def test_summary_worker_in_background(conversation_client):
+    async def create_summary(previous_summary, messages):
+        return "Summary"
+
+    conversation_id = await create_conversation(conversation_client, 4)
+    worker = SummaryWorker(conversation_client, create_summary, threshold=4, keep_recent=2)
+    worker.start()
+    assert worker.submit("user1", conversation_id)
+    await worker.join()
+    await worker.close()
+
+    assert (await conversation_client.get_conversation("user1", conversation_id))["summary"]["content"] == "Summary"
+    assert worker.get_stats()["completed"] == 1
+
+
+def test_summary_worker_invalid_keep_recent(conversation_client):
+    with pytest.raises(ValueError):
+        SummaryWorker(conversation_client, None, threshold=4, keep_recent=4)
@@ -0,0 +1,130 @@
+import asyncio
+
+import pytest
+from conftest import create_conversation
+
+from history.titleworker import TitleWorker
+
+
+@pytest.mark.asyncio
+async def test_title_worker_generates_title(conversation_client, mock_cosmos_container):
+    seen_messages = []
+
+    async def create_title(messages):
+        seen_messages.extend(messages)
+        return "Health plans"
+
+    conversation_id = await create_conversation(conversation_client, messages=10)
+    worker = TitleWorker(conversation_client, create_title, max_messages=2)
+    worker.start()
+    assert worker.submit("user1", conversation_id) is True
+    await worker.join()
+    await worker.close()
+
+    assert (await conversation_client.get_conversation("user1", conversation_id))["title"] == "Health plans"
+    # Only the first messages are read
+    assert [message["content"] for message in seen_messages] == ["Message 0", "Message 1"]
+    assert worker.get_stats()["completed"] == 1
+
+
+@pytest.mark.asyncio
+async def test_title_worker_deduplicates(conversation_client):
+    calls = 0
+
+    async def create_title(messages):
+        nonlocal calls
+        calls += 1
+        return "Health plans"
+
+    conversation_id = await create_conversation(conversation_client)
+    worker = TitleWorker(conversation_client, create_title)
+    worker.start()
+    assert worker.submit("user1", conversation_id) is True
+    assert worker.submit("user1", conversation_id) is False
+    await worker.join()
+    # Once the title is generated, the conversation can be queued again
+    assert worker.submit("user1", conversation_id) is True
+    await worker.join()
+    await worker.close()
+
+    assert calls == 2
+    assert worker.get_stats()["deduplicated"] == 1
+
+
+@pytest.mark.asyncio
+async def test_title_worker_retries(conversation_client):
+    attempts = 0
+
+    async def create_title(messages):
+        nonlocal attempts
+        attempts += 1
+        if attempts < 3:
+            raise ValueError("Rate limited")
+        return "Health plans"
+
+    conversation_id = await create_conversation(conversation_client)
+    worker = TitleWorker(conversation_client, create_title, max_retries=3, retry_delay=0)
+    worker.start()
+    worker.submit("user1", conversation_id)
+    await worker.join()
+    await worker.close()
+
+    assert (await conversation_client.get_conversation("user1", conversation_id))["title"] == "Health plans"
+    assert worker.get_stats()["retried"] == 2
+    assert worker.get_stats()["failed"] == 0
+
+
+@pytest.mark.asyncio
+async def test_title_worker_gives_up(conversation_client):
+    async def create_title(messages):
+        raise ValueError("Rate limited")
+
+    conversation_id = await create_conversation(conversation_client)
+    worker = TitleWorker(conversation_client, create_title, max_retries=1, retry_delay=0)
+    worker.start()
+    worker.submit("user1", conversation_id)
+    worker.submit("user1", "missing")
+    await worker.join()
+    await worker.close()
+
+    assert (await conversation_client.get_conversation("user1", conversation_id))["title"] == ""
+    assert worker.get_stats()["failed"] == 2
+
+
+@pytest.mark.asyncio
+async def test_title_worker_bounded_concurrency(conversation_client):
+    running = 0
+    max_running = 0
+
+    async def create_title(messages):
+        nonlocal running, max_running
+        running += 1
+        max_running = max(max_running, running)
+        await asyncio.sleep(0.01)
+        running -= 1
+        return "Health plans"
+
+    conversation_ids = [await create_conversation(conversation_client) for _ in range(6)]
+    worker = TitleWorker(conversation_client, create_title, max_concurrency=2)
+    worker.start()
+    for conversation_id in conversation_ids:
+        worker.submit("user1", conversation_id)
+    await worker.join()
+    await worker.close()
+
+    assert max_running == 2
+    assert worker.get_stats()["completed"] == 6
+
+
+@pytest.mark.asyncio
+async def test_title_worker_drops_when_full(conversation_client):
+    async def create_title(messages):
+        return "Health plans"
+
+    worker = TitleWorker(conversation_client, create_title, max_queue_size=1)
+    worker.start()
+    # The workers have not run yet, so the first conversation is still in the queue
+    assert worker.submit("user1", "conversation1") is True
+    assert worker.submit("user1", "conversation2") is False
+    assert worker.get_stats()["dropped"] == 1
+    await worker.close()
@@ -0,0 +1,179 @@
+import asyncio
+
+import pytest
+from conftest import turn
+
+from history.writebehind import WriteBehindQueue
+
+
+@pytest.mark.asyncio
+async def test_write_behind_coalesces_turns(conversation_client, mock_cosmos_container):
+    write_queue = WriteBehindQueue(conversation_client)
+    first = write_queue.enqueue("user1", "conversation1", turn("What is included?", "Dental."), True)
+    second = write_queue.enqueue("user1", "conversation1", turn("And vision?", "Yes."))
+    assert write_queue.get_stats()["queue_depth"] == 4
+    assert not mock_cosmos_container.batches
+
+    await write_queue.flush()
+    # Both turns are written in the batch that creates the conversation
+    assert len(mock_cosmos_container.batches) == 1
+    assert (await first) == (await second)
+    assert (await first)["conversation_id"] == "conversation1"
+    messages = await conversation_client.get_messages("user1", "conversation1")
+    assert [message["content"] for message in messages] == ["What is included?", "Dental.", "And vision?", "Yes."]
+    assert (await conversation_client.get_conversation("user1", "conversation1"))["updatedAt"] == (await first)[
+        "version"
+    ]
+    stats = write_queue.get_stats()
+    assert stats["queue_depth"] == 0
+    assert stats["coalesced"] == 1
+    assert stats["written_messages"] == 4
+
+
+@pytest.mark.asyncio
+async def test_write_behind_flush_one_conversation(conversation_client):
+    write_queue = WriteBehindQueue(conversation_client)
+    write_queue.enqueue("user1", "conversation1", turn("What is included?", "Dental."), True)
+    write_queue.enqueue("user1", "conversation2", turn("What is included?", "Dental."), True)
+    await write_queue.flush("user1", "conversation1")
+    assert await conversation_client.get_conversation("user1", "conversation1")
+    assert await conversation_client.get_conversation("user1", "conversation2") is None
+    assert write_queue.get_stats()["pending_conversations"] == 1
+
+
+@pytest.mark.asyncio
+async def test_write_behind_flushes_in_background(conversation_client):
+    write_queue = WriteBehindQueue(conversation_client, flush_interval=0.01)
+    write_queue.start()
+    written = write_queue.enqueue("user1", "conversation1", turn("What is included?", "Dental."), True)
+    await asyncio.wait_for(written, timeout=1)
+    await write_queue.close()
+    assert await conversation_client.get_conversation("user1", "conversation1")
+
+
+@pytest.mark.asyncio
+async def test_write_behind_flushes_at_threshold(conversation_client):
+    write_queue = WriteBehindQueue(conversation_client, flush_interval=60, max_pending_messages=4)
+    write_queue.start()
+    write_queue.enqueue("user1", "conversation1", turn("What is included?", "Dental."), True)
+    written = write_queue.enqueue("user1", "conversation2", turn("What is included?", "Dental."), True)
+    await asyncio.wait_for(written, timeout=1)
+    await write_queue.close()
+
+
+@pytest.mark.asyncio
+async def test_write_behind_drains_on_close(conversation_client):
+    write_queue = WriteBehindQueue(conversation_client, flush_interval=60)
+    write_queue.start()
+    write_queue.enqueue("user1", "conversation1", turn("What is included?", "Dental."), True)
+    await write_queue.close()
+    assert len(await conversation_client.get_messages("user1", "conversation1")) == 2
+
+
+class SlowStorage:
+    def __init__(self, storage):
+        self.storage = storage
+        self.writing = asyncio.Event()
+        self.release = asyncio.Event()
+
+    async def create_turn(self, *args, **kwargs):
+        self.writing.set()
+        await self.release.wait()
+        return await self.storage.create_turn(*args, **kwargs)
+
+
+@pytest.mark.asyncio
+async def test_write_behind_close_during_flush(conversation_client):
+    storage = SlowStorage(conversation_client)
+    write_queue = WriteBehindQueue(storage, flush_interval=0.01)
+    write_queue.start()
+    written = write_queue.enqueue("user1", "conversation1", turn("What is included?", "Dental."), True)
+    await asyncio.wait_for(storage.writing.wait(), timeout=1)
+    # The background flush has taken the turn from the pending ones when the queue is closed
+    closing = asyncio.create_task(write_queue.close())
+    await asyncio.sleep(0.01)
+    storage.release.set()
+    await closing
+    assert (await asyncio.wait_for(written, timeout=1))["conversation_id"] == "conversation1"
+    assert len(await conversation_client.get_messages("user1", "conversation1")) == 2
+
+
+@pytest.mark.asyncio
+async def test_write_behind_splits_large_turns(conversation_client, mock_cosmos_container):
+    write_queue = WriteBehindQueue(conversation_client)
+    write_queue.enqueue("user1", "conversation1", turn("Question?", "Answer.") * 60, True)
+    await write_queue.flush()
+    # Each batch updates the conversation and writes up to 99 messages
+    assert [len(batch) for batch in mock_cosmos_container.batches] == [100, 22]
+    assert len(await conversation_client.get_messages("user1", "conversation1")) == 120
+
+
+@pytest.mark.asyncio
+async def test_write_behind_failure(conversation_client):
+    write_queue = WriteBehindQueue(conversation_client, max_attempts=1)
+    # The conversation does not exist, so updating it fails
+    written = write_queue.enqueue("user1", "missing", turn("What is included?", "Dental."))
+    await write_queue.flush()
+    with pytest.raises(Exception):
+        await written
+    assert write_queue.get_stats()["failed_batches"] == 1
+    assert await conversation_client.get_messages("user1", "missing") is None
+
+
+class FlakyStorage:
+    def __init__(self, storage, failures=1):
+        self.storage = storage
+        self.failures = failures
+        self.calls = []
+
+    async def create_turn(self, *args, **kwargs):
+        self.calls.append(kwargs.get("create_conversation"))
+        if len(self.calls) <= self.failures:
+            raise TimeoutError("Request timed out")
+        return await self.storage.create_turn(*args, **kwargs)
+
+
+@pytest.mark.asyncio
+async def test_write_behind_retries_failed_writes(conversation_client):
+    storage = FlakyStorage(conversation_client)
+    write_queue = WriteBehindQueue(storage, retry_delay=60)
+    first = write_queue.enqueue("user1", "conversation1", turn("What is included?", "Dental."), True)
+    await write_queue.flush()
+    assert not first.done()
+    assert write_queue.get_stats()["queue_depth"] == 2
+
+    # Turns queued after the failure are written after the failed ones, and the retry still creates the conversation
+    second = write_queue.enqueue("user1", "conversation1", turn("And vision?", "Yes."))
+    await write_queue.flush()
+    assert storage.calls == [True, True]
+    assert (await first) == (await second)
+    messages = await conversation_client.get_messages("user1", "conversation1")
+    assert [message["content"] for message in messages] == ["What is included?", "Dental.", "And vision?", "Yes."]
+    stats = write_queue.get_stats()
+    assert (stats["failed_batches"], stats["retried_batches"], stats["queue_depth"]) == (1, 1, 0)
+
+
+@pytest.mark.asyncio
+async def test_write_behind_retries_with_backoff(conversation_client):
+    storage = FlakyStorage(conversation_client, failures=2)
+    write_queue = WriteBehindQueue(storage, flush_interval=0.01, retry_delay=0.02)
+    write_queue.start()
+    written = write_queue.enqueue("user1", "conversation1", turn("What is included?", "Dental."), True)
+    await asyncio.wait_for(written, timeout=1)
+    await write_queue.close()
+    assert len(storage.calls) == 3
+    assert len(await conversation_client.get_messages("user1", "conversation1")) == 2
+
+
+@pytest.mark.asyncio
+async def test_write_behind_close_retries_failed_writes(conversation_client):
+    storage = FlakyStorage(conversation_client, failures=10)
+    write_queue = WriteBehindQueue(storage, flush_interval=60, max_attempts=3, retry_delay=0.01)
+    write_queue.start()
+    written = write_queue.enqueue("user1", "conversation1", turn("What is included?", "Dental."), True)
+    await write_queue.close()
+    # close() waits for the retries, then gives up after max_attempts failed writes
+    assert len(storage.calls) == 3
+    with pytest.raises(TimeoutError):
+        await written
+    assert write_queue.pending == {}